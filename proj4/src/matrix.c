@@ -3,7 +3,15 @@
 #include <stdio.h>
 #include <string.h>
 #include <stdlib.h>
+#include <stdint.h>
+#include <float.h>
+#include <math.h>
 #include <omp.h>
+#include <pthread.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 // Include SSE intrinsics
 #if defined(_MSC_VER)
@@ -27,6 +35,354 @@
  * __m256d _mm256_max_pd (__m256d a, __m256d b)
 */
 
+static const char *const dtype_names[NUM_DTYPES] = {"float64", "float32", "int32"};
+static const size_t dtype_sizes[NUM_DTYPES] = {sizeof(double), sizeof(float), sizeof(int32_t)};
+
+/* Returns the name of one of the DTYPE_* element types, as numpy spells it */
+const char *dtype_name(int dtype) {
+    return dtype_names[dtype];
+}
+
+/* Returns the size in bytes of an entry of the given dtype */
+size_t dtype_size(int dtype) {
+    return dtype_sizes[dtype];
+}
+
+/*
+ * Returns the dtype of the result of an operation on matrices of dtype1 and dtype2: the same
+ * dtype if they are equal, and otherwise DTYPE_FLOAT64, which holds every float32 and int32
+ * exactly.
+ */
+int promote_dtypes(int dtype1, int dtype2) {
+    return dtype1 == dtype2 ? dtype1 : DTYPE_FLOAT64;
+}
+
+/* Returns the address of the entry `offset` entries after the first entry of mat */
+static inline void *entry_address(matrix *mat, long offset) {
+    return (char *) mat->data + offset * (long) dtype_sizes[mat->dtype];
+}
+
+/*
+ * Converts a double into an int32 like numpy's astype: the fractional part is truncated toward
+ * zero. Unlike in C, values out of range saturate instead of being undefined, and NaN gives 0.
+ */
+static inline int32_t to_int32(double val) {
+    if (val >= 2147483647.0) {
+        return INT32_MAX;
+    }
+    if (val <= -2147483648.0) {
+        return INT32_MIN;
+    }
+    return val == val ? (int32_t) val : 0;
+}
+
+/* Returns the entry of `dtype` at `addr` as a double, which holds any of them exactly */
+static inline double load_entry(const void *addr, int dtype) {
+    switch (dtype) {
+    case DTYPE_FLOAT32:
+        return *(const float *) addr;
+    case DTYPE_INT32:
+        return *(const int32_t *) addr;
+    default:
+        return *(const double *) addr;
+    }
+}
+
+/* Stores val at `addr` as an entry of `dtype`, rounding to float32 or converting with to_int32 */
+static inline void store_entry(void *addr, int dtype, double val) {
+    switch (dtype) {
+    case DTYPE_FLOAT32:
+        *(float *) addr = (float) val;
+        break;
+    case DTYPE_INT32:
+        *(int32_t *) addr = to_int32(val);
+        break;
+    default:
+        *(double *) addr = val;
+    }
+}
+
+/* dst[i * dst_step] = src[i * src_step] for 0 <= i < n, where src holds entries of `dtype` */
+static void load_run(double *dst, const void *src, long src_step, long n, int dtype) {
+    if (dtype == DTYPE_FLOAT32) {
+        for (long i = 0; i < n; ++i) {
+            dst[i] = ((const float *) src)[i * src_step];
+        }
+    } else if (dtype == DTYPE_INT32) {
+        for (long i = 0; i < n; ++i) {
+            dst[i] = ((const int32_t *) src)[i * src_step];
+        }
+    } else {
+        for (long i = 0; i < n; ++i) {
+            dst[i] = ((const double *) src)[i * src_step];
+        }
+    }
+}
+
+/* dst[i * dst_step] = src[i] for 0 <= i < n, converting into entries of `dtype` like store_entry */
+static void store_run(void *dst, long dst_step, const double *src, long n, int dtype) {
+    if (dtype == DTYPE_FLOAT32) {
+        for (long i = 0; i < n; ++i) {
+            ((float *) dst)[i * dst_step] = (float) src[i];
+        }
+    } else if (dtype == DTYPE_INT32) {
+        for (long i = 0; i < n; ++i) {
+            ((int32_t *) dst)[i * dst_step] = to_int32(src[i]);
+        }
+    } else {
+        for (long i = 0; i < n; ++i) {
+            ((double *) dst)[i * dst_step] = src[i];
+        }
+    }
+}
+
+/*
+ * Every parallel region runs on at most get_num_threads() threads, which is OpenMP's default
+ * unless set_num_threads was called. A kernel given less work than its parallel cutoff runs on
+ * the calling thread alone, since forking and joining a team would cost more than it saves.
+ * The setting is shared by all threads of the process, so that whichever thread calls a kernel
+ * respects it, unlike omp_set_num_threads which only affects its caller. set_thread_limit
+ * overrides it for the kernels called from one thread only, which is what numc.threads uses.
+ * Kernels read both on the calling thread before entering their parallel regions.
+ */
+static int num_threads = 0; // 0 for OpenMP's default
+static __thread int thread_limit = -1; // overrides num_threads on this thread unless negative
+static long parallel_cutoffs[NUM_KERNELS] = {
+    16384, // KERNEL_ELEMENTWISE
+    64 * 64 * 64, // KERNEL_GEMM
+    32768, // KERNEL_REDUCE
+    65536, // KERNEL_TRANSPOSE
+    16384, // KERNEL_FUSED
+    16384, // KERNEL_RANDOM
+    256, // KERNEL_INVERT
+    65536, // KERNEL_LOAD
+    32768, // KERNEL_SPARSE
+};
+static const char *const kernel_names[NUM_KERNELS] = {
+    "elementwise", "gemm", "reduce", "transpose", "fused", "random", "invert", "load", "sparse"
+};
+
+/*
+ * Limits kernels to `threads` threads, or restores OpenMP's default if it is 0 or less.
+ * Returns the previous setting, 0 for the default.
+ */
+int set_num_threads(int threads) {
+    int previous = num_threads;
+    num_threads = threads > 0 ? threads : 0;
+    return previous;
+}
+
+/*
+ * Limits the kernels called from the calling thread to `threads` threads, or to OpenMP's
+ * default if it is 0, whatever set_num_threads says. A negative value removes the limit.
+ * Returns the previous limit of the calling thread, negative if there was none.
+ */
+int set_thread_limit(int threads) {
+    int previous = thread_limit;
+    thread_limit = threads;
+    return previous;
+}
+
+/* Returns the number of threads kernels called from the calling thread run on */
+int get_num_threads(void) {
+    int threads = thread_limit >= 0 ? thread_limit : num_threads;
+    return threads > 0 ? threads : omp_get_max_threads();
+}
+
+/* Returns the lowercase name of one of the KERNEL_* values */
+const char *kernel_name(int kernel) {
+    return kernel_names[kernel];
+}
+
+/* Returns the smallest amount of work for which `kernel` runs on more than one thread */
+long get_parallel_cutoff(int kernel) {
+    return parallel_cutoffs[kernel];
+}
+
+/* Sets the smallest amount of work for which `kernel` runs on more than one thread */
+void set_parallel_cutoff(int kernel, long cutoff) {
+    parallel_cutoffs[kernel] = cutoff > 0 ? cutoff : 0;
+}
+
+/* Returns the number of threads `kernel` should use for `work` */
+static int kernel_threads(int kernel, double work) {
+    return work >= parallel_cutoffs[kernel] ? get_num_threads() : 1;
+}
+
+/* Parses a positive integer environment variable. Returns -1 if it is unset or invalid. */
+static long env_long(const char *name) {
+    const char *value = getenv(name);
+    char *end;
+    if (value == NULL || *value == '\0') {
+        return -1;
+    }
+    long parsed = strtol(value, &end, 10);
+    return *end == '\0' && parsed >= 0 ? parsed : -1;
+}
+
+/*
+ * Reads NUMC_NUM_THREADS and the cutoffs NUMC_CUTOFF_ELEMENTWISE, NUMC_CUTOFF_GEMM, ... from
+ * the environment. Unset or invalid variables leave the defaults in place.
+ */
+void load_parallel_config(void) {
+    long threads = env_long("NUMC_NUM_THREADS");
+    if (threads > 0) {
+        set_num_threads(threads);
+    }
+    for (int kernel = 0; kernel < NUM_KERNELS; ++kernel) {
+        char name[64] = "NUMC_CUTOFF_";
+        size_t len = strlen(name);
+        for (const char *c = kernel_names[kernel]; *c != '\0' && len + 1 < sizeof(name); ++c) {
+            name[len++] = *c - 'a' + 'A';
+        }
+        name[len] = '\0';
+        long cutoff = env_long(name);
+        if (cutoff >= 0) {
+            set_parallel_cutoff(kernel, cutoff);
+        }
+    }
+}
+
+/*
+ * Matrix data and the scratch space of the kernels come from a pool of 64-byte aligned blocks.
+ * Requests are rounded up to a size class, four per power of two, and freed blocks are kept
+ * in a per-class free list so that the next request of the same class reuses them without
+ * going back to the system allocator or faulting in fresh pages. The cache is bounded both
+ * per class and in total; blocks that do not fit are released right away.
+ */
+#define POOL_ALIGN 64
+/* Smallest block handed out, in bytes */
+#define POOL_MIN_BLOCK 64
+#define POOL_CLASSES (1 + 4 * (64 - 6))
+/* Most blocks kept per size class */
+#define POOL_MAX_CACHED_PER_CLASS 8
+/* Most bytes kept in the cache across all classes */
+#define POOL_MAX_CACHED_BYTES ((size_t) 256 << 20)
+
+/* Every block starts with a header, followed by the data at the next POOL_ALIGN boundary */
+typedef struct pool_block {
+    struct pool_block *next; // next cached block of the same class
+    size_t bytes; // usable bytes after the header
+    int size_class; // index of the size class
+} pool_block;
+
+static pthread_mutex_t pool_lock = PTHREAD_MUTEX_INITIALIZER;
+static pool_block *pool_cache[POOL_CLASSES];
+static int pool_cached_count[POOL_CLASSES];
+static pool_stats pool_counters;
+
+/* Rounds `bytes` up to its size class and returns the index of that class */
+static int pool_size_class(size_t bytes, size_t *class_bytes) {
+    if (bytes <= POOL_MIN_BLOCK) {
+        *class_bytes = POOL_MIN_BLOCK;
+        return 0;
+    }
+    /* 2^shift < bytes <= 2^(shift + 1), split into four classes of 2^(shift - 2) bytes */
+    int shift = 63 - __builtin_clzll(bytes - 1);
+    size_t step = (size_t) 1 << (shift - 2);
+    size_t steps = (bytes + step - 1) >> (shift - 2);
+    *class_bytes = steps << (shift - 2);
+    return 1 + (shift - 6) * 4 + (int) (steps - 5);
+}
+
+/*
+ * Returns a 64-byte aligned block with room for `count` doubles, or NULL if allocating it fails.
+ * The contents are not initialized. Blocks must be released with pool_free. Thread-safe.
+ */
+double *pool_alloc(size_t count) {
+    size_t bytes;
+    if (count > (SIZE_MAX - 2 * POOL_ALIGN) / sizeof(double)) {
+        return NULL;
+    }
+    int size_class = pool_size_class(count * sizeof(double), &bytes);
+
+    pthread_mutex_lock(&pool_lock);
+    pool_block *block = pool_cache[size_class];
+    if (block != NULL) {
+        pool_cache[size_class] = block->next;
+        pool_cached_count[size_class]--;
+        pool_counters.cached_blocks--;
+        pool_counters.cached_bytes -= bytes;
+        pool_counters.hits++;
+    }
+    pthread_mutex_unlock(&pool_lock);
+
+    if (block == NULL) {
+        block = _mm_malloc(POOL_ALIGN + bytes, POOL_ALIGN);
+        if (block == NULL) {
+            return NULL;
+        }
+        block->bytes = bytes;
+        block->size_class = size_class;
+    }
+
+    pthread_mutex_lock(&pool_lock);
+    pool_counters.allocs++;
+    pool_counters.live_bytes += bytes;
+    if (pool_counters.live_bytes > pool_counters.peak_bytes) {
+        pool_counters.peak_bytes = pool_counters.live_bytes;
+    }
+    pthread_mutex_unlock(&pool_lock);
+    return (double *) ((char *) block + POOL_ALIGN);
+}
+
+/* Returns a block from pool_alloc to the pool. Does nothing for NULL. Thread-safe. */
+void pool_free(double *data) {
+    if (data == NULL) {
+        return;
+    }
+    pool_block *block = (pool_block *) ((char *) data - POOL_ALIGN);
+    int size_class = block->size_class;
+
+    pthread_mutex_lock(&pool_lock);
+    pool_counters.frees++;
+    pool_counters.live_bytes -= block->bytes;
+    int keep = pool_cached_count[size_class] < POOL_MAX_CACHED_PER_CLASS &&
+               pool_counters.cached_bytes + block->bytes <= POOL_MAX_CACHED_BYTES;
+    if (keep) {
+        block->next = pool_cache[size_class];
+        pool_cache[size_class] = block;
+        pool_cached_count[size_class]++;
+        pool_counters.cached_blocks++;
+        pool_counters.cached_bytes += block->bytes;
+    }
+    pthread_mutex_unlock(&pool_lock);
+
+    if (!keep) {
+        _mm_free(block);
+    }
+}
+
+/* Copies the current pool counters into `stats` */
+void pool_get_stats(pool_stats *stats) {
+    pthread_mutex_lock(&pool_lock);
+    *stats = pool_counters;
+    pthread_mutex_unlock(&pool_lock);
+}
+
+/* Restarts the peak of the pool counters from the bytes currently handed out */
+void pool_reset_peak(void) {
+    pthread_mutex_lock(&pool_lock);
+    pool_counters.peak_bytes = pool_counters.live_bytes;
+    pthread_mutex_unlock(&pool_lock);
+}
+
+/* Releases every cached block back to the system */
+void pool_trim(void) {
+    pthread_mutex_lock(&pool_lock);
+    for (int i = 0; i < POOL_CLASSES; ++i) {
+        while (pool_cache[i] != NULL) {
+            pool_block *block = pool_cache[i];
+            pool_cache[i] = block->next;
+            _mm_free(block);
+        }
+        pool_cached_count[i] = 0;
+    }
+    pool_counters.cached_blocks = 0;
+    pool_counters.cached_bytes = 0;
+    pthread_mutex_unlock(&pool_lock);
+}
+
 /* Generates a random double between low and high */
 double rand_double(double low, double high) {
     double range = (high - low);
@@ -44,16 +400,210 @@ void rand_matrix(matrix *result, unsigned int seed, double low, double high) {
     }
 }
 
+/*
+ * Counter-based random numbers. Entry k of a random matrix, counting in row-major order, is
+ * computed from (seed, k) alone, by hashing the k-th state of a SplitMix64 stream keyed by
+ * the seed. Any part of the matrix can therefore be generated independently of the rest: the
+ * result is the same whatever the number of threads, and does not depend on libc's rand().
+ */
+#define SPLITMIX_GAMMA 0x9E3779B97F4A7C15ULL
+#define SPLITMIX_MUL1 0xBF58476D1CE4E5B9ULL
+#define SPLITMIX_MUL2 0x94D049BB133111EBULL
+/* Number of entries a thread generates at a time when the matrix is contiguous */
+#define RANDOM_BLOCK 4096
+
+/* The SplitMix64 output function */
+static inline uint64_t splitmix_mix(uint64_t z) {
+    z = (z ^ (z >> 30)) * SPLITMIX_MUL1;
+    z = (z ^ (z >> 27)) * SPLITMIX_MUL2;
+    return z ^ (z >> 31);
+}
+
+/* Returns a double in [0, 1) made of the top 52 bits of z */
+static inline double unit_double(uint64_t z) {
+    uint64_t bits = 0x3FF0000000000000ULL | (z >> 12);
+    double d;
+    memcpy(&d, &bits, sizeof(double));
+    return d - 1.0;
+}
+
+/* The random double in [0, 1) for entry `index` of the stream keyed by `key` */
+static inline double random_unit(uint64_t key, uint64_t index) {
+    return unit_double(splitmix_mix(key + (index + 1) * SPLITMIX_GAMMA));
+}
+
+/* Multiplies both 64-bit lanes of a by c, modulo 2^64, with 32-bit multiplies */
+static inline __m128i mul64_2(__m128i a, uint64_t c) {
+    __m128i c_lo = _mm_set1_epi64x(c & 0xFFFFFFFFULL), c_hi = _mm_set1_epi64x(c >> 32);
+    __m128i cross = _mm_add_epi64(_mm_mul_epu32(_mm_srli_epi64(a, 32), c_lo), _mm_mul_epu32(a, c_hi));
+    return _mm_add_epi64(_mm_mul_epu32(a, c_lo), _mm_slli_epi64(cross, 32));
+}
+
+/* random_unit for two consecutive states z of a stream, matching the scalar version bit for bit */
+static inline __m128d random_unit2(__m128i z) {
+    z = mul64_2(_mm_xor_si128(z, _mm_srli_epi64(z, 30)), SPLITMIX_MUL1);
+    z = mul64_2(_mm_xor_si128(z, _mm_srli_epi64(z, 27)), SPLITMIX_MUL2);
+    z = _mm_xor_si128(z, _mm_srli_epi64(z, 31));
+    z = _mm_or_si128(_mm_srli_epi64(z, 12), _mm_set1_epi64x(0x3FF0000000000000LL));
+    return _mm_sub_pd(_mm_castsi128_pd(z), _mm_set1_pd(1.0));
+}
+
+/* dst[i * step] = low + range * (entry index + i of the stream keyed by `key`), for 0 <= i < n */
+static void uniform_run(double *dst, long step, uint64_t key, uint64_t index, long n, double low,
+                        double range) {
+    long i = 0;
+    if (step == 1) {
+        uint64_t state = key + (index + 1) * SPLITMIX_GAMMA;
+        __m128i z0 = _mm_set_epi64x(state + SPLITMIX_GAMMA, state);
+        __m128i z1 = _mm_set_epi64x(state + 3 * SPLITMIX_GAMMA, state + 2 * SPLITMIX_GAMMA);
+        __m128i advance = _mm_set1_epi64x(4 * SPLITMIX_GAMMA);
+        __m256d low4 = _mm256_set1_pd(low), range4 = _mm256_set1_pd(range);
+        for (; i + 4 <= n; i += 4) {
+            __m256d u = _mm256_insertf128_pd(_mm256_castpd128_pd256(random_unit2(z0)), random_unit2(z1), 1);
+            _mm256_storeu_pd(dst + i, _mm256_fmadd_pd(u, range4, low4));
+            z0 = _mm_add_epi64(z0, advance);
+            z1 = _mm_add_epi64(z1, advance);
+        }
+    }
+    for (; i < n; ++i) {
+        dst[i * step] = fma(random_unit(key, index + i), range, low);
+    }
+}
+
+/*
+ * Entry k of a normal matrix comes from the Box-Muller transform of the uniform entries 2m and
+ * 2m + 1 of the stream, where m = k / 2: even entries take the cosine and odd ones the sine.
+ */
+static inline double normal_value(uint64_t key, uint64_t index, double mean, double std) {
+    uint64_t pair = index & ~1ULL;
+    double radius = sqrt(-2 * log(1 - random_unit(key, pair)));
+    double angle = 2 * M_PI * random_unit(key, pair + 1);
+    return fma(radius * (index & 1 ? sin(angle) : cos(angle)), std, mean);
+}
+
+/* Same as uniform_run, for normally distributed entries */
+static void normal_run(double *dst, long step, uint64_t key, uint64_t index, long n, double mean,
+                       double std) {
+    long i = 0;
+    if (index & 1 && n > 0) {
+        dst[0] = normal_value(key, index, mean, std);
+        i = 1;
+    }
+    /* Both entries of a pair share the transform */
+    for (; i + 2 <= n; i += 2) {
+        double radius = sqrt(-2 * log(1 - random_unit(key, index + i)));
+        double angle = 2 * M_PI * random_unit(key, index + i + 1);
+        dst[i * step] = fma(radius * cos(angle), std, mean);
+        dst[(i + 1) * step] = fma(radius * sin(angle), std, mean);
+    }
+    if (i < n) {
+        dst[i * step] = normal_value(key, index + i, mean, std);
+    }
+}
+
+/*
+ * Fills `result` with entries of the stream keyed by `seed` through `run`, a whole contiguous
+ * matrix at a time or row by row, in parallel. Entries of other dtypes than float64 are the
+ * float64 ones converted.
+ */
+static void random_fill(matrix *result, uint64_t seed,
+                        void (*run)(double *, long, uint64_t, uint64_t, long, double, double),
+                        double a, double b) {
+    uint64_t key = splitmix_mix(seed + SPLITMIX_GAMMA);
+    int rows = result->rows, cols = result->cols;
+    long size = (long) rows * cols;
+    int threads = kernel_threads(KERNEL_RANDOM, size);
+    if (result->dtype != DTYPE_FLOAT64) {
+        /* Entries are drawn as doubles a block at a time, then rounded into place */
+        #pragma omp parallel for num_threads(threads) if(threads > 1)
+        for (int i = 0; i < rows; ++i) {
+            double block[RANDOM_BLOCK];
+            for (int j = 0; j < cols; j += RANDOM_BLOCK) {
+                int n = cols - j < RANDOM_BLOCK ? cols - j : RANDOM_BLOCK;
+                run(block, 1, key, (uint64_t) i * cols + j, n, a, b);
+                store_run(entry_address(result, (long) i * result->row_stride + (long) j * result->col_stride),
+                          result->col_stride, block, n, result->dtype);
+            }
+        }
+        return;
+    }
+    if (is_contiguous(result)) {
+        #pragma omp parallel for num_threads(threads) if(threads > 1)
+        for (long start = 0; start < size; start += RANDOM_BLOCK) {
+            long n = size - start < RANDOM_BLOCK ? size - start : RANDOM_BLOCK;
+            run(result->data + start, 1, key, start, n, a, b);
+        }
+        return;
+    }
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < rows; ++i) {
+        run(result->data + (size_t) i * result->row_stride, result->col_stride, key, (uint64_t) i * cols,
+            cols, a, b);
+    }
+}
+
+/*
+ * Fills `result` with numbers drawn uniformly from [low, high), reproducibly from `seed`.
+ * Entry k in row-major order depends only on seed and k.
+ */
+void uniform_matrix(matrix *result, uint64_t seed, double low, double high) {
+    random_fill(result, seed, uniform_run, low, high - low);
+}
+
+/*
+ * Fills `result` with normally distributed numbers of the given mean and standard deviation,
+ * reproducibly from `seed`. Entry k in row-major order depends only on seed and k.
+ */
+void normal_matrix(matrix *result, uint64_t seed, double mean, double std) {
+    random_fill(result, seed, normal_run, mean, std);
+}
+
+/*
+ * Returns a new block holding one reference to `data`, which `release(base)` frees if `release`
+ * is not NULL and pool_free otherwise, or NULL if allocating the block fails.
+ */
+static matrix_block *new_block(void *data, void *base, void (*release)(void *base)) {
+    matrix_block *block = malloc(sizeof(matrix_block));
+    if (block != NULL) {
+        block->ref_cnt = 1;
+        block->data = data;
+        block->base = base;
+        block->release = release;
+    }
+    return block;
+}
+
 /*
  * Allocates space for a matrix struct pointed to by the double pointer mat with
  * `rows` rows and `cols` columns. You should also allocate memory for the data array
- * and initialize all entries to be zeros. `parent` should be set to NULL to indicate that
- * this matrix is not a slice. You should also set `ref_cnt` to 1.
+ * and initialize all entries to be zeros. The data lives in a new block with a single
+ * reference, since this matrix is not a slice.
  * You should return -1 if either `rows` or `cols` or both have invalid values. Return -2 if any
  * call to allocate memory in this function fails. Remember to set the error messages in numc.c.
  * Return 0 upon success.
  */
 int allocate_matrix(matrix **mat, int rows, int cols) {
+    int failed = allocate_matrix_uninitialized(mat, rows, cols);
+    if (failed) {
+        return failed;
+    }
+    memset((*mat)->data, 0, (size_t) rows * cols * sizeof(double));
+    return 0;
+}
+
+/*
+ * Same as allocate_matrix, but leaves the entries uninitialized. For results that the caller
+ * overwrites entirely anyway. The data comes from the pool (see pool_alloc).
+ */
+int allocate_matrix_uninitialized(matrix **mat, int rows, int cols) {
+    return allocate_matrix_typed(mat, rows, cols, DTYPE_FLOAT64);
+}
+
+/*
+ * Same as allocate_matrix_uninitialized, for a matrix whose entries are of one of the DTYPE_*
+ * element types.
+ */
+int allocate_matrix_typed(matrix **mat, int rows, int cols, int dtype) {
     if (rows <= 0 || cols <= 0) {
         return -1;
     }
@@ -62,30 +612,49 @@ int allocate_matrix(matrix **mat, int rows, int cols) {
     if (*mat == NULL) {
         return -2;
     }
+    /* The pool hands out whole doubles */
+    size_t bytes = (size_t) rows * cols * dtype_size(dtype);
     (*mat)->rows = rows;
     (*mat)->cols = cols;
-    (*mat)->data = malloc(rows * cols * sizeof(double));
-    (*mat)->ref_cnt = 1;
-    (*mat)->parent = NULL;
+    (*mat)->data = pool_alloc((bytes + sizeof(double) - 1) / sizeof(double));
+    (*mat)->row_stride = cols;
+    (*mat)->col_stride = 1;
+    (*mat)->block = (*mat)->data == NULL ? NULL : new_block((*mat)->data, NULL, NULL);
+    (*mat)->dtype = dtype;
 
-    if ((*mat)->data == NULL) {
+    if ((*mat)->block == NULL) {
+        pool_free((*mat)->data);
+        free(*mat);
+        *mat = NULL;
         return -2;
     }
-    memset((*mat)->data, 0, rows * cols * sizeof(double));
-
     return 0;
 }
 
 /*
  * Allocates space for a matrix struct pointed to by `mat` with `rows` rows and `cols` columns.
  * Its data should point to the `offset`th entry of `from`'s data (you do not need to allocate memory)
- * for the data field. `parent` should be set to `from` to indicate this matrix is a slice of `from`.
+ * for the data field. The slice takes a reference on the block of `from`, so the data outlives
+ * `from` for as long as the slice uses it.
  * You should return -1 if either `rows` or `cols` or both have invalid values. Return -2 if any
  * call to allocate memory in this function fails.
  * Remember to set the error messages in numc.c.
  * Return 0 upon success.
  */
 int allocate_matrix_ref(matrix **mat, matrix *from, int offset, int rows, int cols) {
+    return allocate_matrix_view(mat, from, offset, rows, cols, cols, 1);
+}
+
+/*
+ * Same as allocate_matrix_ref, but the entry at row i and column j of the slice is
+ * from->data[offset + i * row_stride + j * col_stride]. This describes any sub-rectangle of
+ * `from`, with or without steps, as well as its transpose, without copying. The offset is a
+ * long so that views can start anywhere in matrices of more than INT_MAX entries. The slice has the
+ * dtype of `from`. Slices of slices share the same block, so this takes constant time at any
+ * depth. Thread-safe.
+ */
+int allocate_matrix_view(matrix **mat, matrix *from, long offset, int rows, int cols, int row_stride,
+                         int col_stride) {
     if (rows <= 0 || cols <= 0) {
         return -1;
     }
@@ -96,55 +665,98 @@ int allocate_matrix_ref(matrix **mat, matrix *from, int offset, int rows, int co
     }
     (*mat)->rows = rows;
     (*mat)->cols = cols;
-    (*mat)->data = from->data + offset;
-    (*mat)->ref_cnt = 1;
-    (*mat)->parent = from;
+    (*mat)->data = entry_address(from, offset);
+    (*mat)->row_stride = row_stride;
+    (*mat)->col_stride = col_stride;
+    (*mat)->block = from->block;
+    (*mat)->dtype = from->dtype;
+
+    if (from->block != NULL) {
+        __atomic_add_fetch(&from->block->ref_cnt, 1, __ATOMIC_RELAXED);
+    }
+    return 0;
+}
 
-    while (from != NULL) {
-        from->ref_cnt += 1;
-        from = from->parent;
+/*
+ * Allocates space for a matrix struct pointed to by `mat` with `rows` rows and `cols` columns
+ * whose data is the existing row-major buffer `data` of `dtype` entries, owned by `base`.
+ * Instead of freeing `data`, `release(base)` is called once neither the matrix nor any of its
+ * slices use it, from the thread that deallocates the last of them.
+ * Return -1 if either `rows` or `cols` or both have invalid values, -2 if allocating the
+ * struct fails, and 0 upon success.
+ */
+int allocate_matrix_external(matrix **mat, int rows, int cols, int dtype, void *data, void *base,
+                             void (*release)(void *base)) {
+    if (rows <= 0 || cols <= 0) {
+        return -1;
     }
 
+    *mat = malloc(sizeof(matrix));
+    if (*mat == NULL) {
+        return -2;
+    }
+    (*mat)->rows = rows;
+    (*mat)->cols = cols;
+    (*mat)->data = data;
+    (*mat)->row_stride = cols;
+    (*mat)->col_stride = 1;
+    (*mat)->block = new_block(data, base, release);
+    (*mat)->dtype = dtype;
+    if ((*mat)->block == NULL) {
+        free(*mat);
+        *mat = NULL;
+        return -2;
+    }
     return 0;
 }
 
 /*
- * You need to make sure that you only free `mat->data` if `mat` is not a slice and has no existing slices,
- * or that you free `mat->parent->data` if `mat` is the last existing slice of its parent matrix and its parent matrix has no other references
- * (including itself). You cannot assume that mat is not NULL.
+ * Drops the reference of `mat` on its block, releasing the data if no other matrix or slice
+ * uses it. This takes constant time, however deeply `mat` was sliced, and is thread-safe.
+ * The struct itself is left for the caller to free. You cannot assume that mat is not NULL.
  */
 void deallocate_matrix(matrix *mat) {
-    if (mat == NULL) {
+    if (mat == NULL || mat->block == NULL) {
         return;
     }
-    mat->ref_cnt -= 1;
-    if (mat->parent == NULL && mat->ref_cnt == 0) {
-        free(mat->data);
-    }
-    if (mat->parent != NULL) {
-        deallocate_matrix(mat->parent);
+    matrix_block *block = mat->block;
+    mat->block = NULL;
+    if (__atomic_sub_fetch(&block->ref_cnt, 1, __ATOMIC_ACQ_REL) == 0) {
+        if (block->release != NULL) {
+            block->release(block->base);
+        } else {
+            pool_free(block->data);
+        }
+        free(block);
     }
 }
 
 /*
- * This function will call `deallocate_matrix` on the specified matrix and reallocate memory to its `data`
- * as well as reset its other members.
+ * This function will call `deallocate_matrix` on the specified matrix and reset its other
+ * members, leaving it without data.
  */
 void reallocate_matrix(matrix *mat, int rows, int cols) {
     deallocate_matrix(mat);
     mat->rows = rows;
     mat->cols = cols;
     mat->data = NULL;
-    mat->ref_cnt = 1;
-    mat->parent = NULL;
+    mat->row_stride = cols;
+    mat->col_stride = 1;
+    mat->block = NULL;
 }
 
 /*
- * Deallocates the specified matrix and sets its data.
+ * Deallocates the specified matrix and sets its data, which must come from pool_alloc, in a new
+ * block. Returns -2 if allocating the block fails, leaving `data` to the caller, and 0 otherwise.
  */
-void reallocate_matrix_with(matrix *mat, int rows, int cols, double *data) {
+int reallocate_matrix_with(matrix *mat, int rows, int cols, double *data) {
     reallocate_matrix(mat, rows, cols);
+    mat->block = new_block(data, NULL, NULL);
+    if (mat->block == NULL) {
+        return -2;
+    }
     mat->data = data;
+    return 0;
 }
 
 /*
@@ -152,139 +764,2867 @@ void reallocate_matrix_with(matrix *mat, int rows, int cols, double *data) {
  * You may assume `row` and `col` are valid.
  */
 double get(matrix *mat, int row, int col) {
-    return mat->data[mat->cols * row + col];
+    long offset = (long) mat->row_stride * row + (long) mat->col_stride * col;
+    return load_entry(entry_address(mat, offset), mat->dtype);
 }
 
 /*
- * Sets the value at the given row and column to val. You may assume `row` and
- * `col` are valid
+ * Sets the value at the given row and column to val, converted to the dtype of mat (see
+ * store_entry). You may assume `row` and `col` are valid
  */
 void set(matrix *mat, int row, int col, double val) {
-    mat->data[mat->cols * row + col] = val;
+    long offset = (long) mat->row_stride * row + (long) mat->col_stride * col;
+    store_entry(entry_address(mat, offset), mat->dtype, val);
 }
 
 /*
- * Sets all entries in mat to val
+ * Returns whether the entries of mat are stored row by row without gaps, so that entry
+ * (i, j) is mat->data[i * cols + j].
  */
-void fill_matrix(matrix *mat, double val) {
-    for (int i = mat->rows * mat->cols - 1; i >= 0; --i) {
-        mat->data[i] = val;
-    }
+int is_contiguous(matrix *mat) {
+    return (mat->rows == 1 || mat->row_stride == mat->cols) && (mat->cols == 1 || mat->col_stride == 1);
 }
 
 /*
- * Store the result of adding mat1 and mat2 to `result`.
- * Return 0 upon success and a nonzero value upon failure.
+ * Returns the address one past the last entry of mat.
  */
-int add_matrix(matrix *result, matrix *mat1, matrix *mat2) {
-    int rows = mat1->rows, cols = mat2->cols;
-    if (mat2->rows != rows || mat2->cols != cols) {
-        return -100;
-    }
-    double *data = malloc(rows * cols * sizeof(data));
-
-    for (int i = rows * cols - 1; i >= 0; --i) {
-        data[i] = mat1->data[i] + mat2->data[i];
-    }
-    reallocate_matrix_with(result, rows, cols, data);
-    return 0;
+static char *data_end(matrix *mat) {
+    return entry_address(mat, (long) (mat->rows - 1) * mat->row_stride + (long) (mat->cols - 1) * mat->col_stride + 1);
 }
 
 /*
- * (OPTIONAL)
- * Store the result of subtracting mat2 from mat1 to `result`.
- * Return 0 upon success and a nonzero value upon failure.
+ * Returns whether the data of mat1 and mat2 may share memory. Views whose entries interleave
+ * without coinciding, such as two column blocks of the same matrix, count as overlapping.
  */
-int sub_matrix(matrix *result, matrix *mat1, matrix *mat2) {
-    /* TODO: YOUR CODE HERE */
-    return 0;
+static int overlaps(matrix *mat1, matrix *mat2) {
+    return (char *) mat1->data < data_end(mat2) && (char *) mat2->data < data_end(mat1);
+}
+
+/* Returns whether the data of mat1 and mat2 may share memory, see overlaps */
+int shares_memory(matrix *mat1, matrix *mat2) {
+    return overlaps(mat1, mat2);
 }
 
 /*
- * Store the result of multiplying mat1 and mat2 to `result`.
- * Return 0 upon success and a nonzero value upon failure.
- * Remember that matrix multiplication is not the same as multiplying individual elements.
+ * Describes the row-major rows x cols buffer `data` as a matrix, for passing pool buffers to
+ * functions that take matrices. The result must not be deallocated.
  */
-int mul_matrix(matrix *result, matrix *mat1, matrix *mat2) {
-    if (mat1->cols != mat2->rows) {
-        return -101;
-    }
-    int rows = mat1->rows, mids = mat1->cols, cols = mat2->cols;
-    double *data = malloc(rows * cols * sizeof(double));
+static matrix wrap_buffer(double *data, int rows, int cols) {
+    matrix mat = {rows, cols, {data}, cols, 1, NULL, DTYPE_FLOAT64};
+    return mat;
+}
 
-    for (int i = 0; i < rows; ++i) {
-        for (int j = 0; j < cols; ++j) {
-            double t = 0;
-            for (int k = 0; k < mids; ++k)
-                t += get(mat1, i, k) * get(mat2, k, j);
-            data[i * rows + j] = t;
-        }
-    }
-    reallocate_matrix_with(result, rows, cols, data);
-    return 0;
+/* Same as wrap_buffer, for a buffer of `dtype` entries */
+static matrix wrap_typed(void *data, int rows, int cols, int dtype) {
+    matrix mat = wrap_buffer(data, rows, cols);
+    mat.dtype = dtype;
+    return mat;
 }
 
 /*
- * Store the result of raising mat to the (pow)th power to `result`.
- * Return 0 upon success and a nonzero value upon failure.
- * Remember that pow is defined with matrix multiplication, not element-wise multiplication.
+ * Every element-wise kernel runs through elementwise(), which computes result = mat op y for
+ * one of the BROADCAST_* or ELEMENTWISE_* operations. The second operand y is a pointer and two
+ * steps, so the same loop serves a matrix of the result's shape, a row or column vector
+ * applied to every row or column (one step 0), and a scalar (both steps 0). Operands are
+ * walked through their strides. Runs of adjacent entries are processed with AVX, and when
+ * every operand is contiguous the whole matrix is processed as a single run. All operands
+ * have the dtype of the result: float32 runs 8 entries per AVX vector and int32, whose
+ * arithmetic wraps around like numpy's, runs 4 per SSE vector.
  */
-int pow_matrix(matrix *result, matrix *mat, int pow) {
-    if (pow == 1) {
-        int rows = mat->rows, cols = mat->cols;
-        double *data = malloc(rows * cols * sizeof(double));
-        memcpy(data, mat->data, rows * cols * sizeof(double));
-        reallocate_matrix_with(result, rows, cols, data);
-        return 0;
+enum { ELEMENTWISE_NEG = BROADCAST_DIV + 1, ELEMENTWISE_ABS, ELEMENTWISE_COPY };
+
+/* Number of entries a thread processes at a time when the operands are contiguous */
+#define ELEMENTWISE_BLOCK 4096
+
+/* The second operand of elementwise(): its entry (i, j) is data[i * row_step + j * col_step] */
+typedef struct operand {
+    const void *data;
+    long row_step;
+    long col_step;
+} operand;
+
+/* Second operand of the unary operations, which ignore it. Zero in every dtype. */
+static const double unused_operand = 0;
+
+/* Computes x op y for one of the BROADCAST_* or ELEMENTWISE_* operations */
+static inline __m256d elementwise_apply(int op, __m256d x, __m256d y) {
+    switch (op) {
+    case BROADCAST_ADD:
+        return _mm256_add_pd(x, y);
+    case BROADCAST_SUB:
+        return _mm256_sub_pd(x, y);
+    case BROADCAST_RSUB:
+        return _mm256_sub_pd(y, x);
+    case BROADCAST_MUL:
+        return _mm256_mul_pd(x, y);
+    case BROADCAST_DIV:
+        return _mm256_div_pd(x, y);
+    case ELEMENTWISE_NEG:
+        return _mm256_xor_pd(x, _mm256_set1_pd(-0.0));
+    case ELEMENTWISE_ABS:
+        return _mm256_andnot_pd(_mm256_set1_pd(-0.0), x);
+    default:
+        return x;
     }
-    if (mat->rows != mat->cols) {
-        return -102;
+}
+
+/* Scalar version of elementwise_apply */
+static inline double elementwise_apply1(int op, double x, double y) {
+    switch (op) {
+    case BROADCAST_ADD:
+        return x + y;
+    case BROADCAST_SUB:
+        return x - y;
+    case BROADCAST_RSUB:
+        return y - x;
+    case BROADCAST_MUL:
+        return x * y;
+    case BROADCAST_DIV:
+        return x / y;
+    case ELEMENTWISE_NEG:
+        return -x;
+    case ELEMENTWISE_ABS:
+        return x >= 0 ? x : -x;
+    default:
+        return x;
     }
-    int n = mat->rows;
+}
 
-    matrix *p, *temp_result;
-    allocate_matrix_ref(&p, mat, 0, n, n);
-    allocate_matrix(&temp_result, n, n);
-    for (int i = 0; i < n; ++i) {
-        set(temp_result, i, i, 1);
+/* float32 version of elementwise_apply */
+static inline __m256 elementwise_apply_ps(int op, __m256 x, __m256 y) {
+    switch (op) {
+    case BROADCAST_ADD:
+        return _mm256_add_ps(x, y);
+    case BROADCAST_SUB:
+        return _mm256_sub_ps(x, y);
+    case BROADCAST_RSUB:
+        return _mm256_sub_ps(y, x);
+    case BROADCAST_MUL:
+        return _mm256_mul_ps(x, y);
+    case BROADCAST_DIV:
+        return _mm256_div_ps(x, y);
+    case ELEMENTWISE_NEG:
+        return _mm256_xor_ps(x, _mm256_set1_ps(-0.0f));
+    case ELEMENTWISE_ABS:
+        return _mm256_andnot_ps(_mm256_set1_ps(-0.0f), x);
+    default:
+        return x;
     }
+}
 
-    while (pow) {
-        if (pow & 1) {
-            mul_matrix(temp_result, temp_result, p);
-        }
-        pow >>= 1, mul_matrix(p, p, p);
+/* Scalar version of elementwise_apply_ps */
+static inline float elementwise_apply1_ps(int op, float x, float y) {
+    switch (op) {
+    case BROADCAST_ADD:
+        return x + y;
+    case BROADCAST_SUB:
+        return x - y;
+    case BROADCAST_RSUB:
+        return y - x;
+    case BROADCAST_MUL:
+        return x * y;
+    case BROADCAST_DIV:
+        return x / y;
+    case ELEMENTWISE_NEG:
+        return -x;
+    case ELEMENTWISE_ABS:
+        return x >= 0 ? x : -x;
+    default:
+        return x;
     }
+}
 
-    reallocate_matrix_with(result, n, n, temp_result->data);
-    deallocate_matrix(p);
-    free(temp_result);
-    free(p);
-    return 0;
+/* int32 version of elementwise_apply. BROADCAST_DIV is never run on int32 entries. */
+static inline __m128i elementwise_apply_epi32(int op, __m128i x, __m128i y) {
+    switch (op) {
+    case BROADCAST_ADD:
+        return _mm_add_epi32(x, y);
+    case BROADCAST_SUB:
+        return _mm_sub_epi32(x, y);
+    case BROADCAST_RSUB:
+        return _mm_sub_epi32(y, x);
+    case BROADCAST_MUL:
+        return _mm_mullo_epi32(x, y);
+    case ELEMENTWISE_NEG:
+        return _mm_sub_epi32(_mm_setzero_si128(), x);
+    case ELEMENTWISE_ABS:
+        return _mm_abs_epi32(x);
+    default:
+        return x;
+    }
 }
 
-/*
- * (OPTIONAL)
- * Store the result of element-wise negating mat's entries to `result`.
- * Return 0 upon success and a nonzero value upon failure.
- */
-int neg_matrix(matrix *result, matrix *mat) {
-    /* TODO: YOUR CODE HERE */
-    return 0;
+/* Scalar version of elementwise_apply_epi32, computed on unsigned values so that it wraps around */
+static inline int32_t elementwise_apply1_epi32(int op, int32_t x, int32_t y) {
+    uint32_t ux = x, uy = y;
+    switch (op) {
+    case BROADCAST_ADD:
+        return ux + uy;
+    case BROADCAST_SUB:
+        return ux - uy;
+    case BROADCAST_RSUB:
+        return uy - ux;
+    case BROADCAST_MUL:
+        return ux * uy;
+    case ELEMENTWISE_NEG:
+        return 0u - ux;
+    case ELEMENTWISE_ABS:
+        return x >= 0 ? ux : 0u - ux;
+    default:
+        return x;
+    }
 }
 
-/*
- * Store the result of taking the absolute value element-wise to `result`.
+/* dst[i * dst_step] = src[i * src_step] op y[i * y_step] for 0 <= i < n */
+static void elementwise_run(int op, double *dst, long dst_step, const double *src, long src_step,
+                            const double *y, long y_step, long n) {
+    long i = 0;
+    if (dst_step == 1 && src_step == 1 && y_step == 1) {
+        for (; i + 4 <= n; i += 4) {
+            _mm256_storeu_pd(dst + i, elementwise_apply(op, _mm256_loadu_pd(src + i), _mm256_loadu_pd(y + i)));
+        }
+    } else if (dst_step == 1 && src_step == 1 && y_step == 0) {
+        __m256d y_all = _mm256_set1_pd(*y);
+        for (; i + 4 <= n; i += 4) {
+            _mm256_storeu_pd(dst + i, elementwise_apply(op, _mm256_loadu_pd(src + i), y_all));
+        }
+    }
+    for (; i < n; ++i) {
+        dst[i * dst_step] = elementwise_apply1(op, src[i * src_step], y[i * y_step]);
+    }
+}
+
+/* float32 version of elementwise_run */
+static void elementwise_run_ps(int op, float *dst, long dst_step, const float *src, long src_step,
+                               const float *y, long y_step, long n) {
+    long i = 0;
+    if (dst_step == 1 && src_step == 1 && y_step == 1) {
+        for (; i + 8 <= n; i += 8) {
+            _mm256_storeu_ps(dst + i, elementwise_apply_ps(op, _mm256_loadu_ps(src + i), _mm256_loadu_ps(y + i)));
+        }
+    } else if (dst_step == 1 && src_step == 1 && y_step == 0) {
+        __m256 y_all = _mm256_set1_ps(*y);
+        for (; i + 8 <= n; i += 8) {
+            _mm256_storeu_ps(dst + i, elementwise_apply_ps(op, _mm256_loadu_ps(src + i), y_all));
+        }
+    }
+    for (; i < n; ++i) {
+        dst[i * dst_step] = elementwise_apply1_ps(op, src[i * src_step], y[i * y_step]);
+    }
+}
+
+/* int32 version of elementwise_run */
+static void elementwise_run_epi32(int op, int32_t *dst, long dst_step, const int32_t *src, long src_step,
+                                  const int32_t *y, long y_step, long n) {
+    long i = 0;
+    if (dst_step == 1 && src_step == 1 && y_step == 1) {
+        for (; i + 4 <= n; i += 4) {
+            __m128i x = _mm_loadu_si128((const __m128i *) (src + i));
+            __m128i v = _mm_loadu_si128((const __m128i *) (y + i));
+            _mm_storeu_si128((__m128i *) (dst + i), elementwise_apply_epi32(op, x, v));
+        }
+    } else if (dst_step == 1 && src_step == 1 && y_step == 0) {
+        __m128i y_all = _mm_set1_epi32(*y);
+        for (; i + 4 <= n; i += 4) {
+            __m128i x = _mm_loadu_si128((const __m128i *) (src + i));
+            _mm_storeu_si128((__m128i *) (dst + i), elementwise_apply_epi32(op, x, y_all));
+        }
+    }
+    for (; i < n; ++i) {
+        dst[i * dst_step] = elementwise_apply1_epi32(op, src[i * src_step], y[i * y_step]);
+    }
+}
+
+/* Calls the elementwise_run for `dtype` on runs starting `dst`, `src` and `y` entries in */
+static void elementwise_run_as(int dtype, int op, const operand *dst, long dst_start, const operand *src,
+                               long src_start, const operand *y, long y_start, long step_dst,
+                               long step_src, long step_y, long n) {
+    switch (dtype) {
+    case DTYPE_FLOAT32:
+        elementwise_run_ps(op, (float *) dst->data + dst_start, step_dst, (const float *) src->data + src_start,
+                           step_src, (const float *) y->data + y_start, step_y, n);
+        break;
+    case DTYPE_INT32:
+        elementwise_run_epi32(op, (int32_t *) dst->data + dst_start, step_dst,
+                              (const int32_t *) src->data + src_start, step_src,
+                              (const int32_t *) y->data + y_start, step_y, n);
+        break;
+    default:
+        elementwise_run(op, (double *) dst->data + dst_start, step_dst, (const double *) src->data + src_start,
+                        step_src, (const double *) y->data + y_start, step_y, n);
+    }
+}
+
+/* Computes result = mat op y, where result and mat have the same shape and do not overlap unsafely */
+static void elementwise(matrix *result, matrix *mat, operand y, int op) {
+    int rows = result->rows, cols = result->cols, dtype = result->dtype;
+    operand dst = {result->data, result->row_stride, result->col_stride};
+    operand src = {mat->data, mat->row_stride, mat->col_stride};
+    if (cols == 1) {
+        /* A single column is a single run through the row steps */
+        dst.col_step = dst.row_step;
+        src.col_step = src.row_step;
+        y.col_step = y.row_step;
+        cols = rows;
+        rows = 1;
+    }
+    int single_run = rows == 1 || (dst.row_step == cols * dst.col_step &&
+                                   src.row_step == cols * src.col_step && y.row_step == cols * y.col_step);
+    long size = (long) rows * cols;
+    int threads = kernel_threads(KERNEL_ELEMENTWISE, size);
+
+    if (single_run) {
+        #pragma omp parallel for num_threads(threads) if(threads > 1)
+        for (long start = 0; start < size; start += ELEMENTWISE_BLOCK) {
+            long n = size - start < ELEMENTWISE_BLOCK ? size - start : ELEMENTWISE_BLOCK;
+            elementwise_run_as(dtype, op, &dst, start * dst.col_step, &src, start * src.col_step,
+                               &y, start * y.col_step, dst.col_step, src.col_step, y.col_step, n);
+        }
+        return;
+    }
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < rows; ++i) {
+        elementwise_run_as(dtype, op, &dst, i * dst.row_step, &src, i * src.row_step,
+                           &y, i * y.row_step, dst.col_step, src.col_step, y.col_step, cols);
+    }
+}
+
+/*
+ * Returns whether an element-wise kernel may write result while reading `mat`: they either
+ * do not overlap or are the very same entries, each of which is read before it is written.
+ */
+static int aliases_safely(matrix *result, matrix *mat) {
+    return !overlaps(result, mat) ||
+           (result->data == mat->data && result->rows == mat->rows && result->cols == mat->cols &&
+            result->row_stride == mat->row_stride && result->col_stride == mat->col_stride);
+}
+
+/*
+ * Computes result = mat op y, where `other` is the matrix y points into, or NULL. If result
+ * overlaps mat or other in any other way than being identical to mat, the entries are first
+ * computed into a scratch buffer. Returns -2 if allocating it fails and 0 otherwise.
+ */
+static int elementwise_checked(matrix *result, matrix *mat, matrix *other, operand y, int op) {
+    if (aliases_safely(result, mat) && (other == NULL || aliases_safely(result, other))) {
+        elementwise(result, mat, y, op);
+        return 0;
+    }
+    double *buffer = pool_alloc((size_t) result->rows * result->cols);
+    if (buffer == NULL) {
+        return -2;
+    }
+    matrix scratch = wrap_typed(buffer, result->rows, result->cols, result->dtype);
+    operand unused = {&unused_operand, 0, 0};
+    elementwise(&scratch, mat, y, op);
+    elementwise(result, &scratch, unused, ELEMENTWISE_COPY);
+    pool_free(buffer);
+    return 0;
+}
+
+/* Returns mat as the second operand of elementwise() */
+static operand matrix_operand(matrix *mat) {
+    operand y = {mat->data, mat->row_stride, mat->col_stride};
+    return y;
+}
+
+/*
+ * Copies mat into result, converting its entries into result's dtype as store_entry does,
+ * a row at a time. The two must have the same shape and not overlap.
+ */
+static void convert_matrix(matrix *result, matrix *mat) {
+    int rows = result->rows, cols = result->cols;
+    int threads = kernel_threads(KERNEL_ELEMENTWISE, (double) rows * cols);
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < rows; ++i) {
+        double block[ELEMENTWISE_BLOCK];
+        for (int j = 0; j < cols; j += ELEMENTWISE_BLOCK) {
+            int n = cols - j < ELEMENTWISE_BLOCK ? cols - j : ELEMENTWISE_BLOCK;
+            load_run(block, entry_address(mat, (long) i * mat->row_stride + (long) j * mat->col_stride),
+                     mat->col_stride, n, mat->dtype);
+            store_run(entry_address(result, (long) i * result->row_stride + (long) j * result->col_stride),
+                      result->col_stride, block, n, result->dtype);
+        }
+    }
+}
+
+/*
+ * Kernels only run natively on operands that all have the dtype of the result, and some only
+ * on float64. Any other combination runs the float64 kernel on float64 stand-ins: operands
+ * that are not float64 are converted into scratch buffers, the kernel writes into a float64
+ * scratch result, and that is converted into the result's dtype. Since float64 holds every
+ * float32 and int32 exactly, this only rounds once, at the end.
+ */
+typedef struct widened {
+    matrix result; // stand-in for the result
+    matrix mats[2]; // stand-ins for the operands
+    double *buffers[3]; // scratch buffers of the result and the operands, NULL for float64 ones
+    matrix *target; // the result itself
+} widened;
+
+/* Whether result and the operands mat1 and mat2, either of which may be NULL, share one dtype */
+static int same_dtype(matrix *result, matrix *mat1, matrix *mat2) {
+    return (mat1 == NULL || mat1->dtype == result->dtype) && (mat2 == NULL || mat2->dtype == result->dtype);
+}
+
+/* Returns `mat` itself if it is float64, and otherwise a float64 scratch matrix of its shape */
+static matrix stand_in(matrix *mat, double **buffer) {
+    if (mat->dtype == DTYPE_FLOAT64) {
+        *buffer = NULL;
+        return *mat;
+    }
+    *buffer = pool_alloc((size_t) mat->rows * mat->cols);
+    return wrap_buffer(*buffer, mat->rows, mat->cols);
+}
+
+/*
+ * Sets up float64 stand-ins in `w` for result and the `n` (at most 2) matrices in `mats`,
+ * converting the operands. Returns -2 if allocating scratch buffers fails and 0 otherwise.
+ */
+static int widen(widened *w, matrix *result, matrix **mats, int n) {
+    w->target = result;
+    w->result = stand_in(result, &w->buffers[0]);
+    int failed = result->dtype != DTYPE_FLOAT64 && w->buffers[0] == NULL;
+    for (int i = 0; i < 2; ++i) {
+        w->buffers[i + 1] = NULL;
+        if (i < n && !failed) {
+            w->mats[i] = stand_in(mats[i], &w->buffers[i + 1]);
+            failed = mats[i]->dtype != DTYPE_FLOAT64 && w->buffers[i + 1] == NULL;
+        }
+    }
+    if (failed) {
+        for (int i = 0; i < 3; ++i) {
+            pool_free(w->buffers[i]);
+        }
+        return -2;
+    }
+    for (int i = 0; i < n; ++i) {
+        if (w->buffers[i + 1] != NULL) {
+            convert_matrix(&w->mats[i], mats[i]);
+        }
+    }
+    return 0;
+}
+
+/*
+ * Finishes a kernel run on the stand-ins in `w` that returned `failed`: unless it failed, the
+ * result is converted into the real one. Releases the stand-ins and returns `failed`.
+ */
+static int narrow(widened *w, int failed) {
+    if (!failed && w->buffers[0] != NULL) {
+        convert_matrix(w->target, &w->result);
+    }
+    for (int i = 0; i < 3; ++i) {
+        pool_free(w->buffers[i]);
+    }
+    return failed;
+}
+
+/*
+ * Sets all entries in mat to val
+ */
+void fill_matrix(matrix *mat, double val) {
+    if (mat->dtype != DTYPE_FLOAT64) {
+        for (int i = 0; i < mat->rows; ++i) {
+            for (int j = 0; j < mat->cols; ++j) {
+                set(mat, i, j, val);
+            }
+        }
+        return;
+    }
+    for (int i = 0; i < mat->rows; ++i) {
+        double *row = mat->data + (size_t) i * mat->row_stride;
+        for (int j = 0; j < mat->cols; ++j) {
+            row[(size_t) j * mat->col_stride] = val;
+        }
+    }
+}
+
+/*
+ * Sets the entries of mat, taken in row-major order, to start, start + step, start + 2 * step, ...
+ * Each entry is computed from its index rather than accumulated, so rounding errors do not
+ * build up along the matrix.
+ */
+void arange_matrix(matrix *mat, double start, double step) {
+    int rows = mat->rows, cols = mat->cols;
+    int threads = kernel_threads(KERNEL_ELEMENTWISE, (double) rows * cols);
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < rows; ++i) {
+        size_t index = (size_t) i * cols;
+        if (mat->dtype != DTYPE_FLOAT64) {
+            for (int j = 0; j < cols; ++j) {
+                set(mat, i, j, start + (double) (index + j) * step);
+            }
+            continue;
+        }
+        double *row = mat->data + (size_t) i * mat->row_stride;
+        for (int j = 0; j < cols; ++j) {
+            row[(size_t) j * mat->col_stride] = start + (double) (index + j) * step;
+        }
+    }
+}
+
+/*
+ * Copies whose source is read down columns and whose destination is written along rows, the
+ * shape of a transpose, go through copy_blocked(). It halves the longer side until the block is
+ * at most TRANSPOSE_TILE x TRANSPOSE_TILE, so that both sides of every block stay in cache
+ * whatever its size, without tuning the split to a particular cache.
+ */
+#define TRANSPOSE_TILE 32
+/* Number of destination rows a thread copies at a time */
+#define TRANSPOSE_STRIP 128
+
+/*
+ * Stores the transpose of the 4 x 4 block whose row r is src[r * src_step ... + 3] into the
+ * block whose row r is dst[r * dst_step ... + 3].
+ */
+static inline void transpose_4x4(const double *src, long src_step, double *dst, long dst_step) {
+    __m256d r0 = _mm256_loadu_pd(src);
+    __m256d r1 = _mm256_loadu_pd(src + src_step);
+    __m256d r2 = _mm256_loadu_pd(src + 2 * src_step);
+    __m256d r3 = _mm256_loadu_pd(src + 3 * src_step);
+    __m256d t0 = _mm256_unpacklo_pd(r0, r1);
+    __m256d t1 = _mm256_unpackhi_pd(r0, r1);
+    __m256d t2 = _mm256_unpacklo_pd(r2, r3);
+    __m256d t3 = _mm256_unpackhi_pd(r2, r3);
+    _mm256_storeu_pd(dst, _mm256_permute2f128_pd(t0, t2, 0x20));
+    _mm256_storeu_pd(dst + dst_step, _mm256_permute2f128_pd(t1, t3, 0x20));
+    _mm256_storeu_pd(dst + 2 * dst_step, _mm256_permute2f128_pd(t0, t2, 0x31));
+    _mm256_storeu_pd(dst + 3 * dst_step, _mm256_permute2f128_pd(t1, t3, 0x31));
+}
+
+/*
+ * Copies the rows x cols block src (row stride srs, column stride scs) into dst (row stride
+ * drs, column stride dcs). When src's columns and dst's rows are contiguous, 4 x 4 blocks
+ * are transposed in registers.
+ */
+static void copy_tile(int rows, int cols, const double *src, long srs, long scs, double *dst,
+                      long drs, long dcs) {
+    int i = 0;
+    if (srs == 1 && dcs == 1) {
+        for (; i + 4 <= rows; i += 4) {
+            int j = 0;
+            for (; j + 4 <= cols; j += 4) {
+                transpose_4x4(src + i + j * scs, scs, dst + i * drs + j, drs);
+            }
+            for (; j < cols; ++j) {
+                for (int r = i; r < i + 4; ++r) {
+                    dst[r * drs + j] = src[r + j * scs];
+                }
+            }
+        }
+    }
+    for (; i < rows; ++i) {
+        for (int j = 0; j < cols; ++j) {
+            dst[i * drs + j * dcs] = src[i * srs + j * scs];
+        }
+    }
+}
+
+/* Cache-oblivious copy of a rows x cols block, with the same arguments as copy_tile */
+static void copy_blocked(int rows, int cols, const double *src, long srs, long scs, double *dst,
+                         long drs, long dcs) {
+    if (rows <= TRANSPOSE_TILE && cols <= TRANSPOSE_TILE) {
+        copy_tile(rows, cols, src, srs, scs, dst, drs, dcs);
+        return;
+    }
+    /* Split near the middle, at a multiple of 4 so that the tiles stay aligned with the 4 x 4 blocks */
+    if (rows >= cols) {
+        int half = rows / 8 * 4;
+        copy_blocked(half, cols, src, srs, scs, dst, drs, dcs);
+        copy_blocked(rows - half, cols, src + half * srs, srs, scs, dst + half * drs, drs, dcs);
+    } else {
+        int half = cols / 8 * 4;
+        copy_blocked(rows, half, src, srs, scs, dst, drs, dcs);
+        copy_blocked(rows, cols - half, src + half * scs, srs, scs, dst + half * dcs, drs, dcs);
+    }
+}
+
+/* Copies mat into result, which must not overlap it, through copy_blocked */
+static void copy_transposed(matrix *result, matrix *mat) {
+    int rows = result->rows, cols = result->cols;
+    int threads = kernel_threads(KERNEL_TRANSPOSE, (double) rows * cols);
+    #pragma omp parallel for schedule(dynamic) num_threads(threads) if(threads > 1)
+    for (int i = 0; i < rows; i += TRANSPOSE_STRIP) {
+        int n = rows - i < TRANSPOSE_STRIP ? rows - i : TRANSPOSE_STRIP;
+        copy_blocked(n, cols, mat->data + (long) i * mat->row_stride, mat->row_stride, mat->col_stride,
+                     result->data + (long) i * result->row_stride, result->row_stride, result->col_stride);
+    }
+}
+
+/*
+ * Copies the entries of mat into `result`, which must already have the shape of mat.
+ * Either may be a view, and they may overlap. If their dtypes differ, the entries are
+ * converted into result's dtype as store_entry does, and they must not overlap.
+ * Return 0 upon success and a nonzero value upon failure.
+ */
+int copy_matrix(matrix *result, matrix *mat) {
+    if (result->rows != mat->rows || result->cols != mat->cols) {
+        return -100;
+    }
+    if (result->dtype != mat->dtype) {
+        convert_matrix(result, mat);
+        return 0;
+    }
+    if (result->data == mat->data && result->row_stride == mat->row_stride &&
+            result->col_stride == mat->col_stride) {
+        return 0;
+    }
+    /* Reading a column-major source row by row would touch a new cache line for every entry */
+    if (mat->dtype == DTYPE_FLOAT64 && mat->rows > 1 && mat->cols > 1 && mat->row_stride == 1 &&
+            result->col_stride == 1 && !overlaps(result, mat)) {
+        copy_transposed(result, mat);
+        return 0;
+    }
+    operand unused = {&unused_operand, 0, 0};
+    return elementwise_checked(result, mat, NULL, unused, ELEMENTWISE_COPY);
+}
+
+/*
+ * Copies the entries of mat in row-major order into `data`, which must hold rows * cols
+ * entries of mat's dtype and not overlap mat.
+ */
+void gather_matrix(void *data, matrix *mat) {
+    matrix packed = wrap_typed(data, mat->rows, mat->cols, mat->dtype);
+    if (is_contiguous(mat)) {
+        memcpy(data, mat->data, (size_t) mat->rows * mat->cols * dtype_size(mat->dtype));
+    } else {
+        copy_matrix(&packed, mat);
+    }
+}
+
+/*
+ * Stores the transpose of mat into `result`, which must already be mat->cols x mat->rows.
+ * Either may be a view, and they may overlap.
+ * Return 0 upon success and a nonzero value upon failure.
+ */
+int transpose_matrix(matrix *result, matrix *mat) {
+    matrix transposed = {mat->cols, mat->rows, {mat->data}, mat->col_stride, mat->row_stride, NULL, mat->dtype};
+    return copy_matrix(result, &transposed);
+}
+
+/*
+ * Store the result of adding mat1 and mat2 to `result`.
+ * `result` must already have the shape of mat1 and may be mat1 or mat2 itself.
+ * Return 0 upon success and a nonzero value upon failure.
+ */
+int add_matrix(matrix *result, matrix *mat1, matrix *mat2) {
+    int rows = mat1->rows, cols = mat1->cols;
+    if (mat2->rows != rows || mat2->cols != cols || result->rows != rows || result->cols != cols) {
+        return -100;
+    }
+    if (!same_dtype(result, mat1, mat2)) {
+        widened w;
+        matrix *operands[] = {mat1, mat2};
+        return widen(&w, result, operands, 2) ? -2 : narrow(&w, add_matrix(&w.result, &w.mats[0], &w.mats[1]));
+    }
+    return elementwise_checked(result, mat1, mat2, matrix_operand(mat2), BROADCAST_ADD);
+}
+
+/*
+ * Store the result of subtracting mat2 from mat1 to `result`.
+ * `result` must already have the shape of mat1 and may be mat1 or mat2 itself.
+ * Return 0 upon success and a nonzero value upon failure.
+ */
+int sub_matrix(matrix *result, matrix *mat1, matrix *mat2) {
+    int rows = mat1->rows, cols = mat1->cols;
+    if (mat2->rows != rows || mat2->cols != cols || result->rows != rows || result->cols != cols) {
+        return -100;
+    }
+    if (!same_dtype(result, mat1, mat2)) {
+        widened w;
+        matrix *operands[] = {mat1, mat2};
+        return widen(&w, result, operands, 2) ? -2 : narrow(&w, sub_matrix(&w.result, &w.mats[0], &w.mats[1]));
+    }
+    return elementwise_checked(result, mat1, mat2, matrix_operand(mat2), BROADCAST_SUB);
+}
+
+/*
+ * Store the result of element-wise negating mat's entries to `result`.
+ * `result` must already have the shape of mat and may be mat itself.
+ * Return 0 upon success and a nonzero value upon failure.
+ */
+int neg_matrix(matrix *result, matrix *mat) {
+    if (result->rows != mat->rows || result->cols != mat->cols) {
+        return -100;
+    }
+    if (!same_dtype(result, mat, NULL)) {
+        widened w;
+        return widen(&w, result, &mat, 1) ? -2 : narrow(&w, neg_matrix(&w.result, &w.mats[0]));
+    }
+    operand unused = {&unused_operand, 0, 0};
+    return elementwise_checked(result, mat, NULL, unused, ELEMENTWISE_NEG);
+}
+
+/*
+ * Store the result of taking the absolute value element-wise to `result`.
+ * `result` must already have the shape of mat and may be mat itself.
  * Return 0 upon success and a nonzero value upon failure.
  */
 int abs_matrix(matrix *result, matrix *mat) {
+    if (result->rows != mat->rows || result->cols != mat->cols) {
+        return -100;
+    }
+    if (!same_dtype(result, mat, NULL)) {
+        widened w;
+        return widen(&w, result, &mat, 1) ? -2 : narrow(&w, abs_matrix(&w.result, &w.mats[0]));
+    }
+    operand unused = {&unused_operand, 0, 0};
+    return elementwise_checked(result, mat, NULL, unused, ELEMENTWISE_ABS);
+}
+
+/*
+ * Store mat op scalar to `result` for one of the BROADCAST_* operations, where BROADCAST_RSUB
+ * computes scalar - mat. `result` must already have the shape of mat and may be mat itself.
+ * For float32 and int32 operations the scalar is first converted into their dtype, and int32
+ * division is computed in float64.
+ * Return 0 upon success and a nonzero value upon failure.
+ */
+int scalar_matrix(matrix *result, matrix *mat, double scalar, int op) {
+    if (result->rows != mat->rows || result->cols != mat->cols) {
+        return -100;
+    }
+    if (!same_dtype(result, mat, NULL) || (result->dtype == DTYPE_INT32 && op == BROADCAST_DIV)) {
+        widened w;
+        return widen(&w, result, &mat, 1) ? -2 : narrow(&w, scalar_matrix(&w.result, &w.mats[0], scalar, op));
+    }
+    float scalar_ps = (float) scalar;
+    int32_t scalar_epi32 = to_int32(scalar);
+    operand y = {result->dtype == DTYPE_FLOAT32 ? (void *) &scalar_ps :
+                 result->dtype == DTYPE_INT32 ? (void *) &scalar_epi32 : (void *) &scalar, 0, 0};
+    return elementwise_checked(result, mat, NULL, y, op);
+}
+
+/*
+ * Store mat op vec to `result` for one of the BROADCAST_* operations, where BROADCAST_RSUB
+ * computes vec - mat. `vec` is either a 1 x cols row vector, applied to every row of mat, or a
+ * rows x 1 column vector, whose i-th entry is applied to the whole i-th row. `result` must
+ * already have the shape of mat and may be mat itself. `vec` may be a slice of mat or result.
+ * Return 0 upon success and a nonzero value upon failure.
+ */
+int broadcast_matrix(matrix *result, matrix *mat, matrix *vec, int op) {
     int rows = mat->rows, cols = mat->cols;
-    double *data = malloc(rows * cols * sizeof(double));
+    int is_row = vec->rows == 1 && vec->cols == cols;
+    if (result->rows != rows || result->cols != cols || (!is_row && (vec->cols != 1 || vec->rows != rows))) {
+        return -100;
+    }
+    if (!same_dtype(result, mat, vec) || (result->dtype == DTYPE_INT32 && op == BROADCAST_DIV)) {
+        widened w;
+        matrix *operands[] = {mat, vec};
+        return widen(&w, result, operands, 2) ? -2 :
+               narrow(&w, broadcast_matrix(&w.result, &w.mats[0], &w.mats[1], op));
+    }
+    operand y = {vec->data, is_row ? 0 : vec->row_stride, is_row ? vec->col_stride : 0};
+    return elementwise_checked(result, mat, vec, y, op);
+}
+
+/*
+ * Blocking parameters for the matrix multiply engine. The micro-kernel keeps a
+ * GEMM_MR x GEMM_NR tile of the result in 12 AVX registers. A GEMM_KC x GEMM_NR
+ * panel of mat2 is sized to stay in L1, a GEMM_MC x GEMM_KC block of mat1 in L2,
+ * and a GEMM_KC x GEMM_NC block of mat2 in L3.
+ */
+#define GEMM_MR 6
+#define GEMM_NR 8
+#define GEMM_MC 96
+#define GEMM_KC 256
+#define GEMM_NC 2048
+
+/*
+ * Packs the mc x kc block of a (row stride lda, column stride csa) into GEMM_MR-row panels.
+ * Within a panel the entries are stored column by column, so the micro-kernel reads them
+ * sequentially. Rows past mc are padded with zeros.
+ */
+static void pack_a(int mc, int kc, const double *a, int lda, int csa, double *packed) {
+    for (int i = 0; i < mc; i += GEMM_MR) {
+        int mr = mc - i < GEMM_MR ? mc - i : GEMM_MR;
+        if (mr == GEMM_MR && lda == 1) {
+            /* a is a transposed view, so each column of the panel is contiguous */
+            for (int p = 0; p < kc; ++p) {
+                const double *col = a + i + (size_t) p * csa;
+                _mm256_storeu_pd(packed, _mm256_loadu_pd(col));
+                _mm_storeu_pd(packed + 4, _mm_loadu_pd(col + 4));
+                packed += GEMM_MR;
+            }
+            continue;
+        }
+        for (int p = 0; p < kc; ++p) {
+            for (int r = 0; r < mr; ++r) {
+                packed[r] = a[(size_t) (i + r) * lda + (size_t) p * csa];
+            }
+            for (int r = mr; r < GEMM_MR; ++r) {
+                packed[r] = 0;
+            }
+            packed += GEMM_MR;
+        }
+    }
+}
+
+/*
+ * Packs the kc x GEMM_NR panel of b (row stride ldb, column stride csb) starting at column
+ * `j` of an nc-column block. Columns past nc are padded with zeros.
+ */
+static void pack_b_panel(int kc, int nc, int j, const double *b, int ldb, int csb, double *packed) {
+    int nr = nc - j < GEMM_NR ? nc - j : GEMM_NR;
+    packed += (size_t) j * kc;
+    b += (size_t) j * csb;
+    if (nr == GEMM_NR && csb == 1) {
+        for (int p = 0; p < kc; ++p) {
+            _mm256_store_pd(packed, _mm256_loadu_pd(b + (size_t) p * ldb));
+            _mm256_store_pd(packed + 4, _mm256_loadu_pd(b + (size_t) p * ldb + 4));
+            packed += GEMM_NR;
+        }
+        return;
+    }
+    int p = 0;
+    if (nr == GEMM_NR && ldb == 1) {
+        /* b is a transposed view: transpose 4 x 4 blocks of its contiguous columns */
+        for (; p + 4 <= kc; p += 4) {
+            transpose_4x4(b + p, csb, packed, GEMM_NR);
+            transpose_4x4(b + p + (size_t) 4 * csb, csb, packed + 4, GEMM_NR);
+            packed += 4 * GEMM_NR;
+        }
+    }
+    for (; p < kc; ++p) {
+        for (int c = 0; c < nr; ++c) {
+            packed[c] = b[(size_t) p * ldb + (size_t) c * csb];
+        }
+        for (int c = nr; c < GEMM_NR; ++c) {
+            packed[c] = 0;
+        }
+        packed += GEMM_NR;
+    }
+}
+
+/*
+ * Accumulates the product of a packed GEMM_MR x kc panel and a packed kc x GEMM_NR panel
+ * into the GEMM_MR x GEMM_NR tile at c (row stride ldc).
+ */
+static void gemm_kernel(int kc, const double *a, const double *b, double *c, int ldc) {
+    __m256d c00 = _mm256_setzero_pd(), c01 = _mm256_setzero_pd();
+    __m256d c10 = _mm256_setzero_pd(), c11 = _mm256_setzero_pd();
+    __m256d c20 = _mm256_setzero_pd(), c21 = _mm256_setzero_pd();
+    __m256d c30 = _mm256_setzero_pd(), c31 = _mm256_setzero_pd();
+    __m256d c40 = _mm256_setzero_pd(), c41 = _mm256_setzero_pd();
+    __m256d c50 = _mm256_setzero_pd(), c51 = _mm256_setzero_pd();
 
-    for (int i = rows * cols - 1; i >= 0; --i) {
-        data[i] = mat->data[i] >= 0 ? mat->data[i] : -mat->data[i];
+    for (int p = 0; p < kc; ++p) {
+        __m256d b0 = _mm256_load_pd(b);
+        __m256d b1 = _mm256_load_pd(b + 4);
+        __m256d a0;
+        a0 = _mm256_broadcast_sd(a);
+        c00 = _mm256_fmadd_pd(a0, b0, c00);
+        c01 = _mm256_fmadd_pd(a0, b1, c01);
+        a0 = _mm256_broadcast_sd(a + 1);
+        c10 = _mm256_fmadd_pd(a0, b0, c10);
+        c11 = _mm256_fmadd_pd(a0, b1, c11);
+        a0 = _mm256_broadcast_sd(a + 2);
+        c20 = _mm256_fmadd_pd(a0, b0, c20);
+        c21 = _mm256_fmadd_pd(a0, b1, c21);
+        a0 = _mm256_broadcast_sd(a + 3);
+        c30 = _mm256_fmadd_pd(a0, b0, c30);
+        c31 = _mm256_fmadd_pd(a0, b1, c31);
+        a0 = _mm256_broadcast_sd(a + 4);
+        c40 = _mm256_fmadd_pd(a0, b0, c40);
+        c41 = _mm256_fmadd_pd(a0, b1, c41);
+        a0 = _mm256_broadcast_sd(a + 5);
+        c50 = _mm256_fmadd_pd(a0, b0, c50);
+        c51 = _mm256_fmadd_pd(a0, b1, c51);
+        a += GEMM_MR;
+        b += GEMM_NR;
     }
 
-    reallocate_matrix_with(result, rows, cols, data);
+    _mm256_storeu_pd(c, _mm256_add_pd(_mm256_loadu_pd(c), c00));
+    _mm256_storeu_pd(c + 4, _mm256_add_pd(_mm256_loadu_pd(c + 4), c01));
+    c += ldc;
+    _mm256_storeu_pd(c, _mm256_add_pd(_mm256_loadu_pd(c), c10));
+    _mm256_storeu_pd(c + 4, _mm256_add_pd(_mm256_loadu_pd(c + 4), c11));
+    c += ldc;
+    _mm256_storeu_pd(c, _mm256_add_pd(_mm256_loadu_pd(c), c20));
+    _mm256_storeu_pd(c + 4, _mm256_add_pd(_mm256_loadu_pd(c + 4), c21));
+    c += ldc;
+    _mm256_storeu_pd(c, _mm256_add_pd(_mm256_loadu_pd(c), c30));
+    _mm256_storeu_pd(c + 4, _mm256_add_pd(_mm256_loadu_pd(c + 4), c31));
+    c += ldc;
+    _mm256_storeu_pd(c, _mm256_add_pd(_mm256_loadu_pd(c), c40));
+    _mm256_storeu_pd(c + 4, _mm256_add_pd(_mm256_loadu_pd(c + 4), c41));
+    c += ldc;
+    _mm256_storeu_pd(c, _mm256_add_pd(_mm256_loadu_pd(c), c50));
+    _mm256_storeu_pd(c + 4, _mm256_add_pd(_mm256_loadu_pd(c + 4), c51));
+}
+
+/*
+ * Multiplies a packed mc x kc block of mat1 with a packed kc x nc block of mat2 and
+ * accumulates into c. Edge tiles are computed into a scratch tile and copied back.
+ */
+static void gemm_macro_kernel(int mc, int nc, int kc, const double *a, const double *b,
+                              double *c, int ldc) {
+    double edge[GEMM_MR * GEMM_NR] __attribute__((aligned(32)));
+    for (int j = 0; j < nc; j += GEMM_NR) {
+        int nr = nc - j < GEMM_NR ? nc - j : GEMM_NR;
+        for (int i = 0; i < mc; i += GEMM_MR) {
+            int mr = mc - i < GEMM_MR ? mc - i : GEMM_MR;
+            const double *a_panel = a + (size_t) i * kc, *b_panel = b + (size_t) j * kc;
+            if (mr == GEMM_MR && nr == GEMM_NR) {
+                gemm_kernel(kc, a_panel, b_panel, c + (size_t) i * ldc + j, ldc);
+                continue;
+            }
+            memset(edge, 0, sizeof(edge));
+            gemm_kernel(kc, a_panel, b_panel, edge, GEMM_NR);
+            for (int r = 0; r < mr; ++r) {
+                for (int s = 0; s < nr; ++s) {
+                    c[(size_t) (i + r) * ldc + j + s] += edge[r * GEMM_NR + s];
+                }
+            }
+        }
+    }
+}
+
+/* How gemm splits an m x n x k product between threads, and the packing space that needs */
+typedef struct gemm_plan {
+    int parallel; // whether the product is large enough to use multiple threads
+    int threads; // number of threads
+    int mc; // rows of mat1 per block
+    int kc_max; // depth of the largest packed block
+    int nc_pad; // columns of the largest packed block of mat2, rounded up to GEMM_NR
+} gemm_plan;
+
+/* Plans an m x n x k product that uses at most `max_threads` threads */
+static gemm_plan gemm_make_plan(int m, int n, int k, int max_threads) {
+    gemm_plan plan;
+    int threads = kernel_threads(KERNEL_GEMM, (double) m * n * k);
+    plan.threads = threads < max_threads ? threads : max_threads;
+    plan.parallel = plan.threads > 1;
+
+    /* Shrink the row blocks so that every thread gets at least one */
+    int mc = (m + plan.threads - 1) / plan.threads;
+    mc = (mc + GEMM_MR - 1) / GEMM_MR * GEMM_MR;
+    plan.mc = mc > GEMM_MC ? GEMM_MC : mc;
+    int nc_max = n < GEMM_NC ? n : GEMM_NC;
+    plan.kc_max = k < GEMM_KC ? k : GEMM_KC;
+    plan.nc_pad = (nc_max + GEMM_NR - 1) / GEMM_NR * GEMM_NR;
+    return plan;
+}
+
+/* Returns the number of doubles of packing workspace gemm_run needs for `plan` */
+static size_t gemm_workspace_size(gemm_plan *plan) {
+    return (size_t) plan->kc_max * plan->nc_pad + (size_t) plan->threads * plan->mc * plan->kc_max;
+}
+
+/*
+ * Computes c = a * b where a is m x k, b is k x n and c is m x n. a and b have row strides
+ * lda and ldb and column strides csa and csb, so they may be any views. c is row-major with
+ * row stride ldc and must not overlap a or b. `plan` must come from
+ * gemm_make_plan(m, n, k, threads) and `work` must be 64-byte aligned and hold
+ * gemm_workspace_size(plan) doubles.
+ *
+ * mat2 is split into GEMM_KC x GEMM_NC blocks which all threads pack together. The rows
+ * of the result are then split into blocks of at most GEMM_MC rows that threads take
+ * in turn, each packing its own block of mat1. Every output tile is written by exactly
+ * one thread, so no synchronization is needed beyond the barriers between blocks.
+ */
+static void gemm_run(gemm_plan *plan, int m, int n, int k, const double *a, int lda, int csa,
+                     const double *b, int ldb, int csb, double *c, int ldc, double *work) {
+    int mc = plan->mc, kc_max = plan->kc_max;
+    double *b_packed = work;
+    double *a_packed = work + (size_t) kc_max * plan->nc_pad;
+
+    for (int i = 0; i < m; ++i) {
+        memset(c + (size_t) i * ldc, 0, n * sizeof(double));
+    }
+
+    #pragma omp parallel num_threads(plan->threads) if(plan->parallel)
+    {
+        double *a_local = a_packed + (size_t) omp_get_thread_num() * mc * kc_max;
+        for (int jc = 0; jc < n; jc += GEMM_NC) {
+            int nc = n - jc < GEMM_NC ? n - jc : GEMM_NC;
+            for (int pc = 0; pc < k; pc += GEMM_KC) {
+                int kc = k - pc < GEMM_KC ? k - pc : GEMM_KC;
+
+                #pragma omp for schedule(static)
+                for (int j = 0; j < nc; j += GEMM_NR) {
+                    pack_b_panel(kc, nc, j, b + (size_t) pc * ldb + (size_t) jc * csb, ldb, csb, b_packed);
+                }
+
+                #pragma omp for schedule(dynamic)
+                for (int ic = 0; ic < m; ic += mc) {
+                    int mcc = m - ic < mc ? m - ic : mc;
+                    pack_a(mcc, kc, a + (size_t) ic * lda + (size_t) pc * csa, lda, csa, a_local);
+                    gemm_macro_kernel(mcc, nc, kc, a_local, b_packed,
+                                      c + (size_t) ic * ldc + jc, ldc);
+                }
+            }
+        }
+    }
+}
+
+/* gemm_run with a freshly allocated workspace. Returns -2 if allocating it fails, else 0. */
+static int gemm(int m, int n, int k, const double *a, int lda, int csa, const double *b, int ldb,
+                int csb, double *c, int ldc) {
+    gemm_plan plan = gemm_make_plan(m, n, k, get_num_threads());
+    double *work = pool_alloc(gemm_workspace_size(&plan));
+    if (work == NULL) {
+        return -2;
+    }
+    gemm_run(&plan, m, n, k, a, lda, csa, b, ldb, csb, c, ldc, work);
+    pool_free(work);
     return 0;
 }
+
+/*
+ * Strassen-Winograd multiplication of square float64 matrices. A product of order n is split
+ * into 2 x 2 blocks of order n / 2, which takes 7 block products and 15 block additions instead
+ * of 8 products. The split recurses until the order is at most the crossover, where gemm_run
+ * computes the leaf products. Orders that do not halve evenly down to the crossover are padded
+ * with zeros. In STRASSEN_AUTO mode only products that need no padding use it.
+ *
+ * The error bound is weaker than the classic one: each entry of the result may be off by about
+ * n * 18^levels * DBL_EPSILON * max|a| * max|b| instead of n * DBL_EPSILON * max|a| * max|b|,
+ * where levels is the number of splits. With the default crossover, products up to order 2048
+ * split at most twice.
+ */
+static int strassen_mode = STRASSEN_AUTO;
+static int strassen_crossover = 512;
+
+/*
+ * Selects when square float64 products and powers use Strassen-Winograd (one of the STRASSEN_*
+ * modes), and the largest order they leave to the classic engine. A crossover of 0 or less
+ * keeps the current one.
+ */
+void set_strassen(int mode, int crossover) {
+    strassen_mode = mode;
+    if (crossover > 0) {
+        strassen_crossover = crossover;
+    }
+}
+
+/* Returns the current STRASSEN_* mode */
+int get_strassen_mode(void) {
+    return strassen_mode;
+}
+
+/* Returns the largest order that Strassen-Winograd leaves to the classic engine */
+int get_strassen_crossover(void) {
+    return strassen_crossover;
+}
+
+/* Whether a product of order n uses Strassen-Winograd under the current settings */
+static int use_strassen(int n) {
+    if (strassen_mode == STRASSEN_OFF || n <= strassen_crossover) {
+        return 0;
+    }
+    if (strassen_mode == STRASSEN_AUTO) {
+        for (; n > strassen_crossover; n /= 2) {
+            if (n % 2) {
+                return 0;
+            }
+        }
+    }
+    return 1;
+}
+
+/* Rounds a number of doubles up to a whole number of 64-byte lines, to keep blocks aligned */
+static size_t whole_lines(size_t count) {
+    return (count + 7) / 8 * 8;
+}
+
+/* How strassen_run splits a product of order n, and the workspace that needs */
+typedef struct strassen_plan {
+    int order; // order of the padded product, leaf << levels
+    int leaf; // order of the products left to gemm_run
+    int threads; // number of threads
+    int tasks; // whether the seven products of the first split run as OpenMP tasks
+    gemm_plan leaf_plan; // plan of the leaf products, on a single thread when tasks is set
+    size_t recursion_size; // workspace of one strassen_recurse of order order / 2 if tasks, else order
+} strassen_plan;
+
+/* Plans a Strassen-Winograd product of order n */
+static strassen_plan strassen_make_plan(int n) {
+    strassen_plan plan;
+    int levels = 0;
+    plan.leaf = n;
+    while (plan.leaf > strassen_crossover) {
+        plan.leaf = (plan.leaf + 1) / 2;
+        ++levels;
+    }
+    plan.order = plan.leaf << levels;
+    plan.threads = kernel_threads(KERNEL_GEMM, (double) n * n * n);
+    plan.tasks = plan.threads > 1;
+    plan.leaf_plan = gemm_make_plan(plan.leaf, plan.leaf, plan.leaf, plan.tasks ? 1 : plan.threads);
+    /* Two blocks for each split below the one the workspace is for, then the packing space */
+    plan.recursion_size = whole_lines(gemm_workspace_size(&plan.leaf_plan));
+    for (int h = plan.order / (plan.tasks ? 4 : 2); h >= plan.leaf; h /= 2) {
+        plan.recursion_size += 2 * whole_lines((size_t) h * h);
+    }
+    return plan;
+}
+
+/* Returns the number of doubles of workspace strassen_run needs for `plan` and order n */
+static size_t strassen_workspace_size(strassen_plan *plan, int n) {
+    size_t block = whole_lines((size_t) plan->order * plan->order / 4);
+    size_t size = plan->tasks ? 11 * block + plan->threads * plan->recursion_size : plan->recursion_size;
+    return size + (plan->order != n ? 3 * whole_lines((size_t) plan->order * plan->order) : 0);
+}
+
+/*
+ * Computes the n x n block z = x + y, or x - y if `subtract` is set, on `threads` threads. z may
+ * be x or y.
+ */
+static void block_add(int n, const double *x, long ldx, const double *y, long ldy, double *z, long ldz,
+                      int subtract, int threads) {
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < n; ++i) {
+        const double *x_row = x + (size_t) i * ldx, *y_row = y + (size_t) i * ldy;
+        double *z_row = z + (size_t) i * ldz;
+        int j = 0;
+        if (subtract) {
+            for (; j + 4 <= n; j += 4) {
+                _mm256_storeu_pd(z_row + j, _mm256_sub_pd(_mm256_loadu_pd(x_row + j), _mm256_loadu_pd(y_row + j)));
+            }
+            for (; j < n; ++j) {
+                z_row[j] = x_row[j] - y_row[j];
+            }
+        } else {
+            for (; j + 4 <= n; j += 4) {
+                _mm256_storeu_pd(z_row + j, _mm256_add_pd(_mm256_loadu_pd(x_row + j), _mm256_loadu_pd(y_row + j)));
+            }
+            for (; j < n; ++j) {
+                z_row[j] = x_row[j] + y_row[j];
+            }
+        }
+    }
+}
+
+/*
+ * Computes c = a * b of order n, which must be plan->leaf times a power of two, with rows lda,
+ * ldb and ldc doubles apart. c must not overlap a or b. `work` must be 64-byte aligned and hold
+ * the two blocks of each split below n and the packing space of the leaf products. Additions run
+ * on `threads` threads, and the leaf products as planned.
+ *
+ * The blocks are scheduled so that two temporaries suffice, x for the sums of blocks of a and
+ * then the product a11 * b11, and y for the sums of blocks of b (Boyer, Dumas, Pernet and Zhou,
+ * "Memory efficient scheduling of Strassen-Winograd's matrix multiplication algorithm", 2009).
+ */
+static void strassen_recurse(strassen_plan *plan, int n, const double *a, long lda, const double *b,
+                             long ldb, double *c, long ldc, double *work, int threads) {
+    if (n == plan->leaf) {
+        gemm_run(&plan->leaf_plan, n, n, n, a, lda, 1, b, ldb, 1, c, ldc, work);
+        return;
+    }
+    int h = n / 2;
+    const double *a11 = a, *a12 = a + h, *a21 = a + (size_t) h * lda, *a22 = a21 + h;
+    const double *b11 = b, *b12 = b + h, *b21 = b + (size_t) h * ldb, *b22 = b21 + h;
+    double *c11 = c, *c12 = c + h, *c21 = c + (size_t) h * ldc, *c22 = c21 + h;
+    double *x = work, *y = work + whole_lines((size_t) h * h);
+    double *rest = y + whole_lines((size_t) h * h);
+    int add_threads = threads > 1 ? kernel_threads(KERNEL_ELEMENTWISE, (double) h * h) : 1;
+
+    block_add(h, a11, lda, a21, lda, x, h, 1, add_threads); // s3
+    block_add(h, b22, ldb, b12, ldb, y, h, 1, add_threads); // t3
+    strassen_recurse(plan, h, x, h, y, h, c21, ldc, rest, threads); // p7 = s3 * t3
+    block_add(h, a21, lda, a22, lda, x, h, 0, add_threads); // s1
+    block_add(h, b12, ldb, b11, ldb, y, h, 1, add_threads); // t1
+    strassen_recurse(plan, h, x, h, y, h, c22, ldc, rest, threads); // p5 = s1 * t1
+    block_add(h, x, h, a11, lda, x, h, 1, add_threads); // s2 = s1 - a11
+    block_add(h, b22, ldb, y, h, y, h, 1, add_threads); // t2 = b22 - t1
+    strassen_recurse(plan, h, x, h, y, h, c12, ldc, rest, threads); // p6 = s2 * t2
+    block_add(h, a12, lda, x, h, x, h, 1, add_threads); // s4 = a12 - s2
+    strassen_recurse(plan, h, x, h, b22, ldb, c11, ldc, rest, threads); // p3 = s4 * b22
+    strassen_recurse(plan, h, a11, lda, b11, ldb, x, h, rest, threads); // p1
+    block_add(h, x, h, c12, ldc, c12, ldc, 0, add_threads); // u2 = p1 + p6
+    block_add(h, c12, ldc, c21, ldc, c21, ldc, 0, add_threads); // u3 = u2 + p7
+    block_add(h, c12, ldc, c22, ldc, c12, ldc, 0, add_threads); // u4 = u2 + p5
+    block_add(h, c21, ldc, c22, ldc, c22, ldc, 0, add_threads); // u7 = u3 + p5, c22
+    block_add(h, c12, ldc, c11, ldc, c12, ldc, 0, add_threads); // u5 = u4 + p3, c12
+    block_add(h, y, h, b21, ldb, y, h, 1, add_threads); // t4 = t2 - b21
+    strassen_recurse(plan, h, a22, lda, y, h, c11, ldc, rest, threads); // p4 = a22 * t4
+    block_add(h, c21, ldc, c11, ldc, c21, ldc, 1, add_threads); // u6 = u3 - p4, c21
+    strassen_recurse(plan, h, a12, lda, b21, ldb, c11, ldc, rest, threads); // p2
+    block_add(h, x, h, c11, ldc, c11, ldc, 0, add_threads); // u1 = p1 + p2, c11
+}
+
+/*
+ * The first split of strassen_recurse with its seven block products run as OpenMP tasks, each
+ * on a single thread with its own temporaries. This needs 11 blocks of order n / 2 for the sums
+ * and the products that do not go straight into c, and a workspace of strassen_recurse per thread.
+ */
+static void strassen_tasks(strassen_plan *plan, int n, const double *a, long lda, const double *b,
+                           long ldb, double *c, long ldc, double *work) {
+    int h = n / 2, add_threads = kernel_threads(KERNEL_ELEMENTWISE, (double) h * h);
+    const double *a11 = a, *a12 = a + h, *a21 = a + (size_t) h * lda, *a22 = a21 + h;
+    const double *b11 = b, *b12 = b + h, *b21 = b + (size_t) h * ldb, *b22 = b21 + h;
+    double *c11 = c, *c12 = c + h, *c21 = c + (size_t) h * ldc, *c22 = c21 + h;
+    size_t block = whole_lines((size_t) h * h);
+    double *s1 = work, *s2 = s1 + block, *s3 = s2 + block, *s4 = s3 + block;
+    double *t1 = s4 + block, *t2 = t1 + block, *t3 = t2 + block, *t4 = t3 + block;
+    double *p1 = t4 + block, *p6 = p1 + block, *p7 = p6 + block, *thread_work = p7 + block;
+
+    block_add(h, a21, lda, a22, lda, s1, h, 0, add_threads);
+    block_add(h, s1, h, a11, lda, s2, h, 1, add_threads);
+    block_add(h, a11, lda, a21, lda, s3, h, 1, add_threads);
+    block_add(h, a12, lda, s2, h, s4, h, 1, add_threads);
+    block_add(h, b12, ldb, b11, ldb, t1, h, 1, add_threads);
+    block_add(h, b22, ldb, t1, h, t2, h, 1, add_threads);
+    block_add(h, b22, ldb, b12, ldb, t3, h, 1, add_threads);
+    block_add(h, t2, h, b21, ldb, t4, h, 1, add_threads);
+
+    const double *lhs[7] = {a11, a12, s4, a22, s1, s2, s3};
+    const double *rhs[7] = {b11, b21, b22, t4, t1, t2, t3};
+    long lhs_ld[7] = {lda, lda, h, lda, h, h, h}, rhs_ld[7] = {ldb, ldb, ldb, h, h, h, h};
+    double *products[7] = {p1, c11, c12, c21, c22, p6, p7};
+    long product_ld[7] = {h, ldc, ldc, ldc, ldc, h, h};
+    #pragma omp parallel num_threads(plan->threads)
+    #pragma omp single
+    for (int i = 0; i < 7; ++i) {
+        #pragma omp task firstprivate(i)
+        {
+            /* Tied tasks never move between threads, so the workspace of a thread is its own */
+            double *local = thread_work + (size_t) omp_get_thread_num() * plan->recursion_size;
+            strassen_recurse(plan, h, lhs[i], lhs_ld[i], rhs[i], rhs_ld[i], products[i], product_ld[i], local, 1);
+        }
+    }
+
+    block_add(h, c11, ldc, p1, h, c11, ldc, 0, add_threads); // u1 = p2 + p1
+    block_add(h, p6, h, p1, h, p6, h, 0, add_threads); // u2 = p1 + p6
+    block_add(h, c12, ldc, c22, ldc, c12, ldc, 0, add_threads); // p3 + p5
+    block_add(h, c12, ldc, p6, h, c12, ldc, 0, add_threads); // u5 = u2 + p5 + p3
+    block_add(h, p7, h, p6, h, p7, h, 0, add_threads); // u3 = u2 + p7
+    block_add(h, c22, ldc, p7, h, c22, ldc, 0, add_threads); // u7 = u3 + p5
+    block_add(h, p7, h, c21, ldc, c21, ldc, 1, add_threads); // u6 = u3 - p4
+}
+
+/*
+ * Computes c = a * b of order n with Strassen-Winograd, with rows lda, ldb and ldc doubles
+ * apart. c must not overlap a or b. `plan` must come from strassen_make_plan(n) and `work` must
+ * be 64-byte aligned and hold strassen_workspace_size(plan, n) doubles.
+ */
+static void strassen_run(strassen_plan *plan, int n, const double *a, long lda, const double *b,
+                         long ldb, double *c, long ldc, double *work) {
+    int order = plan->order;
+    if (order != n) {
+        /* Pad the operands with zeros up to the planned order */
+        size_t size = whole_lines((size_t) order * order);
+        double *padded_a = work, *padded_b = work + size, *padded_c = work + 2 * size;
+        memset(work, 0, 2 * size * sizeof(double));
+        for (int i = 0; i < n; ++i) {
+            memcpy(padded_a + (size_t) i * order, a + (size_t) i * lda, n * sizeof(double));
+            memcpy(padded_b + (size_t) i * order, b + (size_t) i * ldb, n * sizeof(double));
+        }
+        strassen_run(plan, order, padded_a, order, padded_b, order, padded_c, order, work + 3 * size);
+        for (int i = 0; i < n; ++i) {
+            memcpy(c + (size_t) i * ldc, padded_c + (size_t) i * order, n * sizeof(double));
+        }
+    } else if (plan->tasks) {
+        strassen_tasks(plan, n, a, lda, b, ldb, c, ldc, work);
+    } else {
+        strassen_recurse(plan, n, a, lda, b, ldb, c, ldc, work, plan->threads);
+    }
+}
+
+/*
+ * mul_matrix for square float64 matrices whose entries within a row are adjacent, with
+ * Strassen-Winograd. Returns -2 if allocating workspace fails and 0 otherwise.
+ */
+static int strassen_mul(matrix *result, matrix *mat1, matrix *mat2) {
+    int n = result->rows;
+    strassen_plan plan = strassen_make_plan(n);
+    int scratch = overlaps(result, mat1) || overlaps(result, mat2) || result->col_stride != 1;
+    size_t work_size = strassen_workspace_size(&plan, n);
+    double *work = pool_alloc(work_size + (scratch ? (size_t) n * n : 0));
+    if (work == NULL) {
+        return -2;
+    }
+    double *c = scratch ? work + work_size : result->data;
+    long ldc = scratch ? n : result->row_stride;
+    strassen_run(&plan, n, mat1->data, mat1->row_stride, mat2->data, mat2->row_stride, c, ldc, work);
+    int failed = 0;
+    if (scratch) {
+        matrix product = wrap_buffer(c, n, n);
+        failed = copy_matrix(result, &product);
+    }
+    pool_free(work);
+    return failed;
+}
+
+/*
+ * Products of float32 or int32 matrices use a simpler engine than the float64 one: each row of
+ * the result is accumulated in place from the rows of mat2, scaled by the entries of the
+ * matching row of mat1, 8 float32 or 4 int32 entries at a time. int32 products wrap around
+ * like numpy's. The rows of mat2 and of c must be contiguous. Rows are split between threads.
+ */
+static void gemm_ps(int m, int n, int k, const float *a, long rsa, long csa, const float *b, long ldb,
+                    float *c, long ldc) {
+    int threads = kernel_threads(KERNEL_GEMM, (double) m * n * k);
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < m; ++i) {
+        float *row = c + (size_t) i * ldc;
+        memset(row, 0, n * sizeof(float));
+        for (int p = 0; p < k; ++p) {
+            float scale = a[(size_t) i * rsa + (size_t) p * csa];
+            const float *src = b + (size_t) p * ldb;
+            __m256 scale_all = _mm256_set1_ps(scale);
+            int j = 0;
+            for (; j + 8 <= n; j += 8) {
+                _mm256_storeu_ps(row + j, _mm256_fmadd_ps(scale_all, _mm256_loadu_ps(src + j),
+                                                         _mm256_loadu_ps(row + j)));
+            }
+            for (; j < n; ++j) {
+                row[j] += scale * src[j];
+            }
+        }
+    }
+}
+
+/* int32 version of gemm_ps */
+static void gemm_epi32(int m, int n, int k, const int32_t *a, long rsa, long csa, const int32_t *b,
+                       long ldb, int32_t *c, long ldc) {
+    int threads = kernel_threads(KERNEL_GEMM, (double) m * n * k);
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < m; ++i) {
+        int32_t *row = c + (size_t) i * ldc;
+        memset(row, 0, n * sizeof(int32_t));
+        for (int p = 0; p < k; ++p) {
+            uint32_t scale = a[(size_t) i * rsa + (size_t) p * csa];
+            const int32_t *src = b + (size_t) p * ldb;
+            __m128i scale_all = _mm_set1_epi32(scale);
+            int j = 0;
+            for (; j + 4 <= n; j += 4) {
+                __m128i product = _mm_mullo_epi32(scale_all, _mm_loadu_si128((const __m128i *) (src + j)));
+                _mm_storeu_si128((__m128i *) (row + j),
+                                 _mm_add_epi32(product, _mm_loadu_si128((const __m128i *) (row + j))));
+            }
+            for (; j < n; ++j) {
+                row[j] = (uint32_t) row[j] + scale * (uint32_t) src[j];
+            }
+        }
+    }
+}
+
+/*
+ * Computes the product of float32 or int32 matrices with gemm_ps or gemm_epi32. mat2 is packed
+ * first unless its rows are contiguous, and the product goes through a scratch buffer unless
+ * result's rows are contiguous and it does not overlap either operand.
+ */
+static int mul_typed(matrix *result, matrix *mat1, matrix *mat2) {
+    int rows = mat1->rows, mids = mat1->cols, cols = mat2->cols, dtype = result->dtype;
+    int pack_b = cols > 1 && mat2->col_stride != 1;
+    int own_result = overlaps(result, mat1) || overlaps(result, mat2) || (cols > 1 && result->col_stride != 1);
+    size_t b_size = pack_b ? (size_t) mids * cols : 0;
+    double *work = NULL;
+    if (pack_b || own_result) {
+        /* A double holds two entries, so this is twice what is needed */
+        work = pool_alloc(b_size + (own_result ? (size_t) rows * cols : 0));
+        if (work == NULL) {
+            return -2;
+        }
+    }
+    matrix b = *mat2, c = *result;
+    if (pack_b) {
+        b = wrap_typed(work, mids, cols, dtype);
+        copy_matrix(&b, mat2);
+    }
+    if (own_result) {
+        c = wrap_typed(work + b_size, rows, cols, dtype);
+    }
+    if (dtype == DTYPE_FLOAT32) {
+        gemm_ps(rows, cols, mids, mat1->fdata, mat1->row_stride, mat1->col_stride, b.fdata, b.row_stride,
+                c.fdata, c.row_stride);
+    } else {
+        gemm_epi32(rows, cols, mids, mat1->idata, mat1->row_stride, mat1->col_stride, b.idata, b.row_stride,
+                   c.idata, c.row_stride);
+    }
+    if (own_result) {
+        copy_matrix(result, &c);
+    }
+    pool_free(work);
+    return 0;
+}
+
+/*
+ * Store the result of multiplying mat1 and mat2 to `result`.
+ * `result` must already be mat1->rows x mat2->cols. If it shares memory with either
+ * operand, or its entries within a row are not adjacent, the product is computed into a
+ * scratch buffer and copied back. float32 and int32 products run natively when all three
+ * matrices share their dtype, see mul_typed. Large square float64 products may use
+ * Strassen-Winograd, see set_strassen.
+ * Return 0 upon success and a nonzero value upon failure.
+ * Remember that matrix multiplication is not the same as multiplying individual elements.
+ */
+int mul_matrix(matrix *result, matrix *mat1, matrix *mat2) {
+    if (mat1->cols != mat2->rows) {
+        return -101;
+    }
+    int rows = mat1->rows, mids = mat1->cols, cols = mat2->cols;
+    if (result->rows != rows || result->cols != cols) {
+        return -101;
+    }
+    if (!same_dtype(result, mat1, mat2)) {
+        widened w;
+        matrix *operands[] = {mat1, mat2};
+        return widen(&w, result, operands, 2) ? -2 : narrow(&w, mul_matrix(&w.result, &w.mats[0], &w.mats[1]));
+    }
+    if (result->dtype != DTYPE_FLOAT64) {
+        return mul_typed(result, mat1, mat2);
+    }
+    if (rows == cols && cols == mids && use_strassen(rows) && mat1->col_stride == 1 && mat2->col_stride == 1) {
+        return strassen_mul(result, mat1, mat2);
+    }
+    if (!overlaps(result, mat1) && !overlaps(result, mat2) && (cols == 1 || result->col_stride == 1)) {
+        return gemm(rows, cols, mids, mat1->data, mat1->row_stride, mat1->col_stride,
+                    mat2->data, mat2->row_stride, mat2->col_stride, result->data, result->row_stride);
+    }
+
+    double *data = pool_alloc((size_t) rows * cols);
+    if (data == NULL) {
+        return -2;
+    }
+    int failed = gemm(rows, cols, mids, mat1->data, mat1->row_stride, mat1->col_stride,
+                      mat2->data, mat2->row_stride, mat2->col_stride, data, cols);
+    if (!failed) {
+        matrix product = wrap_buffer(data, rows, cols);
+        failed = copy_matrix(result, &product);
+    }
+    pool_free(data);
+    return failed;
+}
+
+/*
+ * Computes results[i] = mat1s[i] * mat2s[i] for each of the `n` pairs. Every result must
+ * already have the right shape, be contiguous and not share memory with any operand.
+ * Returns -101 if any shapes do not match, before computing anything, -2 if allocating
+ * workspace fails and 0 upon success.
+ *
+ * When there are at least as many pairs as threads, each thread takes whole products in turn
+ * and runs them on its own, reusing one workspace sized for the largest product. Small
+ * products are then computed without any synchronization between threads. Otherwise, the
+ * products run one after another, each split between all threads.
+ */
+int batch_mul_matrix(matrix **results, matrix **mat1s, matrix **mat2s, int n) {
+    size_t work_size = 0;
+    for (int i = 0; i < n; ++i) {
+        matrix *result = results[i], *mat1 = mat1s[i], *mat2 = mat2s[i];
+        if (mat1->cols != mat2->rows || result->rows != mat1->rows || result->cols != mat2->cols) {
+            return -101;
+        }
+        gemm_plan plan = gemm_make_plan(mat1->rows, mat2->cols, mat1->cols, 1);
+        size_t size = gemm_workspace_size(&plan);
+        work_size = size > work_size ? size : work_size;
+    }
+
+    int threads = get_num_threads();
+    int all_float64 = 1;
+    for (int i = 0; i < n; ++i) {
+        all_float64 &= results[i]->dtype == DTYPE_FLOAT64 && mat1s[i]->dtype == DTYPE_FLOAT64 &&
+                       mat2s[i]->dtype == DTYPE_FLOAT64;
+    }
+    if (n < threads || threads == 1 || !all_float64) {
+        for (int i = 0; i < n; ++i) {
+            int failed = mul_matrix(results[i], mat1s[i], mat2s[i]);
+            if (failed) {
+                return failed;
+            }
+        }
+        return 0;
+    }
+
+    int failed = 0;
+    #pragma omp parallel num_threads(threads)
+    {
+        double *work = pool_alloc(work_size);
+        if (work == NULL) {
+            #pragma omp atomic write
+            failed = -2;
+        }
+        #pragma omp barrier
+        if (!failed) {
+            #pragma omp for schedule(dynamic)
+            for (int i = 0; i < n; ++i) {
+                matrix *result = results[i], *mat1 = mat1s[i], *mat2 = mat2s[i];
+                gemm_plan plan = gemm_make_plan(mat1->rows, mat2->cols, mat1->cols, 1);
+                gemm_run(&plan, mat1->rows, mat2->cols, mat1->cols,
+                         mat1->data, mat1->row_stride, mat1->col_stride,
+                         mat2->data, mat2->row_stride, mat2->col_stride,
+                         result->data, result->row_stride, work);
+            }
+        }
+        pool_free(work);
+    }
+    return failed;
+}
+
+/*
+ * Stores the inverse of the n x n matrix `a` into `inv` by Gauss-Jordan elimination with
+ * partial pivoting. `a` is overwritten. Returns -103 if the matrix is singular to working
+ * precision and 0 upon success.
+ */
+static int invert(int n, double *a, double *inv) {
+    double scale = 0;
+    for (size_t i = 0; i < (size_t) n * n; ++i) {
+        double v = a[i] >= 0 ? a[i] : -a[i];
+        scale = v > scale ? v : scale;
+    }
+    memset(inv, 0, (size_t) n * n * sizeof(double));
+    for (int i = 0; i < n; ++i) {
+        inv[(size_t) i * n + i] = 1;
+    }
+    int threads = kernel_threads(KERNEL_INVERT, n);
+
+    for (int col = 0; col < n; ++col) {
+        int pivot = col;
+        double best = 0;
+        for (int r = col; r < n; ++r) {
+            double v = a[(size_t) r * n + col];
+            v = v >= 0 ? v : -v;
+            if (v > best) {
+                best = v;
+                pivot = r;
+            }
+        }
+        if (best <= scale * n * DBL_EPSILON) {
+            return -103;
+        }
+        if (pivot != col) {
+            for (int c = 0; c < n; ++c) {
+                double t = a[(size_t) pivot * n + c];
+                a[(size_t) pivot * n + c] = a[(size_t) col * n + c];
+                a[(size_t) col * n + c] = t;
+                t = inv[(size_t) pivot * n + c];
+                inv[(size_t) pivot * n + c] = inv[(size_t) col * n + c];
+                inv[(size_t) col * n + c] = t;
+            }
+        }
+
+        double *a_row = a + (size_t) col * n, *inv_row = inv + (size_t) col * n;
+        double factor = 1 / a_row[col];
+        for (int c = 0; c < n; ++c) {
+            a_row[c] *= factor;
+            inv_row[c] *= factor;
+        }
+        #pragma omp parallel for num_threads(threads) if(threads > 1)
+        for (int r = 0; r < n; ++r) {
+            double f = a[(size_t) r * n + col];
+            if (r == col || f == 0) {
+                continue;
+            }
+            double *a_r = a + (size_t) r * n, *inv_r = inv + (size_t) r * n;
+            for (int c = 0; c < n; ++c) {
+                a_r[c] -= f * a_row[c];
+                inv_r[c] -= f * inv_row[c];
+            }
+        }
+    }
+    return 0;
+}
+
+/*
+ * Computes c = a * b of order n for pow_matrix, with Strassen-Winograd planned by `fast`, or
+ * gemm_run planned by `plan` if fast is NULL. `work` is the workspace of the chosen engine.
+ */
+static void power_product(gemm_plan *plan, strassen_plan *fast, int n, const double *a, const double *b,
+                          double *c, double *work) {
+    if (fast != NULL) {
+        strassen_run(fast, n, a, n, b, n, c, n, work);
+    } else {
+        gemm_run(plan, n, n, n, a, n, 1, b, n, 1, c, n, work);
+    }
+}
+
+/* Returns the one of the three ping-pong buffers of pow_matrix that is neither base nor acc */
+static double *free_buffer(double **buffers, const double *base, const double *acc) {
+    for (int i = 0; i < 2; ++i) {
+        if (buffers[i] != base && buffers[i] != acc) {
+            return buffers[i];
+        }
+    }
+    return buffers[2];
+}
+
+/*
+ * Raises the int32 matrix mat to the (pow)th power, pow > 1, into the int32 `result` by binary
+ * exponentiation with mul_typed, so that products wrap around exactly as repeated `*` does.
+ * Squares and partial products ping-pong between three n x n buffers.
+ */
+static int pow_epi32(matrix *result, matrix *mat, unsigned int pow) {
+    int n = mat->rows;
+    size_t half = (size_t) n * n / 2 + 1;
+    double *work = pool_alloc(3 * half);
+    if (work == NULL) {
+        return -2;
+    }
+    matrix buffers[3];
+    for (int i = 0; i < 3; ++i) {
+        buffers[i] = wrap_typed(work + i * half, n, n, DTYPE_INT32);
+    }
+
+    matrix *base = mat, *acc = NULL;
+    int failed = 0;
+    while (pow && !failed) {
+        if (pow & 1) {
+            if (acc == NULL) {
+                acc = base;
+            } else {
+                matrix *dst = &buffers[0];
+                while (dst == base || dst == acc) {
+                    dst++;
+                }
+                failed = mul_typed(dst, acc, base);
+                acc = dst;
+            }
+        }
+        pow >>= 1;
+        if (pow && !failed) {
+            matrix *dst = &buffers[0];
+            while (dst == base || dst == acc) {
+                dst++;
+            }
+            failed = mul_typed(dst, base, base);
+            base = dst;
+        }
+    }
+    if (!failed) {
+        copy_matrix(result, acc);
+    }
+    pool_free(work);
+    return failed;
+}
+
+/*
+ * Store the result of raising mat to the (pow)th power to `result`.
+ * `result` must already have the shape of mat and may be mat itself.
+ * pow 0 gives the identity and a negative pow raises the inverse of mat to -pow.
+ * float32 matrices, and int32 ones for pow < 2, are powered in float64 and rounded at the end.
+ * Positive int32 powers use the native int32 product and wrap around like repeated `*`, see
+ * pow_epi32.
+ * Return -103 if pow is negative and mat is singular, -2 if allocating memory fails,
+ * another nonzero value upon other failures, and 0 upon success.
+ * Remember that pow is defined with matrix multiplication, not element-wise multiplication.
+ *
+ * Squares and partial products ping-pong between three n x n buffers: two work buffers
+ * allocated once, plus the data of `result` itself whenever that is contiguous and does not
+ * overlap mat. The workspace of the multiply engine, Strassen-Winograd for large orders (see
+ * set_strassen), is also allocated once and reused by every product. mat is only ever read, so unless it is a view with gaps its data serves as
+ * the first base and partial product without being copied, and the last squaring, whose
+ * result would be unused, is skipped.
+ */
+int pow_matrix(matrix *result, matrix *mat, int pow) {
+    if (result->rows != mat->rows || result->cols != mat->cols || mat->rows != mat->cols) {
+        return -102;
+    }
+    if (result->dtype != DTYPE_FLOAT64 || mat->dtype != DTYPE_FLOAT64) {
+        if (pow > 1 && result->dtype == DTYPE_INT32 && mat->dtype == DTYPE_INT32) {
+            return pow_epi32(result, mat, pow);
+        }
+        widened w;
+        return widen(&w, result, &mat, 1) ? -2 : narrow(&w, pow_matrix(&w.result, &w.mats[0], pow));
+    }
+    int n = mat->rows;
+    size_t size = (size_t) n * n;
+    if (pow == 0) {
+        fill_matrix(result, 0);
+        for (int i = 0; i < n; ++i) {
+            set(result, i, i, 1);
+        }
+        return 0;
+    }
+    if (pow == 1) {
+        return copy_matrix(result, mat);
+    }
+
+    gemm_plan plan = gemm_make_plan(n, n, n, get_num_threads());
+    strassen_plan fast_plan, *fast = NULL;
+    if (use_strassen(n)) {
+        fast_plan = strassen_make_plan(n);
+        fast = &fast_plan;
+    }
+    int own_result = overlaps(result, mat) || !is_contiguous(result);
+    /* Keep every buffer, and in particular the packing workspace, 64-byte aligned */
+    size_t stride = whole_lines(size);
+    size_t product_size = fast != NULL ? strassen_workspace_size(fast, n) : gemm_workspace_size(&plan);
+    double *work = pool_alloc(stride * (2 + own_result) + product_size);
+    if (work == NULL) {
+        return -2;
+    }
+    double *buffers[3] = {work, work + stride, own_result ? work + 2 * stride : result->data};
+    double *gemm_work = work + stride * (2 + own_result);
+
+    const double *base = mat->data, *acc = NULL;
+    unsigned int remaining = pow < 0 ? -(unsigned int) pow : (unsigned int) pow;
+    matrix first = wrap_buffer(buffers[0], n, n);
+    if (pow < 0 || !is_contiguous(mat)) {
+        copy_matrix(&first, mat);
+        base = buffers[0];
+    }
+    if (pow < 0) {
+        if (invert(n, buffers[0], buffers[1])) {
+            pool_free(work);
+            return -103;
+        }
+        base = buffers[1];
+    }
+
+    while (remaining) {
+        if (remaining & 1) {
+            if (acc == NULL) {
+                acc = base;
+            } else {
+                double *dst = free_buffer(buffers, base, acc);
+                power_product(&plan, fast, n, acc, base, dst, gemm_work);
+                acc = dst;
+            }
+        }
+        remaining >>= 1;
+        if (remaining) {
+            double *dst = free_buffer(buffers, base, acc);
+            power_product(&plan, fast, n, base, base, dst, gemm_work);
+            base = dst;
+        }
+    }
+
+    if (acc != result->data) {
+        matrix power = wrap_buffer((double *) acc, n, n);
+        copy_matrix(result, &power);
+    }
+    pool_free(work);
+    return 0;
+}
+
+/*
+ * Reductions over all entries split them into blocks of REDUCE_BLOCK entries and combine the
+ * block results along a fixed binary tree: a range of more than one block is split after the
+ * largest power-of-two number of blocks it holds. Ranges of REDUCE_CHUNK entries starting at a
+ * multiple of REDUCE_CHUNK are therefore subtrees, which lets threads reduce chunks
+ * independently and the results are bitwise identical for any number of threads.
+ */
+#define REDUCE_BLOCK 1024
+#define REDUCE_CHUNK (REDUCE_BLOCK * 64)
+/* Number of columns whose running results are kept at a time in column reductions */
+#define REDUCE_COLS 512
+
+/* The result of reducing a range of entries: their sum, or the selected entry and its index */
+typedef struct reduction {
+    double value;
+    long index;
+} reduction;
+
+/* Whether `x` should replace `best` for REDUCE_MIN, REDUCE_MAX and REDUCE_ARGMAX, NaN winning */
+static inline int reduce_better(int op, double x, double best) {
+    if (x != x) {
+        return best == best;
+    }
+    return op == REDUCE_MIN ? x < best : x > best;
+}
+
+/* Vector version of reduce_better, returning an all-ones lane where x should replace best */
+static inline __m256d reduce_better_pd(int op, __m256d x, __m256d best) {
+    __m256d x_nan = _mm256_cmp_pd(x, x, _CMP_UNORD_Q);
+    __m256d best_nan = _mm256_cmp_pd(best, best, _CMP_UNORD_Q);
+    __m256d better = op == REDUCE_MIN ? _mm256_cmp_pd(x, best, _CMP_LT_OQ) : _mm256_cmp_pd(x, best, _CMP_GT_OQ);
+    return _mm256_or_pd(better, _mm256_andnot_pd(best_nan, x_nan));
+}
+
+/* Combines the reductions of two adjacent ranges, `left` coming first */
+static inline reduction reduce_combine(int op, reduction left, reduction right) {
+    if (op == REDUCE_SUM || op == REDUCE_MEAN) {
+        left.value += right.value;
+        return left;
+    }
+    return reduce_better(op, right.value, left.value) ? right : left;
+}
+
+/* Reduces the `len` entries of one block, whose first entry has index `start` */
+static reduction reduce_block(int op, const double *data, int len, long start) {
+    reduction rv = {0, start};
+    int i = 0;
+    if (op == REDUCE_SUM || op == REDUCE_MEAN) {
+        __m256d acc0 = _mm256_setzero_pd(), acc1 = _mm256_setzero_pd();
+        __m256d acc2 = _mm256_setzero_pd(), acc3 = _mm256_setzero_pd();
+        for (; i + 16 <= len; i += 16) {
+            acc0 = _mm256_add_pd(acc0, _mm256_loadu_pd(data + i));
+            acc1 = _mm256_add_pd(acc1, _mm256_loadu_pd(data + i + 4));
+            acc2 = _mm256_add_pd(acc2, _mm256_loadu_pd(data + i + 8));
+            acc3 = _mm256_add_pd(acc3, _mm256_loadu_pd(data + i + 12));
+        }
+        double lanes[4];
+        _mm256_storeu_pd(lanes, _mm256_add_pd(_mm256_add_pd(acc0, acc1), _mm256_add_pd(acc2, acc3)));
+        rv.value = (lanes[0] + lanes[1]) + (lanes[2] + lanes[3]);
+        for (; i < len; ++i) {
+            rv.value += data[i];
+        }
+        return rv;
+    }
+
+    /* Find the smallest or largest value, and separately whether there is a NaN */
+    int min = op == REDUCE_MIN, has_nan = data[0] != data[0];
+    rv.value = data[0];
+    if (len >= 16) {
+        __m256d best0 = _mm256_loadu_pd(data), best1 = _mm256_loadu_pd(data + 4);
+        __m256d best2 = _mm256_loadu_pd(data + 8), best3 = _mm256_loadu_pd(data + 12);
+        __m256d nan = _mm256_or_pd(_mm256_cmp_pd(best0, best1, _CMP_UNORD_Q),
+                                   _mm256_cmp_pd(best2, best3, _CMP_UNORD_Q));
+        for (i = 16; i + 16 <= len; i += 16) {
+            __m256d x0 = _mm256_loadu_pd(data + i), x1 = _mm256_loadu_pd(data + i + 4);
+            __m256d x2 = _mm256_loadu_pd(data + i + 8), x3 = _mm256_loadu_pd(data + i + 12);
+            nan = _mm256_or_pd(nan, _mm256_or_pd(_mm256_cmp_pd(x0, x1, _CMP_UNORD_Q),
+                                                 _mm256_cmp_pd(x2, x3, _CMP_UNORD_Q)));
+            if (min) {
+                best0 = _mm256_min_pd(best0, x0);
+                best1 = _mm256_min_pd(best1, x1);
+                best2 = _mm256_min_pd(best2, x2);
+                best3 = _mm256_min_pd(best3, x3);
+            } else {
+                best0 = _mm256_max_pd(best0, x0);
+                best1 = _mm256_max_pd(best1, x1);
+                best2 = _mm256_max_pd(best2, x2);
+                best3 = _mm256_max_pd(best3, x3);
+            }
+        }
+        if (min) {
+            best0 = _mm256_min_pd(_mm256_min_pd(best0, best1), _mm256_min_pd(best2, best3));
+        } else {
+            best0 = _mm256_max_pd(_mm256_max_pd(best0, best1), _mm256_max_pd(best2, best3));
+        }
+        double lanes[4];
+        _mm256_storeu_pd(lanes, best0);
+        rv.value = lanes[0];
+        for (int k = 1; k < 4; ++k) {
+            if (min ? lanes[k] < rv.value : lanes[k] > rv.value) {
+                rv.value = lanes[k];
+            }
+        }
+        has_nan = _mm256_movemask_pd(nan) != 0;
+    }
+    for (i = i == 0 ? 1 : i; i < len; ++i) {
+        if (data[i] != data[i]) {
+            has_nan = 1;
+        } else if (min ? data[i] < rv.value : data[i] > rv.value) {
+            rv.value = data[i];
+        }
+    }
+    if (op != REDUCE_ARGMAX && !has_nan) {
+        return rv;
+    }
+
+    /* Find the first entry equal to the value found, or the first NaN */
+    __m256d value = _mm256_set1_pd(rv.value);
+    for (i = 0; i + 4 <= len; i += 4) {
+        __m256d x = _mm256_loadu_pd(data + i);
+        int mask = _mm256_movemask_pd(has_nan ? _mm256_cmp_pd(x, x, _CMP_UNORD_Q) : _mm256_cmp_pd(x, value, _CMP_EQ_OQ));
+        if (mask) {
+            i += __builtin_ctz(mask);
+            break;
+        }
+    }
+    for (; i < len && (has_nan ? data[i] == data[i] : data[i] != rv.value); ++i) {
+    }
+    rv.value = data[i];
+    rv.index = start + i;
+    return rv;
+}
+
+/* Reduces the `n` entries from index `start` on along the tree described above */
+static reduction reduce_range(int op, const double *data, long start, long n) {
+    if (n <= REDUCE_BLOCK) {
+        return reduce_block(op, data + start, (int) n, start);
+    }
+    long split = REDUCE_BLOCK;
+    while (split * 2 < n) {
+        split *= 2;
+    }
+    return reduce_combine(op, reduce_range(op, data, start, split),
+                          reduce_range(op, data, start + split, n - split));
+}
+
+/* Combines the `n` chunk reductions in `partial` from `first` on along the same tree */
+static reduction reduce_partials(int op, const reduction *partial, long first, long n) {
+    if (n == 1) {
+        return partial[first];
+    }
+    long split = 1;
+    while (split * 2 < n) {
+        split *= 2;
+    }
+    return reduce_combine(op, reduce_partials(op, partial, first, split),
+                          reduce_partials(op, partial, first + split, n - split));
+}
+
+/* Reduces all `size` entries of `data`, splitting them into chunks among `threads` threads */
+static int reduce_all(int op, const double *data, long size, int threads, reduction *rv) {
+    if (size <= REDUCE_CHUNK) {
+        *rv = reduce_range(op, data, 0, size);
+        return 0;
+    }
+    long n_chunks = (size + REDUCE_CHUNK - 1) / REDUCE_CHUNK;
+    reduction *partial = (reduction *) pool_alloc(n_chunks * (sizeof(reduction) / sizeof(double)));
+    if (partial == NULL) {
+        return -2;
+    }
+    #pragma omp parallel for schedule(static) num_threads(threads) if(threads > 1)
+    for (long c = 0; c < n_chunks; ++c) {
+        long start = c * REDUCE_CHUNK;
+        partial[c] = reduce_range(op, data, start, size - start < REDUCE_CHUNK ? size - start : REDUCE_CHUNK);
+    }
+    *rv = reduce_partials(op, partial, 0, n_chunks);
+    pool_free((double *) partial);
+    return 0;
+}
+
+/*
+ * Reduces the columns cols0 <= j < cols1 of mat over its rows into result (value) and index.
+ * Every column is reduced in row order, so the result does not depend on how the columns are
+ * split among threads.
+ */
+static void reduce_columns(int op, matrix *mat, double *result, double *index, int cols0, int cols1) {
+    int rows = mat->rows, cols = mat->cols;
+    int sum = op == REDUCE_SUM || op == REDUCE_MEAN;
+    memcpy(result + cols0, mat->data + cols0, (cols1 - cols0) * sizeof(double));
+    for (int j = cols0; j < cols1; ++j) {
+        index[j] = 0;
+    }
+    for (int i = 1; i < rows; ++i) {
+        const double *row = mat->data + (size_t) i * cols;
+        __m256d row_index = _mm256_set1_pd(i);
+        int j = cols0;
+        for (; j + 4 <= cols1; j += 4) {
+            __m256d x = _mm256_loadu_pd(row + j), best = _mm256_loadu_pd(result + j);
+            if (sum) {
+                _mm256_storeu_pd(result + j, _mm256_add_pd(best, x));
+            } else {
+                __m256d better = reduce_better_pd(op, x, best);
+                _mm256_storeu_pd(result + j, _mm256_blendv_pd(best, x, better));
+                _mm256_storeu_pd(index + j, _mm256_blendv_pd(_mm256_loadu_pd(index + j), row_index, better));
+            }
+        }
+        for (; j < cols1; ++j) {
+            if (sum) {
+                result[j] += row[j];
+            } else if (reduce_better(op, row[j], result[j])) {
+                result[j] = row[j];
+                index[j] = i;
+            }
+        }
+    }
+}
+
+/*
+ * Store a reduction of mat to `result` for one of the REDUCE_* operations. With axis -1 all
+ * entries are reduced into a 1 x 1 result. With axis 0 each column is reduced into a 1 x cols
+ * result, and with axis 1 each row into a rows x 1 result. REDUCE_ARGMAX stores the index of
+ * the first largest entry: the row-major flat index for axis -1, the row for axis 0 and the
+ * column for axis 1. NaN entries propagate to sums, minima and maxima, and count as largest
+ * for REDUCE_ARGMAX. The result only depends on the data, not on the number of threads.
+ * float32 and int32 matrices are reduced in float64.
+ * Return 0 upon success and a nonzero value upon failure.
+ */
+int reduce_matrix(matrix *result, matrix *mat, int op, int axis) {
+    int rows = mat->rows, cols = mat->cols;
+    int out_rows = axis == 1 ? rows : 1, out_cols = axis == 0 ? cols : 1;
+    if (axis < -1 || axis > 1 || op < REDUCE_SUM || op > REDUCE_ARGMAX) {
+        return -1;
+    }
+    if (result->rows != out_rows || result->cols != out_cols || overlaps(result, mat)) {
+        return -100;
+    }
+    if (result->dtype != DTYPE_FLOAT64 || mat->dtype != DTYPE_FLOAT64) {
+        widened w;
+        return widen(&w, result, &mat, 1) ? -2 : narrow(&w, reduce_matrix(&w.result, &w.mats[0], op, axis));
+    }
+    long size = (long) rows * cols;
+    int threads = kernel_threads(KERNEL_REDUCE, size);
+
+    /* Views with gaps are packed first, so that they reduce exactly like a copy would */
+    matrix source = *mat, target = *result;
+    double *scratch = NULL;
+    if (!is_contiguous(mat) || !is_contiguous(result)) {
+        scratch = pool_alloc(size + out_rows * out_cols);
+        if (scratch == NULL) {
+            return -2;
+        }
+        if (!is_contiguous(mat)) {
+            source = wrap_buffer(scratch, rows, cols);
+            copy_matrix(&source, mat);
+        }
+        if (!is_contiguous(result)) {
+            target = wrap_buffer(scratch + size, out_rows, out_cols);
+        }
+    }
+    double *out = target.data;
+    int failed = 0;
+
+    if (axis == -1) {
+        reduction rv;
+        failed = reduce_all(op, source.data, size, threads, &rv);
+        if (!failed) {
+            out[0] = op == REDUCE_ARGMAX ? (double) rv.index : op == REDUCE_MEAN ? rv.value / size : rv.value;
+        }
+    } else if (axis == 0) {
+        double *index = pool_alloc(cols);
+        if (index == NULL) {
+            pool_free(scratch);
+            return -2;
+        }
+        #pragma omp parallel for num_threads(threads) if(threads > 1) schedule(static)
+        for (int j = 0; j < cols; j += REDUCE_COLS) {
+            int end = cols - j < REDUCE_COLS ? cols : j + REDUCE_COLS;
+            reduce_columns(op, &source, out, index, j, end);
+            for (int k = j; k < end; ++k) {
+                if (op == REDUCE_ARGMAX) {
+                    out[k] = index[k];
+                } else if (op == REDUCE_MEAN) {
+                    out[k] /= rows;
+                }
+            }
+        }
+        pool_free(index);
+    } else {
+        #pragma omp parallel for num_threads(threads) if(threads > 1) schedule(static)
+        for (int i = 0; i < rows; ++i) {
+            reduction rv = reduce_range(op, source.data + (size_t) i * cols, 0, cols);
+            out[i] = op == REDUCE_ARGMAX ? (double) rv.index : op == REDUCE_MEAN ? rv.value / cols : rv.value;
+        }
+    }
+    if (!failed && out != result->data) {
+        copy_matrix(result, &target);
+    }
+    pool_free(scratch);
+    return failed;
+}
+
+/*
+ * Whether x is close to the reference y: equal, or within atol + rtol * |y| of a finite y. NaN
+ * is never close. Raises max_abs and max_rel to the absolute and relative errors of x, leaving
+ * them as they are for NaN errors.
+ */
+static int compare_entry(double x, double y, double rtol, double atol, double *max_abs, double *max_rel) {
+    if (x == y) {
+        return 1;
+    }
+    double err = fabs(x - y), magnitude = fabs(y);
+    if (err > *max_abs) {
+        *max_abs = err;
+    }
+    if (err / magnitude > *max_rel) {
+        *max_rel = err / magnitude;
+    }
+    return err <= fma(rtol, magnitude, atol) && magnitude <= DBL_MAX;
+}
+
+/*
+ * compare_entry on the `cols` entries of two rows, four at a time. Returns the column of the
+ * first entry that is not close, or -1.
+ */
+static int compare_row(const double *a, const double *b, int cols, double rtol, double atol,
+                       double *max_abs, double *max_rel) {
+    __m256d sign = _mm256_set1_pd(-0.0), largest = _mm256_set1_pd(DBL_MAX);
+    __m256d rtol_v = _mm256_set1_pd(rtol), atol_v = _mm256_set1_pd(atol);
+    __m256d abs_acc = _mm256_setzero_pd(), rel_acc = _mm256_setzero_pd();
+    int first = -1, j = 0;
+    for (; j + 4 <= cols; j += 4) {
+        __m256d x = _mm256_loadu_pd(a + j), y = _mm256_loadu_pd(b + j);
+        __m256d equal = _mm256_cmp_pd(x, y, _CMP_EQ_OQ);
+        __m256d magnitude = _mm256_andnot_pd(sign, y);
+        /* Equal entries have no error, even infinite ones whose difference is NaN */
+        __m256d err = _mm256_andnot_pd(equal, _mm256_andnot_pd(sign, _mm256_sub_pd(x, y)));
+        __m256d rel = _mm256_andnot_pd(equal, _mm256_div_pd(err, magnitude));
+        __m256d within = _mm256_and_pd(_mm256_cmp_pd(err, _mm256_fmadd_pd(rtol_v, magnitude, atol_v), _CMP_LE_OQ),
+                                       _mm256_cmp_pd(magnitude, largest, _CMP_LE_OQ));
+        /* max_pd returns its second operand when either is NaN, which skips NaN errors */
+        abs_acc = _mm256_max_pd(err, abs_acc);
+        rel_acc = _mm256_max_pd(rel, rel_acc);
+        int far = _mm256_movemask_pd(_mm256_or_pd(equal, within)) ^ 0xF;
+        if (far && first < 0) {
+            first = j + __builtin_ctz(far);
+        }
+    }
+    double acc[8];
+    _mm256_storeu_pd(acc, abs_acc);
+    _mm256_storeu_pd(acc + 4, rel_acc);
+    for (int k = 0; k < 4; ++k) {
+        *max_abs = acc[k] > *max_abs ? acc[k] : *max_abs;
+        *max_rel = acc[k + 4] > *max_rel ? acc[k + 4] : *max_rel;
+    }
+    for (; j < cols; ++j) {
+        if (!compare_entry(a[j], b[j], rtol, atol, max_abs, max_rel) && first < 0) {
+            first = j;
+        }
+    }
+    return first;
+}
+
+/*
+ * Compares every entry of mat1 with the entry of the reference mat2 at the same position, as
+ * numpy.isclose does: an entry is close if it is equal to the reference or within
+ * atol + rtol * |reference| of a finite one, and NaN is never close. Stores in `result` the
+ * row-major index of the first entry that is not close (-1 if all are), and the largest
+ * absolute and relative errors, ignoring NaN ones. Entries whose reference is 0 have an
+ * infinite relative error. Matrices of any dtype are compared in float64.
+ * Returns 0 upon success and -100 if the shapes differ.
+ */
+int compare_matrix(matrix *mat1, matrix *mat2, double rtol, double atol, comparison *result) {
+    int rows = mat1->rows, cols = mat1->cols;
+    if (rows != mat2->rows || cols != mat2->cols) {
+        return -100;
+    }
+    int fast = mat1->dtype == DTYPE_FLOAT64 && mat2->dtype == DTYPE_FLOAT64 && mat1->col_stride == 1 &&
+               mat2->col_stride == 1;
+    long first = LONG_MAX;
+    double max_abs = 0, max_rel = 0;
+    int threads = kernel_threads(KERNEL_REDUCE, (long) rows * cols);
+    #pragma omp parallel for num_threads(threads) if(threads > 1) schedule(static) \
+        reduction(min:first) reduction(max:max_abs, max_rel)
+    for (int i = 0; i < rows; ++i) {
+        int j = -1;
+        if (fast) {
+            j = compare_row(mat1->data + (long) i * mat1->row_stride, mat2->data + (long) i * mat2->row_stride,
+                            cols, rtol, atol, &max_abs, &max_rel);
+        } else {
+            for (int k = 0; k < cols; ++k) {
+                if (!compare_entry(get(mat1, i, k), get(mat2, i, k), rtol, atol, &max_abs, &max_rel) && j < 0) {
+                    j = k;
+                }
+            }
+        }
+        if (j >= 0 && (long) i * cols + j < first) {
+            first = (long) i * cols + j;
+        }
+    }
+    result->mismatch = first == LONG_MAX ? -1 : first;
+    result->max_abs_err = max_abs > 0 ? max_abs : 0;
+    result->max_rel_err = max_rel > 0 ? max_rel : 0;
+    return 0;
+}
+
+/* Number of entries each fused instruction processes at a time. Keeps the stack in L1. */
+#define FUSED_BLOCK 512
+
+/* Applies one fused instruction to `len` entries: dst = a op b, or dst = op a */
+static void fused_apply(int op, double *dst, const double *a, const double *b, int len) {
+    __m256d sign = _mm256_set1_pd(-0.0);
+    int i = 0;
+    switch (op) {
+        case FUSED_ADD:
+            for (; i + 4 <= len; i += 4) {
+                _mm256_storeu_pd(dst + i, _mm256_add_pd(_mm256_loadu_pd(a + i), _mm256_loadu_pd(b + i)));
+            }
+            for (; i < len; ++i) {
+                dst[i] = a[i] + b[i];
+            }
+            break;
+        case FUSED_SUB:
+            for (; i + 4 <= len; i += 4) {
+                _mm256_storeu_pd(dst + i, _mm256_sub_pd(_mm256_loadu_pd(a + i), _mm256_loadu_pd(b + i)));
+            }
+            for (; i < len; ++i) {
+                dst[i] = a[i] - b[i];
+            }
+            break;
+        case FUSED_NEG:
+            for (; i + 4 <= len; i += 4) {
+                _mm256_storeu_pd(dst + i, _mm256_xor_pd(_mm256_loadu_pd(a + i), sign));
+            }
+            for (; i < len; ++i) {
+                dst[i] = -a[i];
+            }
+            break;
+        case FUSED_ABS:
+            for (; i + 4 <= len; i += 4) {
+                _mm256_storeu_pd(dst + i, _mm256_andnot_pd(sign, _mm256_loadu_pd(a + i)));
+            }
+            for (; i < len; ++i) {
+                dst[i] = a[i] >= 0 ? a[i] : -a[i];
+            }
+            break;
+    }
+}
+
+/*
+ * Evaluates the postfix program `ops` into `result` in a single pass over memory.
+ * Every FUSED_LOAD pushes a contiguous operand with the shape of `result`, which must be
+ * contiguous as well (see is_contiguous). Every other
+ * instruction pops one or two operands and pushes their combination, and the program must
+ * leave exactly one operand on the stack. The entries are processed in blocks of FUSED_BLOCK,
+ * with the intermediate values of a block held in a small per-thread stack, so no temporary
+ * matrices are created. Blocks are distributed over OpenMP threads.
+ * Return -1 if the program is malformed, -2 if allocating memory fails and 0 upon success.
+ */
+int fused_matrix(matrix *result, fused_op *ops, int n_ops) {
+    int depth = 0, max_depth = 0;
+    for (int i = 0; i < n_ops; ++i) {
+        if (ops[i].op == FUSED_LOAD) {
+            depth++;
+        } else if (ops[i].op == FUSED_ADD || ops[i].op == FUSED_SUB) {
+            depth--;
+        } else if (ops[i].op != FUSED_NEG && ops[i].op != FUSED_ABS) {
+            return -1;
+        }
+        if (depth < 1) {
+            return -1;
+        }
+        max_depth = depth > max_depth ? depth : max_depth;
+    }
+    if (depth != 1 || !is_contiguous(result)) {
+        return -1;
+    }
+
+    long size = (long) result->rows * result->cols;
+    int threads = kernel_threads(KERNEL_FUSED, size);
+    double *scratch = pool_alloc((size_t) threads * max_depth * FUSED_BLOCK);
+    if (scratch == NULL) {
+        return -2;
+    }
+
+    #pragma omp parallel num_threads(threads) if(threads > 1)
+    {
+        double *slots = scratch + (size_t) omp_get_thread_num() * max_depth * FUSED_BLOCK;
+        const double *stack[max_depth];
+
+        #pragma omp for schedule(static)
+        for (long start = 0; start < size; start += FUSED_BLOCK) {
+            int len = size - start < FUSED_BLOCK ? (int) (size - start) : FUSED_BLOCK;
+            int top = 0;
+            for (int i = 0; i < n_ops; ++i) {
+                int op = ops[i].op;
+                if (op == FUSED_LOAD) {
+                    stack[top++] = ops[i].data + start;
+                    continue;
+                }
+                int binary = op == FUSED_ADD || op == FUSED_SUB;
+                int dst_slot = top - 1 - binary;
+                /* The last instruction writes straight into the result */
+                double *dst = i == n_ops - 1 ? result->data + start :
+                              slots + (size_t) dst_slot * FUSED_BLOCK;
+                fused_apply(op, dst, stack[dst_slot], binary ? stack[top - 1] : NULL, len);
+                stack[dst_slot] = dst;
+                top = dst_slot + 1;
+            }
+            if (ops[n_ops - 1].op == FUSED_LOAD) {
+                memcpy(result->data + start, stack[0], len * sizeof(double));
+            }
+        }
+    }
+
+    pool_free(scratch);
+    return 0;
+}
+
+/*
+ * Matrix files use the layout of proj2's read_matrix and write_matrix: the number of rows and
+ * the number of columns as little-endian int32, followed by the entries in row-major order.
+ * The entries are int32 in the original format and float64 in the variant numc writes by
+ * default. Which one a file holds follows from its size.
+ */
+#define MATRIX_FILE_HEADER (2 * sizeof(int32_t))
+/* Number of int32 entries converted per write when saving in the int32 layout */
+#define MATRIX_FILE_CHUNK 4096
+
+/* A mapped file backing the data of a matrix */
+typedef struct file_mapping {
+    void *addr;
+    size_t len;
+} file_mapping;
+
+static void unmap_file(void *base) {
+    file_mapping *mapping = base;
+    munmap(mapping->addr, mapping->len);
+    free(mapping);
+}
+
+/*
+ * Loads the matrix stored at `path` into a new matrix of `dtype` pointed to by `mat`.
+ * If `use_mmap` is nonzero and the file holds entries of `dtype`, the file is mapped
+ * copy-on-write and becomes the storage of the matrix, so pages are only read from disk once
+ * they are touched and writes to the matrix never reach the file. Files holding the other
+ * type of entries are always converted into a newly allocated matrix.
+ * Return -1 if the file is not a valid matrix file, -2 if allocating memory fails, -3 if an
+ * I/O call fails (with errno set), and 0 upon success.
+ */
+int load_matrix(matrix **mat, const char *path, int use_mmap, int dtype) {
+    int fd = open(path, O_RDONLY);
+    if (fd < 0) {
+        return -3;
+    }
+    struct stat st;
+    int32_t header[2] = {0, 0};
+    if (fstat(fd, &st) || pread(fd, header, MATRIX_FILE_HEADER, 0) < 0) {
+        close(fd);
+        return -3;
+    }
+    int rows = header[0], cols = header[1];
+    if (st.st_size < (off_t) MATRIX_FILE_HEADER || rows <= 0 || cols <= 0) {
+        close(fd);
+        return -1;
+    }
+    size_t count = (size_t) rows * cols, len = st.st_size;
+    int as_int32 = len == MATRIX_FILE_HEADER + count * sizeof(int32_t);
+    if (!as_int32 && len != MATRIX_FILE_HEADER + count * sizeof(double)) {
+        close(fd);
+        return -1;
+    }
+    int file_dtype = as_int32 ? DTYPE_INT32 : DTYPE_FLOAT64;
+
+    if (use_mmap && dtype == file_dtype) {
+        file_mapping *mapping = malloc(sizeof(file_mapping));
+        void *addr = mmap(NULL, len, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+        close(fd);
+        if (mapping == NULL || addr == MAP_FAILED) {
+            free(mapping);
+            if (addr != MAP_FAILED) {
+                munmap(addr, len);
+            }
+            return mapping == NULL ? -2 : -3;
+        }
+        mapping->addr = addr;
+        mapping->len = len;
+        int failed = allocate_matrix_external(mat, rows, cols, dtype, (char *) addr + MATRIX_FILE_HEADER,
+                                              mapping, unmap_file);
+        if (failed) {
+            unmap_file(mapping);
+        }
+        return failed;
+    }
+
+    if (allocate_matrix_typed(mat, rows, cols, dtype)) {
+        close(fd);
+        return -2;
+    }
+    int failed = 0;
+    if (dtype != file_dtype) {
+        void *addr = mmap(NULL, len, PROT_READ, MAP_PRIVATE, fd, 0);
+        if (addr == MAP_FAILED) {
+            failed = -3;
+        } else {
+            const char *src = (const char *) addr + MATRIX_FILE_HEADER;
+            size_t item = dtype_size(file_dtype);
+            int threads = kernel_threads(KERNEL_LOAD, count);
+            #pragma omp parallel for num_threads(threads) if(threads > 1)
+            for (size_t i = 0; i < count; i += ELEMENTWISE_BLOCK) {
+                double block[ELEMENTWISE_BLOCK];
+                long n = count - i < ELEMENTWISE_BLOCK ? count - i : ELEMENTWISE_BLOCK;
+                load_run(block, src + i * item, 1, n, file_dtype);
+                store_run(entry_address(*mat, i), 1, block, n, dtype);
+            }
+            munmap(addr, len);
+        }
+    } else {
+        char *dst = (char *) (*mat)->data;
+        size_t remaining = count * dtype_size(dtype);
+        off_t offset = MATRIX_FILE_HEADER;
+        while (remaining > 0) {
+            ssize_t n = pread(fd, dst, remaining, offset);
+            if (n <= 0) {
+                failed = n < 0 ? -3 : -1;
+                break;
+            }
+            dst += n;
+            offset += n;
+            remaining -= n;
+        }
+    }
+    close(fd);
+    if (failed) {
+        deallocate_matrix(*mat);
+        free(*mat);
+    }
+    return failed;
+}
+
+/*
+ * Writes the entries of `mat` to `file` in row-major order as entries of `dtype`, converted as
+ * store_entry does. Contiguous data already of `dtype` is written with a single call, and
+ * anything else is converted one chunk at a time.
+ * Return -2 if allocating memory fails, -3 if a write fails and 0 upon success.
+ */
+static int write_entries(FILE *file, matrix *mat, int dtype) {
+    size_t count = (size_t) mat->rows * mat->cols;
+    size_t item = dtype_size(dtype);
+    if (dtype == mat->dtype && is_contiguous(mat)) {
+        return fwrite(mat->data, item, count, file) != count ? -3 : 0;
+    }
+    char *chunk = malloc(MATRIX_FILE_CHUNK * item);
+    if (chunk == NULL) {
+        return -2;
+    }
+    int failed = 0;
+    size_t n = 0;
+    for (int i = 0; i < mat->rows && !failed; ++i) {
+        for (int j = 0; j < mat->cols && !failed; ++j) {
+            store_entry(chunk + n++ * item, dtype, get(mat, i, j));
+            if (n == MATRIX_FILE_CHUNK || (i == mat->rows - 1 && j == mat->cols - 1)) {
+                failed = fwrite(chunk, item, n, file) != n;
+                n = 0;
+            }
+        }
+    }
+    free(chunk);
+    return failed ? -3 : 0;
+}
+
+/*
+ * Writes `mat` to `path` in the matrix file layout, with float64 entries unless `as_int32` is
+ * nonzero. In the int32 layout every entry is truncated toward zero, and saturates if it does
+ * not fit in an int32.
+ * Return -2 if allocating memory fails, -3 if an I/O call fails (with errno set), and 0 upon
+ * success.
+ */
+int save_matrix(const char *path, matrix *mat, int as_int32) {
+    FILE *file = fopen(path, "wb");
+    if (file == NULL) {
+        return -3;
+    }
+    int32_t header[2] = {mat->rows, mat->cols};
+    int failed = fwrite(header, sizeof(int32_t), 2, file) != 2 ? -3 : 0;
+    if (!failed) {
+        failed = write_entries(file, mat, as_int32 ? DTYPE_INT32 : DTYPE_FLOAT64);
+    }
+    if (fclose(file) && !failed) {
+        failed = -3;
+    }
+    return failed;
+}
+
+/*
+ * Writes the entries of `mat` to `path` as raw native values of its dtype in row-major order,
+ * without the header of the matrix file layout, like numpy's tofile.
+ * Return -2 if allocating memory fails, -3 if an I/O call fails (with errno set), and 0 upon
+ * success.
+ */
+int dump_matrix(const char *path, matrix *mat) {
+    FILE *file = fopen(path, "wb");
+    if (file == NULL) {
+        return -3;
+    }
+    int failed = write_entries(file, mat, mat->dtype);
+    if (fclose(file) && !failed) {
+        failed = -3;
+    }
+    return failed;
+}
+
+/*
+ * Allocates a rows x cols sparse matrix with room for `nnz` entries, with all of row_ptr set
+ * to 0. Return -1 if the shape or nnz is invalid, -2 if allocating memory fails and 0 upon
+ * success.
+ */
+int allocate_sparse(sparse_matrix **mat, int rows, int cols, long nnz) {
+    if (rows <= 0 || cols <= 0 || nnz < 0 || nnz > (long) rows * cols) {
+        return -1;
+    }
+    sparse_matrix *sparse = malloc(sizeof(sparse_matrix));
+    if (sparse == NULL) {
+        return -2;
+    }
+    sparse->rows = rows;
+    sparse->cols = cols;
+    sparse->nnz = nnz;
+    sparse->row_ptr = calloc((size_t) rows + 1, sizeof(long));
+    /* malloc(0) may return NULL, which would look like a failure */
+    sparse->col_idx = malloc((nnz > 0 ? nnz : 1) * sizeof(int));
+    sparse->values = malloc((nnz > 0 ? nnz : 1) * sizeof(double));
+    if (sparse->row_ptr == NULL || sparse->col_idx == NULL || sparse->values == NULL) {
+        deallocate_sparse(sparse);
+        return -2;
+    }
+    *mat = sparse;
+    return 0;
+}
+
+/* Frees a sparse matrix and its arrays. mat may be NULL. */
+void deallocate_sparse(sparse_matrix *mat) {
+    if (mat == NULL) {
+        return;
+    }
+    free(mat->row_ptr);
+    free(mat->col_idx);
+    free(mat->values);
+    free(mat);
+}
+
+/* Turns the number of entries of each row, in row_ptr[1] to row_ptr[rows], into offsets */
+static long counts_to_offsets(long *row_ptr, int rows) {
+    row_ptr[0] = 0;
+    for (int i = 0; i < rows; i++) {
+        row_ptr[i + 1] += row_ptr[i];
+    }
+    return row_ptr[rows];
+}
+
+/*
+ * Stores the nonzero entries of the dense matrix `mat`, of any dtype, in a new sparse matrix
+ * in *result. NaNs count as nonzero. Return -2 if allocating memory fails and 0 upon success.
+ */
+int sparse_from_dense(sparse_matrix **result, matrix *mat) {
+    int rows = mat->rows, cols = mat->cols;
+    long *counts = malloc(((size_t) rows + 1) * sizeof(long));
+    if (counts == NULL) {
+        return -2;
+    }
+    int threads = kernel_threads(KERNEL_SPARSE, (double) rows * cols);
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < rows; i++) {
+        long n = 0;
+        for (int j = 0; j < cols; j++) {
+            n += get(mat, i, j) != 0;
+        }
+        counts[i + 1] = n;
+    }
+    sparse_matrix *sparse;
+    int failed = allocate_sparse(&sparse, rows, cols, counts_to_offsets(counts, rows));
+    if (failed) {
+        free(counts);
+        return failed;
+    }
+    memcpy(sparse->row_ptr, counts, ((size_t) rows + 1) * sizeof(long));
+    free(counts);
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < rows; i++) {
+        long k = sparse->row_ptr[i];
+        for (int j = 0; j < cols; j++) {
+            double val = get(mat, i, j);
+            if (val != 0) {
+                sparse->col_idx[k] = j;
+                sparse->values[k++] = val;
+            }
+        }
+    }
+    *result = sparse;
+    return 0;
+}
+
+/* An entry of a row while building a sparse matrix from coordinates */
+typedef struct coo_entry {
+    int col;
+    double value;
+} coo_entry;
+
+static int compare_columns(const void *a, const void *b) {
+    int col1 = ((const coo_entry *) a)->col, col2 = ((const coo_entry *) b)->col;
+    return (col1 > col2) - (col1 < col2);
+}
+
+/*
+ * Builds a rows x cols sparse matrix in *result from `n` coordinate (COO) triples: entry k has
+ * the value values[k] at row row_idx[k] and column col_idx[k]. The triples may come in any
+ * order, and the values of repeated coordinates are summed.
+ * Return -1 if the shape is invalid or a coordinate is out of range, -2 if allocating memory
+ * fails and 0 upon success.
+ */
+int sparse_from_coo(sparse_matrix **result, int rows, int cols, long n, const int *row_idx,
+                    const int *col_idx, const double *values) {
+    if (rows <= 0 || cols <= 0 || n < 0) {
+        return -1;
+    }
+    for (long k = 0; k < n; k++) {
+        if (row_idx[k] < 0 || row_idx[k] >= rows || col_idx[k] < 0 || col_idx[k] >= cols) {
+            return -1;
+        }
+    }
+    long *offsets = calloc((size_t) rows + 1, sizeof(long));
+    long *counts = malloc(((size_t) rows + 1) * sizeof(long));
+    coo_entry *entries = malloc((n > 0 ? n : 1) * sizeof(coo_entry));
+    int failed = offsets == NULL || counts == NULL || entries == NULL ? -2 : 0;
+    if (!failed) {
+        /* Bucket the triples by row, then sort each row by column and sum repeated columns */
+        for (long k = 0; k < n; k++) {
+            offsets[row_idx[k] + 1]++;
+        }
+        counts_to_offsets(offsets, rows);
+        memcpy(counts, offsets, (size_t) rows * sizeof(long));
+        for (long k = 0; k < n; k++) {
+            entries[counts[row_idx[k]]++] = (coo_entry) {col_idx[k], values[k]};
+        }
+        int threads = kernel_threads(KERNEL_SPARSE, (double) n);
+        #pragma omp parallel for schedule(dynamic, 64) num_threads(threads) if(threads > 1)
+        for (int i = 0; i < rows; i++) {
+            long start = offsets[i], end = offsets[i + 1], last = start;
+            qsort(entries + start, end - start, sizeof(coo_entry), compare_columns);
+            for (long k = start + 1; k < end; k++) {
+                if (entries[k].col == entries[last].col) {
+                    entries[last].value += entries[k].value;
+                } else {
+                    entries[++last] = entries[k];
+                }
+            }
+            counts[i + 1] = end > start ? last - start + 1 : 0;
+        }
+        sparse_matrix *sparse = NULL;
+        failed = allocate_sparse(&sparse, rows, cols, counts_to_offsets(counts, rows));
+        if (!failed) {
+            memcpy(sparse->row_ptr, counts, ((size_t) rows + 1) * sizeof(long));
+            for (int i = 0; i < rows; i++) {
+                for (long k = sparse->row_ptr[i], from = offsets[i]; k < sparse->row_ptr[i + 1]; k++, from++) {
+                    sparse->col_idx[k] = entries[from].col;
+                    sparse->values[k] = entries[from].value;
+                }
+            }
+            *result = sparse;
+        }
+    }
+    free(offsets);
+    free(counts);
+    free(entries);
+    return failed;
+}
+
+/*
+ * Writes the sparse matrix `mat` into the dense matrix `result` of any dtype, which must already
+ * have its shape. Return -100 if the shapes differ and 0 upon success.
+ */
+int sparse_to_dense(matrix *result, sparse_matrix *mat) {
+    if (result->rows != mat->rows || result->cols != mat->cols) {
+        return -100;
+    }
+    fill_matrix(result, 0);
+    int threads = kernel_threads(KERNEL_SPARSE, (double) mat->nnz);
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < mat->rows; i++) {
+        for (long k = mat->row_ptr[i]; k < mat->row_ptr[i + 1]; k++) {
+            set(result, i, mat->col_idx[k], mat->values[k]);
+        }
+    }
+    return 0;
+}
+
+/*
+ * Stores `scalar` times `mat` in a new sparse matrix in *result, with the same stored entries
+ * as mat. Return -2 if allocating memory fails and 0 upon success.
+ */
+int sparse_scale(sparse_matrix **result, sparse_matrix *mat, double scalar) {
+    sparse_matrix *sparse;
+    int failed = allocate_sparse(&sparse, mat->rows, mat->cols, mat->nnz);
+    if (failed) {
+        return failed;
+    }
+    memcpy(sparse->row_ptr, mat->row_ptr, ((size_t) mat->rows + 1) * sizeof(long));
+    memcpy(sparse->col_idx, mat->col_idx, mat->nnz * sizeof(int));
+    for (long k = 0; k < mat->nnz; k++) {
+        sparse->values[k] = scalar * mat->values[k];
+    }
+    *result = sparse;
+    return 0;
+}
+
+/*
+ * Merges row i of mat1 and mat2, summing the entries in columns stored in both, into col_idx
+ * and values, which may both be NULL to only count the entries. Returns the number of entries.
+ */
+static long merge_rows(sparse_matrix *mat1, sparse_matrix *mat2, int i, int *col_idx, double *values) {
+    long p = mat1->row_ptr[i], p_end = mat1->row_ptr[i + 1];
+    long q = mat2->row_ptr[i], q_end = mat2->row_ptr[i + 1], n = 0;
+    while (p < p_end || q < q_end) {
+        /* Column indices are below INT32_MAX, which marks an exhausted row */
+        int col1 = p < p_end ? mat1->col_idx[p] : INT32_MAX;
+        int col2 = q < q_end ? mat2->col_idx[q] : INT32_MAX;
+        if (col_idx != NULL) {
+            col_idx[n] = col1 < col2 ? col1 : col2;
+            values[n] = (col1 <= col2 ? mat1->values[p] : 0) + (col2 <= col1 ? mat2->values[q] : 0);
+        }
+        p += col1 <= col2;
+        q += col2 <= col1;
+        n++;
+    }
+    return n;
+}
+
+/*
+ * Stores mat1 + mat2 in a new sparse matrix in *result, whose entries are those stored in
+ * either operand. Return -100 if the shapes differ, -2 if allocating memory fails and 0 upon
+ * success.
+ */
+int sparse_add_sparse(sparse_matrix **result, sparse_matrix *mat1, sparse_matrix *mat2) {
+    if (mat1->rows != mat2->rows || mat1->cols != mat2->cols) {
+        return -100;
+    }
+    int rows = mat1->rows;
+    long *counts = malloc(((size_t) rows + 1) * sizeof(long));
+    if (counts == NULL) {
+        return -2;
+    }
+    int threads = kernel_threads(KERNEL_SPARSE, (double) mat1->nnz + mat2->nnz);
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < rows; i++) {
+        counts[i + 1] = merge_rows(mat1, mat2, i, NULL, NULL);
+    }
+    sparse_matrix *sparse;
+    int failed = allocate_sparse(&sparse, rows, mat1->cols, counts_to_offsets(counts, rows));
+    if (!failed) {
+        memcpy(sparse->row_ptr, counts, ((size_t) rows + 1) * sizeof(long));
+        #pragma omp parallel for num_threads(threads) if(threads > 1)
+        for (int i = 0; i < rows; i++) {
+            long start = sparse->row_ptr[i];
+            merge_rows(mat1, mat2, i, sparse->col_idx + start, sparse->values + start);
+        }
+        *result = sparse;
+    }
+    free(counts);
+    return failed;
+}
+
+/*
+ * Stores mat1 + mat2 in the dense matrix `result`, which must already have their shape. mat2
+ * and result may be of any dtype and may share memory, as in mat2 += mat1.
+ * Return -100 if the shapes differ and 0 upon success.
+ */
+int sparse_add_dense(matrix *result, sparse_matrix *mat1, matrix *mat2) {
+    if (mat1->rows != mat2->rows || mat1->cols != mat2->cols || result->rows != mat2->rows ||
+            result->cols != mat2->cols) {
+        return -100;
+    }
+    int failed = copy_matrix(result, mat2);
+    if (failed) {
+        return failed;
+    }
+    int threads = kernel_threads(KERNEL_SPARSE, (double) mat1->nnz);
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < mat1->rows; i++) {
+        for (long k = mat1->row_ptr[i]; k < mat1->row_ptr[i + 1]; k++) {
+            int j = mat1->col_idx[k];
+            set(result, i, j, get(result, i, j) + mat1->values[k]);
+        }
+    }
+    return 0;
+}
+
+/*
+ * Returns where a sparse product should write the rows of `result`, setting *stride to the
+ * distance between them: result's own data if its entries within a row are adjacent and it
+ * does not share memory with the dense operand, and otherwise a scratch buffer, also stored in
+ * *scratch, that finish_sparse_product copies back. Returns NULL if allocating it fails.
+ */
+static double *sparse_product_target(matrix *result, matrix *dense, double **scratch, long *stride) {
+    *scratch = NULL;
+    if (!overlaps(result, dense) && (result->cols == 1 || result->col_stride == 1)) {
+        *stride = result->row_stride;
+        return result->data;
+    }
+    *scratch = pool_alloc((size_t) result->rows * result->cols);
+    *stride = result->cols;
+    return *scratch;
+}
+
+/* Copies the scratch buffer of sparse_product_target, if any, into result and frees it */
+static int finish_sparse_product(matrix *result, double *scratch) {
+    if (scratch == NULL) {
+        return 0;
+    }
+    matrix product = wrap_buffer(scratch, result->rows, result->cols);
+    int failed = copy_matrix(result, &product);
+    pool_free(scratch);
+    return failed;
+}
+
+/*
+ * Computes the rows of a * b, with rows `stride` doubles apart, into `out`. Each row of the
+ * product is the sum of the rows of b selected by the stored entries of that row of a, scaled
+ * by them, so b is read one contiguous row at a time. A single column (SpMV) is a dot product
+ * per row instead.
+ */
+static void spmm(sparse_matrix *a, matrix *b, double *out, long stride) {
+    int cols = b->cols;
+    long b_rs = b->row_stride, b_cs = b->col_stride;
+    int threads = kernel_threads(KERNEL_SPARSE, (double) a->nnz * cols);
+    /* Rows of graphs hold very different numbers of entries */
+    #pragma omp parallel for schedule(dynamic, 64) num_threads(threads) if(threads > 1)
+    for (int i = 0; i < a->rows; i++) {
+        double *row = out + i * stride;
+        long start = a->row_ptr[i], end = a->row_ptr[i + 1];
+        if (cols == 1) {
+            double sum = 0;
+            for (long k = start; k < end; k++) {
+                sum += a->values[k] * b->data[a->col_idx[k] * b_rs];
+            }
+            row[0] = sum;
+            continue;
+        }
+        memset(row, 0, (size_t) cols * sizeof(double));
+        for (long k = start; k < end; k++) {
+            const double *src = b->data + a->col_idx[k] * b_rs;
+            double val = a->values[k];
+            if (b_cs != 1) {
+                for (int j = 0; j < cols; j++) {
+                    row[j] += val * src[j * b_cs];
+                }
+                continue;
+            }
+            __m256d scale = _mm256_set1_pd(val);
+            int j = 0;
+            for (; j + 4 <= cols; j += 4) {
+                _mm256_storeu_pd(row + j, _mm256_fmadd_pd(scale, _mm256_loadu_pd(src + j), _mm256_loadu_pd(row + j)));
+            }
+            for (; j < cols; j++) {
+                row[j] += val * src[j];
+            }
+        }
+    }
+}
+
+/*
+ * Computes the rows of a * b, with rows `stride` doubles apart, into `out`. Each entry of a row
+ * of a scales the stored entries of the matching row of b into the row of the product. Zero
+ * entries of a are not skipped, so that infinities and NaNs in b propagate as in a dense product.
+ */
+static void dense_spmm(matrix *a, sparse_matrix *b, double *out, long stride) {
+    int mids = a->cols, cols = b->cols;
+    long a_rs = a->row_stride, a_cs = a->col_stride;
+    int threads = kernel_threads(KERNEL_SPARSE, (double) a->rows * b->nnz);
+    #pragma omp parallel for num_threads(threads) if(threads > 1)
+    for (int i = 0; i < a->rows; i++) {
+        double *row = out + i * stride;
+        if (cols == 1) {
+            row[0] = 0;
+        } else {
+            memset(row, 0, (size_t) cols * sizeof(double));
+        }
+        for (int k = 0; k < mids; k++) {
+            double val = a->data[i * a_rs + k * a_cs];
+            for (long p = b->row_ptr[k]; p < b->row_ptr[k + 1]; p++) {
+                row[b->col_idx[p]] += val * b->values[p];
+            }
+        }
+    }
+}
+
+/*
+ * Stores the product of the sparse mat1 and the dense mat2 in `result`, which must already be
+ * mat1->rows x mat2->cols. mat2 and result may be views of any dtype, and may share memory.
+ * Return -101 if the shapes do not match, -2 if allocating memory fails and 0 upon success.
+ */
+int sparse_mul_dense(matrix *result, sparse_matrix *mat1, matrix *mat2) {
+    if (mat1->cols != mat2->rows || result->rows != mat1->rows || result->cols != mat2->cols) {
+        return -101;
+    }
+    if (result->dtype != DTYPE_FLOAT64 || mat2->dtype != DTYPE_FLOAT64) {
+        widened w;
+        matrix *operands[] = {mat2};
+        return widen(&w, result, operands, 1) ? -2 : narrow(&w, sparse_mul_dense(&w.result, mat1, &w.mats[0]));
+    }
+    double *scratch;
+    long stride;
+    double *out = sparse_product_target(result, mat2, &scratch, &stride);
+    if (out == NULL) {
+        return -2;
+    }
+    spmm(mat1, mat2, out, stride);
+    return finish_sparse_product(result, scratch);
+}
+
+/*
+ * Stores the product of the dense mat1 and the sparse mat2 in `result`, which must already be
+ * mat1->rows x mat2->cols, with the same allowances as sparse_mul_dense.
+ * Return -101 if the shapes do not match, -2 if allocating memory fails and 0 upon success.
+ */
+int dense_mul_sparse(matrix *result, matrix *mat1, sparse_matrix *mat2) {
+    if (mat1->cols != mat2->rows || result->rows != mat1->rows || result->cols != mat2->cols) {
+        return -101;
+    }
+    if (result->dtype != DTYPE_FLOAT64 || mat1->dtype != DTYPE_FLOAT64) {
+        widened w;
+        matrix *operands[] = {mat1};
+        return widen(&w, result, operands, 1) ? -2 : narrow(&w, dense_mul_sparse(&w.result, &w.mats[0], mat2));
+    }
+    double *scratch;
+    long stride;
+    double *out = sparse_product_target(result, mat1, &scratch, &stride);
+    if (out == NULL) {
+        return -2;
+    }
+    dense_spmm(mat1, mat2, out, stride);
+    return finish_sparse_product(result, scratch);
+}
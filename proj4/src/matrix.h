@@ -1,26 +1,162 @@
 #include <Python.h>
+#include <stdint.h>
+
+/*
+ * Element types of matrices. An operation on two dtypes gives the same dtype if they are equal
+ * and DTYPE_FLOAT64 otherwise, see promote_dtypes.
+ */
+enum { DTYPE_FLOAT64, DTYPE_FLOAT32, DTYPE_INT32, NUM_DTYPES };
+
+/*
+ * The data shared by a matrix and all of its slices, however deeply nested. Every matrix and
+ * slice using it holds one reference, counted atomically, so matrices may be sliced and
+ * deallocated from any thread. The data is released when the last reference is dropped.
+ */
+typedef struct matrix_block {
+    long ref_cnt; // How many matrices/slices are referring to this data
+    void *data; // start of the data, from pool_alloc unless `release` is set
+    void *base; // NULL if `data` was allocated by numc, else the object that owns `data`
+    void (*release)(void *base); // Called with `base` instead of freeing `data` when it is no longer used
+} matrix_block;
 
 typedef struct matrix {
     int rows; // number of rows
     int cols; // number of columns
-    double* data; // pointer to rows * columns doubles
-    int ref_cnt; // How many slices/matrices are referring to this matrix's data
-    struct matrix *parent; // NULL if matrix is not a slice, else the parent matrix of the slice
+    union {
+        double* data; // pointer to the entry at row 0, column 0
+        float *fdata; // same as data, for DTYPE_FLOAT32 matrices
+        int32_t *idata; // same as data, for DTYPE_INT32 matrices
+    };
+    int row_stride; // distance in entries between the entries of two consecutive rows
+    int col_stride; // distance in entries between the entries of two consecutive columns
+    matrix_block *block; // the data this matrix or slice shares, NULL for scratch stand-ins
+    int dtype; // one of the DTYPE_* element types
 } matrix;
 
+/* Instructions of a fused element-wise program, evaluated like a stack machine */
+enum { FUSED_LOAD, FUSED_ADD, FUSED_SUB, FUSED_NEG, FUSED_ABS };
+
+typedef struct fused_op {
+    int op; // one of the FUSED_* instructions
+    double *data; // for FUSED_LOAD, the rows * cols entries to push on the stack
+} fused_op;
+
+/* Operations of scalar_matrix and broadcast_matrix. BROADCAST_RSUB subtracts the matrix. */
+enum { BROADCAST_ADD, BROADCAST_SUB, BROADCAST_RSUB, BROADCAST_MUL, BROADCAST_DIV };
+
+/* When square float64 products use Strassen-Winograd, see set_strassen */
+enum { STRASSEN_OFF, STRASSEN_AUTO, STRASSEN_ON };
+
+/* Operations of reduce_matrix */
+enum { REDUCE_SUM, REDUCE_MEAN, REDUCE_MIN, REDUCE_MAX, REDUCE_ARGMAX };
+
+/*
+ * Kernels with their own parallel cutoff, see set_parallel_cutoff. The work they compare with
+ * it is in entries, except for KERNEL_GEMM (m * n * k), KERNEL_INVERT (matrix order) and
+ * KERNEL_SPARSE (multiply-adds, or entries visited by conversions).
+ */
+enum {
+    KERNEL_ELEMENTWISE, KERNEL_GEMM, KERNEL_REDUCE, KERNEL_TRANSPOSE, KERNEL_FUSED, KERNEL_RANDOM,
+    KERNEL_INVERT, KERNEL_LOAD, KERNEL_SPARSE, NUM_KERNELS
+};
+
+/*
+ * A float64 matrix in compressed sparse row (CSR) format. The stored entries of row i are
+ * values[row_ptr[i]] to values[row_ptr[i + 1] - 1], in the columns col_idx[row_ptr[i]] to
+ * col_idx[row_ptr[i + 1] - 1], which increase strictly within each row.
+ */
+typedef struct sparse_matrix {
+    int rows; // number of rows
+    int cols; // number of columns
+    long nnz; // number of stored entries
+    long *row_ptr; // rows + 1 offsets into col_idx and values, row_ptr[rows] == nnz
+    int *col_idx; // column of each stored entry
+    double *values; // value of each stored entry
+} sparse_matrix;
+
+/* Outcome of compare_matrix */
+typedef struct comparison {
+    long mismatch; // row-major index of the first entry that is not close, -1 if there is none
+    double max_abs_err; // largest absolute error, ignoring NaN
+    double max_rel_err; // largest error relative to the reference entry, ignoring NaN
+} comparison;
+
+/* Counters of the matrix data pool, see pool_alloc */
+typedef struct pool_stats {
+    size_t allocs; // blocks handed out by pool_alloc
+    size_t hits; // blocks handed out that were recycled from the cache
+    size_t frees; // blocks returned to pool_free
+    size_t live_bytes; // bytes in blocks currently handed out
+    size_t peak_bytes; // largest value live_bytes has reached
+    size_t cached_blocks; // blocks kept for reuse
+    size_t cached_bytes; // bytes in blocks kept for reuse
+} pool_stats;
+
+const char *dtype_name(int dtype);
+size_t dtype_size(int dtype);
+int promote_dtypes(int dtype1, int dtype2);
+int set_num_threads(int threads);
+int set_thread_limit(int threads);
+int get_num_threads(void);
+const char *kernel_name(int kernel);
+long get_parallel_cutoff(int kernel);
+void set_parallel_cutoff(int kernel, long cutoff);
+void load_parallel_config(void);
+void set_strassen(int mode, int crossover);
+int get_strassen_mode(void);
+int get_strassen_crossover(void);
+double *pool_alloc(size_t count);
+void pool_free(double *data);
+void pool_get_stats(pool_stats *stats);
+void pool_trim(void);
+void pool_reset_peak(void);
 double rand_double(double low, double high);
 void rand_matrix(matrix *result, unsigned int seed, double low, double high);
+void uniform_matrix(matrix *result, uint64_t seed, double low, double high);
+void normal_matrix(matrix *result, uint64_t seed, double mean, double std);
 int allocate_matrix(matrix **mat, int rows, int cols);
+int allocate_matrix_uninitialized(matrix **mat, int rows, int cols);
+int allocate_matrix_typed(matrix **mat, int rows, int cols, int dtype);
 int allocate_matrix_ref(matrix **mat, matrix *from, int offset, int rows, int cols);
+int allocate_matrix_view(matrix **mat, matrix *from, long offset, int rows, int cols, int row_stride,
+                         int col_stride);
+int allocate_matrix_external(matrix **mat, int rows, int cols, int dtype, void *data, void *base,
+                             void (*release)(void *base));
 void deallocate_matrix(matrix *mat);
 void reallocate_matrix(matrix *mat, int rows, int cols);
-void reallocate_matrix_with(matrix *mat, int rows, int cols, double *data);
+int reallocate_matrix_with(matrix *mat, int rows, int cols, double *data);
+int is_contiguous(matrix *mat);
+int shares_memory(matrix *mat1, matrix *mat2);
 double get(matrix *mat, int row, int col);
 void set(matrix *mat, int row, int col, double val);
 void fill_matrix(matrix *mat, double val);
+void arange_matrix(matrix *mat, double start, double step);
+int copy_matrix(matrix *result, matrix *mat);
+int transpose_matrix(matrix *result, matrix *mat);
+void gather_matrix(void *data, matrix *mat);
 int add_matrix(matrix *result, matrix *mat1, matrix *mat2);
 int sub_matrix(matrix *result, matrix *mat1, matrix *mat2);
 int mul_matrix(matrix *result, matrix *mat1, matrix *mat2);
+int batch_mul_matrix(matrix **results, matrix **mat1s, matrix **mat2s, int n);
 int pow_matrix(matrix *result, matrix *mat, int pow);
 int neg_matrix(matrix *result, matrix *mat);
 int abs_matrix(matrix *result, matrix *mat);
+int scalar_matrix(matrix *result, matrix *mat, double scalar, int op);
+int broadcast_matrix(matrix *result, matrix *mat, matrix *vec, int op);
+int reduce_matrix(matrix *result, matrix *mat, int op, int axis);
+int compare_matrix(matrix *mat1, matrix *mat2, double rtol, double atol, comparison *result);
+int fused_matrix(matrix *result, fused_op *ops, int n_ops);
+int load_matrix(matrix **mat, const char *path, int use_mmap, int dtype);
+int save_matrix(const char *path, matrix *mat, int as_int32);
+int dump_matrix(const char *path, matrix *mat);
+int allocate_sparse(sparse_matrix **mat, int rows, int cols, long nnz);
+void deallocate_sparse(sparse_matrix *mat);
+int sparse_from_dense(sparse_matrix **result, matrix *mat);
+int sparse_from_coo(sparse_matrix **result, int rows, int cols, long n, const int *row_idx,
+                    const int *col_idx, const double *values);
+int sparse_to_dense(matrix *result, sparse_matrix *mat);
+int sparse_scale(sparse_matrix **result, sparse_matrix *mat, double scalar);
+int sparse_add_sparse(sparse_matrix **result, sparse_matrix *mat1, sparse_matrix *mat2);
+int sparse_add_dense(matrix *result, sparse_matrix *mat1, matrix *mat2);
+int sparse_mul_dense(matrix *result, sparse_matrix *mat1, matrix *mat2);
+int dense_mul_sparse(matrix *result, matrix *mat1, sparse_matrix *mat2);
@@ -1,13 +1,24 @@
 #include "numc.h"
 #include <structmember.h>
+#include <sched.h>
+#include <time.h>
 
 static PyTypeObject Matrix61cType;
+static PyTypeObject Matrix61cRowIterType;
+static PyTypeObject SparseMatrixType;
+
+/* Whether +, -, unary - and abs build lazy expressions instead of computing their result */
+static int lazy_mode = 0;
+/* A lazy expression that would need more fused instructions than this evaluates its operands */
+#define LAZY_MAX_OPS 64
+/* Every pending lazy expression, so that in-place writes can evaluate those reading their target */
+static lazy_expr *lazy_pending = NULL;
 
 /* Helper functions for initalization of matrices and vectors */
 /* Matrix(rows, cols, low, high). Fill a matrix random double values */
 static int init_rand(PyObject *self, int rows, int cols, unsigned int seed, double low, double high) {
     matrix *new_mat;
-    int alloc_failed = allocate_matrix(&new_mat, rows, cols);
+    int alloc_failed = allocate_matrix_uninitialized(&new_mat, rows, cols);
     if (alloc_failed)
         return alloc_failed;
     rand_matrix(new_mat, seed, low, high);
@@ -19,7 +30,7 @@ static int init_rand(PyObject *self, int rows, int cols, unsigned int seed, doub
 /* Matrix(rows, cols, val). Fill a matrix of dimension rows * cols with val*/
 static int init_fill(PyObject *self, int rows, int cols, double val) {
     matrix *new_mat;
-    int alloc_failed = allocate_matrix(&new_mat, rows, cols);
+    int alloc_failed = allocate_matrix_uninitialized(&new_mat, rows, cols);
     if (alloc_failed)
         return alloc_failed;
     else {
@@ -30,22 +41,97 @@ static int init_fill(PyObject *self, int rows, int cols, double val) {
     return 0;
 }
 
+/*
+ * Converts the n Python numbers in `items` into `data`. Returns 0 on success and -1 with an
+ * exception set if one of them is not a number.
+ */
+static int convert_items(PyObject **items, Py_ssize_t n, double *data) {
+    for (Py_ssize_t i = 0; i < n; i++) {
+        if (PyFloat_CheckExact(items[i])) {
+            data[i] = PyFloat_AS_DOUBLE(items[i]);
+            continue;
+        }
+        data[i] = PyFloat_AsDouble(items[i]);
+        if (data[i] == -1 && PyErr_Occurred()) {
+            return -1;
+        }
+    }
+    return 0;
+}
+
+/*
+ * Converter for the "O&" format of PyArg_Parse*: parses a dtype name, "float64", "float32" or
+ * "int32", into the int pointed to by `dtype`. None leaves it unchanged. Returns 1 on success
+ * and 0 with an exception set on failure.
+ */
+static int parse_dtype(PyObject *obj, void *dtype) {
+    if (obj == Py_None) {
+        return 1;
+    }
+    const char *name = PyUnicode_Check(obj) ? PyUnicode_AsUTF8(obj) : NULL;
+    if (name == NULL) {
+        if (!PyErr_Occurred()) {
+            PyErr_SetString(PyExc_TypeError, "dtype must be a string");
+        }
+        return 0;
+    }
+    for (int i = 0; i < NUM_DTYPES; i++) {
+        if (strcmp(name, dtype_name(i)) == 0) {
+            *(int *) dtype = i;
+            return 1;
+        }
+    }
+    PyErr_Format(PyExc_ValueError, "dtype must be 'float64', 'float32' or 'int32', not '%s'", name);
+    return 0;
+}
+
+/*
+ * Returns `mat` if it has the given dtype, and otherwise a converted copy of it, deallocating
+ * mat either way. Returns NULL with an exception set on failure.
+ */
+static matrix *as_dtype(matrix *mat, int dtype) {
+    matrix *converted;
+    if (mat->dtype == dtype) {
+        return mat;
+    }
+    int failed = allocate_matrix_typed(&converted, mat->rows, mat->cols, dtype);
+    if (!failed) {
+        copy_matrix(converted, mat);
+    }
+    deallocate_matrix(mat);
+    free(mat);
+    if (failed) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    return converted;
+}
+
+/* Returns entry (i, j) of mat as a Python int for int32 matrices and as a float otherwise */
+static PyObject *entry_object(matrix *mat, int i, int j) {
+    double val = get(mat, i, j);
+    return mat->dtype == DTYPE_INT32 ? PyLong_FromLong((long) val) : PyFloat_FromDouble(val);
+}
+
+/* Whether `obj` is a list or a tuple, whose items can be read in bulk */
+static int is_list_or_tuple(PyObject *obj) {
+    return PyList_Check(obj) || PyTuple_Check(obj);
+}
+
 /* Matrix(rows, cols, 1d_list). Fill a matrix with dimension rows * cols with 1d_list values */
 static int init_1d(PyObject *self, int rows, int cols, PyObject *lst) {
-    if (rows * cols != PyList_Size(lst)) {
+    if ((Py_ssize_t) rows * cols != PySequence_Fast_GET_SIZE(lst)) {
         PyErr_SetString(PyExc_ValueError, "Incorrect number of elements in list");
         return -1;
     }
     matrix *new_mat;
-    int alloc_failed = allocate_matrix(&new_mat, rows, cols);
+    int alloc_failed = allocate_matrix_uninitialized(&new_mat, rows, cols);
     if (alloc_failed)
         return alloc_failed;
-    int count = 0;
-    for (int i = 0; i < rows; i++) {
-        for (int j = 0; j < cols; j++) {
-            set(new_mat, i, j, PyFloat_AsDouble(PyList_GetItem(lst, count)));
-            count++;
-        }
+    if (convert_items(PySequence_Fast_ITEMS(lst), (Py_ssize_t) rows * cols, new_mat->data)) {
+        deallocate_matrix(new_mat);
+        free(new_mat);
+        return -1;
     }
     ((Matrix61c *)self)->mat = new_mat;
     ((Matrix61c *)self)->shape = PyTuple_Pack(2, PyLong_FromLong(rows), PyLong_FromLong(cols));
@@ -54,31 +140,34 @@ static int init_1d(PyObject *self, int rows, int cols, PyObject *lst) {
 
 /* Matrix(2d_list). Fill a matrix with dimension len(2d_list) * len(2d_list[0]) */
 static int init_2d(PyObject *self, PyObject *lst) {
-    int rows = PyList_Size(lst);
+    int rows = PySequence_Fast_GET_SIZE(lst);
     if (rows == 0) {
         PyErr_SetString(PyExc_ValueError, "Cannot initialize numc.Matrix with an empty list");
         return -1;
     }
+    PyObject **row_items = PySequence_Fast_ITEMS(lst);
     int cols;
-    if (!PyList_Check(PyList_GetItem(lst, 0))) {
+    if (!is_list_or_tuple(row_items[0])) {
         PyErr_SetString(PyExc_ValueError, "List values not valid");
         return -1;
     } else {
-        cols = PyList_Size(PyList_GetItem(lst, 0));
+        cols = PySequence_Fast_GET_SIZE(row_items[0]);
     }
     for (int i = 0; i < rows; i++) {
-        if (!PyList_Check(PyList_GetItem(lst, i)) || PyList_Size(PyList_GetItem(lst, i)) != cols) {
+        if (!is_list_or_tuple(row_items[i]) || PySequence_Fast_GET_SIZE(row_items[i]) != cols) {
             PyErr_SetString(PyExc_ValueError, "List values not valid");
             return -1;
         }
     }
     matrix *new_mat;
-    int alloc_failed = allocate_matrix(&new_mat, rows, cols);
+    int alloc_failed = allocate_matrix_uninitialized(&new_mat, rows, cols);
     if (alloc_failed)
         return alloc_failed;
     for (int i = 0; i < rows; i++) {
-        for (int j = 0; j < cols; j++) {
-            set(new_mat, i, j, PyFloat_AsDouble(PyList_GetItem(PyList_GetItem(lst, i), j)));
+        if (convert_items(PySequence_Fast_ITEMS(row_items[i]), cols, new_mat->data + (size_t) i * cols)) {
+            deallocate_matrix(new_mat);
+            free(new_mat);
+            return -1;
         }
     }
     ((Matrix61c *)self)->mat = new_mat;
@@ -86,9 +175,29 @@ static int init_2d(PyObject *self, PyObject *lst) {
     return 0;
 }
 
+/* Drops a lazy expression and its references to its operands */
+static void lazy_free(lazy_expr *expr) {
+    if (expr->prev != NULL) {
+        expr->prev->next = expr->next;
+    } else if (lazy_pending == expr) {
+        lazy_pending = expr->next;
+    }
+    if (expr->next != NULL) {
+        expr->next->prev = expr->prev;
+    }
+    Py_XDECREF(expr->args[0]);
+    Py_XDECREF(expr->args[1]);
+    PyMem_Free(expr);
+}
+
 /* This deallocation function is called when reference count is 0*/
 static void Matrix61c_dealloc(Matrix61c *self) {
+    if (self->lazy != NULL) {
+        lazy_free(self->lazy);
+    }
+    /* Slices hold their own reference on the data, so the struct can go right away */
     deallocate_matrix(self->mat);
+    free(self->mat);
     Py_TYPE(self)->tp_free(self);
 }
 
@@ -99,8 +208,37 @@ static PyObject *Matrix61c_new(PyTypeObject *type, PyObject *args, PyObject *kwd
     return (PyObject *)self;
 }
 
-/* This matrix61c type is mutable, so needs init function. Return 0 on success otherwise -1 */
+/*
+ * This matrix61c type is mutable, so needs init function. Return 0 on success otherwise -1.
+ * Every form takes an optional dtype keyword: the entries are built as float64 by
+ * init_entries, then converted.
+ */
 static int Matrix61c_init(PyObject *self, PyObject *args, PyObject *kwds) {
+    int dtype = DTYPE_FLOAT64;
+    PyObject *dtype_obj = kwds == NULL ? NULL : PyDict_GetItemString(kwds, "dtype");
+    if (dtype_obj == NULL) {
+        return init_entries(self, args, kwds);
+    }
+    if (!parse_dtype(dtype_obj, &dtype)) {
+        return -1;
+    }
+    PyObject *rest = PyDict_Copy(kwds);
+    if (rest == NULL || PyDict_DelItemString(rest, "dtype")) {
+        Py_XDECREF(rest);
+        return -1;
+    }
+    int failed = init_entries(self, args, PyDict_Size(rest) > 0 ? rest : NULL);
+    Py_DECREF(rest);
+    if (failed) {
+        return failed;
+    }
+    Matrix61c *mat = (Matrix61c *) self;
+    mat->mat = as_dtype(mat->mat, dtype);
+    return mat->mat == NULL ? -1 : 0;
+}
+
+/* Matrix61c_init without the dtype keyword */
+static int init_entries(PyObject *self, PyObject *args, PyObject *kwds) {
     /* Generate random matrices */
     if (kwds != NULL) {
         PyObject *rand = PyDict_GetItemString(kwds, "rand");
@@ -174,10 +312,10 @@ static int Matrix61c_init(PyObject *self, PyObject *args, PyObject *kwds) {
             }
             else
                 return init_fill(self, PyLong_AsLong(arg1), PyLong_AsLong(arg2), PyFloat_AsDouble(arg3));
-        } else if (arg1 && arg2 && arg3 && PyLong_Check(arg1) && PyLong_Check(arg2) && PyList_Check(arg3)) {
+        } else if (arg1 && arg2 && arg3 && PyLong_Check(arg1) && PyLong_Check(arg2) && is_list_or_tuple(arg3)) {
             /* Matrix(rows, cols, 1D list) */
             return init_1d(self, PyLong_AsLong(arg1), PyLong_AsLong(arg2), arg3);
-        } else if (arg1 && PyList_Check(arg1) && arg2 == NULL && arg3 == NULL) {
+        } else if (arg1 && is_list_or_tuple(arg1) && arg2 == NULL && arg3 == NULL) {
             /* Matrix(rows, cols, 1D list) */
             return init_2d(self, arg1);
         } else if (arg1 && arg2 && PyLong_Check(arg1) && PyLong_Check(arg2) && arg3 == NULL) {
@@ -193,258 +331,1922 @@ static int Matrix61c_init(PyObject *self, PyObject *args, PyObject *kwds) {
     }
 }
 
-/* List of lists representations for matrices */
-static PyObject *Matrix61c_to_list(Matrix61c *self) {
-    int rows = self->mat->rows;
-    int cols = self->mat->cols;
-    PyObject *py_lst = PyList_New(rows);
-    for (int i = 0; i < rows; i++) {
-        PyList_SetItem(py_lst, i, PyList_New(cols));
-        PyObject *curr_row = PyList_GetItem(py_lst, i);
-        for (int j = 0; j < cols; j++) {
-            PyList_SetItem(curr_row, j, PyFloat_FromDouble(get(self->mat, i, j)));
-        }
-    }
-    return py_lst;
-}
+/* LAZY EVALUATION */
 
-static PyObject *Matrix61c_class_to_list(Matrix61c *self, PyObject *args) {
-    PyObject *mat = NULL;
-    if (PyArg_UnpackTuple(args, "args", 1, 1, &mat)) {
-        if (!PyObject_TypeCheck(mat, &Matrix61cType)) {
-            PyErr_SetString(PyExc_TypeError, "Argument must of type numc.Matrix!");
-            return NULL;
-        }
-        Matrix61c* mat61c = (Matrix61c*)mat;
-        return Matrix61c_to_list(mat61c);
+/* Returns the shape of a numc.Matrix, whether or not it is a pending lazy expression */
+static void matrix_shape(Matrix61c *self, int *rows, int *cols) {
+    if (self->lazy != NULL) {
+        *rows = self->lazy->rows;
+        *cols = self->lazy->cols;
     } else {
-        PyErr_SetString(PyExc_TypeError, "Invalid arguments");
-        return NULL;
+        *rows = self->mat->rows;
+        *cols = self->mat->cols;
     }
 }
 
-/* Add class methods */
-static PyMethodDef Matrix61c_class_methods[] = {
-    {"to_list", (PyCFunction)Matrix61c_class_to_list, METH_VARARGS, "Returns a list representation of numc.Matrix"},
-    {NULL, NULL, 0, NULL}
-};
+/*
+ * Whether a numc.Matrix can be an operand of a lazy expression: fused kernels need contiguous
+ * float64 data
+ */
+static int lazy_operand(Matrix61c *self) {
+    return self->lazy != NULL || (is_contiguous(self->mat) && self->mat->dtype == DTYPE_FLOAT64);
+}
 
-/* Matrix61c string representation. For printing purposes. */
-static PyObject *Matrix61c_repr(PyObject *self) {
-    PyObject *py_lst = Matrix61c_to_list((Matrix61c *)self);
-    return PyObject_Repr(py_lst);
+/* Returns the number of fused instructions needed to evaluate a numc.Matrix */
+static int lazy_size(Matrix61c *self) {
+    return self->lazy != NULL ? self->lazy->size : 1;
 }
 
-/* For __getitem__. (e.g. mat[0]) */
-static PyObject *Matrix61c_subscript(Matrix61c* self, PyObject* key) {
-    if (!PyLong_Check(key)) {
-        PyErr_SetString(PyExc_TypeError, "Key is not valid");
-        return NULL;
+/*
+ * Appends the postfix program evaluating `self` to `ops` at index `n`, and the numc.Matrix each
+ * load reads from to `leaves` at the same index (NULL for other instructions). Returns the new
+ * length.
+ */
+static int lazy_emit(Matrix61c *self, fused_op *ops, PyObject **leaves, int n) {
+    lazy_expr *expr = self->lazy;
+    if (expr == NULL) {
+        ops[n].op = FUSED_LOAD;
+        ops[n].data = self->mat->data;
+        leaves[n] = (PyObject *) self;
+        return n + 1;
+    }
+    n = lazy_emit((Matrix61c *) expr->args[0], ops, leaves, n);
+    if (expr->args[1] != NULL) {
+        n = lazy_emit((Matrix61c *) expr->args[1], ops, leaves, n);
+    }
+    ops[n].op = expr->op;
+    ops[n].data = NULL;
+    leaves[n] = NULL;
+    return n + 1;
+}
+
+/*
+ * Evaluates a pending lazy expression into a newly allocated matrix with a single fused kernel,
+ * then drops the expression. Does nothing for a matrix that is not lazy.
+ * Large expressions are evaluated with the GIL released, like every other kernel. The expression
+ * is marked as being forced meanwhile, so that other threads forcing it wait for the result
+ * rather than evaluating or freeing it a second time, and the matrix and every leaf it reads
+ * gain a reference until the kernel is done.
+ * Returns 0 on success and -1 with an exception set on failure.
+ */
+static int Matrix61c_force(Matrix61c *self) {
+    lazy_expr *expr;
+    while ((expr = self->lazy) != NULL && expr->forcing) {
+        Py_BEGIN_ALLOW_THREADS
+        sched_yield();
+        Py_END_ALLOW_THREADS
     }
-    int index = PyLong_AsLong(key);
-    if (index >= self->mat->rows || index < 0) {
-        PyErr_SetString(PyExc_IndexError, "Index out of range");
+    if (expr == NULL) {
+        return 0;
+    }
+    matrix *result;
+    fused_op *ops = PyMem_Malloc(expr->size * sizeof(fused_op));
+    /* The matrix itself, then the leaf of each instruction */
+    PyObject **refs = PyMem_Malloc((expr->size + 1) * sizeof(PyObject *));
+    if (ops == NULL || refs == NULL || allocate_matrix_uninitialized(&result, expr->rows, expr->cols)) {
+        PyMem_Free(ops);
+        PyMem_Free(refs);
+        PyErr_NoMemory();
+        return -1;
+    }
+    unsigned long long start = stats_clock();
+    refs[0] = (PyObject *) self;
+    int n_ops = lazy_emit(self, ops, refs + 1, 0);
+    /* Every instruction other than a load is one operation per entry */
+    int arithmetic = 0;
+    for (int i = 0; i < n_ops; i++) {
+        arithmetic += ops[i].op != FUSED_LOAD;
+    }
+    double flops = (double) arithmetic * result->rows * result->cols;
+    expr->forcing = 1;
+    PyThreadState *state = release_gil(flops, refs, n_ops + 1);
+    int failed = fused_matrix(result, ops, n_ops);
+    acquire_gil(state, refs, n_ops + 1);
+    expr->forcing = 0;
+    PyMem_Free(ops);
+    PyMem_Free(refs);
+    if (failed) {
+        deallocate_matrix(result);
+        free(result);
+        PyErr_SetString(PyExc_RuntimeError, "numc kernel failed");
+        return -1;
+    }
+    self->mat = result;
+    self->lazy = NULL;
+    lazy_free(expr);
+    record_op(STAT_FUSED, start, result->rows, result->cols, flops,
+              (size_t) result->rows * result->cols * sizeof(double));
+    return 0;
+}
+
+/*
+ * Returns a new lazy numc.Matrix standing for `op mat1` or `mat1 op mat2`, where op is one of
+ * the element-wise FUSED_* instructions. The shapes must already have been checked.
+ */
+static PyObject *Matrix61c_lazy(int op, Matrix61c *mat1, Matrix61c *mat2) {
+    int size = 1 + lazy_size(mat1) + (mat2 != NULL ? lazy_size(mat2) : 0);
+    if (size > LAZY_MAX_OPS) {
+        if (Matrix61c_force(mat1) || (mat2 != NULL && Matrix61c_force(mat2))) {
+            return NULL;
+        }
+        size = mat2 != NULL ? 3 : 2;
+    }
+    lazy_expr *expr = PyMem_Malloc(sizeof(lazy_expr));
+    if (expr == NULL) {
+        return PyErr_NoMemory();
+    }
+    expr->op = op;
+    expr->args[0] = (PyObject *) mat1;
+    expr->args[1] = (PyObject *) mat2;
+    Py_INCREF(mat1);
+    Py_XINCREF(mat2);
+    expr->size = size;
+    matrix_shape(mat1, &expr->rows, &expr->cols);
+    expr->forcing = 0;
+    expr->owner = NULL;
+    expr->prev = expr->next = NULL;
+
+    Matrix61c *rv = (Matrix61c *) Matrix61c_new(&Matrix61cType, NULL, NULL);
+    if (rv == NULL) {
+        lazy_free(expr);
         return NULL;
     }
-    if (self->mat->cols == 1) { // if one single number, unwrap from list
-        return PyFloat_FromDouble(get(self->mat, index, 0));
+    rv->lazy = expr;
+    expr->owner = (PyObject *) rv;
+    expr->next = lazy_pending;
+    if (lazy_pending != NULL) {
+        lazy_pending->prev = expr;
     }
-    matrix *new_mat;
-    int ref_failed = allocate_matrix_ref(&new_mat, self->mat, index * self->mat->cols, self->mat->cols, 1);
-    if (ref_failed != 0) {
-        PyErr_SetString(PyExc_RuntimeError, "Failed to allocate slice");
+    lazy_pending = expr;
+    rv->shape = Py_BuildValue("(ii)", expr->rows, expr->cols);
+    if (rv->shape == NULL) {
+        Py_DECREF(rv);
         return NULL;
     }
-    Matrix61c* rv = (Matrix61c*) Matrix61c_new(&Matrix61cType, NULL, NULL);
-    rv->mat = new_mat;
-    rv->shape = PyTuple_Pack(2, PyLong_FromLong(new_mat->rows), PyLong_FromLong(1));
-    return (PyObject*)rv;
+    return (PyObject *) rv;
 }
 
-/* For __setitem__ (e.g. mat[0] = 1) */
-static int Matrix61c_set_subscript(Matrix61c* self, PyObject *key, PyObject *v) {
-    if (!PyLong_Check(key)) {
-        PyErr_SetString(PyExc_TypeError, "Key is not valid");
-        return -1;
+/* Returns whether evaluating a numc.Matrix reads memory shared with mat */
+static int lazy_reads(Matrix61c *self, matrix *mat) {
+    lazy_expr *expr = self->lazy;
+    if (expr == NULL) {
+        return shares_memory(self->mat, mat);
     }
-    int index = PyLong_AsLong(key);
-    if (index >= self->mat->rows || index < 0) {
-        PyErr_SetString(PyExc_IndexError, "Index out of range");
+    return lazy_reads((Matrix61c *) expr->args[0], mat) ||
+           (expr->args[1] != NULL && lazy_reads((Matrix61c *) expr->args[1], mat));
+}
+
+/*
+ * Prepares a numc.Matrix for having its entries written in place: evaluates it if it is lazy,
+ * then every pending lazy expression that reads memory shared with it, so that a write never
+ * changes the result of an expression built before it.
+ * Returns 0 on success and -1 with an exception set on failure.
+ */
+static int Matrix61c_prepare_write(Matrix61c *self) {
+    if (Matrix61c_force(self)) {
         return -1;
     }
-    int cols = self->mat->cols;
-    if (cols == 1) {
-        if (!PyFloat_Check(v) && !PyLong_Check(v)) {
-            PyErr_SetString(PyExc_TypeError, "Value is not valid");
-            return -1;
+    lazy_expr *expr = lazy_pending;
+    while (expr != NULL) {
+        if (!lazy_reads((Matrix61c *) expr->owner, self->mat)) {
+            expr = expr->next;
+            continue;
         }
-        double val = PyFloat_AsDouble(v);
-        set(self->mat, index, 0, val);
-        return 0;
-    } else {
-        if (!PyList_Check(v)) {
-            PyErr_SetString(PyExc_TypeError, "Value is not valid");
+        if (Matrix61c_force((Matrix61c *) expr->owner)) {
             return -1;
         }
-        for (int i = 0; i < cols; i++) {
-            if (!PyFloat_Check(PyList_GetItem(v, i)) && !PyLong_Check(PyList_GetItem(v, i))) {
-                PyErr_SetString(PyExc_ValueError, "Value is not valid");
-                return -1;
-            }
-            set(self->mat, index, i, PyFloat_AsDouble(PyList_GetItem(v, i)));
-        }
-        return 0;
+        /* Evaluating drops references to operands, which may free other pending expressions */
+        expr = lazy_pending;
     }
-    return -1;
+    return 0;
 }
 
-static PyMappingMethods Matrix61c_mapping = {
-    NULL,
-    (binaryfunc) Matrix61c_subscript,
-    (objobjargproc) Matrix61c_set_subscript,
-};
-
-/* NUMBER METHODS */
-
 /*
- * Add the second numc.Matrix (Matrix61c) object to the first one. The first operand is
- * self, and the second operand can be obtained by casting `args`.
+ * numc.set_lazy(enabled). Turns lazy mode on or off and returns the previous setting.
+ * In lazy mode +, -, unary - and abs() do not compute anything. They return a numc.Matrix
+ * holding the expression, which is evaluated in one fused pass over memory once its entries
+ * are read (get, indexing, to_list, numc.eval, ...) or it is used by any other operation.
+ * Writing in place into an operand (indexing, out=, +=, ...) first evaluates the pending
+ * expressions that read it, so results are the same as in eager mode. Writes made through an
+ * exported buffer after the expression was built are not tracked.
  */
-static PyObject *Matrix61c_add(Matrix61c* self, PyObject* args) {
-    if (Py_TYPE(self) != &Matrix61cType || Py_TYPE(args) != &Matrix61cType) {
-        PyErr_SetString(PyExc_TypeError, "unsupported operand type(s) for +");
+static PyObject *Matrix61c_class_set_lazy(PyObject *self, PyObject *args) {
+    int enabled;
+    if (!PyArg_ParseTuple(args, "p", &enabled)) {
         return NULL;
     }
+    PyObject *previous = PyBool_FromLong(lazy_mode);
+    lazy_mode = enabled;
+    return previous;
+}
 
-    int rows = self->mat->rows, cols = self->mat->cols;
-    matrix *mat;
-    allocate_matrix(&mat, rows, cols);
-    int failed = add_matrix(mat, self->mat, ((Matrix61c *)args)->mat);
-    if (failed) {
-        deallocate_matrix(mat);
-        free(mat);
-        PyErr_SetString(PyExc_ValueError, "matrices of different shapes added");
-        return NULL;
+/*
+ * numc.eval(*mats). Evaluates the given lazy matrices. Returns the matrix when given one, and
+ * a tuple of them otherwise.
+ */
+static PyObject *Matrix61c_class_eval(PyObject *self, PyObject *args) {
+    Py_ssize_t n = PyTuple_GET_SIZE(args);
+    for (Py_ssize_t i = 0; i < n; i++) {
+        PyObject *mat = PyTuple_GET_ITEM(args, i);
+        if (!PyObject_TypeCheck(mat, &Matrix61cType)) {
+            PyErr_SetString(PyExc_TypeError, "Argument must of type numc.Matrix!");
+            return NULL;
+        }
+        if (Matrix61c_force((Matrix61c *) mat)) {
+            return NULL;
+        }
     }
+    if (n == 1) {
+        Py_INCREF(PyTuple_GET_ITEM(args, 0));
+        return PyTuple_GET_ITEM(args, 0);
+    }
+    Py_INCREF(args);
+    return args;
+}
 
-    PyObject *result = Matrix61c_new(&Matrix61cType, NULL, NULL);
-    ((Matrix61c *)result)->mat = mat;
-    ((Matrix61c *)result)->shape = PyTuple_Pack(2, PyLong_FromLong(rows), PyLong_FromLong(cols));
-    return result;
+/*
+ * MEMORY POOL
+ */
+
+/* numc.pool_stats(): returns the counters of the pool matrix data is allocated from, as a dict */
+static PyObject *Matrix61c_class_pool_stats(PyObject *self, PyObject *args) {
+    pool_stats stats;
+    pool_get_stats(&stats);
+    return Py_BuildValue("{s:n,s:n,s:n,s:n,s:n,s:n,s:n}",
+                         "allocs", (Py_ssize_t) stats.allocs,
+                         "hits", (Py_ssize_t) stats.hits,
+                         "frees", (Py_ssize_t) stats.frees,
+                         "live_bytes", (Py_ssize_t) stats.live_bytes,
+                         "peak_bytes", (Py_ssize_t) stats.peak_bytes,
+                         "cached_blocks", (Py_ssize_t) stats.cached_blocks,
+                         "cached_bytes", (Py_ssize_t) stats.cached_bytes);
+}
+
+/* numc.pool_trim(): returns the blocks the pool keeps for reuse to the system */
+static PyObject *Matrix61c_class_pool_trim(PyObject *self, PyObject *args) {
+    pool_trim();
+    Py_RETURN_NONE;
 }
 
 /*
- * (OPTIONAL) Subtract the second numc.Matrix (Matrix61c) object from the first one. The first operand is
- * self, and the second operand can be obtained by casting `args`.
+ * PROFILING
+ * Every operation on numc.Matrix objects is counted once it has succeeded, with the GIL held,
+ * so the counters need no locking. Timing an operation costs two clock reads.
  */
-static PyObject *Matrix61c_sub(Matrix61c* self, PyObject* args) {
-    /* TODO: YOUR CODE HERE */
-    return 0;
+static const char *const stat_names[NUM_STATS] = {"add", "sub", "mul", "div", "pow", "neg", "abs", "slice", "fused"};
+static op_counter op_counters[NUM_STATS];
+static size_t allocs_at_reset, frees_at_reset; // pool counters when the stats were last reset
+static PyObject *stats_callback = NULL; // set by numc.set_stats_callback, or NULL
+
+/* Returns a monotonic timestamp in nanoseconds */
+static unsigned long long stats_clock(void) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return now.tv_sec * 1000000000ULL + now.tv_nsec;
 }
 
 /*
- * NOT element-wise multiplication. The first operand is self, and the second operand
- * can be obtained by casting `args`.
+ * Counts an operation of kind `stat` that started at `start` (see stats_clock), produced a
+ * rows x cols result and took `flops` nominal floating-point operations. `bytes` is the size of
+ * the result matrix it allocated, 0 if it wrote into an existing one. Then calls the callback
+ * set with numc.set_stats_callback, if any. Errors the callback raises are reported as
+ * unraisable, so that tracing never fails an operation.
  */
-static PyObject *Matrix61c_multiply(Matrix61c* self, PyObject *args) {
-    if (Py_TYPE(self) != &Matrix61cType || Py_TYPE(args) != &Matrix61cType) {
-        PyErr_SetString(PyExc_TypeError, "unsupported operand type(s) for +");
-        return NULL;
+static void record_op(int stat, unsigned long long start, int rows, int cols, double flops, size_t bytes) {
+    unsigned long long ns = stats_clock() - start;
+    op_counter *counter = &op_counters[stat];
+    counter->calls++;
+    counter->ns += ns;
+    counter->flops += (unsigned long long) flops;
+    counter->bytes += bytes;
+    if (stats_callback != NULL) {
+        /* The callback may replace itself */
+        PyObject *callback = stats_callback;
+        Py_INCREF(callback);
+        PyObject *rv = PyObject_CallFunction(callback, "s(ii)K", stat_names[stat], rows, cols, ns);
+        if (rv == NULL) {
+            PyErr_WriteUnraisable(callback);
+        }
+        Py_XDECREF(rv);
+        Py_DECREF(callback);
     }
+}
 
-    int rows = self->mat->rows, cols = ((Matrix61c *)args)->mat->cols;
-    matrix *mat;
-    allocate_matrix(&mat, rows, cols);
-    int failed = mul_matrix(mat, self->mat, ((Matrix61c *)args)->mat);
-    if (failed) {
-        deallocate_matrix(mat);
-        free(mat);
-        PyErr_SetString(PyExc_ValueError, "matrices of unmatched shape multiplied");
+/* Bytes allocated for the rows x cols result of `dtype` of an operation writing into `out` */
+static size_t result_bytes(Matrix61c *out, int rows, int cols, int dtype) {
+    return out != NULL ? 0 : (size_t) rows * cols * dtype_size(dtype);
+}
+
+/*
+ * numc.stats(): returns a dict with, under "ops", the calls, nanoseconds, nominal floating-point
+ * operations and result bytes allocated of each kind of operation, and the blocks allocated and
+ * freed, the bytes live and the peak of live bytes of the matrix data pool, all since the last
+ * numc.reset_stats(). Pool bytes include the scratch space of kernels.
+ */
+static PyObject *Matrix61c_class_stats(PyObject *self, PyObject *args) {
+    PyObject *ops = PyDict_New();
+    if (ops == NULL) {
         return NULL;
     }
+    for (int i = 0; i < NUM_STATS; i++) {
+        op_counter *counter = &op_counters[i];
+        PyObject *entry = Py_BuildValue("{s:K,s:K,s:K,s:K}", "calls", counter->calls, "ns", counter->ns,
+                                        "flops", counter->flops, "bytes", counter->bytes);
+        if (entry == NULL || PyDict_SetItemString(ops, stat_names[i], entry)) {
+            Py_XDECREF(entry);
+            Py_DECREF(ops);
+            return NULL;
+        }
+        Py_DECREF(entry);
+    }
+    pool_stats pool;
+    pool_get_stats(&pool);
+    return Py_BuildValue("{s:N,s:n,s:n,s:n,s:n}", "ops", ops,
+                         "allocs", (Py_ssize_t) (pool.allocs - allocs_at_reset),
+                         "frees", (Py_ssize_t) (pool.frees - frees_at_reset),
+                         "live_bytes", (Py_ssize_t) pool.live_bytes,
+                         "peak_bytes", (Py_ssize_t) pool.peak_bytes);
+}
 
-    PyObject *result = Matrix61c_new(&Matrix61cType, NULL, NULL);
-    ((Matrix61c *)result)->mat = mat;
-    ((Matrix61c *)result)->shape = PyTuple_Pack(2, PyLong_FromLong(rows), PyLong_FromLong(cols));
-    return result;
+/* numc.reset_stats(): zeroes the counters of numc.stats() and restarts the peak from live bytes */
+static PyObject *Matrix61c_class_reset_stats(PyObject *self, PyObject *args) {
+    memset(op_counters, 0, sizeof(op_counters));
+    pool_stats pool;
+    pool_reset_peak();
+    pool_get_stats(&pool);
+    allocs_at_reset = pool.allocs;
+    frees_at_reset = pool.frees;
+    Py_RETURN_NONE;
 }
 
 /*
- * (OPTIONAL) Negates the given numc.Matrix.
+ * numc.set_stats_callback(callback): calls callback(op, shape, ns) after every operation counted
+ * by numc.stats(), with the name of the operation, the shape of its result and its duration in
+ * nanoseconds. None removes the callback.
  */
-static PyObject *Matrix61c_neg(Matrix61c* self) {
-    /* TODO: YOUR CODE HERE */
-    return 0;
+static PyObject *Matrix61c_class_set_stats_callback(PyObject *self, PyObject *callback) {
+    if (callback != Py_None && !PyCallable_Check(callback)) {
+        PyErr_SetString(PyExc_TypeError, "callback must be callable or None");
+        return NULL;
+    }
+    Py_XDECREF(stats_callback);
+    stats_callback = callback == Py_None ? NULL : callback;
+    Py_XINCREF(stats_callback);
+    Py_RETURN_NONE;
 }
 
 /*
- * Take the element-wise absolute value of this numc.Matrix.
+ * THREADING
  */
-static PyObject *Matrix61c_abs(Matrix61c *self) {
-    if (Py_TYPE(self) != &Matrix61cType) {
-        PyErr_SetString(PyExc_TypeError, "unsupported operand type(s) for +");
-        return NULL;
+
+/* Parses the argument of set_num_threads and threads: a positive number of threads, or None for OpenMP's default */
+static int parse_num_threads(PyObject *obj, int *threads) {
+    if (obj == Py_None) {
+        *threads = 0;
+        return 0;
+    }
+    long value = PyLong_AsLong(obj);
+    if (value == -1 && PyErr_Occurred()) {
+        return -1;
+    }
+    if (value < 1 || value > INT_MAX) {
+        PyErr_SetString(PyExc_ValueError, "number of threads must be positive");
+        return -1;
     }
+    *threads = value;
+    return 0;
+}
 
-    int rows = self->mat->rows, cols = self->mat->cols;
-    matrix *mat;
-    allocate_matrix(&mat, rows, cols);
-    int failed = abs_matrix(mat, self->mat);
-    if (failed) {
-        deallocate_matrix(mat);
-        free(mat);
-        PyErr_SetString(PyExc_ValueError, "failed");
+/*
+ * numc.set_num_threads(n): runs every kernel on at most n threads, or on OpenMP's default number
+ * if n is None. The limit applies to the whole process, whichever thread calls the kernels,
+ * except inside numc.threads blocks, whose limit takes precedence on their own thread.
+ */
+static PyObject *Matrix61c_class_set_num_threads(PyObject *self, PyObject *arg) {
+    int threads;
+    if (parse_num_threads(arg, &threads)) {
         return NULL;
     }
+    set_num_threads(threads);
+    Py_RETURN_NONE;
+}
 
-    PyObject *result = Matrix61c_new(&Matrix61cType, NULL, NULL);
-    ((Matrix61c *)result)->mat = mat;
-    ((Matrix61c *)result)->shape = PyTuple_Pack(2, PyLong_FromLong(rows), PyLong_FromLong(cols));
-    return result;
+/* numc.get_num_threads(): returns the number of threads kernels called from this thread run on */
+static PyObject *Matrix61c_class_get_num_threads(PyObject *self, PyObject *args) {
+    return PyLong_FromLong(get_num_threads());
+}
+
+/* Returns the KERNEL_* value named `name`, or -1 with an exception set */
+static int parse_kernel(const char *name) {
+    for (int kernel = 0; kernel < NUM_KERNELS; kernel++) {
+        if (strcmp(name, kernel_name(kernel)) == 0) {
+            return kernel;
+        }
+    }
+    PyErr_Format(PyExc_ValueError, "unknown kernel '%s'", name);
+    return -1;
 }
 
 /*
- * Raise numc.Matrix (Matrix61c) to the `pow`th power. You can ignore the argument `optional`.
+ * numc.get_parallel_cutoffs(): returns a dict from kernel name to the smallest amount of work
+ * for which the kernel runs on more than one thread
  */
-static PyObject *Matrix61c_pow(Matrix61c *self, PyObject *pow, PyObject *optional) {
-    if (Py_TYPE(self) != &Matrix61cType) {
-        PyErr_SetString(PyExc_TypeError, "unsupported operand type(s) for +");
+static PyObject *Matrix61c_class_get_parallel_cutoffs(PyObject *self, PyObject *args) {
+    PyObject *cutoffs = PyDict_New();
+    if (cutoffs == NULL) {
         return NULL;
     }
-
-    int rows = self->mat->rows, cols = self->mat->cols;
-    matrix *mat;
-    allocate_matrix(&mat, rows, cols);
-    int failed = pow_matrix(mat, self->mat, PyLong_AsLong(pow));
-    if (failed) {
-        deallocate_matrix(mat);
-        free(mat);
-        PyErr_SetString(PyExc_ValueError, "non-square matrix powered");
-        return NULL;
+    for (int kernel = 0; kernel < NUM_KERNELS; kernel++) {
+        PyObject *value = PyLong_FromLong(get_parallel_cutoff(kernel));
+        if (value == NULL || PyDict_SetItemString(cutoffs, kernel_name(kernel), value)) {
+            Py_XDECREF(value);
+            Py_DECREF(cutoffs);
+            return NULL;
+        }
+        Py_DECREF(value);
     }
-
-    PyObject *result = Matrix61c_new(&Matrix61cType, NULL, NULL);
-    ((Matrix61c *)result)->mat = mat;
-    ((Matrix61c *)result)->shape = PyTuple_Pack(2, PyLong_FromLong(rows), PyLong_FromLong(cols));
-    return result;
+    return cutoffs;
 }
 
 /*
- * Create a PyNumberMethods struct for overloading operators with all the number methods you have
- * define. You might find this link helpful: https://docs.python.org/3.6/c-api/typeobj.html
+ * numc.set_parallel_cutoff(kernel, cutoff): makes the named kernel run on a single thread when
+ * given less work than `cutoff`. The defaults can also be set with the NUMC_CUTOFF_<KERNEL>
+ * environment variables, such as NUMC_CUTOFF_GEMM, when numc is imported.
  */
-static PyNumberMethods Matrix61c_as_number = {
-        .nb_add = (binaryfunc) Matrix61c_add,
-        .nb_multiply = (binaryfunc) Matrix61c_multiply,
-        .nb_absolute = (unaryfunc) Matrix61c_abs,
-        .nb_power = (ternaryfunc) Matrix61c_pow,
-};
+static PyObject *Matrix61c_class_set_parallel_cutoff(PyObject *self, PyObject *args) {
+    const char *name;
+    long cutoff;
+    if (!PyArg_ParseTuple(args, "sl", &name, &cutoff)) {
+        return NULL;
+    }
+    int kernel = parse_kernel(name);
+    if (kernel < 0) {
+        return NULL;
+    }
+    if (cutoff < 0) {
+        PyErr_SetString(PyExc_ValueError, "cutoff must not be negative");
+        return NULL;
+    }
+    set_parallel_cutoff(kernel, cutoff);
+    Py_RETURN_NONE;
+}
 
+/* Names of the STRASSEN_* modes */
+static const char *const strassen_modes[] = {"off", "auto", "on"};
 
-/* INSTANCE METHODS */
 /*
- * Given a numc.Matrix self, parse `args` to (int) row, (int) col, and (double/int) val.
- * This function should return None in Python.
+ * numc.set_strassen(mode, crossover=None): selects when square float64 products and powers use
+ * Strassen-Winograd. "auto" uses it for orders above the crossover that halve evenly down to it,
+ * such as powers of two, "on" for all orders above the crossover, padding them with zeros, and
+ * "off" never. Products of at most `crossover` rows are left to the classic kernel.
+ */
+static PyObject *Matrix61c_class_set_strassen(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"mode", "crossover", NULL};
+    const char *name;
+    int crossover = 0;
+    PyObject *crossover_obj = Py_None;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "s|O", kwlist, &name, &crossover_obj)) {
+        return NULL;
+    }
+    int mode = -1;
+    for (int i = 0; i < 3; i++) {
+        if (strcmp(name, strassen_modes[i]) == 0) {
+            mode = i;
+        }
+    }
+    if (mode < 0) {
+        PyErr_Format(PyExc_ValueError, "mode must be 'auto', 'on' or 'off', not '%s'", name);
+        return NULL;
+    }
+    if (crossover_obj != Py_None) {
+        long value = PyLong_AsLong(crossover_obj);
+        if (value == -1 && PyErr_Occurred()) {
+            return NULL;
+        }
+        if (value < 1 || value > INT_MAX) {
+            PyErr_SetString(PyExc_ValueError, "crossover must be a positive int");
+            return NULL;
+        }
+        crossover = value;
+    }
+    set_strassen(mode, crossover);
+    Py_RETURN_NONE;
+}
+
+/* numc.get_strassen(): returns the (mode, crossover) set by numc.set_strassen */
+static PyObject *Matrix61c_class_get_strassen(PyObject *self, PyObject *args) {
+    return Py_BuildValue("(si)", strassen_modes[get_strassen_mode()], get_strassen_crossover());
+}
+
+/*
+ * with numc.threads(n): limits the kernels the current thread calls to n threads (None for the
+ * default) inside the block. Other Python threads keep their own limits, see set_thread_limit.
+ */
+typedef struct {
+    PyObject_HEAD
+    int threads; // limit set on entry, 0 for OpenMP's default
+    int previous; // limit of the entering thread restored on exit, negative for none
+} ThreadLimit;
+
+static PyObject *ThreadLimit_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"n", NULL};
+    PyObject *n;
+    int threads;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O", kwlist, &n) || parse_num_threads(n, &threads)) {
+        return NULL;
+    }
+    ThreadLimit *self = (ThreadLimit *) type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self->threads = threads;
+    }
+    return (PyObject *) self;
+}
+
+static PyObject *ThreadLimit_enter(ThreadLimit *self, PyObject *args) {
+    self->previous = set_thread_limit(self->threads);
+    Py_INCREF(self);
+    return (PyObject *) self;
+}
+
+static PyObject *ThreadLimit_exit(ThreadLimit *self, PyObject *args) {
+    set_thread_limit(self->previous);
+    Py_RETURN_FALSE;
+}
+
+static PyMethodDef ThreadLimit_methods[] = {
+    {"__enter__", (PyCFunction) ThreadLimit_enter, METH_NOARGS, NULL},
+    {"__exit__", (PyCFunction) ThreadLimit_exit, METH_VARARGS, NULL},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject ThreadLimitType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "numc.threads",
+    .tp_basicsize = sizeof(ThreadLimit),
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "threads(n): context manager limiting numc kernels called from the current thread to n threads inside its block",
+    .tp_methods = ThreadLimit_methods,
+    .tp_new = ThreadLimit_new,
+};
+
+/* List of lists representations for matrices */
+static PyObject *Matrix61c_to_list(Matrix61c *self) {
+    if (Matrix61c_force(self)) {
+        return NULL;
+    }
+    matrix *mat = self->mat;
+    PyObject *py_lst = PyList_New(mat->rows);
+    if (py_lst == NULL) {
+        return NULL;
+    }
+    for (int i = 0; i < mat->rows; i++) {
+        PyObject *curr_row = PyList_New(mat->cols);
+        if (curr_row == NULL) {
+            Py_DECREF(py_lst);
+            return NULL;
+        }
+        PyList_SET_ITEM(py_lst, i, curr_row);
+        for (int j = 0; j < mat->cols; j++) {
+            PyObject *val = entry_object(mat, i, j);
+            if (val == NULL) {
+                Py_DECREF(py_lst);
+                return NULL;
+            }
+            PyList_SET_ITEM(curr_row, j, val);
+        }
+    }
+    return py_lst;
+}
+
+static PyObject *Matrix61c_class_to_list(Matrix61c *self, PyObject *args) {
+    PyObject *mat = NULL;
+    if (PyArg_UnpackTuple(args, "args", 1, 1, &mat)) {
+        if (!PyObject_TypeCheck(mat, &Matrix61cType)) {
+            PyErr_SetString(PyExc_TypeError, "Argument must of type numc.Matrix!");
+            return NULL;
+        }
+        Matrix61c* mat61c = (Matrix61c*)mat;
+        return Matrix61c_to_list(mat61c);
+    } else {
+        PyErr_SetString(PyExc_TypeError, "Invalid arguments");
+        return NULL;
+    }
+}
+
+/* mat.tolist(): returns the entries of mat as a list of rows, like numc.to_list(mat) */
+static PyObject *Matrix61c_tolist(Matrix61c *self, PyObject *args) {
+    return Matrix61c_to_list(self);
+}
+
+/*
+ * mat.tobytes(): returns the entries of mat as native values of its dtype in row-major order,
+ * the layout Matrix.frombytes reads. Contiguous data is copied with a single memcpy.
+ */
+static PyObject *Matrix61c_tobytes(Matrix61c *self, PyObject *args) {
+    if (Matrix61c_force(self)) {
+        return NULL;
+    }
+    matrix *mat = self->mat;
+    PyObject *bytes = PyBytes_FromStringAndSize(NULL, (Py_ssize_t) mat->rows * mat->cols * dtype_size(mat->dtype));
+    if (bytes == NULL) {
+        return NULL;
+    }
+    gather_matrix(PyBytes_AS_STRING(bytes), mat);
+    return bytes;
+}
+
+/* Sets the Python error for a failed load_matrix or save_matrix call on `path` */
+static void set_file_error(int failed, PyObject *path) {
+    if (failed == -2) {
+        PyErr_NoMemory();
+    } else if (failed == -3) {
+        PyErr_SetFromErrnoWithFilenameObject(PyExc_OSError, path);
+    } else {
+        PyErr_Format(PyExc_ValueError, "%R is not a valid matrix file", path);
+    }
+}
+
+/*
+ * numc.load(path, mmap=True, dtype="float64"). Loads a matrix saved by numc.save or in the
+ * int32 layout of proj2's .bin files, as a matrix of `dtype`. With mmap=True a file whose
+ * entries already are of `dtype`, such as a .bin file loaded with dtype="int32", is mapped
+ * instead of read up front.
+ */
+static PyObject *Matrix61c_class_load(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"path", "mmap", "dtype", NULL};
+    PyObject *path = NULL, *encoded = NULL;
+    int use_mmap = 1, dtype = DTYPE_FLOAT64;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|pO&", kwlist, &path, &use_mmap, parse_dtype, &dtype) ||
+            !PyUnicode_FSConverter(path, &encoded)) {
+        return NULL;
+    }
+    matrix *mat;
+    int failed;
+    Py_BEGIN_ALLOW_THREADS
+    failed = load_matrix(&mat, PyBytes_AS_STRING(encoded), use_mmap, dtype);
+    Py_END_ALLOW_THREADS
+    Py_DECREF(encoded);
+    if (failed) {
+        set_file_error(failed, path);
+        return NULL;
+    }
+    return Matrix61c_wrap(mat);
+}
+
+/*
+ * numc.save(path, mat, dtype=None). Writes `mat` to `path`. dtype="int32" writes the layout of
+ * proj2's .bin files, truncating every entry to an integer, and dtype="float64" the float64
+ * one. By default int32 matrices are written in the int32 layout and others in float64.
+ */
+static PyObject *Matrix61c_class_save(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"path", "mat", "dtype", NULL};
+    PyObject *path = NULL, *mat = NULL, *encoded = NULL;
+    int dtype = -1;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO!|O&", kwlist, &path, &Matrix61cType, &mat,
+                                     parse_dtype, &dtype)) {
+        return NULL;
+    }
+    if (dtype == DTYPE_FLOAT32) {
+        PyErr_SetString(PyExc_ValueError, "dtype must be 'float64' or 'int32'");
+        return NULL;
+    }
+    if (Matrix61c_force((Matrix61c *) mat) || !PyUnicode_FSConverter(path, &encoded)) {
+        return NULL;
+    }
+    int failed;
+    matrix *data = ((Matrix61c *) mat)->mat;
+    int as_int32 = dtype == DTYPE_INT32 || (dtype == -1 && data->dtype == DTYPE_INT32);
+    Py_BEGIN_ALLOW_THREADS
+    failed = save_matrix(PyBytes_AS_STRING(encoded), data, as_int32);
+    Py_END_ALLOW_THREADS
+    Py_DECREF(encoded);
+    if (failed) {
+        set_file_error(failed, path);
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+/*
+ * mat.tofile(path): writes the entries of mat to `path` as raw native values of its dtype in
+ * row-major order, without a header, with large buffered writes.
+ */
+static PyObject *Matrix61c_tofile(Matrix61c *self, PyObject *args) {
+    PyObject *path, *encoded = NULL;
+    if (!PyArg_ParseTuple(args, "O", &path) || Matrix61c_force(self) ||
+            !PyUnicode_FSConverter(path, &encoded)) {
+        return NULL;
+    }
+    int failed;
+    Py_BEGIN_ALLOW_THREADS
+    failed = dump_matrix(PyBytes_AS_STRING(encoded), self->mat);
+    Py_END_ALLOW_THREADS
+    Py_DECREF(encoded);
+    if (failed) {
+        set_file_error(failed, path);
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+/* Add class methods */
+static PyMethodDef Matrix61c_class_methods[] = {
+    {"to_list", (PyCFunction)Matrix61c_class_to_list, METH_VARARGS, "Returns a list representation of numc.Matrix"},
+    {"load", (PyCFunction)Matrix61c_class_load, METH_VARARGS | METH_KEYWORDS,
+     "load(path, mmap=True, dtype='float64'): loads a matrix file, mapping it instead of reading it "
+     "when its entries are of dtype"},
+    {"save", (PyCFunction)Matrix61c_class_save, METH_VARARGS | METH_KEYWORDS,
+     "save(path, mat, dtype=None): writes a matrix file, float64 or proj2's int32 layout"},
+    {"set_lazy", (PyCFunction)Matrix61c_class_set_lazy, METH_VARARGS,
+     "set_lazy(enabled): turns fused lazy evaluation of +, -, unary - and abs on or off"},
+    {"eval", (PyCFunction)Matrix61c_class_eval, METH_VARARGS,
+     "eval(*mats): evaluates pending lazy matrices"},
+    {"pool_stats", (PyCFunction)Matrix61c_class_pool_stats, METH_NOARGS,
+     "pool_stats(): returns the allocation counters of the matrix memory pool"},
+    {"pool_trim", (PyCFunction)Matrix61c_class_pool_trim, METH_NOARGS,
+     "pool_trim(): releases the blocks cached by the matrix memory pool"},
+    {"stats", (PyCFunction)Matrix61c_class_stats, METH_NOARGS,
+     "stats(): calls, time, FLOPs and bytes allocated per operation, and pool memory since reset_stats()"},
+    {"reset_stats", (PyCFunction)Matrix61c_class_reset_stats, METH_NOARGS,
+     "reset_stats(): zeroes the counters of stats()"},
+    {"set_stats_callback", (PyCFunction)Matrix61c_class_set_stats_callback, METH_O,
+     "set_stats_callback(callback): calls callback(op, shape, ns) after every operation, None removes it"},
+    {"set_num_threads", (PyCFunction)Matrix61c_class_set_num_threads, METH_O,
+     "set_num_threads(n): runs kernels on at most n threads, or OpenMP's default for None"},
+    {"get_num_threads", (PyCFunction)Matrix61c_class_get_num_threads, METH_NOARGS,
+     "get_num_threads(): number of threads kernels run on"},
+    {"get_parallel_cutoffs", (PyCFunction)Matrix61c_class_get_parallel_cutoffs, METH_NOARGS,
+     "get_parallel_cutoffs(): the work below which each kernel runs on a single thread"},
+    {"set_parallel_cutoff", (PyCFunction)Matrix61c_class_set_parallel_cutoff, METH_VARARGS,
+     "set_parallel_cutoff(kernel, cutoff): sets the work below which a kernel runs on a single thread"},
+    {"set_strassen", (PyCFunction)Matrix61c_class_set_strassen, METH_VARARGS | METH_KEYWORDS,
+     "set_strassen(mode, crossover=None): when large square products use Strassen-Winograd, "
+     "'auto', 'on' or 'off'"},
+    {"get_strassen", (PyCFunction)Matrix61c_class_get_strassen, METH_NOARGS,
+     "get_strassen(): the (mode, crossover) of Strassen-Winograd products"},
+    {"compare", (PyCFunction)Matrix61c_class_compare, METH_VARARGS | METH_KEYWORDS,
+     "compare(a, b, rtol=1e-05, atol=1e-08): the first entry of a not close to b, and the largest errors"},
+    {"allclose", (PyCFunction)Matrix61c_class_allclose, METH_VARARGS | METH_KEYWORDS,
+     "allclose(a, b, rtol=1e-05, atol=1e-08): whether every entry of a is close to b, like numpy.allclose"},
+    {"batch_mul", (PyCFunction)Matrix61c_class_batch_mul, METH_VARARGS,
+     "batch_mul(lhs, rhs): multiplies two equally long sequences of matrices pairwise"},
+    {"transpose", (PyCFunction)Matrix61c_class_transpose, METH_VARARGS,
+     "transpose(mat): returns a transposed copy of mat"},
+    {"arange", (PyCFunction)Matrix61c_class_arange, METH_VARARGS | METH_KEYWORDS,
+     "arange(start, stop=None, step=1, shape=None, dtype='float64'): evenly spaced values in [start, stop)"},
+    {"eye", (PyCFunction)Matrix61c_class_eye, METH_VARARGS | METH_KEYWORDS,
+     "eye(n, cols=n, dtype='float64'): identity matrix"},
+    {"uniform", (PyCFunction)Matrix61c_class_uniform, METH_VARARGS | METH_KEYWORDS,
+     "uniform(rows, cols, low=0.0, high=1.0, seed=0, dtype='float64'): reproducible uniform random matrix"},
+    {"normal", (PyCFunction)Matrix61c_class_normal, METH_VARARGS | METH_KEYWORDS,
+     "normal(rows, cols, mean=0.0, std=1.0, seed=0, dtype='float64'): reproducible normal random matrix"},
+    {NULL, NULL, 0, NULL}
+};
+
+/* Matrices with more entries than this are summarized by repr */
+#define REPR_MAX_ENTRIES 1000
+/* Number of rows and columns shown at each end of a summarized matrix */
+#define REPR_EDGE_ITEMS 3
+/* Longest repr of a double, such as -2.2250738585072014e-308, with some margin */
+#define REPR_ENTRY_MAX 32
+
+/*
+ * Returns the text of entry (i, j) of mat, to be freed with PyMem_Free: the same as repr() of
+ * the Python int or float it converts to, except that float32 entries get the shortest text
+ * that reads back as the same float32, as in numpy. Returns NULL with an exception set on failure.
+ */
+static char *entry_repr(matrix *mat, int i, int j) {
+    double val = get(mat, i, j);
+    if (mat->dtype == DTYPE_INT32) {
+        return PyOS_double_to_string(val, 'f', 0, 0, NULL);
+    }
+    if (mat->dtype == DTYPE_FLOAT32 && isfinite(val)) {
+        /* The shortest decimal that rounds to the same float32; 9 significant digits always do */
+        for (int precision = 0; precision < 9; precision++) {
+            char *digits = PyOS_double_to_string(val, 'e', precision, 0, NULL);
+            if (digits == NULL) {
+                return NULL;
+            }
+            double shortest = PyOS_string_to_double(digits, NULL, NULL);
+            PyMem_Free(digits);
+            if ((float) shortest == (float) val) {
+                val = shortest;
+                break;
+            }
+        }
+    }
+    return PyOS_double_to_string(val, 'r', 0, Py_DTSF_ADD_DOT_0, NULL);
+}
+
+/*
+ * Matrix61c string representation. For printing purposes. Small matrices look like their
+ * to_list, while larger ones show their first and last REPR_EDGE_ITEMS rows and columns around
+ * an ellipsis, so that the text has a bounded length however large the matrix is.
+ */
+static PyObject *Matrix61c_repr(PyObject *self) {
+    if (Matrix61c_force((Matrix61c *) self)) {
+        return NULL;
+    }
+    matrix *mat = ((Matrix61c *) self)->mat;
+    /* Entries shown along each dimension, leaving out the middle ones when summarizing */
+    int summarize = (long long) mat->rows * mat->cols > REPR_MAX_ENTRIES;
+    int skip_rows = summarize && mat->rows > 2 * REPR_EDGE_ITEMS;
+    int skip_cols = summarize && mat->cols > 2 * REPR_EDGE_ITEMS;
+    size_t shown_rows = skip_rows ? 2 * REPR_EDGE_ITEMS + 1 : mat->rows;
+    size_t shown_cols = skip_cols ? 2 * REPR_EDGE_ITEMS + 1 : mat->cols;
+    char *buf = PyMem_Malloc(shown_rows * (shown_cols * (REPR_ENTRY_MAX + 2) + 4) + 4);
+    if (buf == NULL) {
+        return PyErr_NoMemory();
+    }
+
+    char *p = buf;
+    *p++ = '[';
+    for (int i = 0; i < mat->rows; i++) {
+        if (i > 0) {
+            p += sprintf(p, ", ");
+        }
+        if (skip_rows && i == REPR_EDGE_ITEMS) {
+            p += sprintf(p, "...");
+            i = mat->rows - REPR_EDGE_ITEMS - 1;
+            continue;
+        }
+        *p++ = '[';
+        for (int j = 0; j < mat->cols; j++) {
+            if (j > 0) {
+                p += sprintf(p, ", ");
+            }
+            if (skip_cols && j == REPR_EDGE_ITEMS) {
+                p += sprintf(p, "...");
+                j = mat->cols - REPR_EDGE_ITEMS - 1;
+                continue;
+            }
+            char *entry = entry_repr(mat, i, j);
+            if (entry == NULL) {
+                PyMem_Free(buf);
+                return NULL;
+            }
+            /* Clamped so that the buffer can never overrun, should an entry ever be longer */
+            size_t len = strlen(entry);
+            len = len < REPR_ENTRY_MAX ? len : REPR_ENTRY_MAX;
+            memcpy(p, entry, len);
+            p += len;
+            PyMem_Free(entry);
+        }
+        *p++ = ']';
+    }
+    *p++ = ']';
+    PyObject *repr = PyUnicode_FromStringAndSize(buf, p - buf);
+    PyMem_Free(buf);
+    return repr;
+}
+
+/* The entries one index of a subscript selects along a dimension */
+typedef struct index_range {
+    int start; // first entry selected
+    int step; // distance between two selected entries
+    int count; // number of entries selected
+    int is_int; // whether the index was an integer rather than a slice
+} index_range;
+
+/*
+ * Parses one index of a subscript, an integer or a slice, along a dimension of length `len`.
+ * Slices follow Python's rules but must select at least one entry with a positive step.
+ * Returns 0 on success and -1 with an exception set on failure.
+ */
+static int parse_index(PyObject *index, int len, index_range *range) {
+    if (PyLong_Check(index)) {
+        long value = PyLong_AsLong(index);
+        if (value == -1 && PyErr_Occurred()) {
+            return -1;
+        }
+        if (value < 0 || value >= len) {
+            PyErr_SetString(PyExc_IndexError, "Index out of range");
+            return -1;
+        }
+        range->start = (int) value;
+        range->step = 1;
+        range->count = 1;
+        range->is_int = 1;
+        return 0;
+    }
+    if (!PySlice_Check(index)) {
+        PyErr_SetString(PyExc_TypeError, "Key is not valid");
+        return -1;
+    }
+    Py_ssize_t start, stop, step;
+    if (PySlice_Unpack(index, &start, &stop, &step) < 0) {
+        return -1;
+    }
+    Py_ssize_t count = PySlice_AdjustIndices(len, &start, &stop, step);
+    if (step < 0) {
+        PyErr_SetString(PyExc_ValueError, "Slice step must be positive");
+        return -1;
+    }
+    if (count == 0) {
+        PyErr_SetString(PyExc_ValueError, "Slice is empty");
+        return -1;
+    }
+    range->start = (int) start;
+    range->step = (int) step;
+    range->count = (int) count;
+    range->is_int = 0;
+    return 0;
+}
+
+/*
+ * Parses a subscript of the form mat[rows] or mat[rows, cols], where either part is an integer
+ * or a slice, into the range of rows and columns it selects. A missing column part selects
+ * every column. Returns 0 on success and -1 with an exception set on failure.
+ */
+static int parse_key(Matrix61c *self, PyObject *key, index_range *rows, index_range *cols) {
+    PyObject *row_index = key, *col_index = NULL;
+    if (PyTuple_Check(key)) {
+        if (PyTuple_GET_SIZE(key) != 2) {
+            PyErr_SetString(PyExc_TypeError, "Key is not valid");
+            return -1;
+        }
+        row_index = PyTuple_GET_ITEM(key, 0);
+        col_index = PyTuple_GET_ITEM(key, 1);
+    }
+    if (parse_index(row_index, self->mat->rows, rows)) {
+        return -1;
+    }
+    if (col_index == NULL) {
+        cols->start = 0;
+        cols->step = 1;
+        cols->count = self->mat->cols;
+        cols->is_int = 0;
+        return 0;
+    }
+    return parse_index(col_index, self->mat->cols, cols);
+}
+
+/*
+ * Creates the matrix viewing the entries of `self` selected by `rows` and `cols`, sharing its
+ * data. Returns 0 on success and -1 with an exception set on failure.
+ */
+static int make_view(Matrix61c *self, index_range *rows, index_range *cols, matrix **view) {
+    matrix *mat = self->mat;
+    long offset = (long) rows->start * mat->row_stride + (long) cols->start * mat->col_stride;
+    long row_stride = (long) rows->step * mat->row_stride, col_stride = (long) cols->step * mat->col_stride;
+    if (row_stride > INT_MAX || row_stride < INT_MIN || col_stride > INT_MAX || col_stride < INT_MIN) {
+        PyErr_SetString(PyExc_ValueError, "Slice steps are too large for this matrix");
+        return -1;
+    }
+    if (allocate_matrix_view(view, mat, offset, rows->count, cols->count, (int) row_stride, (int) col_stride)) {
+        PyErr_SetString(PyExc_RuntimeError, "Failed to allocate slice");
+        return -1;
+    }
+    return 0;
+}
+
+/*
+ * Returns row i of self as a cols x 1 matrix sharing its data, or the entry itself if self has
+ * a single column. This is mat[i] and what iterating over mat yields.
+ */
+static PyObject *row_item(Matrix61c *self, int i) {
+    matrix *mat = self->mat, *row;
+    if (mat->cols == 1) { // if one single number, unwrap from list
+        return entry_object(mat, i, 0);
+    }
+    /* Consecutive rows of the view are col_stride apart */
+    if (allocate_matrix_view(&row, mat, (long) i * mat->row_stride, mat->cols, 1, mat->col_stride, 1)) {
+        PyErr_SetString(PyExc_RuntimeError, "Failed to allocate slice");
+        return NULL;
+    }
+    return Matrix61c_wrap(row);
+}
+
+/*
+ * For __getitem__. mat[i] returns row i as a cols x 1 matrix, or the entry itself if mat has
+ * a single column. mat[r0:r1], mat[r0:r1, c0:c1], mat[:, j] and mat[i, c0:c1] return views
+ * sharing mat's data, steps included, and mat[i, j] returns the entry.
+ */
+static PyObject *Matrix61c_subscript(Matrix61c* self, PyObject* key) {
+    if (Matrix61c_force(self)) {
+        return NULL;
+    }
+    index_range rows, cols;
+    if (parse_key(self, key, &rows, &cols)) {
+        return NULL;
+    }
+    unsigned long long start = stats_clock();
+    matrix *new_mat;
+    PyObject *view;
+    if (!PyTuple_Check(key) && rows.is_int) {
+        view = row_item(self, rows.start);
+    } else if (rows.is_int && cols.is_int) {
+        return entry_object(self->mat, rows.start, cols.start);
+    } else {
+        view = make_view(self, &rows, &cols, &new_mat) ? NULL : Matrix61c_wrap(new_mat);
+    }
+    if (view != NULL && PyObject_TypeCheck(view, &Matrix61cType)) {
+        new_mat = ((Matrix61c *) view)->mat;
+        record_op(STAT_SLICE, start, new_mat->rows, new_mat->cols, 0, 0);
+    }
+    return view;
+}
+
+/* Whether `v` is a number that can be assigned to entries */
+static int is_number(PyObject *v) {
+    return PyFloat_Check(v) || PyLong_Check(v);
+}
+
+/*
+ * For __setitem__. mat[i] = v sets row i from a list, or the entry itself if mat has a single
+ * column. Any other key selects entries as in Matrix61c_subscript, which are all set to the
+ * number v, or copied from the numc.Matrix v of the same shape.
+ */
+static int Matrix61c_set_subscript(Matrix61c* self, PyObject *key, PyObject *v) {
+    if (Matrix61c_prepare_write(self)) {
+        return -1;
+    }
+    if (v == NULL) {
+        PyErr_SetString(PyExc_TypeError, "Cannot delete entries of numc.Matrix");
+        return -1;
+    }
+    index_range rows, cols;
+    if (parse_key(self, key, &rows, &cols)) {
+        return -1;
+    }
+    int index = rows.start;
+    if (!PyTuple_Check(key) && rows.is_int) {
+        int n_cols = self->mat->cols;
+        if (n_cols == 1) {
+            if (!is_number(v)) {
+                PyErr_SetString(PyExc_TypeError, "Value is not valid");
+                return -1;
+            }
+            double val = PyFloat_AsDouble(v);
+            set(self->mat, index, 0, val);
+            return 0;
+        }
+        if (!PyList_Check(v)) {
+            PyErr_SetString(PyExc_TypeError, "Value is not valid");
+            return -1;
+        }
+        if (PyList_Size(v) != n_cols) {
+            PyErr_SetString(PyExc_ValueError, "Value is not valid");
+            return -1;
+        }
+        for (int i = 0; i < n_cols; i++) {
+            if (!is_number(PyList_GetItem(v, i))) {
+                PyErr_SetString(PyExc_ValueError, "Value is not valid");
+                return -1;
+            }
+            set(self->mat, index, i, PyFloat_AsDouble(PyList_GetItem(v, i)));
+        }
+        return 0;
+    }
+
+    if (!is_number(v) && !PyObject_TypeCheck(v, &Matrix61cType)) {
+        PyErr_SetString(PyExc_TypeError, "Value is not valid");
+        return -1;
+    }
+    if (rows.is_int && cols.is_int) {
+        if (!is_number(v)) {
+            PyErr_SetString(PyExc_TypeError, "Value is not valid");
+            return -1;
+        }
+        set(self->mat, rows.start, cols.start, PyFloat_AsDouble(v));
+        return 0;
+    }
+    matrix *view;
+    if ((!is_number(v) && Matrix61c_force((Matrix61c *) v)) || make_view(self, &rows, &cols, &view)) {
+        return -1;
+    }
+    int failed = 0;
+    if (is_number(v)) {
+        double val = PyFloat_AsDouble(v);
+        if (val == -1 && PyErr_Occurred()) {
+            failed = -1;
+        } else {
+            fill_matrix(view, val);
+        }
+    } else if (copy_matrix(view, ((Matrix61c *) v)->mat)) {
+        PyErr_SetString(PyExc_ValueError, "Value has the wrong shape");
+        failed = -1;
+    }
+    deallocate_matrix(view);
+    free(view);
+    return failed;
+}
+
+/* iter(mat) walks the rows of mat as mat[0], mat[1], ..., without copying them */
+static PyObject *Matrix61c_iter(Matrix61c *self) {
+    if (Matrix61c_force(self)) {
+        return NULL;
+    }
+    Matrix61cRowIter *it = PyObject_New(Matrix61cRowIter, &Matrix61cRowIterType);
+    if (it == NULL) {
+        return NULL;
+    }
+    Py_INCREF(self);
+    it->mat = self;
+    it->row = 0;
+    return (PyObject *) it;
+}
+
+static PyObject *Matrix61cRowIter_next(Matrix61cRowIter *it) {
+    if (it->row >= it->mat->mat->rows) {
+        return NULL;
+    }
+    return row_item(it->mat, it->row++);
+}
+
+static void Matrix61cRowIter_dealloc(Matrix61cRowIter *it) {
+    Py_DECREF(it->mat);
+    PyObject_Del(it);
+}
+
+static PyTypeObject Matrix61cRowIterType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "numc.MatrixRowIterator",
+    .tp_basicsize = sizeof(Matrix61cRowIter),
+    .tp_dealloc = (destructor) Matrix61cRowIter_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "Iterator over the rows of a numc.Matrix",
+    .tp_iter = PyObject_SelfIter,
+    .tp_iternext = (iternextfunc) Matrix61cRowIter_next,
+};
+
+static PyMappingMethods Matrix61c_mapping = {
+    NULL,
+    (binaryfunc) Matrix61c_subscript,
+    (objobjargproc) Matrix61c_set_subscript,
+};
+
+/* NUMBER METHODS */
+
+/* Kernels and error messages for the binary and unary operations */
+enum { OP_ADD, OP_SUB, OP_MUL, OP_DIV };
+enum { OP_NEG, OP_ABS };
+
+static int (*const binary_kernels[])(matrix *, matrix *, matrix *) = {
+    add_matrix, sub_matrix, mul_matrix
+};
+static const char *const binary_errors[] = {
+    "matrices of different shapes added",
+    "matrices of different shapes subtracted",
+    "matrices of unmatched shape multiplied"
+};
+static const char *const binary_symbols[] = {"+", "-", "*", "/"};
+/* The BROADCAST_* operation computing `matrix op scalar`, and the one computing `scalar op matrix` */
+static const int scalar_ops[] = {BROADCAST_ADD, BROADCAST_SUB, BROADCAST_MUL, BROADCAST_DIV};
+static const int reflected_scalar_ops[] = {BROADCAST_ADD, BROADCAST_RSUB, BROADCAST_MUL};
+static int (*const unary_kernels[])(matrix *, matrix *) = {
+    neg_matrix, abs_matrix
+};
+/* The STAT_* kind of each binary, BROADCAST_* and unary operation */
+static const int binary_stats[] = {STAT_ADD, STAT_SUB, STAT_MUL, STAT_DIV};
+static const int broadcast_stats[] = {STAT_ADD, STAT_SUB, STAT_SUB, STAT_MUL, STAT_DIV};
+static const int unary_stats[] = {STAT_NEG, STAT_ABS};
+
+/* Wraps `mat` in a new numc.Matrix object, taking ownership of it. Returns NULL on failure. */
+static PyObject *Matrix61c_wrap(matrix *mat) {
+    return wrap_as(&Matrix61cType, mat);
+}
+
+/* Same as Matrix61c_wrap, for a new object of `type`, which may be a subclass of numc.Matrix */
+static PyObject *wrap_as(PyTypeObject *type, matrix *mat) {
+    Matrix61c *rv = (Matrix61c *) type->tp_alloc(type, 0);
+    if (rv == NULL) {
+        deallocate_matrix(mat);
+        free(mat);
+        return NULL;
+    }
+    rv->mat = mat;
+    rv->shape = Py_BuildValue("(ii)", mat->rows, mat->cols);
+    if (rv->shape == NULL) {
+        Py_DECREF(rv);
+        return NULL;
+    }
+    return (PyObject *) rv;
+}
+
+/*
+ * Kernels estimated to take fewer floating-point operations than this run with the GIL held,
+ * since releasing and reacquiring it would cost about as much as the kernel itself.
+ */
+#define GIL_RELEASE_COST 32768
+#define MAX_OPERANDS 3
+
+/*
+ * Releases the GIL before a kernel estimated to take `cost` floating-point operations, if that
+ * is worth it. The `n` numc.Matrix objects in `operands` (NULL entries are skipped) gain a
+ * reference so that their data outlives the kernel even if other threads drop theirs meanwhile.
+ * Returns the thread state to pass to acquire_gil, or NULL if the GIL was kept.
+ */
+static PyThreadState *release_gil(double cost, PyObject **operands, int n) {
+    if (cost < GIL_RELEASE_COST) {
+        return NULL;
+    }
+    for (int i = 0; i < n; i++) {
+        Py_XINCREF(operands[i]);
+    }
+    return PyEval_SaveThread();
+}
+
+/* Reacquires the GIL released by release_gil and drops the references it took on `operands` */
+static void acquire_gil(PyThreadState *state, PyObject **operands, int n) {
+    if (state == NULL) {
+        return;
+    }
+    PyEval_RestoreThread(state);
+    for (int i = 0; i < n; i++) {
+        Py_XDECREF(operands[i]);
+    }
+}
+
+/*
+ * Returns the matrix an operation should write to: out's own matrix, or a new rows * cols one
+ * of `dtype`
+ */
+static matrix *result_matrix(Matrix61c *out, int rows, int cols, int dtype) {
+    matrix *result;
+    if (out != NULL) {
+        return out->mat;
+    }
+    if (allocate_matrix_typed(&result, rows, cols, dtype)) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    return result;
+}
+
+/*
+ * Turns the return value `failed` of a kernel that wrote into `result` into a Python result.
+ * Returns `out` when the kernel wrote into it, and a new numc.Matrix otherwise.
+ */
+static PyObject *finish_op(matrix *result, Matrix61c *out, int failed) {
+    if (failed) {
+        if (out == NULL) {
+            deallocate_matrix(result);
+            free(result);
+        }
+        if (failed == -2) {
+            return PyErr_NoMemory();
+        }
+        if (failed == -103) {
+            PyErr_SetString(PyExc_ValueError, "singular matrix powered to a negative exponent");
+            return NULL;
+        }
+        PyErr_SetString(PyExc_RuntimeError, "numc kernel failed");
+        return NULL;
+    }
+    if (out != NULL) {
+        Py_INCREF(out);
+        return (PyObject *) out;
+    }
+    return Matrix61c_wrap(result);
+}
+
+/*
+ * Checks that `out` is either NULL or a numc.Matrix of shape rows * cols that can hold a result
+ * of `dtype`. Like numpy's same_kind casting, a floating-point result may be rounded into a
+ * float32 out, but not truncated into an int32 one.
+ */
+static int check_out(Matrix61c *out, int rows, int cols, int dtype) {
+    int out_rows, out_cols;
+    if (out == NULL) {
+        return 0;
+    }
+    matrix_shape(out, &out_rows, &out_cols);
+    if (out_rows != rows || out_cols != cols) {
+        PyErr_SetString(PyExc_ValueError, "out has the wrong shape");
+        return -1;
+    }
+    int out_dtype = out->lazy != NULL ? DTYPE_FLOAT64 : out->mat->dtype;
+    if (out_dtype == DTYPE_INT32 && dtype != DTYPE_INT32) {
+        PyErr_Format(PyExc_TypeError, "cannot cast %s result to int32 out", dtype_name(dtype));
+        return -1;
+    }
+    return 0;
+}
+
+/* Returns the dtype of a numc.Matrix, whether or not it is a pending lazy expression */
+static int matrix_dtype(Matrix61c *self) {
+    return self->lazy != NULL ? DTYPE_FLOAT64 : self->mat->dtype;
+}
+
+/*
+ * Returns the dtype of `mat op scalar`. As in numpy, a Python int keeps the dtype of the matrix,
+ * a Python float keeps float32 but turns int32 into float64, and so does division. scalar_op
+ * rejects Python ints outside the int32 range with an int32 result.
+ */
+static int scalar_dtype(int dtype, PyObject *scalar, int op) {
+    if (dtype == DTYPE_INT32 && (PyFloat_Check(scalar) || op == BROADCAST_DIV)) {
+        return DTYPE_FLOAT64;
+    }
+    return dtype;
+}
+
+/* Whether `obj` is a Python number, which operations broadcast to every entry of a matrix */
+static int is_scalar(PyObject *obj) {
+    return PyFloat_Check(obj) || PyLong_Check(obj);
+}
+
+/*
+ * Computes `self op scalar` for one of the BROADCAST_* operations, writing the result into
+ * `out` when it is not NULL.
+ */
+static PyObject *scalar_op(Matrix61c *self, PyObject *scalar, Matrix61c *out, int op) {
+    double value = PyFloat_AsDouble(scalar);
+    if (value == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+    int rows, cols, dtype = scalar_dtype(matrix_dtype(self), scalar, op);
+    if (dtype == DTYPE_INT32 && PyLong_Check(scalar) && (value < INT32_MIN || value > INT32_MAX)) {
+        /* As in numpy, rather than saturating the scalar and then wrapping around */
+        PyErr_Format(PyExc_OverflowError, "Python integer %S out of bounds for int32", scalar);
+        return NULL;
+    }
+    matrix_shape(self, &rows, &cols);
+    if (check_out(out, rows, cols, dtype) || Matrix61c_force(self) ||
+            (out != NULL && Matrix61c_prepare_write(out))) {
+        return NULL;
+    }
+    unsigned long long start = stats_clock();
+    matrix *result = result_matrix(out, rows, cols, dtype);
+    if (result == NULL) {
+        return NULL;
+    }
+    PyObject *operands[MAX_OPERANDS] = {(PyObject *) self, (PyObject *) out, NULL};
+    PyThreadState *state = release_gil((double) rows * cols, operands, MAX_OPERANDS);
+    int failed = scalar_matrix(result, self->mat, value, op);
+    acquire_gil(state, operands, MAX_OPERANDS);
+    if (!failed) {
+        record_op(broadcast_stats[op], start, rows, cols, (double) rows * cols, result_bytes(out, rows, cols, dtype));
+    }
+    return finish_op(result, out, failed);
+}
+
+/*
+ * Computes `self op vec` for one of the BROADCAST_* operations, where `vec` is a row or column
+ * vector matching self (see broadcast_matrix), writing the result into `out` when it is not NULL.
+ */
+static PyObject *broadcast_op(Matrix61c *self, Matrix61c *vec, Matrix61c *out, int op) {
+    int rows, cols, dtype = promote_dtypes(matrix_dtype(self), matrix_dtype(vec));
+    matrix_shape(self, &rows, &cols);
+    if (check_out(out, rows, cols, dtype) || Matrix61c_force(self) || Matrix61c_force(vec) ||
+            (out != NULL && Matrix61c_prepare_write(out))) {
+        return NULL;
+    }
+    unsigned long long start = stats_clock();
+    matrix *result = result_matrix(out, rows, cols, dtype);
+    if (result == NULL) {
+        return NULL;
+    }
+    PyObject *operands[MAX_OPERANDS] = {(PyObject *) self, (PyObject *) vec, (PyObject *) out};
+    PyThreadState *state = release_gil((double) rows * cols, operands, MAX_OPERANDS);
+    int failed = broadcast_matrix(result, self->mat, vec->mat, op);
+    acquire_gil(state, operands, MAX_OPERANDS);
+    if (!failed) {
+        record_op(broadcast_stats[op], start, rows, cols, (double) rows * cols, result_bytes(out, rows, cols, dtype));
+    }
+    return finish_op(result, out, failed);
+}
+
+/*
+ * Computes `self op other` for op in OP_ADD, OP_SUB, OP_MUL and OP_DIV, writing the result
+ * into `out` when it is not NULL. Either operand may be a Python number, except for the
+ * divisor. For OP_ADD and OP_SUB, either operand may also be a row or column vector matching
+ * the other one, which is then applied to every row or column. Operations with a
+ * numc.SparseMatrix are left to sparse_binary_op.
+ */
+static PyObject *binary_op(Matrix61c *self, PyObject *other, Matrix61c *out, int op) {
+    if (PyObject_TypeCheck(self, &SparseMatrixType) || PyObject_TypeCheck(other, &SparseMatrixType)) {
+        return sparse_binary_op((PyObject *) self, other, out, op);
+    }
+    if (PyObject_TypeCheck(self, &Matrix61cType) && is_scalar(other)) {
+        return scalar_op(self, other, out, scalar_ops[op]);
+    }
+    if (op != OP_DIV && is_scalar((PyObject *) self) && PyObject_TypeCheck(other, &Matrix61cType)) {
+        return scalar_op((Matrix61c *) other, (PyObject *) self, out, reflected_scalar_ops[op]);
+    }
+    if (op == OP_DIV || !PyObject_TypeCheck(self, &Matrix61cType) ||
+            !PyObject_TypeCheck(other, &Matrix61cType)) {
+        PyErr_Format(PyExc_TypeError, "unsupported operand type(s) for %s", binary_symbols[op]);
+        return NULL;
+    }
+    int rows1, cols1, rows2, cols2;
+    matrix_shape(self, &rows1, &cols1);
+    matrix_shape((Matrix61c *) other, &rows2, &cols2);
+    if (op != OP_MUL && (rows1 != rows2 || cols1 != cols2)) {
+        if ((rows2 == 1 && cols2 == cols1) || (cols2 == 1 && rows2 == rows1)) {
+            return broadcast_op(self, (Matrix61c *) other, out, op == OP_ADD ? BROADCAST_ADD : BROADCAST_SUB);
+        }
+        if ((rows1 == 1 && cols1 == cols2) || (cols1 == 1 && rows1 == rows2)) {
+            return broadcast_op((Matrix61c *) other, self, out, op == OP_ADD ? BROADCAST_ADD : BROADCAST_RSUB);
+        }
+    }
+    if (op == OP_MUL ? cols1 != rows2 : rows1 != rows2 || cols1 != cols2) {
+        PyErr_SetString(PyExc_ValueError, binary_errors[op]);
+        return NULL;
+    }
+    if (lazy_mode && op != OP_MUL && out == NULL && lazy_operand(self) && lazy_operand((Matrix61c *) other)) {
+        return Matrix61c_lazy(op == OP_ADD ? FUSED_ADD : FUSED_SUB, self, (Matrix61c *) other);
+    }
+    int rows = rows1, cols = cols2;
+    int dtype = promote_dtypes(matrix_dtype(self), matrix_dtype((Matrix61c *) other));
+    if (check_out(out, rows, cols, dtype) || Matrix61c_force(self) ||
+            Matrix61c_force((Matrix61c *) other) || (out != NULL && Matrix61c_prepare_write(out))) {
+        return NULL;
+    }
+    matrix *mat1 = self->mat, *mat2 = ((Matrix61c *) other)->mat;
+    unsigned long long start = stats_clock();
+    matrix *result = result_matrix(out, rows, cols, dtype);
+    if (result == NULL) {
+        return NULL;
+    }
+    PyObject *operands[MAX_OPERANDS] = {(PyObject *) self, other, (PyObject *) out};
+    double cost = op == OP_MUL ? 2.0 * rows * cols * cols1 : (double) rows * cols;
+    PyThreadState *state = release_gil(cost, operands, MAX_OPERANDS);
+    int failed = binary_kernels[op](result, mat1, mat2);
+    acquire_gil(state, operands, MAX_OPERANDS);
+    if (!failed) {
+        record_op(binary_stats[op], start, rows, cols, cost, result_bytes(out, rows, cols, dtype));
+    }
+    return finish_op(result, out, failed);
+}
+
+/* Computes `op self` for op in OP_NEG and OP_ABS, writing the result into `out` when it is not NULL */
+static PyObject *unary_op(Matrix61c *self, Matrix61c *out, int op) {
+    if (!PyObject_TypeCheck(self, &Matrix61cType)) {
+        PyErr_SetString(PyExc_TypeError, op == OP_NEG ? "bad operand type for unary -" :
+                        "bad operand type for abs()");
+        return NULL;
+    }
+    int rows, cols;
+    matrix_shape(self, &rows, &cols);
+    if (lazy_mode && out == NULL && lazy_operand(self)) {
+        return Matrix61c_lazy(op == OP_NEG ? FUSED_NEG : FUSED_ABS, self, NULL);
+    }
+    int dtype = matrix_dtype(self);
+    if (check_out(out, rows, cols, dtype) || Matrix61c_force(self) ||
+            (out != NULL && Matrix61c_prepare_write(out))) {
+        return NULL;
+    }
+    unsigned long long start = stats_clock();
+    matrix *result = result_matrix(out, rows, cols, dtype);
+    if (result == NULL) {
+        return NULL;
+    }
+    PyObject *operands[MAX_OPERANDS] = {(PyObject *) self, (PyObject *) out, NULL};
+    PyThreadState *state = release_gil((double) rows * cols, operands, MAX_OPERANDS);
+    int failed = unary_kernels[op](result, self->mat);
+    acquire_gil(state, operands, MAX_OPERANDS);
+    if (!failed) {
+        record_op(unary_stats[op], start, rows, cols, (double) rows * cols, result_bytes(out, rows, cols, dtype));
+    }
+    return finish_op(result, out, failed);
+}
+
+/*
+ * Nominal floating-point operations of raising an n x n matrix to `exponent`: 2n^3 for each
+ * product of binary exponentiation, and as much for the inversion of a negative exponent
+ */
+static double pow_flops(int n, long exponent) {
+    unsigned long magnitude = exponent < 0 ? -(unsigned long) exponent : (unsigned long) exponent;
+    double products = magnitude < 2 ? 0 : 62 - __builtin_clzl(magnitude) + __builtin_popcountl(magnitude);
+    return (products + (exponent < 0)) * 2.0 * n * n * n;
+}
+
+/* Computes `self ** pow`, writing the result into `out` when it is not NULL */
+static PyObject *pow_op(Matrix61c *self, PyObject *pow, Matrix61c *out) {
+    if (!PyObject_TypeCheck(self, &Matrix61cType) || !PyLong_Check(pow)) {
+        PyErr_SetString(PyExc_TypeError, "unsupported operand type(s) for **");
+        return NULL;
+    }
+    int rows, cols;
+    matrix_shape(self, &rows, &cols);
+    if (rows != cols) {
+        PyErr_SetString(PyExc_ValueError, "non-square matrix powered");
+        return NULL;
+    }
+    long exponent = PyLong_AsLong(pow);
+    if (exponent == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+    if (exponent > INT_MAX || exponent < -INT_MAX) {
+        PyErr_SetString(PyExc_ValueError, "power too large");
+        return NULL;
+    }
+    /* The inverse of an int32 matrix is not an integer matrix */
+    int dtype = exponent < 0 && matrix_dtype(self) == DTYPE_INT32 ? DTYPE_FLOAT64 : matrix_dtype(self);
+    if (check_out(out, rows, cols, dtype) || Matrix61c_force(self) ||
+            (out != NULL && Matrix61c_prepare_write(out))) {
+        return NULL;
+    }
+    unsigned long long start = stats_clock();
+    matrix *result = result_matrix(out, rows, cols, dtype);
+    if (result == NULL) {
+        return NULL;
+    }
+    /* Every exponent other than 0 and 1 takes at least one multiply or an inversion */
+    PyObject *operands[MAX_OPERANDS] = {(PyObject *) self, (PyObject *) out, NULL};
+    double cost = exponent == 0 || exponent == 1 ? (double) rows * cols : 2.0 * rows * rows * cols;
+    PyThreadState *state = release_gil(cost, operands, MAX_OPERANDS);
+    int failed = pow_matrix(result, self->mat, (int) exponent);
+    acquire_gil(state, operands, MAX_OPERANDS);
+    if (!failed) {
+        record_op(STAT_POW, start, rows, cols, pow_flops(rows, exponent), result_bytes(out, rows, cols, dtype));
+    }
+    return finish_op(result, out, failed);
+}
+
+/*
+ * numc.batch_mul(lhs, rhs): returns the list [lhs[0] * rhs[0], lhs[1] * rhs[1], ...] for two
+ * equally long sequences of numc.Matrix objects. All shapes are checked before anything is
+ * computed, and the whole batch then runs in one kernel call spread across threads.
+ */
+static PyObject *Matrix61c_class_batch_mul(PyObject *self, PyObject *args) {
+    PyObject *lhs_obj, *rhs_obj;
+    if (!PyArg_ParseTuple(args, "OO", &lhs_obj, &rhs_obj)) {
+        return NULL;
+    }
+    /* Tuples keep every operand alive while the GIL is released, whatever happens to the inputs */
+    PyObject *lhs = PySequence_Tuple(lhs_obj);
+    PyObject *rhs = lhs == NULL ? NULL : PySequence_Tuple(rhs_obj);
+    if (rhs == NULL) {
+        Py_XDECREF(lhs);
+        return NULL;
+    }
+    PyObject *rv = NULL;
+    matrix **mats = NULL;
+    Py_ssize_t n = PyTuple_GET_SIZE(lhs), allocated = 0;
+    if (PyTuple_GET_SIZE(rhs) != n) {
+        PyErr_SetString(PyExc_ValueError, "lhs and rhs have different lengths");
+        goto done;
+    }
+    if (n > INT_MAX) {
+        PyErr_SetString(PyExc_ValueError, "batch is too large");
+        goto done;
+    }
+
+    double cost = 0;
+    for (Py_ssize_t i = 0; i < n; i++) {
+        PyObject *a = PyTuple_GET_ITEM(lhs, i), *b = PyTuple_GET_ITEM(rhs, i);
+        if (!PyObject_TypeCheck(a, &Matrix61cType) || !PyObject_TypeCheck(b, &Matrix61cType)) {
+            PyErr_Format(PyExc_TypeError, "batch entry %zd is not a pair of numc.Matrix", i);
+            goto done;
+        }
+        int rows1, cols1, rows2, cols2;
+        matrix_shape((Matrix61c *) a, &rows1, &cols1);
+        matrix_shape((Matrix61c *) b, &rows2, &cols2);
+        if (cols1 != rows2) {
+            PyErr_Format(PyExc_ValueError, "matrices of unmatched shape multiplied at batch entry %zd", i);
+            goto done;
+        }
+        if (Matrix61c_force((Matrix61c *) a) || Matrix61c_force((Matrix61c *) b)) {
+            goto done;
+        }
+        cost += 2.0 * rows1 * cols2 * cols1;
+    }
+
+    mats = PyMem_Calloc(3 * n + 1, sizeof(matrix *));
+    if (mats == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    matrix **results = mats, **mat1s = mats + n, **mat2s = mats + 2 * n;
+    for (; allocated < n; allocated++) {
+        mat1s[allocated] = ((Matrix61c *) PyTuple_GET_ITEM(lhs, allocated))->mat;
+        mat2s[allocated] = ((Matrix61c *) PyTuple_GET_ITEM(rhs, allocated))->mat;
+        if (allocate_matrix_typed(&results[allocated], mat1s[allocated]->rows, mat2s[allocated]->cols,
+                                  promote_dtypes(mat1s[allocated]->dtype, mat2s[allocated]->dtype))) {
+            PyErr_NoMemory();
+            goto done;
+        }
+    }
+
+    PyObject *operands[MAX_OPERANDS] = {lhs, rhs, NULL};
+    PyThreadState *state = release_gil(cost, operands, MAX_OPERANDS);
+    int failed = batch_mul_matrix(results, mat1s, mat2s, (int) n);
+    acquire_gil(state, operands, MAX_OPERANDS);
+    if (failed) {
+        if (failed == -2) {
+            PyErr_NoMemory();
+        } else {
+            PyErr_SetString(PyExc_RuntimeError, "numc kernel failed");
+        }
+        goto done;
+    }
+
+    rv = PyList_New(n);
+    if (rv == NULL) {
+        goto done;
+    }
+    /* Matrix61c_wrap takes ownership of each result, even when it fails */
+    for (Py_ssize_t i = 0; i < n; i++) {
+        PyObject *item = Matrix61c_wrap(results[i]);
+        results[i] = NULL;
+        if (item == NULL) {
+            Py_CLEAR(rv);
+            for (Py_ssize_t j = i + 1; j < n; j++) {
+                deallocate_matrix(results[j]);
+                free(results[j]);
+                results[j] = NULL;
+            }
+            break;
+        }
+        PyList_SET_ITEM(rv, i, item);
+    }
+    allocated = 0;
+
+done:
+    if (mats != NULL) {
+        for (Py_ssize_t i = 0; i < allocated; i++) {
+            deallocate_matrix(mats[i]);
+            free(mats[i]);
+        }
+        PyMem_Free(mats);
+    }
+    Py_DECREF(lhs);
+    Py_DECREF(rhs);
+    return rv;
+}
+
+/*
+ * numc.transpose(mat): returns a new numc.Matrix holding the transpose of mat. Use mat.T for a
+ * view that does not copy.
+ */
+static PyObject *Matrix61c_class_transpose(PyObject *self, PyObject *args) {
+    Matrix61c *mat;
+    if (!PyArg_ParseTuple(args, "O!", &Matrix61cType, &mat) || Matrix61c_force(mat)) {
+        return NULL;
+    }
+    int rows, cols;
+    matrix_shape(mat, &rows, &cols);
+    matrix *result = result_matrix(NULL, cols, rows, mat->mat->dtype);
+    if (result == NULL) {
+        return NULL;
+    }
+    PyObject *operands[MAX_OPERANDS] = {(PyObject *) mat, NULL, NULL};
+    PyThreadState *state = release_gil((double) rows * cols, operands, MAX_OPERANDS);
+    int failed = transpose_matrix(result, mat->mat);
+    acquire_gil(state, operands, MAX_OPERANDS);
+    return finish_op(result, NULL, failed);
+}
+
+/*
+ * numc.arange(start, stop=None, step=1, shape=None, dtype="float64"). Like range, but for floats
+ * as well: returns the entries start, start + step, ... up to but excluding stop, as a single
+ * row, or as a matrix of `shape` filled in row-major order. numc.arange(stop) starts from 0.
+ */
+static PyObject *Matrix61c_class_arange(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"start", "stop", "step", "shape", "dtype", NULL};
+    double start, stop, step = 1;
+    PyObject *stop_obj = Py_None, *shape = Py_None;
+    int dtype = DTYPE_FLOAT64;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "d|Od$OO&", kwlist, &start, &stop_obj, &step, &shape,
+                                     parse_dtype, &dtype)) {
+        return NULL;
+    }
+    if (stop_obj == Py_None) {
+        stop = start;
+        start = 0;
+    } else {
+        stop = PyFloat_AsDouble(stop_obj);
+        if (stop == -1 && PyErr_Occurred()) {
+            return NULL;
+        }
+    }
+    if (step == 0) {
+        PyErr_SetString(PyExc_ValueError, "step must not be zero");
+        return NULL;
+    }
+    double count = ceil((stop - start) / step);
+    if (!(count >= 1) || count > PY_SSIZE_T_MAX) {
+        PyErr_SetString(PyExc_ValueError, "range must hold at least one entry");
+        return NULL;
+    }
+    Py_ssize_t n = (Py_ssize_t) count, rows = 1, cols = n;
+    if (shape != Py_None) {
+        if (!PyTuple_Check(shape) || !PyArg_ParseTuple(shape, "nn", &rows, &cols)) {
+            PyErr_SetString(PyExc_TypeError, "shape must be a (rows, cols) tuple");
+            return NULL;
+        }
+        if (rows * cols != n) {
+            PyErr_Format(PyExc_ValueError, "range has %zd entries, not the %zd of a %zd x %zd matrix",
+                         n, rows * cols, rows, cols);
+            return NULL;
+        }
+    }
+    matrix *mat = new_matrix(rows, cols, dtype);
+    if (mat == NULL) {
+        return NULL;
+    }
+    arange_matrix(mat, start, step);
+    return Matrix61c_wrap(mat);
+}
+
+/*
+ * Shared body of numc.uniform and numc.normal: allocates a rows x cols matrix of `dtype` and
+ * fills it with `fill`, whose parameters a and b are checked by the caller.
+ */
+static PyObject *random_matrix(Py_ssize_t rows, Py_ssize_t cols, int dtype, unsigned long long seed,
+                               void (*fill)(matrix *, uint64_t, double, double), double a, double b) {
+    if (dtype == DTYPE_INT32) {
+        PyErr_SetString(PyExc_ValueError, "dtype must be 'float64' or 'float32'");
+        return NULL;
+    }
+    matrix *mat = new_matrix(rows, cols, dtype);
+    if (mat == NULL) {
+        return NULL;
+    }
+    PyThreadState *state = release_gil((double) rows * cols, NULL, 0);
+    fill(mat, seed, a, b);
+    acquire_gil(state, NULL, 0);
+    return Matrix61c_wrap(mat);
+}
+
+/*
+ * numc.uniform(rows, cols, low=0.0, high=1.0, seed=0, dtype="float64"): returns a rows x cols
+ * matrix of numbers drawn uniformly from [low, high). The entries only depend on the seed and
+ * their position, not on the number of threads or the platform's rand(). float32 entries are
+ * the float64 ones rounded.
+ */
+static PyObject *Matrix61c_class_uniform(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"rows", "cols", "low", "high", "seed", "dtype", NULL};
+    Py_ssize_t rows, cols;
+    double low = 0, high = 1;
+    unsigned long long seed = 0;
+    int dtype = DTYPE_FLOAT64;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "nn|ddKO&", kwlist, &rows, &cols, &low, &high, &seed,
+                                     parse_dtype, &dtype)) {
+        return NULL;
+    }
+    if (!(low < high)) {
+        PyErr_SetString(PyExc_ValueError, "low must be less than high");
+        return NULL;
+    }
+    return random_matrix(rows, cols, dtype, seed, uniform_matrix, low, high);
+}
+
+/*
+ * numc.normal(rows, cols, mean=0.0, std=1.0, seed=0, dtype="float64"): returns a rows x cols
+ * matrix of normally distributed numbers, reproducible from the seed in the same way as
+ * numc.uniform.
+ */
+static PyObject *Matrix61c_class_normal(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"rows", "cols", "mean", "std", "seed", "dtype", NULL};
+    Py_ssize_t rows, cols;
+    double mean = 0, std = 1;
+    unsigned long long seed = 0;
+    int dtype = DTYPE_FLOAT64;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "nn|ddKO&", kwlist, &rows, &cols, &mean, &std, &seed,
+                                     parse_dtype, &dtype)) {
+        return NULL;
+    }
+    if (!(std >= 0)) {
+        PyErr_SetString(PyExc_ValueError, "std must not be negative");
+        return NULL;
+    }
+    return random_matrix(rows, cols, dtype, seed, normal_matrix, mean, std);
+}
+
+/*
+ * numc.eye(n, cols=n, dtype="float64"): returns the n x cols matrix with ones on its diagonal and
+ * zeros elsewhere
+ */
+static PyObject *Matrix61c_class_eye(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"n", "cols", "dtype", NULL};
+    Py_ssize_t rows, cols = -1;
+    int dtype = DTYPE_FLOAT64;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "n|nO&", kwlist, &rows, &cols, parse_dtype, &dtype)) {
+        return NULL;
+    }
+    cols = cols < 0 ? rows : cols;
+    matrix *mat = new_matrix(rows, cols, dtype);
+    if (mat == NULL) {
+        return NULL;
+    }
+    memset(mat->data, 0, (size_t) rows * cols * dtype_size(dtype));
+    for (Py_ssize_t i = 0; i < rows && i < cols; i++) {
+        set(mat, i, i, 1);
+    }
+    return Matrix61c_wrap(mat);
+}
+
+/*
+ * Add the second numc.Matrix (Matrix61c) object to the first one. The first operand is
+ * self, and the second operand can be obtained by casting `args`.
+ */
+static PyObject *Matrix61c_add(Matrix61c* self, PyObject* args) {
+    return binary_op(self, args, NULL, OP_ADD);
+}
+
+/*
+ * Subtract the second numc.Matrix (Matrix61c) object from the first one. The first operand is
+ * self, and the second operand can be obtained by casting `args`.
+ */
+static PyObject *Matrix61c_sub(Matrix61c* self, PyObject* args) {
+    return binary_op(self, args, NULL, OP_SUB);
+}
+
+/*
+ * NOT element-wise multiplication. The first operand is self, and the second operand
+ * can be obtained by casting `args`.
+ */
+static PyObject *Matrix61c_multiply(Matrix61c* self, PyObject *args) {
+    return binary_op(self, args, NULL, OP_MUL);
+}
+
+/*
+ * Divides every entry of the numc.Matrix self by the number `args`.
+ */
+static PyObject *Matrix61c_true_divide(Matrix61c* self, PyObject *args) {
+    return binary_op(self, args, NULL, OP_DIV);
+}
+
+/*
+ * Negates the given numc.Matrix.
+ */
+static PyObject *Matrix61c_neg(Matrix61c* self) {
+    return unary_op(self, NULL, OP_NEG);
+}
+
+/*
+ * Take the element-wise absolute value of this numc.Matrix.
+ */
+static PyObject *Matrix61c_abs(Matrix61c *self) {
+    return unary_op(self, NULL, OP_ABS);
+}
+
+/*
+ * Raise numc.Matrix (Matrix61c) to the `pow`th power. You can ignore the argument `optional`.
+ */
+static PyObject *Matrix61c_pow(Matrix61c *self, PyObject *pow, PyObject *optional) {
+    return pow_op(self, pow, NULL);
+}
+
+/* a += b. Writes the sum into a's own data. */
+static PyObject *Matrix61c_inplace_add(Matrix61c *self, PyObject *args) {
+    return binary_op(self, args, self, OP_ADD);
+}
+
+/* a -= b. Writes the difference into a's own data. */
+static PyObject *Matrix61c_inplace_sub(Matrix61c *self, PyObject *args) {
+    return binary_op(self, args, self, OP_SUB);
+}
+
+/*
+ * a *= b. The product is written into a's own data when b is square or a number. Otherwise the
+ * result has a different shape and Python falls back to a = a * b.
+ */
+static PyObject *Matrix61c_inplace_multiply(Matrix61c *self, PyObject *args) {
+    int rows1, cols1, rows2, cols2;
+    if (PyObject_TypeCheck(args, &Matrix61cType)) {
+        matrix_shape(self, &rows1, &cols1);
+        matrix_shape((Matrix61c *) args, &rows2, &cols2);
+        if (cols2 != cols1) {
+            Py_RETURN_NOTIMPLEMENTED;
+        }
+    }
+    if (PyObject_TypeCheck(args, &SparseMatrixType)) {
+        matrix_shape(self, &rows1, &cols1);
+        if (((SparseMatrix *) args)->mat->cols != cols1) {
+            Py_RETURN_NOTIMPLEMENTED;
+        }
+    }
+    return binary_op(self, args, self, OP_MUL);
+}
+
+/* a /= b for a number b. Writes the quotient into a's own data. */
+static PyObject *Matrix61c_inplace_true_divide(Matrix61c *self, PyObject *args) {
+    return binary_op(self, args, self, OP_DIV);
+}
+
+/* a **= pow. Writes the power into a's own data. */
+static PyObject *Matrix61c_inplace_pow(Matrix61c *self, PyObject *pow, PyObject *optional) {
+    return pow_op(self, pow, self);
+}
+
+/*
+ * Create a PyNumberMethods struct for overloading operators with all the number methods you have
+ * define. You might find this link helpful: https://docs.python.org/3.6/c-api/typeobj.html
+ */
+static PyNumberMethods Matrix61c_as_number = {
+        .nb_add = (binaryfunc) Matrix61c_add,
+        .nb_subtract = (binaryfunc) Matrix61c_sub,
+        .nb_multiply = (binaryfunc) Matrix61c_multiply,
+        .nb_negative = (unaryfunc) Matrix61c_neg,
+        .nb_absolute = (unaryfunc) Matrix61c_abs,
+        .nb_power = (ternaryfunc) Matrix61c_pow,
+        .nb_inplace_add = (binaryfunc) Matrix61c_inplace_add,
+        .nb_inplace_subtract = (binaryfunc) Matrix61c_inplace_sub,
+        .nb_inplace_multiply = (binaryfunc) Matrix61c_inplace_multiply,
+        .nb_inplace_power = (ternaryfunc) Matrix61c_inplace_pow,
+        .nb_true_divide = (binaryfunc) Matrix61c_true_divide,
+        .nb_inplace_true_divide = (binaryfunc) Matrix61c_inplace_true_divide,
+};
+
+
+/* INSTANCE METHODS */
+/*
+ * Given a numc.Matrix self, parse `args` to (int) row, (int) col, and (double/int) val.
+ * This function should return None in Python.
  */
 static PyObject *Matrix61c_set_value(Matrix61c *self, PyObject* args) {
     PyObject *arg1, *arg2, *arg3;
@@ -452,42 +2254,842 @@ static PyObject *Matrix61c_set_value(Matrix61c *self, PyObject* args) {
 
     int row = PyLong_AsLong(arg1), col = PyLong_AsLong(arg2);
     double val = 0;
+    if (Matrix61c_prepare_write(self)) {
+        return NULL;
+    }
+
+    if (PyFloat_Check(arg3)) {
+        val = PyFloat_AsDouble(arg3);
+    } else {
+        val = PyLong_AsDouble(arg3);
+    }
+
+    set(self->mat, row, col, val);
+    return Py_None;
+}
+
+/*
+ * Given a numc.Matrix `self`, parse `args` to (int) row and (int) col.
+ * This function should return the value at the `row`th row and `col`th column, which is a Python
+ * float, or an int for int32 matrices.
+ */
+static PyObject *Matrix61c_get_value(Matrix61c *self, PyObject* args) {
+    PyObject *arg1, *arg2;
+    PyArg_UnpackTuple(args, "args", 2, 2, &arg1, &arg2);
+
+    int row = PyLong_AsLong(arg1), col = PyLong_AsLong(arg2);
+    if (Matrix61c_force(self)) {
+        return NULL;
+    }
+
+    return entry_object(self->mat, row, col);
+}
+
+/*
+ * Parses the optional `out` keyword argument into `out`, which is left NULL when `out` is
+ * missing or None. Returns 0 on success and -1 on failure.
+ */
+static int parse_out(PyObject *out_obj, Matrix61c **out) {
+    *out = NULL;
+    if (out_obj == NULL || out_obj == Py_None) {
+        return 0;
+    }
+    if (!PyObject_TypeCheck(out_obj, &Matrix61cType)) {
+        PyErr_SetString(PyExc_TypeError, "out must be of type numc.Matrix");
+        return -1;
+    }
+    *out = (Matrix61c *) out_obj;
+    return 0;
+}
+
+/* Shared body of a.add(b, out=None), a.sub(b, out=None), a.mul(b, out=None) and a.div(b, out=None) */
+static PyObject *binary_method(Matrix61c *self, PyObject *args, PyObject *kwds, int op) {
+    static char *kwlist[] = {"other", "out", NULL};
+    PyObject *other = NULL, *out_obj = NULL;
+    Matrix61c *out;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|$O", kwlist, &other, &out_obj) ||
+            parse_out(out_obj, &out)) {
+        return NULL;
+    }
+    return binary_op(self, other, out, op);
+}
+
+/* Shared body of a.neg(out=None) and a.abs(out=None) */
+static PyObject *unary_method(Matrix61c *self, PyObject *args, PyObject *kwds, int op) {
+    static char *kwlist[] = {"out", NULL};
+    PyObject *out_obj = NULL;
+    Matrix61c *out;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|$O", kwlist, &out_obj) ||
+            parse_out(out_obj, &out)) {
+        return NULL;
+    }
+    return unary_op(self, out, op);
+}
+
+/* a.add(b, out=None). Writes a + b into `out` if given, else into a new matrix. */
+static PyObject *Matrix61c_add_method(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return binary_method(self, args, kwds, OP_ADD);
+}
+
+/* a.sub(b, out=None). Writes a - b into `out` if given, else into a new matrix. */
+static PyObject *Matrix61c_sub_method(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return binary_method(self, args, kwds, OP_SUB);
+}
+
+/* a.mul(b, out=None). Writes a * b into `out` if given, else into a new matrix. */
+static PyObject *Matrix61c_mul_method(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return binary_method(self, args, kwds, OP_MUL);
+}
+
+/* a.div(b, out=None). Writes a / b into `out` if given, else into a new matrix. */
+static PyObject *Matrix61c_div_method(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return binary_method(self, args, kwds, OP_DIV);
+}
+
+/* a.neg(out=None). Writes -a into `out` if given, else into a new matrix. */
+static PyObject *Matrix61c_neg_method(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return unary_method(self, args, kwds, OP_NEG);
+}
+
+/* a.abs(out=None). Writes abs(a) into `out` if given, else into a new matrix. */
+static PyObject *Matrix61c_abs_method(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return unary_method(self, args, kwds, OP_ABS);
+}
+
+/* a.pow(n, out=None). Writes a ** n into `out` if given, else into a new matrix. */
+static PyObject *Matrix61c_pow_method(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"pow", "out", NULL};
+    PyObject *pow = NULL, *out_obj = NULL;
+    Matrix61c *out;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|$O", kwlist, &pow, &out_obj) ||
+            parse_out(out_obj, &out)) {
+        return NULL;
+    }
+    return pow_op(self, pow, out);
+}
+
+/*
+ * Shared body of a.sum(axis=None), a.mean(axis=None), a.min(axis=None), a.max(axis=None) and
+ * a.argmax(axis=None). Returns a number for axis=None, and otherwise a 1 x cols (axis=0) or
+ * rows x 1 (axis=1) numc.Matrix.
+ */
+static PyObject *reduce_method(Matrix61c *self, PyObject *args, PyObject *kwds, int op) {
+    static char *kwlist[] = {"axis", NULL};
+    PyObject *axis_obj = Py_None;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|O", kwlist, &axis_obj)) {
+        return NULL;
+    }
+    int axis = -1;
+    if (axis_obj != Py_None) {
+        if (!PyLong_Check(axis_obj)) {
+            PyErr_SetString(PyExc_TypeError, "axis must be an integer or None");
+            return NULL;
+        }
+        long value = PyLong_AsLong(axis_obj);
+        if (value != 0 && value != 1) {
+            if (!PyErr_Occurred()) {
+                PyErr_SetString(PyExc_ValueError, "axis must be None, 0 or 1");
+            }
+            return NULL;
+        }
+        axis = (int) value;
+    }
+    if (Matrix61c_force(self)) {
+        return NULL;
+    }
+    int rows = self->mat->rows, cols = self->mat->cols;
+    matrix *result = result_matrix(NULL, axis == 1 ? rows : 1, axis == 0 ? cols : 1, DTYPE_FLOAT64);
+    if (result == NULL) {
+        return NULL;
+    }
+    PyObject *operands[MAX_OPERANDS] = {(PyObject *) self, NULL, NULL};
+    PyThreadState *state = release_gil((double) rows * cols, operands, MAX_OPERANDS);
+    int failed = reduce_matrix(result, self->mat, op, axis);
+    acquire_gil(state, operands, MAX_OPERANDS);
+    if (failed || axis != -1) {
+        return finish_op(result, NULL, failed);
+    }
+    double value = result->data[0];
+    deallocate_matrix(result);
+    free(result);
+    return op == REDUCE_ARGMAX ? PyLong_FromDouble(value) : PyFloat_FromDouble(value);
+}
+
+/* a.sum(axis=None). Sum of all entries, or of each column (axis=0) or row (axis=1). */
+static PyObject *Matrix61c_sum(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return reduce_method(self, args, kwds, REDUCE_SUM);
+}
+
+/* a.mean(axis=None). Mean of all entries, or of each column (axis=0) or row (axis=1). */
+static PyObject *Matrix61c_mean(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return reduce_method(self, args, kwds, REDUCE_MEAN);
+}
+
+/* a.min(axis=None). Smallest entry overall, or of each column (axis=0) or row (axis=1). */
+static PyObject *Matrix61c_min(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return reduce_method(self, args, kwds, REDUCE_MIN);
+}
+
+/* a.max(axis=None). Largest entry overall, or of each column (axis=0) or row (axis=1). */
+static PyObject *Matrix61c_max(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return reduce_method(self, args, kwds, REDUCE_MAX);
+}
+
+/*
+ * a.argmax(axis=None). Row-major index of the first largest entry, or the row (axis=0) or
+ * column (axis=1) index of the first largest entry of each column or row.
+ */
+static PyObject *Matrix61c_argmax(Matrix61c *self, PyObject *args, PyObject *kwds) {
+    return reduce_method(self, args, kwds, REDUCE_ARGMAX);
+}
+
+/*
+ * a.astype(dtype). Copy of a converted to `dtype`. Conversion to int32 truncates towards zero
+ * and saturates at the int32 bounds, with NaN becoming 0.
+ */
+static PyObject *Matrix61c_astype(Matrix61c *self, PyObject *args) {
+    int dtype = DTYPE_FLOAT64;
+    if (!PyArg_ParseTuple(args, "O&", parse_dtype, &dtype) || Matrix61c_force(self)) {
+        return NULL;
+    }
+    matrix *mat = self->mat, *result;
+    if (allocate_matrix_typed(&result, mat->rows, mat->cols, dtype)) {
+        PyErr_SetString(PyExc_RuntimeError, "Failed to allocate matrix");
+        return NULL;
+    }
+    copy_matrix(result, mat);
+    return Matrix61c_wrap(result);
+}
+
+/*
+ * Create an array of PyMethodDef structs to hold the instance methods.
+ * Name the python function corresponding to Matrix61c_get_value as "get" and Matrix61c_set_value
+ * as "set"
+ * You might find this link helpful: https://docs.python.org/3.6/c-api/structures.html
+ */
+static PyMethodDef Matrix61c_methods[] = {
+        {"set", (PyCFunction)Matrix61c_set_value, METH_VARARGS, "Set a value for the matrix"},
+        {"get", (PyCFunction)Matrix61c_get_value, METH_VARARGS, "Get a value from the matrix"},
+        {"add", (PyCFunction)Matrix61c_add_method, METH_VARARGS | METH_KEYWORDS,
+         "add(other, out=None): element-wise sum, written into out if given"},
+        {"sub", (PyCFunction)Matrix61c_sub_method, METH_VARARGS | METH_KEYWORDS,
+         "sub(other, out=None): element-wise difference, written into out if given"},
+        {"mul", (PyCFunction)Matrix61c_mul_method, METH_VARARGS | METH_KEYWORDS,
+         "mul(other, out=None): matrix product, written into out if given"},
+        {"div", (PyCFunction)Matrix61c_div_method, METH_VARARGS | METH_KEYWORDS,
+         "div(scalar, out=None): element-wise division by a number, written into out if given"},
+        {"neg", (PyCFunction)Matrix61c_neg_method, METH_VARARGS | METH_KEYWORDS,
+         "neg(out=None): element-wise negation, written into out if given"},
+        {"abs", (PyCFunction)Matrix61c_abs_method, METH_VARARGS | METH_KEYWORDS,
+         "abs(out=None): element-wise absolute value, written into out if given"},
+        {"pow", (PyCFunction)Matrix61c_pow_method, METH_VARARGS | METH_KEYWORDS,
+         "pow(n, out=None): matrix power, written into out if given"},
+        {"sum", (PyCFunction)Matrix61c_sum, METH_VARARGS | METH_KEYWORDS,
+         "sum(axis=None): sum of all entries, or of each column (axis=0) or row (axis=1)"},
+        {"mean", (PyCFunction)Matrix61c_mean, METH_VARARGS | METH_KEYWORDS,
+         "mean(axis=None): mean of all entries, or of each column (axis=0) or row (axis=1)"},
+        {"min", (PyCFunction)Matrix61c_min, METH_VARARGS | METH_KEYWORDS,
+         "min(axis=None): smallest entry, or that of each column (axis=0) or row (axis=1)"},
+        {"max", (PyCFunction)Matrix61c_max, METH_VARARGS | METH_KEYWORDS,
+         "max(axis=None): largest entry, or that of each column (axis=0) or row (axis=1)"},
+        {"argmax", (PyCFunction)Matrix61c_argmax, METH_VARARGS | METH_KEYWORDS,
+         "argmax(axis=None): flat index of the first largest entry, or its row (axis=0) or "
+         "column (axis=1) index in each column or row"},
+        {"astype", (PyCFunction)Matrix61c_astype, METH_VARARGS,
+         "astype(dtype): copy converted to 'float64', 'float32' or 'int32'"},
+        {"from_buffer", (PyCFunction)Matrix61c_from_buffer, METH_VARARGS | METH_KEYWORDS | METH_CLASS,
+         "from_buffer(obj, copy=False): matrix sharing or copying a C-contiguous float64, float32 or "
+         "int32 buffer"},
+        {"tolist", (PyCFunction)Matrix61c_tolist, METH_NOARGS, "tolist(): list of the rows of the matrix"},
+        {"__reduce_ex__", (PyCFunction)Matrix61c_reduce_ex, METH_VARARGS,
+         "__reduce_ex__(protocol): pickles the raw entries, out of band from protocol 5 on"},
+        {"_from_pickle", (PyCFunction)Matrix61c_from_pickle, METH_VARARGS | METH_CLASS,
+         "_from_pickle(buf, rows, cols, dtype): rebuilds a pickled matrix, adopting writable buffers"},
+        {"tobytes", (PyCFunction)Matrix61c_tobytes, METH_NOARGS,
+         "tobytes(): the entries as native bytes of the matrix dtype in row-major order"},
+        {"tofile", (PyCFunction)Matrix61c_tofile, METH_VARARGS,
+         "tofile(path): writes the entries to path as raw native values in row-major order"},
+        {"frombytes", (PyCFunction)Matrix61c_frombytes, METH_VARARGS | METH_KEYWORDS | METH_CLASS,
+         "frombytes(buf, rows, cols, dtype='float64'): matrix copied from rows * cols native values"},
+        {"fromiter", (PyCFunction)Matrix61c_fromiter, METH_VARARGS | METH_KEYWORDS | METH_CLASS,
+         "fromiter(iterable, rows, cols, dtype='float64'): matrix filled from exactly rows * cols numbers"},
+        {"from_array", (PyCFunction)Matrix61c_from_array, METH_VARARGS | METH_KEYWORDS | METH_CLASS,
+         "from_array(arr, rows=1, cols=len(arr), dtype='float64'): matrix copied from an array.array "
+         "of numbers"},
+        {NULL, NULL, 0, NULL}
+};
+
+/* BUFFER PROTOCOL */
+
+/* Buffer protocol format of each dtype */
+static const char *const dtype_formats[NUM_DTYPES] = {"d", "f", "i"};
+
+/*
+ * Exposes the data of a numc.Matrix as a writable 2-D C-contiguous buffer of its dtype, so that
+ * e.g. memoryview(mat) and numpy.asarray(mat) share memory with it.
+ */
+static int Matrix61c_getbuffer(Matrix61c *self, Py_buffer *view, int flags) {
+    /* Every export is writable, whatever the consumer asked for, so it counts as a write */
+    if (Matrix61c_prepare_write(self)) {
+        view->obj = NULL;
+        return -1;
+    }
+    matrix *mat = self->mat;
+    Py_ssize_t item = dtype_size(mat->dtype);
+    self->buf_shape[0] = mat->rows;
+    self->buf_shape[1] = mat->cols;
+    self->buf_strides[0] = mat->row_stride * item;
+    self->buf_strides[1] = mat->col_stride * item;
+    int contiguity = PyBUF_C_CONTIGUOUS | PyBUF_F_CONTIGUOUS | PyBUF_ANY_CONTIGUOUS;
+    if (!is_contiguous(mat) && ((flags & PyBUF_STRIDES) != PyBUF_STRIDES || (flags & contiguity & ~PyBUF_STRIDES))) {
+        PyErr_SetString(PyExc_BufferError, "numc.Matrix view is not contiguous");
+        view->obj = NULL;
+        return -1;
+    }
+
+    view->buf = mat->data;
+    view->obj = (PyObject *) self;
+    Py_INCREF(self);
+    view->len = (Py_ssize_t) mat->rows * mat->cols * item;
+    view->readonly = 0;
+    view->itemsize = item;
+    view->format = (flags & PyBUF_FORMAT) ? (char *) dtype_formats[mat->dtype] : NULL;
+    view->ndim = (flags & PyBUF_ND) ? 2 : 1;
+    view->shape = (flags & PyBUF_ND) ? self->buf_shape : NULL;
+    view->strides = (flags & PyBUF_STRIDES) == PyBUF_STRIDES ? self->buf_strides : NULL;
+    view->suboffsets = NULL;
+    view->internal = NULL;
+    return 0;
+}
+
+static PyBufferProcs Matrix61c_as_buffer = {
+    .bf_getbuffer = (getbufferproc) Matrix61c_getbuffer,
+};
+
+/*
+ * Releases a buffer wrapped by Matrix.from_buffer once no matrix uses its memory anymore. The
+ * last matrix may be deallocated on any thread, so this takes the GIL if it is not held.
+ */
+static void release_buffer(void *view) {
+    PyGILState_STATE gil = PyGILState_Ensure();
+    PyBuffer_Release((Py_buffer *) view);
+    PyMem_Free(view);
+    PyGILState_Release(gil);
+}
+
+/* Returns the dtype of a buffer of native entries described by `format` and `itemsize`, or -1 */
+static int buffer_dtype(const char *format, Py_ssize_t itemsize) {
+    if (format == NULL) {
+        return -1;
+    }
+    if (*format == '@' || *format == '=' || *format == (PY_LITTLE_ENDIAN ? '<' : '>')) {
+        format++;
+    }
+    for (int dtype = 0; dtype < NUM_DTYPES; dtype++) {
+        if (strcmp(format, dtype_formats[dtype]) == 0 && (size_t) itemsize == dtype_size(dtype)) {
+            return dtype;
+        }
+    }
+    /* numpy describes int32 as 'l' where long is 32 bits wide */
+    return strcmp(format, "l") == 0 && itemsize == sizeof(int32_t) ? DTYPE_INT32 : -1;
+}
+
+/*
+ * Matrix.from_buffer(obj, copy=False). Builds a numc.Matrix from any C-contiguous 1-D or 2-D
+ * buffer of float64, float32 or int32, such as a NumPy array, with the matching dtype. A 1-D
+ * buffer becomes a single row. The matrix shares memory with `obj` unless `copy` is true or
+ * the buffer is read-only, in which case the data is copied with a single memcpy.
+ */
+static PyObject *Matrix61c_from_buffer(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"obj", "copy", NULL};
+    PyObject *obj = NULL;
+    int copy = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|p", kwlist, &obj, &copy)) {
+        return NULL;
+    }
+
+    Py_buffer *view = PyMem_Malloc(sizeof(Py_buffer));
+    if (view == NULL) {
+        return PyErr_NoMemory();
+    }
+    int flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT;
+    if (copy || PyObject_GetBuffer(obj, view, flags | PyBUF_WRITABLE)) {
+        PyErr_Clear();
+        if (PyObject_GetBuffer(obj, view, flags)) {
+            PyMem_Free(view);
+            return NULL;
+        }
+        copy = 1;
+    }
+
+    Py_ssize_t rows = 0, cols = 0;
+    int dtype = buffer_dtype(view->format, view->itemsize);
+    if (dtype < 0) {
+        PyErr_SetString(PyExc_TypeError, "Buffer must contain float64, float32 or int32 values");
+    } else if (view->ndim == 1) {
+        rows = 1;
+        cols = view->shape[0];
+    } else if (view->ndim == 2) {
+        rows = view->shape[0];
+        cols = view->shape[1];
+    } else {
+        PyErr_SetString(PyExc_ValueError, "Buffer must be 1-D or 2-D");
+    }
+    if (!PyErr_Occurred() && (rows <= 0 || cols <= 0 || rows > INT_MAX || cols > INT_MAX)) {
+        PyErr_SetString(PyExc_ValueError, "Buffer dimensions not valid");
+    }
+    if (PyErr_Occurred()) {
+        release_buffer(view);
+        return NULL;
+    }
+
+    return adopt_buffer(type, view, rows, cols, dtype, copy);
+}
+
+/*
+ * Returns a new rows x cols matrix of `type` and `dtype` holding the row-major entries in
+ * `view`, which must come from PyMem_Malloc. The matrix takes over the view and shares its
+ * memory, unless `copy` is true, in which case the data is copied with a single memcpy and the
+ * view released.
+ */
+static PyObject *adopt_buffer(PyTypeObject *type, Py_buffer *view, int rows, int cols, int dtype, int copy) {
+    matrix *mat;
+    int failed;
+    if (copy) {
+        failed = allocate_matrix_typed(&mat, rows, cols, dtype);
+        if (!failed) {
+            memcpy(mat->data, view->buf, view->len);
+        }
+        release_buffer(view);
+    } else {
+        failed = allocate_matrix_external(&mat, rows, cols, dtype, view->buf, view, release_buffer);
+        if (failed) {
+            release_buffer(view);
+        }
+    }
+    if (failed) {
+        return PyErr_NoMemory();
+    }
+    return wrap_as(type, mat);
+}
 
-    if (PyFloat_Check(arg3)) {
-        val = PyFloat_AsDouble(arg3);
+/*
+ * Matrix.__reduce_ex__(protocol). Pickles the entries as raw row-major values of the matrix
+ * dtype. From protocol 5 on they are exported as a pickle.PickleBuffer, which
+ * pickle.dumps(..., buffer_callback=...) can hand out of band without copying; views with gaps
+ * are packed first. Earlier protocols copy the entries into a bytes object.
+ */
+static PyObject *Matrix61c_reduce_ex(Matrix61c *self, PyObject *args) {
+    int protocol;
+    if (!PyArg_ParseTuple(args, "i", &protocol) || Matrix61c_force(self)) {
+        return NULL;
+    }
+    matrix *mat = self->mat;
+    PyObject *data;
+    if (protocol >= 5) {
+        PyObject *source = (PyObject *) self;
+        Py_INCREF(source);
+        if (!is_contiguous(mat)) {
+            matrix *packed = new_matrix(mat->rows, mat->cols, mat->dtype);
+            Py_DECREF(source);
+            if (packed == NULL) {
+                return NULL;
+            }
+            copy_matrix(packed, mat);
+            source = Matrix61c_wrap(packed);
+            if (source == NULL) {
+                return NULL;
+            }
+        }
+        data = PyPickleBuffer_FromObject(source);
+        Py_DECREF(source);
     } else {
-        val = PyLong_AsDouble(arg3);
+        data = Matrix61c_tobytes(self, NULL);
+    }
+    if (data == NULL) {
+        return NULL;
     }
+    PyObject *reconstructor = PyObject_GetAttrString((PyObject *) Py_TYPE(self), "_from_pickle");
+    if (reconstructor == NULL) {
+        Py_DECREF(data);
+        return NULL;
+    }
+    return Py_BuildValue("(N(Niis))", reconstructor, data, mat->rows, mat->cols, dtype_name(mat->dtype));
+}
 
-    set(self->mat, row, col, val);
-    return Py_None;
+/*
+ * Matrix._from_pickle(buf, rows, cols, dtype), the reconstructor of Matrix.__reduce_ex__.
+ * Builds a rows x cols matrix of `dtype` from the raw entries in `buf`. A writable buffer, such
+ * as an out-of-band buffer given to pickle.loads or the bytearray an in-band PickleBuffer is
+ * loaded as, is adopted without copying. A read-only one is copied with a single memcpy.
+ */
+static PyObject *Matrix61c_from_pickle(PyTypeObject *type, PyObject *args) {
+    PyObject *obj;
+    int rows, cols, dtype = DTYPE_FLOAT64;
+    if (!PyArg_ParseTuple(args, "OiiO&", &obj, &rows, &cols, parse_dtype, &dtype)) {
+        return NULL;
+    }
+    Py_buffer *view = PyMem_Malloc(sizeof(Py_buffer));
+    if (view == NULL) {
+        return PyErr_NoMemory();
+    }
+    int copy = 0;
+    if (PyObject_GetBuffer(obj, view, PyBUF_C_CONTIGUOUS | PyBUF_WRITABLE)) {
+        PyErr_Clear();
+        if (PyObject_GetBuffer(obj, view, PyBUF_C_CONTIGUOUS)) {
+            PyMem_Free(view);
+            return NULL;
+        }
+        copy = 1;
+    }
+    if (rows <= 0 || cols <= 0 || view->len != (Py_ssize_t) rows * cols * (Py_ssize_t) dtype_size(dtype)) {
+        PyErr_SetString(PyExc_ValueError, "Pickled data does not match the matrix shape");
+        release_buffer(view);
+        return NULL;
+    }
+    return adopt_buffer(type, view, rows, cols, dtype, copy);
 }
 
 /*
- * Given a numc.Matrix `self`, parse `args` to (int) row and (int) col.
- * This function should return the value at the `row`th row and `col`th column, which is a Python
- * float.
+ * An operand of numc.compare: a numc.Matrix, a 1-D or 2-D buffer of float64, float32 or int32
+ * (wrapped in place, with any strides), or an object with .shape and .get(i, j) such as a
+ * dumbpy.Matrix, which is copied. compare_operand fills one in and compare_release releases it.
  */
-static PyObject *Matrix61c_get_value(Matrix61c *self, PyObject* args) {
-    PyObject *arg1, *arg2;
-    PyArg_UnpackTuple(args, "args", 2, 2, &arg1, &arg2);
+typedef struct compare_arg {
+    matrix *mat; // the matrix to compare
+    matrix wrapped; // a buffer operand as a matrix, which `mat` then points to
+    Py_buffer view; // the buffer of a buffer operand, view.obj is NULL for other operands
+    PyObject *owner; // a numc.Matrix operand, NULL for other operands
+    int copied; // whether `mat` is a copy that compare_release deallocates
+} compare_arg;
 
-    int row = PyLong_AsLong(arg1), col = PyLong_AsLong(arg2);
+/* Sets up `arg` for `obj`. Returns 0 on success and -1 with an exception set on failure. */
+static int compare_operand(PyObject *obj, compare_arg *arg) {
+    arg->view.obj = NULL;
+    arg->owner = NULL;
+    arg->copied = 0;
+    if (PyObject_TypeCheck(obj, &Matrix61cType)) {
+        if (Matrix61c_force((Matrix61c *) obj)) {
+            return -1;
+        }
+        arg->owner = obj;
+        arg->mat = ((Matrix61c *) obj)->mat;
+        return 0;
+    }
+    if (PyObject_CheckBuffer(obj)) {
+        if (PyObject_GetBuffer(obj, &arg->view, PyBUF_STRIDES | PyBUF_FORMAT)) {
+            return -1;
+        }
+        Py_buffer *view = &arg->view;
+        int dtype = buffer_dtype(view->format, view->itemsize);
+        Py_ssize_t rows = view->ndim == 2 ? view->shape[0] : 1;
+        Py_ssize_t cols = view->ndim == 2 ? view->shape[1] : view->ndim == 1 ? view->shape[0] : 0;
+        Py_ssize_t row_stride = view->ndim == 2 ? view->strides[0] : 0;
+        Py_ssize_t col_stride = view->ndim >= 1 ? view->strides[view->ndim - 1] : 0;
+        if (dtype < 0) {
+            PyErr_SetString(PyExc_TypeError, "Buffer must contain float64, float32 or int32 values");
+        } else if (view->ndim != 1 && view->ndim != 2) {
+            PyErr_SetString(PyExc_ValueError, "Buffer must be 1-D or 2-D");
+        } else if (rows <= 0 || cols <= 0 || rows > INT_MAX || cols > INT_MAX ||
+                   row_stride % view->itemsize || col_stride % view->itemsize ||
+                   row_stride / view->itemsize > INT_MAX || col_stride / view->itemsize > INT_MAX ||
+                   row_stride / view->itemsize < INT_MIN || col_stride / view->itemsize < INT_MIN) {
+            PyErr_SetString(PyExc_ValueError, "Buffer dimensions not valid");
+        }
+        if (PyErr_Occurred()) {
+            PyBuffer_Release(view);
+            return -1;
+        }
+        matrix wrapped = {rows, cols, {view->buf}, row_stride / view->itemsize, col_stride / view->itemsize,
+                          NULL, dtype};
+        arg->wrapped = wrapped;
+        arg->mat = &arg->wrapped;
+        return 0;
+    }
 
-    return PyFloat_FromDouble(get(self->mat, row, col));
+    PyObject *shape = PyObject_GetAttrString(obj, "shape");
+    int rows, cols;
+    if (shape == NULL || !PyArg_ParseTuple(shape, "ii", &rows, &cols)) {
+        Py_XDECREF(shape);
+        PyErr_Format(PyExc_TypeError, "Cannot compare %.200s objects, expected a numc.Matrix, a "
+                     "buffer or an object with .shape and .get(i, j)", Py_TYPE(obj)->tp_name);
+        return -1;
+    }
+    Py_DECREF(shape);
+    if (allocate_matrix(&arg->mat, rows, cols)) {
+        PyErr_SetString(PyExc_ValueError, "Matrix dimensions not valid");
+        return -1;
+    }
+    arg->copied = 1;
+    for (int i = 0; i < rows; i++) {
+        for (int j = 0; j < cols; j++) {
+            PyObject *entry = PyObject_CallMethod(obj, "get", "ii", i, j);
+            double value = entry == NULL ? -1 : PyFloat_AsDouble(entry);
+            Py_XDECREF(entry);
+            if (value == -1 && PyErr_Occurred()) {
+                deallocate_matrix(arg->mat);
+                free(arg->mat);
+                return -1;
+            }
+            arg->mat->data[i * cols + j] = value;
+        }
+    }
+    return 0;
+}
+
+/* Releases what compare_operand set up in `arg` */
+static void compare_release(compare_arg *arg) {
+    if (arg->view.obj != NULL) {
+        PyBuffer_Release(&arg->view);
+    }
+    if (arg->copied) {
+        deallocate_matrix(arg->mat);
+        free(arg->mat);
+    }
 }
 
 /*
- * Create an array of PyMethodDef structs to hold the instance methods.
- * Name the python function corresponding to Matrix61c_get_value as "get" and Matrix61c_set_value
- * as "set"
- * You might find this link helpful: https://docs.python.org/3.6/c-api/structures.html
+ * Runs compare_matrix on the operands `a` and `b` of numc.compare or numc.allclose, with the GIL
+ * released for large ones, and stores their number of columns in `cols`. Returns 0 on success
+ * and -1 with an exception set on failure.
  */
-static PyMethodDef Matrix61c_methods[] = {
-        {"set", (PyCFunction)Matrix61c_set_value, METH_VARARGS, "Set a value for the matrix"},
-        {"get", (PyCFunction)Matrix61c_get_value, METH_VARARGS, "Get a value from the matrix"},
-        {NULL, NULL, 0, NULL}
-};
+static int compare_objects(PyObject *a, PyObject *b, double rtol, double atol, comparison *result, int *cols) {
+    compare_arg args[2];
+    if (compare_operand(a, &args[0])) {
+        return -1;
+    }
+    if (compare_operand(b, &args[1])) {
+        compare_release(&args[0]);
+        return -1;
+    }
+    PyObject *operands[MAX_OPERANDS] = {args[0].owner, args[1].owner, NULL};
+    PyThreadState *state = release_gil((double) args[0].mat->rows * args[0].mat->cols, operands, MAX_OPERANDS);
+    int failed = compare_matrix(args[0].mat, args[1].mat, rtol, atol, result);
+    acquire_gil(state, operands, MAX_OPERANDS);
+    *cols = args[0].mat->cols;
+    if (failed) {
+        PyErr_Format(PyExc_ValueError, "Cannot compare a %d x %d matrix with a %d x %d one", args[0].mat->rows,
+                     args[0].mat->cols, args[1].mat->rows, args[1].mat->cols);
+    }
+    compare_release(&args[0]);
+    compare_release(&args[1]);
+    return failed ? -1 : 0;
+}
+
+/*
+ * numc.compare(a, b, rtol=1e-05, atol=1e-08). Compares every entry of `a` with the entry of the
+ * reference `b` at the same position like numpy.isclose, in a single vectorized pass. Each of
+ * a and b may be a numc.Matrix, a 1-D or 2-D float64, float32 or int32 buffer such as a NumPy
+ * array, or an object with .shape and .get(i, j) such as a dumbpy.Matrix. Returns a dict with
+ * the (row, col) of the first entry that is not close, or None, and the largest absolute and
+ * relative errors.
+ */
+static PyObject *Matrix61c_class_compare(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"a", "b", "rtol", "atol", NULL};
+    PyObject *a, *b;
+    double rtol = 1e-05, atol = 1e-08;
+    comparison result;
+    int cols;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|dd", kwlist, &a, &b, &rtol, &atol) ||
+        compare_objects(a, b, rtol, atol, &result, &cols)) {
+        return NULL;
+    }
+    if (result.mismatch >= 0) {
+        return Py_BuildValue("{s:(ll),s:d,s:d}", "mismatch", result.mismatch / cols, result.mismatch % cols,
+                             "max_abs_err", result.max_abs_err, "max_rel_err", result.max_rel_err);
+    }
+    return Py_BuildValue("{s:O,s:d,s:d}", "mismatch", Py_None, "max_abs_err", result.max_abs_err,
+                         "max_rel_err", result.max_rel_err);
+}
+
+/*
+ * numc.allclose(a, b, rtol=1e-05, atol=1e-08). Whether every entry of `a` is close to the entry
+ * of `b` at the same position, see numc.compare.
+ */
+static PyObject *Matrix61c_class_allclose(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"a", "b", "rtol", "atol", NULL};
+    PyObject *a, *b;
+    double rtol = 1e-05, atol = 1e-08;
+    comparison result;
+    int cols;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|dd", kwlist, &a, &b, &rtol, &atol) ||
+        compare_objects(a, b, rtol, atol, &result, &cols)) {
+        return NULL;
+    }
+    return PyBool_FromLong(result.mismatch < 0);
+}
+
+/*
+ * Allocates the rows x cols matrix of `dtype` of a bulk constructor. Returns NULL with an
+ * exception set on failure.
+ */
+static matrix *new_matrix(Py_ssize_t rows, Py_ssize_t cols, int dtype) {
+    matrix *mat;
+    if (rows <= 0 || cols <= 0 || rows > INT_MAX || cols > INT_MAX) {
+        PyErr_SetString(PyExc_ValueError, "Matrix dimensions not valid");
+        return NULL;
+    }
+    if (allocate_matrix_typed(&mat, rows, cols, dtype)) {
+        PyErr_NoMemory();
+        return NULL;
+    }
+    return mat;
+}
+
+/*
+ * Matrix.frombytes(buf, rows, cols, dtype="float64"). Builds a rows x cols numc.Matrix from any
+ * bytes-like object holding rows * cols native values of `dtype` in row-major order, such as the
+ * output of mat.tobytes() or a file read into memory. The data is copied with a single memcpy.
+ */
+static PyObject *Matrix61c_frombytes(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"buf", "rows", "cols", "dtype", NULL};
+    Py_buffer view;
+    Py_ssize_t rows, cols;
+    int dtype = DTYPE_FLOAT64;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "y*nn|O&", kwlist, &view, &rows, &cols, parse_dtype, &dtype)) {
+        return NULL;
+    }
+    matrix *mat = NULL;
+    Py_ssize_t item = dtype_size(dtype);
+    if (rows > 0 && cols > 0 && view.len != rows * cols * item) {
+        PyErr_Format(PyExc_ValueError, "Buffer holds %zd bytes, not the %zd of a %zd x %zd matrix",
+                     view.len, rows * cols * item, rows, cols);
+    } else {
+        mat = new_matrix(rows, cols, dtype);
+    }
+    if (mat != NULL) {
+        memcpy(mat->data, view.buf, view.len);
+    }
+    PyBuffer_Release(&view);
+    return mat == NULL ? NULL : wrap_as(type, mat);
+}
+
+/*
+ * Matrix.fromiter(iterable, rows, cols, dtype="float64"). Builds a rows x cols numc.Matrix from
+ * an iterable of exactly rows * cols numbers in row-major order, such as a generator. Lists and
+ * tuples are read directly, without going through the iterator protocol.
+ */
+static PyObject *Matrix61c_fromiter(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"iterable", "rows", "cols", "dtype", NULL};
+    PyObject *iterable;
+    Py_ssize_t rows, cols;
+    int dtype = DTYPE_FLOAT64;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Onn|O&", kwlist, &iterable, &rows, &cols,
+                                     parse_dtype, &dtype)) {
+        return NULL;
+    }
+    matrix *mat = new_matrix(rows, cols, DTYPE_FLOAT64);
+    if (mat == NULL) {
+        return NULL;
+    }
+    Py_ssize_t size = rows * cols, count = 0;
+    int failed = 0;
+    if (is_list_or_tuple(iterable)) {
+        count = PySequence_Fast_GET_SIZE(iterable);
+        failed = count == size && convert_items(PySequence_Fast_ITEMS(iterable), size, mat->data);
+    } else {
+        PyObject *it = PyObject_GetIter(iterable);
+        PyObject *item;
+        failed = it == NULL;
+        /* Reads one item past the end, to tell an iterable that is too long */
+        while (!failed && count <= size && (item = PyIter_Next(it)) != NULL) {
+            if (count < size) {
+                failed = convert_items(&item, 1, mat->data + count);
+            }
+            count++;
+            Py_DECREF(item);
+        }
+        Py_XDECREF(it);
+        failed = failed || PyErr_Occurred() != NULL;
+    }
+    if (!failed && count != size) {
+        PyErr_Format(PyExc_ValueError, "Iterable has %s than the %zd entries of a %zd x %zd matrix",
+                     count < size ? "fewer" : "more", size, rows, cols);
+        failed = 1;
+    }
+    if (failed) {
+        deallocate_matrix(mat);
+        free(mat);
+        return NULL;
+    }
+    mat = as_dtype(mat, dtype);
+    return mat == NULL ? NULL : wrap_as(type, mat);
+}
+
+/* Converts the n values of type T at src into doubles at dst */
+#define CONVERT_VALUES(T, src, dst, n) \
+    for (Py_ssize_t i = 0; i < (n); i++) { \
+        (dst)[i] = (double) ((const T *) (src))[i]; \
+    }
+
+/*
+ * Matrix.from_array(arr, rows=1, cols=len(arr), dtype="float64"). Builds a numc.Matrix of
+ * `dtype` from an array.array, or any other C-contiguous buffer of native integers or
+ * floating-point numbers, by default as a single row. Data that already is of `dtype` is copied
+ * with a single memcpy and other types are converted. The matrix never shares memory with `arr`.
+ */
+static PyObject *Matrix61c_from_array(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"arr", "rows", "cols", "dtype", NULL};
+    PyObject *obj;
+    Py_ssize_t rows = -1, cols = -1;
+    int dtype = DTYPE_FLOAT64;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|nnO&", kwlist, &obj, &rows, &cols, parse_dtype, &dtype)) {
+        return NULL;
+    }
+    Py_buffer view;
+    if (PyObject_GetBuffer(obj, &view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT)) {
+        return NULL;
+    }
+    Py_ssize_t n = view.len / view.itemsize;
+    if (rows < 0 && cols < 0) {
+        rows = 1;
+        cols = n;
+    } else if (rows < 0 || cols < 0) {
+        rows = rows < 0 ? (cols > 0 ? n / cols : 0) : rows;
+        cols = cols < 0 ? (rows > 0 ? n / rows : 0) : cols;
+    }
+    const char *format = view.format;
+    if (*format == '@') {
+        format++;
+    }
+    char code = strlen(format) == 1 ? *format : 0;
+    matrix *mat = NULL;
+    if (code == 0 || strchr("bBhHiIlLqQfd", code) == NULL) {
+        PyErr_Format(PyExc_TypeError, "Unsupported array format '%s'", view.format);
+    } else if (rows * cols != n) {
+        PyErr_Format(PyExc_ValueError, "Array has %zd entries, not the %zd of a %zd x %zd matrix",
+                     n, rows * cols, rows, cols);
+    } else if (buffer_dtype(view.format, view.itemsize) == dtype) {
+        mat = new_matrix(rows, cols, dtype);
+        if (mat != NULL) {
+            memcpy(mat->data, view.buf, view.len);
+        }
+        PyBuffer_Release(&view);
+        return mat == NULL ? NULL : wrap_as(type, mat);
+    } else {
+        mat = new_matrix(rows, cols, DTYPE_FLOAT64);
+    }
+    if (mat != NULL) {
+        double *data = mat->data;
+        switch (code) {
+        case 'b': CONVERT_VALUES(signed char, view.buf, data, n); break;
+        case 'B': CONVERT_VALUES(unsigned char, view.buf, data, n); break;
+        case 'h': CONVERT_VALUES(short, view.buf, data, n); break;
+        case 'H': CONVERT_VALUES(unsigned short, view.buf, data, n); break;
+        case 'i': CONVERT_VALUES(int, view.buf, data, n); break;
+        case 'I': CONVERT_VALUES(unsigned int, view.buf, data, n); break;
+        case 'l': CONVERT_VALUES(long, view.buf, data, n); break;
+        case 'L': CONVERT_VALUES(unsigned long, view.buf, data, n); break;
+        case 'q': CONVERT_VALUES(long long, view.buf, data, n); break;
+        case 'Q': CONVERT_VALUES(unsigned long long, view.buf, data, n); break;
+        case 'f': CONVERT_VALUES(float, view.buf, data, n); break;
+        default: memcpy(data, view.buf, n * sizeof(double)); break;
+        }
+        mat = as_dtype(mat, dtype);
+    }
+    PyBuffer_Release(&view);
+    return mat == NULL ? NULL : wrap_as(type, mat);
+}
 
 /* INSTANCE ATTRIBUTES*/
 static PyMemberDef Matrix61c_members[] = {
@@ -496,6 +3098,33 @@ static PyMemberDef Matrix61c_members[] = {
     {NULL}  /* Sentinel */
 };
 
+/*
+ * mat.T: the transpose of mat as a view sharing its data, with the row and column strides
+ * swapped. Products such as mat.T * other read the view directly, without copying it.
+ */
+static PyObject *Matrix61c_get_T(Matrix61c *self, void *closure) {
+    if (Matrix61c_force(self)) {
+        return NULL;
+    }
+    matrix *mat = self->mat, *view;
+    if (allocate_matrix_view(&view, mat, 0, mat->cols, mat->rows, mat->col_stride, mat->row_stride)) {
+        PyErr_SetString(PyExc_RuntimeError, "Failed to allocate transpose");
+        return NULL;
+    }
+    return Matrix61c_wrap(view);
+}
+
+/* mat.dtype: the name of the element type of mat, "float64", "float32" or "int32" */
+static PyObject *Matrix61c_get_dtype(Matrix61c *self, void *closure) {
+    return PyUnicode_FromString(dtype_name(matrix_dtype(self)));
+}
+
+static PyGetSetDef Matrix61c_getset[] = {
+    {"T", (getter) Matrix61c_get_T, NULL, "transposed view of the matrix", NULL},
+    {"dtype", (getter) Matrix61c_get_dtype, NULL, "element type of the matrix", NULL},
+    {NULL}  /* Sentinel */
+};
+
 static PyTypeObject Matrix61cType = {
     PyVarObject_HEAD_INIT(NULL, 0)
     .tp_name = "numc.Matrix",
@@ -508,11 +3137,300 @@ static PyTypeObject Matrix61cType = {
     .tp_doc = "numc.Matrix objects",
     .tp_methods = Matrix61c_methods,
     .tp_members = Matrix61c_members,
+    .tp_getset = Matrix61c_getset,
+    .tp_iter = (getiterfunc) Matrix61c_iter,
     .tp_as_mapping = &Matrix61c_mapping,
+    .tp_as_buffer = &Matrix61c_as_buffer,
     .tp_init = (initproc)Matrix61c_init,
     .tp_new = Matrix61c_new
 };
 
+/* SPARSE MATRICES */
+
+/* Wraps a sparse matrix in a new numc.SparseMatrix, or frees it and returns NULL on failure */
+static PyObject *SparseMatrix_wrap(sparse_matrix *mat) {
+    SparseMatrix *rv = (SparseMatrix *) SparseMatrixType.tp_alloc(&SparseMatrixType, 0);
+    if (rv == NULL) {
+        deallocate_sparse(mat);
+        return NULL;
+    }
+    rv->mat = mat;
+    rv->shape = Py_BuildValue("(ii)", mat->rows, mat->cols);
+    if (rv->shape == NULL) {
+        Py_DECREF(rv);
+        return NULL;
+    }
+    return (PyObject *) rv;
+}
+
+/* Turns the return value `failed` of a sparse constructor into a Python result */
+static PyObject *sparse_result(sparse_matrix *mat, int failed) {
+    if (failed == -1) {
+        PyErr_SetString(PyExc_ValueError, "Sparse matrix coordinates out of range");
+        return NULL;
+    }
+    if (failed) {
+        return PyErr_NoMemory();
+    }
+    return SparseMatrix_wrap(mat);
+}
+
+/*
+ * Reads the sequence `obj` of Python numbers into a new array of ints if `indices` is true and
+ * of doubles otherwise, to be freed with PyMem_Free. Sets *n to its length if *n is negative,
+ * and otherwise checks that it is *n long. Indices that do not fit an int become -1, which is
+ * out of range. Returns NULL with an exception set on failure.
+ */
+static void *coo_array(PyObject *obj, Py_ssize_t *n, int indices) {
+    PyObject *seq = PySequence_Fast(obj, "Sparse matrix coordinates and values must be sequences");
+    if (seq == NULL) {
+        return NULL;
+    }
+    Py_ssize_t len = PySequence_Fast_GET_SIZE(seq);
+    if (*n >= 0 && len != *n) {
+        PyErr_SetString(PyExc_ValueError, "Sparse matrix coordinates and values differ in length");
+        Py_DECREF(seq);
+        return NULL;
+    }
+    *n = len;
+    void *array = PyMem_Malloc((len > 0 ? len : 1) * (indices ? sizeof(int) : sizeof(double)));
+    if (array == NULL) {
+        Py_DECREF(seq);
+        return PyErr_NoMemory();
+    }
+    PyObject **items = PySequence_Fast_ITEMS(seq);
+    for (Py_ssize_t k = 0; k < len && !PyErr_Occurred(); k++) {
+        if (indices) {
+            Py_ssize_t index = PyNumber_AsSsize_t(items[k], NULL);
+            ((int *) array)[k] = index >= 0 && index <= INT_MAX ? (int) index : -1;
+        } else {
+            ((double *) array)[k] = PyFloat_AsDouble(items[k]);
+        }
+    }
+    Py_DECREF(seq);
+    if (PyErr_Occurred()) {
+        PyMem_Free(array);
+        return NULL;
+    }
+    return array;
+}
+
+/*
+ * SparseMatrix(mat) stores the nonzero entries of the numc.Matrix mat.
+ * SparseMatrix(rows, cols, row_indices, col_indices, values) builds a rows x cols matrix from
+ * coordinate (COO) triples: values[k] goes to row row_indices[k] and column col_indices[k].
+ * The triples may come in any order, and the values of repeated coordinates are summed.
+ */
+static PyObject *SparseMatrix_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+    if (kwds != NULL && PyDict_GET_SIZE(kwds) > 0) {
+        PyErr_SetString(PyExc_TypeError, "SparseMatrix() takes no keyword arguments");
+        return NULL;
+    }
+    sparse_matrix *mat = NULL;
+    int failed;
+    if (PyTuple_GET_SIZE(args) == 1) {
+        Matrix61c *dense;
+        if (!PyArg_ParseTuple(args, "O!:SparseMatrix", &Matrix61cType, &dense) || Matrix61c_force(dense)) {
+            return NULL;
+        }
+        PyObject *operands[] = {(PyObject *) dense};
+        PyThreadState *state = release_gil((double) dense->mat->rows * dense->mat->cols, operands, 1);
+        failed = sparse_from_dense(&mat, dense->mat);
+        acquire_gil(state, operands, 1);
+        return sparse_result(mat, failed);
+    }
+    int rows, cols;
+    PyObject *row_obj, *col_obj, *value_obj;
+    if (!PyArg_ParseTuple(args, "iiOOO:SparseMatrix", &rows, &cols, &row_obj, &col_obj, &value_obj)) {
+        return NULL;
+    }
+    if (rows <= 0 || cols <= 0) {
+        PyErr_SetString(PyExc_ValueError, "Matrix dimensions not valid");
+        return NULL;
+    }
+    Py_ssize_t n = -1;
+    int *row_idx = coo_array(row_obj, &n, 1);
+    int *col_idx = row_idx == NULL ? NULL : coo_array(col_obj, &n, 1);
+    double *values = col_idx == NULL ? NULL : coo_array(value_obj, &n, 0);
+    if (values != NULL) {
+        PyThreadState *state = release_gil((double) n, NULL, 0);
+        failed = sparse_from_coo(&mat, rows, cols, n, row_idx, col_idx, values);
+        acquire_gil(state, NULL, 0);
+    }
+    PyMem_Free(row_idx);
+    PyMem_Free(col_idx);
+    PyMem_Free(values);
+    return values == NULL ? NULL : sparse_result(mat, failed);
+}
+
+static void SparseMatrix_dealloc(SparseMatrix *self) {
+    deallocate_sparse(self->mat);
+    Py_XDECREF(self->shape);
+    Py_TYPE(self)->tp_free(self);
+}
+
+static PyObject *SparseMatrix_repr(SparseMatrix *self) {
+    return PyUnicode_FromFormat("<%d x %d numc.SparseMatrix with %ld stored entries>",
+                                self->mat->rows, self->mat->cols, self->mat->nnz);
+}
+
+/* s.nnz: the number of stored entries of s */
+static PyObject *SparseMatrix_get_nnz(SparseMatrix *self, void *closure) {
+    return PyLong_FromLong(self->mat->nnz);
+}
+
+/* s.todense(): s as a float64 numc.Matrix */
+static PyObject *SparseMatrix_todense(SparseMatrix *self, PyObject *args) {
+    matrix *result;
+    if (allocate_matrix_typed(&result, self->mat->rows, self->mat->cols, DTYPE_FLOAT64)) {
+        return PyErr_NoMemory();
+    }
+    PyObject *operands[] = {(PyObject *) self};
+    PyThreadState *state = release_gil((double) result->rows * result->cols, operands, 1);
+    int failed = sparse_to_dense(result, self->mat);
+    acquire_gil(state, operands, 1);
+    return finish_op(result, NULL, failed);
+}
+
+/* s.tocoo(): the lists (row_indices, col_indices, values) of the stored entries in row-major order */
+static PyObject *SparseMatrix_tocoo(SparseMatrix *self, PyObject *args) {
+    sparse_matrix *mat = self->mat;
+    PyObject *rows = PyList_New(mat->nnz), *cols = PyList_New(mat->nnz), *values = PyList_New(mat->nnz);
+    if (rows == NULL || cols == NULL || values == NULL) {
+        goto error;
+    }
+    for (int i = 0; i < mat->rows; i++) {
+        for (long k = mat->row_ptr[i]; k < mat->row_ptr[i + 1]; k++) {
+            PyObject *row = PyLong_FromLong(i), *col = PyLong_FromLong(mat->col_idx[k]);
+            PyObject *value = PyFloat_FromDouble(mat->values[k]);
+            if (row == NULL || col == NULL || value == NULL) {
+                Py_XDECREF(row);
+                Py_XDECREF(col);
+                Py_XDECREF(value);
+                goto error;
+            }
+            PyList_SET_ITEM(rows, k, row);
+            PyList_SET_ITEM(cols, k, col);
+            PyList_SET_ITEM(values, k, value);
+        }
+    }
+    return Py_BuildValue("(NNN)", rows, cols, values);
+error:
+    Py_XDECREF(rows);
+    Py_XDECREF(cols);
+    Py_XDECREF(values);
+    return NULL;
+}
+
+/*
+ * Computes `a op b` where either operand is a numc.SparseMatrix, writing the result into `out`
+ * when it is not NULL. Sums and products of a sparse matrix and a numc.Matrix are float64
+ * numc.Matrix objects. The sum of two sparse matrices and the product of a sparse matrix and a
+ * number are sparse. Other operations are not supported.
+ */
+static PyObject *sparse_binary_op(PyObject *a, PyObject *b, Matrix61c *out, int op) {
+    int a_sparse = PyObject_TypeCheck(a, &SparseMatrixType), b_sparse = PyObject_TypeCheck(b, &SparseMatrixType);
+    sparse_matrix *sparse = ((SparseMatrix *) (a_sparse ? a : b))->mat, *result_sparse = NULL;
+    PyObject *other = a_sparse ? b : a;
+    if (out == NULL && op == OP_MUL && is_scalar(other)) {
+        double scalar = PyFloat_AsDouble(other);
+        if (scalar == -1 && PyErr_Occurred()) {
+            return NULL;
+        }
+        return sparse_result(result_sparse, sparse_scale(&result_sparse, sparse, scalar));
+    }
+    if (out == NULL && op == OP_ADD && a_sparse && b_sparse) {
+        sparse_matrix *sparse2 = ((SparseMatrix *) b)->mat;
+        if (sparse->rows != sparse2->rows || sparse->cols != sparse2->cols) {
+            PyErr_SetString(PyExc_ValueError, binary_errors[op]);
+            return NULL;
+        }
+        return sparse_result(result_sparse, sparse_add_sparse(&result_sparse, sparse, sparse2));
+    }
+    if ((op != OP_ADD && op != OP_MUL) || !PyObject_TypeCheck(other, &Matrix61cType)) {
+        PyErr_Format(PyExc_TypeError, "unsupported operand type(s) for %s", binary_symbols[op]);
+        return NULL;
+    }
+    Matrix61c *dense = (Matrix61c *) other;
+    int rows, cols;
+    matrix_shape(dense, &rows, &cols);
+    if (op == OP_ADD ? sparse->rows != rows || sparse->cols != cols :
+            a_sparse ? sparse->cols != rows : cols != sparse->rows) {
+        PyErr_SetString(PyExc_ValueError, binary_errors[op]);
+        return NULL;
+    }
+    if (op == OP_MUL) {
+        rows = a_sparse ? sparse->rows : rows;
+        cols = a_sparse ? cols : sparse->cols;
+    }
+    if (check_out(out, rows, cols, DTYPE_FLOAT64) || Matrix61c_force(dense) ||
+            (out != NULL && Matrix61c_prepare_write(out))) {
+        return NULL;
+    }
+    matrix *result = result_matrix(out, rows, cols, DTYPE_FLOAT64);
+    if (result == NULL) {
+        return NULL;
+    }
+    PyObject *operands[MAX_OPERANDS] = {a, b, (PyObject *) out};
+    double cost = op == OP_ADD ? (double) sparse->nnz : 2.0 * sparse->nnz * (a_sparse ? cols : rows);
+    PyThreadState *state = release_gil(cost, operands, MAX_OPERANDS);
+    int failed;
+    if (op == OP_ADD) {
+        failed = sparse_add_dense(result, sparse, dense->mat);
+    } else if (a_sparse) {
+        failed = sparse_mul_dense(result, sparse, dense->mat);
+    } else {
+        failed = dense_mul_sparse(result, dense->mat, sparse);
+    }
+    acquire_gil(state, operands, MAX_OPERANDS);
+    return finish_op(result, out, failed);
+}
+
+static PyObject *SparseMatrix_add(PyObject *a, PyObject *b) {
+    return sparse_binary_op(a, b, NULL, OP_ADD);
+}
+
+static PyObject *SparseMatrix_multiply(PyObject *a, PyObject *b) {
+    return sparse_binary_op(a, b, NULL, OP_MUL);
+}
+
+static PyNumberMethods SparseMatrix_as_number = {
+    .nb_add = (binaryfunc) SparseMatrix_add,
+    .nb_multiply = (binaryfunc) SparseMatrix_multiply,
+};
+
+static PyMethodDef SparseMatrix_methods[] = {
+    {"todense", (PyCFunction) SparseMatrix_todense, METH_NOARGS, "todense(): the matrix as a numc.Matrix"},
+    {"tocoo", (PyCFunction) SparseMatrix_tocoo, METH_NOARGS,
+     "tocoo(): lists (row_indices, col_indices, values) of the stored entries"},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyMemberDef SparseMatrix_members[] = {
+    {"shape", T_OBJECT_EX, offsetof(SparseMatrix, shape), READONLY, "(rows, cols)"},
+    {NULL}  /* Sentinel */
+};
+
+static PyGetSetDef SparseMatrix_getset[] = {
+    {"nnz", (getter) SparseMatrix_get_nnz, NULL, "number of stored entries", NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject SparseMatrixType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "numc.SparseMatrix",
+    .tp_basicsize = sizeof(SparseMatrix),
+    .tp_dealloc = (destructor) SparseMatrix_dealloc,
+    .tp_repr = (reprfunc) SparseMatrix_repr,
+    .tp_as_number = &SparseMatrix_as_number,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "SparseMatrix(mat) or SparseMatrix(rows, cols, row_indices, col_indices, values): "
+              "immutable float64 matrix in compressed sparse row format",
+    .tp_methods = SparseMatrix_methods,
+    .tp_members = SparseMatrix_members,
+    .tp_getset = SparseMatrix_getset,
+    .tp_new = SparseMatrix_new,
+};
 
 static struct PyModuleDef numcmodule = {
     PyModuleDef_HEAD_INIT,
@@ -526,8 +3444,10 @@ static struct PyModuleDef numcmodule = {
 PyMODINIT_FUNC PyInit_numc(void) {
     PyObject* m;
 
-    if (PyType_Ready(&Matrix61cType) < 0)
+    if (PyType_Ready(&Matrix61cType) < 0 || PyType_Ready(&Matrix61cRowIterType) < 0 ||
+            PyType_Ready(&ThreadLimitType) < 0 || PyType_Ready(&SparseMatrixType) < 0)
         return NULL;
+    load_parallel_config();
 
     m = PyModule_Create(&numcmodule);
     if (m == NULL)
@@ -535,6 +3455,10 @@ PyMODINIT_FUNC PyInit_numc(void) {
 
     Py_INCREF(&Matrix61cType);
     PyModule_AddObject(m, "Matrix", (PyObject *)&Matrix61cType);
+    Py_INCREF(&ThreadLimitType);
+    PyModule_AddObject(m, "threads", (PyObject *)&ThreadLimitType);
+    Py_INCREF(&SparseMatrixType);
+    PyModule_AddObject(m, "SparseMatrix", (PyObject *)&SparseMatrixType);
     printf("CS61C Summer 2021 Project 4: numc imported!\n");
     fflush(stdout);
     return m;
@@ -1,5 +1,32 @@
 #include "matrix.h"
 
+/*
+ * A pending element-wise operation of a lazy numc.Matrix (see numc.set_lazy). The operands are
+ * numc.Matrix objects themselves, so lazy matrices form a DAG that is evaluated in one fused
+ * pass when the result is read.
+ */
+typedef struct lazy_expr {
+    int op; // FUSED_ADD, FUSED_SUB, FUSED_NEG or FUSED_ABS
+    PyObject *args[2]; // operands, the second one NULL for unary operations
+    int size; // number of fused instructions needed to evaluate the expression
+    int rows; // number of rows of the result
+    int cols; // number of columns of the result
+    int forcing; // whether a thread is evaluating the expression with the GIL released
+    PyObject *owner; // the lazy numc.Matrix holding the expression, NULL until it is created
+    struct lazy_expr *prev, *next; // neighbours in the list of pending expressions
+} lazy_expr;
+
+/* Kinds of operations counted by numc.stats() */
+enum { STAT_ADD, STAT_SUB, STAT_MUL, STAT_DIV, STAT_POW, STAT_NEG, STAT_ABS, STAT_SLICE, STAT_FUSED, NUM_STATS };
+
+/* Totals of one kind of operation since numc.reset_stats() */
+typedef struct op_counter {
+    unsigned long long calls; // operations that succeeded
+    unsigned long long ns; // nanoseconds they took
+    unsigned long long flops; // nominal floating-point operations they took
+    unsigned long long bytes; // bytes of the result matrices they allocated
+} op_counter;
+
 /*
  * Defines the struct that represents the object
  * Has the default PyObject_HEAD so it can be a python object
@@ -8,10 +35,27 @@
  */
 typedef struct {
     PyObject_HEAD
-    matrix* mat;
+    matrix* mat; // NULL while the matrix is a pending lazy expression
     PyObject *shape;
+    lazy_expr *lazy; // NULL unless the matrix is a pending lazy expression
+    Py_ssize_t buf_shape[2]; // shape reported to buffer protocol consumers
+    Py_ssize_t buf_strides[2]; // strides in bytes reported to buffer protocol consumers
 } Matrix61c;
 
+/* Iterator over the rows of a numc.Matrix */
+typedef struct {
+    PyObject_HEAD
+    Matrix61c *mat;
+    int row; // index of the next row
+} Matrix61cRowIter;
+
+/* numc.SparseMatrix, an immutable wrapper of a sparse_matrix */
+typedef struct {
+    PyObject_HEAD
+    sparse_matrix *mat;
+    PyObject *shape;
+} SparseMatrix;
+
 /* Function definitions */
 static int init_rand(PyObject *self, int rows, int cols, unsigned int seed, double low, double high);
 static int init_fill(PyObject *self, int rows, int cols, double val);
@@ -20,14 +64,90 @@ static int init_2d(PyObject *self, PyObject *lst);
 static void Matrix61c_dealloc(Matrix61c *self);
 static PyObject *Matrix61c_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
 static int Matrix61c_init(PyObject *self, PyObject *args, PyObject *kwds);
+static int init_entries(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_wrap(matrix *mat);
+static PyObject *wrap_as(PyTypeObject *type, matrix *mat);
+static matrix *new_matrix(Py_ssize_t rows, Py_ssize_t cols, int dtype);
+static int Matrix61c_force(Matrix61c *self);
+static PyThreadState *release_gil(double cost, PyObject **operands, int n);
+static void acquire_gil(PyThreadState *state, PyObject **operands, int n);
+static unsigned long long stats_clock(void);
+static void record_op(int stat, unsigned long long start, int rows, int cols, double flops, size_t bytes);
+static PyObject *Matrix61c_lazy(int op, Matrix61c *mat1, Matrix61c *mat2);
+static int lazy_reads(Matrix61c *self, matrix *mat);
+static int Matrix61c_prepare_write(Matrix61c *self);
+static PyObject *Matrix61c_class_set_lazy(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_eval(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_pool_stats(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_pool_trim(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_set_num_threads(PyObject *self, PyObject *arg);
+static PyObject *Matrix61c_class_get_num_threads(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_get_parallel_cutoffs(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_set_parallel_cutoff(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_set_strassen(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_class_get_strassen(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_compare(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_class_allclose(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_class_stats(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_reset_stats(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_set_stats_callback(PyObject *self, PyObject *callback);
+static PyObject *Matrix61c_class_batch_mul(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_transpose(PyObject *self, PyObject *args);
+static PyObject *Matrix61c_class_arange(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_class_eye(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_class_uniform(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_class_normal(PyObject *self, PyObject *args, PyObject *kwds);
 static PyObject *Matrix61c_to_list(Matrix61c *self);
+static PyObject *Matrix61c_class_load(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_class_save(PyObject *self, PyObject *args, PyObject *kwds);
 static PyObject *Matrix61c_repr(PyObject *self);
+static PyObject *Matrix61c_tolist(Matrix61c *self, PyObject *args);
+static PyObject *Matrix61c_tobytes(Matrix61c *self, PyObject *args);
+static PyObject *Matrix61c_tofile(Matrix61c *self, PyObject *args);
+static PyObject *Matrix61c_iter(Matrix61c *self);
 static PyObject *Matrix61c_set_value(Matrix61c *self, PyObject* args);
 static PyObject *Matrix61c_get_value(Matrix61c *self, PyObject* args);
+static PyObject *Matrix61c_get_T(Matrix61c *self, void *closure);
+static PyObject *Matrix61c_get_dtype(Matrix61c *self, void *closure);
 static PyObject *Matrix61c_add(Matrix61c* self, PyObject* args);
 static PyObject *Matrix61c_sub(Matrix61c* self, PyObject* args);
 static PyObject *Matrix61c_multiply(Matrix61c* self, PyObject *args);
+static PyObject *Matrix61c_true_divide(Matrix61c* self, PyObject *args);
 static PyObject *Matrix61c_neg(Matrix61c* self);
 static PyObject *Matrix61c_abs(Matrix61c *self);
 static PyObject *Matrix61c_pow(Matrix61c *self, PyObject *pow, PyObject *optional);
+static PyObject *Matrix61c_inplace_add(Matrix61c *self, PyObject *args);
+static PyObject *Matrix61c_inplace_sub(Matrix61c *self, PyObject *args);
+static PyObject *Matrix61c_inplace_multiply(Matrix61c *self, PyObject *args);
+static PyObject *Matrix61c_inplace_true_divide(Matrix61c *self, PyObject *args);
+static PyObject *Matrix61c_inplace_pow(Matrix61c *self, PyObject *pow, PyObject *optional);
+static PyObject *Matrix61c_add_method(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_sub_method(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_mul_method(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_div_method(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_neg_method(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_abs_method(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_pow_method(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_sum(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_mean(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_min(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_max(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_argmax(Matrix61c *self, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_astype(Matrix61c *self, PyObject *args);
+static int Matrix61c_getbuffer(Matrix61c *self, Py_buffer *view, int flags);
+static PyObject *Matrix61c_from_buffer(PyTypeObject *type, PyObject *args, PyObject *kwds);
+static PyObject *adopt_buffer(PyTypeObject *type, Py_buffer *view, int rows, int cols, int dtype, int copy);
+static PyObject *Matrix61c_reduce_ex(Matrix61c *self, PyObject *args);
+static PyObject *Matrix61c_from_pickle(PyTypeObject *type, PyObject *args);
+static PyObject *Matrix61c_frombytes(PyTypeObject *type, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_fromiter(PyTypeObject *type, PyObject *args, PyObject *kwds);
+static PyObject *Matrix61c_from_array(PyTypeObject *type, PyObject *args, PyObject *kwds);
+static PyObject *SparseMatrix_wrap(sparse_matrix *mat);
+static PyObject *SparseMatrix_new(PyTypeObject *type, PyObject *args, PyObject *kwds);
+static void SparseMatrix_dealloc(SparseMatrix *self);
+static PyObject *SparseMatrix_repr(SparseMatrix *self);
+static PyObject *SparseMatrix_get_nnz(SparseMatrix *self, void *closure);
+static PyObject *SparseMatrix_todense(SparseMatrix *self, PyObject *args);
+static PyObject *SparseMatrix_tocoo(SparseMatrix *self, PyObject *args);
+static PyObject *sparse_binary_op(PyObject *a, PyObject *b, Matrix61c *out, int op);
 
@@ -2,6 +2,9 @@
 #include "CUnit/Basic.h"
 #include "../src/matrix.h"
 #include <stdio.h>
+#include <math.h>
+#include <stdint.h>
+#include <string.h>
 
 /* Test Suite setup and cleanup functions: */
 int init_suite(void) { return 0; }
@@ -32,7 +35,6 @@ void add_test(void) {
   deallocate_matrix(mat2);
 }
 
-/* (OPTIONAL) Uncomment the following sub_test if you have decided to implement it in matrix.c.
 void sub_test(void) {
   matrix *result = NULL;
   matrix *mat1 = NULL;
@@ -56,7 +58,6 @@ void sub_test(void) {
   deallocate_matrix(mat1);
   deallocate_matrix(mat2);
 }
-*/
 
 void mul_test(void) {
   matrix *result = NULL;
@@ -86,7 +87,38 @@ void mul_test(void) {
   deallocate_matrix(mat2);
 }
 
-/* (OPTIONAL) Uncomment the following neg_test if you have decided to implement it in matrix.c.
+void mul_nonsquare_test(void) {
+  matrix *result = NULL;
+  matrix *mat1 = NULL;
+  matrix *mat2 = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix(&result, 2, 3), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&mat1, 2, 4), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&mat2, 4, 3), 0);
+  for (int i = 0; i < 2; i++) {
+    for (int j = 0; j < 4; j++) {
+      set(mat1, i, j, i * 4 + j + 1);
+    }
+  }
+  for (int i = 0; i < 4; i++) {
+    for (int j = 0; j < 3; j++) {
+      set(mat2, i, j, i * 3 + j + 1);
+    }
+  }
+  CU_ASSERT_EQUAL(mul_matrix(result, mat1, mat2), 0);
+  CU_ASSERT_EQUAL(result->rows, 2);
+  CU_ASSERT_EQUAL(result->cols, 3);
+  CU_ASSERT_EQUAL(get(result, 0, 0), 70);
+  CU_ASSERT_EQUAL(get(result, 0, 1), 80);
+  CU_ASSERT_EQUAL(get(result, 0, 2), 90);
+  CU_ASSERT_EQUAL(get(result, 1, 0), 158);
+  CU_ASSERT_EQUAL(get(result, 1, 1), 184);
+  CU_ASSERT_EQUAL(get(result, 1, 2), 210);
+  CU_ASSERT_NOT_EQUAL(mul_matrix(result, mat2, mat2), 0);
+  deallocate_matrix(result);
+  deallocate_matrix(mat1);
+  deallocate_matrix(mat2);
+}
+
 void neg_test(void) {
   matrix *result = NULL;
   matrix *mat = NULL;
@@ -105,8 +137,7 @@ void neg_test(void) {
   }
   deallocate_matrix(result);
   deallocate_matrix(mat);
-} 
-*/
+}
 
 void abs_test(void) {
   matrix *result = NULL;
@@ -154,6 +185,661 @@ void pow_test(void) {
   deallocate_matrix(mat);
 }
 
+void pow_edge_test(void) {
+  matrix *result = NULL;
+  matrix *mat = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix(&result, 2, 2), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&mat, 2, 2), 0);
+  set(mat, 0, 0, 1);
+  set(mat, 0, 1, 1);
+  set(mat, 1, 0, 1);
+  set(mat, 1, 1, 0);
+  CU_ASSERT_EQUAL(pow_matrix(result, mat, 0), 0);
+  CU_ASSERT_EQUAL(get(result, 0, 0), 1);
+  CU_ASSERT_EQUAL(get(result, 0, 1), 0);
+  CU_ASSERT_EQUAL(get(result, 1, 0), 0);
+  CU_ASSERT_EQUAL(get(result, 1, 1), 1);
+  /* The inverse of [[1, 1], [1, 0]] is [[0, 1], [1, -1]] */
+  CU_ASSERT_EQUAL(pow_matrix(result, mat, -2), 0);
+  CU_ASSERT_DOUBLE_EQUAL(get(result, 0, 0), 1, 1e-12);
+  CU_ASSERT_DOUBLE_EQUAL(get(result, 0, 1), -1, 1e-12);
+  CU_ASSERT_DOUBLE_EQUAL(get(result, 1, 0), -1, 1e-12);
+  CU_ASSERT_DOUBLE_EQUAL(get(result, 1, 1), 2, 1e-12);
+  /* In place */
+  CU_ASSERT_EQUAL(pow_matrix(mat, mat, 10), 0);
+  CU_ASSERT_EQUAL(get(mat, 0, 0), 89);
+  CU_ASSERT_EQUAL(get(mat, 1, 1), 34);
+  set(mat, 0, 0, 2);
+  set(mat, 0, 1, 4);
+  set(mat, 1, 0, 1);
+  set(mat, 1, 1, 2);
+  CU_ASSERT_EQUAL(pow_matrix(result, mat, -1), -103);
+  deallocate_matrix(result);
+  deallocate_matrix(mat);
+}
+
+void fused_test(void) {
+  matrix *result = NULL;
+  matrix *mat1 = NULL;
+  matrix *mat2 = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix(&result, 3, 5), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&mat1, 3, 5), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&mat2, 3, 5), 0);
+  for (int i = 0; i < 3; i++) {
+    for (int j = 0; j < 5; j++) {
+      set(mat1, i, j, i * 5 + j);
+      set(mat2, i, j, 2 * (i * 5 + j) + 1);
+    }
+  }
+  /* abs(mat1 - mat2) + -mat1 */
+  fused_op ops[] = {
+    {FUSED_LOAD, mat1->data}, {FUSED_LOAD, mat2->data}, {FUSED_SUB, NULL}, {FUSED_ABS, NULL},
+    {FUSED_LOAD, mat1->data}, {FUSED_NEG, NULL}, {FUSED_ADD, NULL}
+  };
+  CU_ASSERT_EQUAL(fused_matrix(result, ops, 7), 0);
+  for (int i = 0; i < 3; i++) {
+    for (int j = 0; j < 5; j++) {
+      CU_ASSERT_EQUAL(get(result, i, j), 1);
+    }
+  }
+  CU_ASSERT_NOT_EQUAL(fused_matrix(result, ops, 2), 0);
+  CU_ASSERT_NOT_EQUAL(fused_matrix(result, ops + 2, 1), 0);
+  deallocate_matrix(result);
+  deallocate_matrix(mat1);
+  deallocate_matrix(mat2);
+}
+
+void broadcast_test(void) {
+  matrix *result = NULL;
+  matrix *mat = NULL;
+  matrix *row = NULL;
+  matrix *col = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix(&result, 3, 5), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&mat, 3, 5), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&row, 1, 5), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&col, 3, 1), 0);
+  for (int i = 0; i < 3; i++) {
+    for (int j = 0; j < 5; j++) {
+      set(mat, i, j, i * 5 + j);
+    }
+    set(col, i, 0, 100 * i);
+  }
+  for (int j = 0; j < 5; j++) {
+    set(row, 0, j, 10 * j);
+  }
+  CU_ASSERT_EQUAL(scalar_matrix(result, mat, 2, BROADCAST_MUL), 0);
+  CU_ASSERT_EQUAL(get(result, 2, 4), 28);
+  CU_ASSERT_EQUAL(scalar_matrix(result, mat, 1, BROADCAST_RSUB), 0);
+  CU_ASSERT_EQUAL(get(result, 1, 3), -7);
+  CU_ASSERT_EQUAL(scalar_matrix(result, mat, 4, BROADCAST_DIV), 0);
+  CU_ASSERT_EQUAL(get(result, 0, 1), 0.25);
+  CU_ASSERT_EQUAL(broadcast_matrix(result, mat, row, BROADCAST_SUB), 0);
+  for (int i = 0; i < 3; i++) {
+    for (int j = 0; j < 5; j++) {
+      CU_ASSERT_EQUAL(get(result, i, j), i * 5 - 9 * j);
+    }
+  }
+  CU_ASSERT_EQUAL(broadcast_matrix(mat, mat, col, BROADCAST_ADD), 0);
+  for (int i = 0; i < 3; i++) {
+    for (int j = 0; j < 5; j++) {
+      CU_ASSERT_EQUAL(get(mat, i, j), 105 * i + j);
+    }
+  }
+  CU_ASSERT_NOT_EQUAL(broadcast_matrix(result, mat, result, BROADCAST_ADD), 0);
+  CU_ASSERT_NOT_EQUAL(broadcast_matrix(result, mat, mat, BROADCAST_ADD), 0);
+  deallocate_matrix(result);
+  deallocate_matrix(mat);
+  deallocate_matrix(row);
+  deallocate_matrix(col);
+}
+
+void reduce_test(void) {
+  matrix *mat = NULL;
+  matrix *all = NULL;
+  matrix *cols = NULL;
+  matrix *rows = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix(&mat, 3, 21), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&all, 1, 1), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&cols, 1, 21), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&rows, 3, 1), 0);
+  for (int i = 0; i < 3; i++) {
+    for (int j = 0; j < 21; j++) {
+      set(mat, i, j, (i * 7 + j) % 10);
+    }
+  }
+  CU_ASSERT_EQUAL(reduce_matrix(all, mat, REDUCE_SUM, -1), 0);
+  CU_ASSERT_EQUAL(get(all, 0, 0), 281);
+  CU_ASSERT_EQUAL(reduce_matrix(all, mat, REDUCE_MEAN, -1), 0);
+  CU_ASSERT_EQUAL(get(all, 0, 0), 281.0 / 63);
+  CU_ASSERT_EQUAL(reduce_matrix(all, mat, REDUCE_MAX, -1), 0);
+  CU_ASSERT_EQUAL(get(all, 0, 0), 9);
+  CU_ASSERT_EQUAL(reduce_matrix(all, mat, REDUCE_ARGMAX, -1), 0);
+  CU_ASSERT_EQUAL(get(all, 0, 0), 9);
+  CU_ASSERT_EQUAL(reduce_matrix(cols, mat, REDUCE_MIN, 0), 0);
+  CU_ASSERT_EQUAL(get(cols, 0, 3), 0);
+  CU_ASSERT_EQUAL(get(cols, 0, 4), 1);
+  CU_ASSERT_EQUAL(reduce_matrix(cols, mat, REDUCE_ARGMAX, 0), 0);
+  CU_ASSERT_EQUAL(get(cols, 0, 0), 1);
+  CU_ASSERT_EQUAL(get(cols, 0, 9), 0);
+  CU_ASSERT_EQUAL(reduce_matrix(rows, mat, REDUCE_ARGMAX, 1), 0);
+  CU_ASSERT_EQUAL(get(rows, 0, 0), 9);
+  CU_ASSERT_EQUAL(get(rows, 1, 0), 2);
+  CU_ASSERT_EQUAL(reduce_matrix(rows, mat, REDUCE_SUM, 1), 0);
+  CU_ASSERT_EQUAL(get(rows, 2, 0), 94);
+  CU_ASSERT_NOT_EQUAL(reduce_matrix(rows, mat, REDUCE_SUM, 0), 0);
+  CU_ASSERT_NOT_EQUAL(reduce_matrix(all, mat, REDUCE_SUM, 2), 0);
+  deallocate_matrix(mat);
+  deallocate_matrix(all);
+  deallocate_matrix(cols);
+  deallocate_matrix(rows);
+}
+
+void random_test(void) {
+  matrix *mat = NULL;
+  matrix *parent = NULL;
+  matrix *view = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix(&mat, 37, 29), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&parent, 74, 58), 0);
+  CU_ASSERT_EQUAL(allocate_matrix_view(&view, parent, 59, 37, 29, 116, 2), 0);
+
+  /* Entries depend only on the seed and their row-major index, so a strided view matches */
+  uniform_matrix(mat, 42, -1, 3);
+  uniform_matrix(view, 42, -1, 3);
+  for (int i = 0; i < 37; i++) {
+    for (int j = 0; j < 29; j++) {
+      CU_ASSERT_EQUAL(get(mat, i, j), get(view, i, j));
+      CU_ASSERT_TRUE(get(mat, i, j) >= -1 && get(mat, i, j) < 3);
+    }
+  }
+  double first = get(mat, 0, 0);
+  uniform_matrix(mat, 43, -1, 3);
+  CU_ASSERT_NOT_EQUAL(get(mat, 0, 0), first);
+
+  normal_matrix(mat, 7, 10, 2);
+  normal_matrix(view, 7, 10, 2);
+  double sum = 0;
+  for (int i = 0; i < 37; i++) {
+    for (int j = 0; j < 29; j++) {
+      CU_ASSERT_EQUAL(get(mat, i, j), get(view, i, j));
+      sum += get(mat, i, j);
+    }
+  }
+  CU_ASSERT_DOUBLE_EQUAL(sum / (37 * 29), 10, 0.5);
+  deallocate_matrix(view);
+  deallocate_matrix(parent);
+  deallocate_matrix(mat);
+}
+
+void arange_test(void) {
+  matrix *mat = NULL;
+  matrix *view = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix(&mat, 3, 4), 0);
+  arange_matrix(mat, 1, 0.5);
+  for (int i = 0; i < 12; i++) {
+    CU_ASSERT_EQUAL(mat->data[i], 1 + i * 0.5);
+  }
+  /* Fills a view in its own row-major order */
+  CU_ASSERT_EQUAL(allocate_matrix_view(&view, mat, 1, 2, 2, 4, 2), 0);
+  arange_matrix(view, -4, -1);
+  CU_ASSERT_EQUAL(get(mat, 0, 1), -4);
+  CU_ASSERT_EQUAL(get(mat, 0, 3), -5);
+  CU_ASSERT_EQUAL(get(mat, 1, 1), -6);
+  CU_ASSERT_EQUAL(get(mat, 1, 3), -7);
+  CU_ASSERT_EQUAL(get(mat, 1, 2), 4);
+  deallocate_matrix(view);
+  deallocate_matrix(mat);
+}
+
+void transpose_test(void) {
+  int shapes[4][2] = {{1, 1}, {3, 5}, {37, 70}, {300, 257}};
+  for (int s = 0; s < 4; s++) {
+    int rows = shapes[s][0], cols = shapes[s][1];
+    matrix *mat = NULL;
+    matrix *result = NULL;
+    CU_ASSERT_EQUAL(allocate_matrix(&mat, rows, cols), 0);
+    CU_ASSERT_EQUAL(allocate_matrix(&result, cols, rows), 0);
+    for (int i = 0; i < rows * cols; i++) {
+      mat->data[i] = i;
+    }
+    CU_ASSERT_EQUAL(transpose_matrix(result, mat), 0);
+    for (int i = 0; i < rows; i++) {
+      for (int j = 0; j < cols; j++) {
+        CU_ASSERT_EQUAL(get(result, j, i), i * cols + j);
+      }
+    }
+    CU_ASSERT_EQUAL(transpose_matrix(result, result), rows == cols ? 0 : -100);
+    deallocate_matrix(mat);
+    deallocate_matrix(result);
+  }
+
+  /* A square matrix transposed into itself */
+  matrix *mat = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix(&mat, 9, 9), 0);
+  for (int i = 0; i < 81; i++) {
+    mat->data[i] = i;
+  }
+  CU_ASSERT_EQUAL(transpose_matrix(mat, mat), 0);
+  CU_ASSERT_EQUAL(get(mat, 2, 7), 65);
+  CU_ASSERT_EQUAL(get(mat, 7, 2), 25);
+
+  /* mat^T * mat through a transposed view */
+  matrix *view = NULL;
+  matrix *result = NULL;
+  matrix *expected = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix_view(&view, mat, 0, 9, 9, 1, 9), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&result, 9, 9), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&expected, 9, 9), 0);
+  CU_ASSERT_EQUAL(mul_matrix(result, view, mat), 0);
+  for (int i = 0; i < 9; i++) {
+    for (int j = 0; j < 9; j++) {
+      double sum = 0;
+      for (int k = 0; k < 9; k++) {
+        sum += get(mat, k, i) * get(mat, k, j);
+      }
+      set(expected, i, j, sum);
+    }
+  }
+  for (int i = 0; i < 81; i++) {
+    CU_ASSERT_EQUAL(result->data[i], expected->data[i]);
+  }
+  deallocate_matrix(view);
+  deallocate_matrix(mat);
+  deallocate_matrix(result);
+  deallocate_matrix(expected);
+}
+
+void batch_mul_test(void) {
+  matrix *lhs[3] = {NULL, NULL, NULL};
+  matrix *rhs[3] = {NULL, NULL, NULL};
+  matrix *results[3] = {NULL, NULL, NULL};
+  int shapes[3][3] = {{2, 3, 4}, {1, 1, 1}, {70, 50, 30}};
+  for (int b = 0; b < 3; b++) {
+    CU_ASSERT_EQUAL(allocate_matrix(&lhs[b], shapes[b][0], shapes[b][1]), 0);
+    CU_ASSERT_EQUAL(allocate_matrix(&rhs[b], shapes[b][1], shapes[b][2]), 0);
+    CU_ASSERT_EQUAL(allocate_matrix(&results[b], shapes[b][0], shapes[b][2]), 0);
+    for (int i = 0; i < shapes[b][0] * shapes[b][1]; i++) {
+      lhs[b]->data[i] = i % 7 - b;
+    }
+    for (int i = 0; i < shapes[b][1] * shapes[b][2]; i++) {
+      rhs[b]->data[i] = i % 5 + b;
+    }
+  }
+  CU_ASSERT_EQUAL(batch_mul_matrix(results, lhs, rhs, 3), 0);
+  for (int b = 0; b < 3; b++) {
+    matrix *expected = NULL;
+    CU_ASSERT_EQUAL(allocate_matrix(&expected, shapes[b][0], shapes[b][2]), 0);
+    CU_ASSERT_EQUAL(mul_matrix(expected, lhs[b], rhs[b]), 0);
+    for (int i = 0; i < shapes[b][0] * shapes[b][2]; i++) {
+      CU_ASSERT_EQUAL(results[b]->data[i], expected->data[i]);
+    }
+    deallocate_matrix(expected);
+  }
+
+  /* A mismatched pair fails the whole batch before anything is written */
+  fill_matrix(results[0], 0);
+  CU_ASSERT_EQUAL(batch_mul_matrix(results, lhs, results, 3), -101);
+  CU_ASSERT_EQUAL(get(results[0], 0, 0), 0);
+  for (int b = 0; b < 3; b++) {
+    deallocate_matrix(lhs[b]);
+    deallocate_matrix(rhs[b]);
+    deallocate_matrix(results[b]);
+  }
+}
+
+void view_test(void) {
+  matrix *mat = NULL;
+  matrix *block = NULL;
+  matrix *col = NULL;
+  matrix *result = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix(&mat, 4, 6), 0);
+  for (int i = 0; i < 4; i++) {
+    for (int j = 0; j < 6; j++) {
+      set(mat, i, j, i * 6 + j);
+    }
+  }
+  /* mat[1:4:2, 1:6:2] and mat[:, 5] */
+  CU_ASSERT_EQUAL(allocate_matrix_view(&block, mat, 7, 2, 3, 12, 2), 0);
+  CU_ASSERT_EQUAL(allocate_matrix_view(&col, mat, 5, 4, 1, 6, 1), 0);
+  CU_ASSERT_FALSE(is_contiguous(block));
+  CU_ASSERT_FALSE(is_contiguous(col));
+  CU_ASSERT_EQUAL(mat->block->ref_cnt, 3);
+  CU_ASSERT_EQUAL(get(block, 1, 2), 23);
+  CU_ASSERT_EQUAL(get(col, 3, 0), 23);
+  double packed[6];
+  gather_matrix(packed, block);
+  for (int k = 0; k < 6; k++) {
+    CU_ASSERT_EQUAL(packed[k], 7 + (k / 3) * 12 + (k % 3) * 2);
+  }
+
+  CU_ASSERT_EQUAL(allocate_matrix(&result, 2, 3), 0);
+  CU_ASSERT_EQUAL(add_matrix(result, block, block), 0);
+  CU_ASSERT_EQUAL(get(result, 0, 1), 18);
+  CU_ASSERT_EQUAL(abs_matrix(block, result), 0);
+  CU_ASSERT_EQUAL(get(mat, 3, 5), 46);
+  CU_ASSERT_EQUAL(get(mat, 3, 4), 22);
+  CU_ASSERT_EQUAL(scalar_matrix(col, col, 1, BROADCAST_ADD), 0);
+  CU_ASSERT_EQUAL(get(mat, 0, 5), 6);
+  CU_ASSERT_EQUAL(get(mat, 3, 5), 47);
+  deallocate_matrix(result);
+  free(result);
+
+  /* block * mat[0:3, 0:1] */
+  matrix *lhs = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix_view(&lhs, mat, 0, 3, 1, 6, 1), 0);
+  CU_ASSERT_EQUAL(allocate_matrix(&result, 2, 1), 0);
+  CU_ASSERT_EQUAL(mul_matrix(result, block, lhs), 0);
+  CU_ASSERT_EQUAL(get(result, 0, 0), get(block, 0, 0) * 0 + get(block, 0, 1) * 6 + get(block, 0, 2) * 12);
+  CU_ASSERT_EQUAL(reduce_matrix(result, block, REDUCE_MAX, 1), 0);
+  CU_ASSERT_EQUAL(get(result, 1, 0), 47);
+
+  deallocate_matrix(result);
+  deallocate_matrix(lhs);
+  deallocate_matrix(col);
+  deallocate_matrix(block);
+  CU_ASSERT_EQUAL(mat->block->ref_cnt, 1);
+  deallocate_matrix(mat);
+}
+
+void block_test(void) {
+  matrix *root = NULL;
+  matrix *views[64];
+  allocate_matrix(&root, 65, 65);
+  set(root, 64, 64, 7);
+  /* Every level of nesting shares the root block */
+  matrix *from = root;
+  for (int i = 0; i < 64; i++) {
+    CU_ASSERT_EQUAL(allocate_matrix_view(&views[i], from, 65 + 1, 64 - i, 64 - i, 65, 1), 0);
+    CU_ASSERT_PTR_EQUAL(views[i]->block, root->block);
+    from = views[i];
+  }
+  CU_ASSERT_EQUAL(root->block->ref_cnt, 65);
+  CU_ASSERT_EQUAL(get(views[63], 0, 0), 7);
+  /* The data outlives the root and every other slice */
+  matrix_block *block = root->block;
+  deallocate_matrix(root);
+  free(root);
+  for (int i = 0; i < 63; i++) {
+    deallocate_matrix(views[i]);
+    free(views[i]);
+  }
+  CU_ASSERT_EQUAL(block->ref_cnt, 1);
+  CU_ASSERT_EQUAL(get(views[63], 0, 0), 7);
+  deallocate_matrix(views[63]);
+  free(views[63]);
+
+  /* Slicing and deallocating from several threads at once keeps the count exact */
+  allocate_matrix(&root, 8, 8);
+  #pragma omp parallel num_threads(4)
+  for (int i = 0; i < 10000; i++) {
+    matrix *view = NULL;
+    if (allocate_matrix_ref(&view, root, 9, 2, 2) == 0) {
+      deallocate_matrix(view);
+      free(view);
+    }
+  }
+  CU_ASSERT_EQUAL(root->block->ref_cnt, 1);
+  deallocate_matrix(root);
+  CU_ASSERT_PTR_NULL(root->block);
+  deallocate_matrix(root);
+  free(root);
+}
+
+void pool_test(void) {
+  pool_stats before, after;
+  pool_get_stats(&before);
+  double *data = pool_alloc(1000);
+  CU_ASSERT_PTR_NOT_NULL(data);
+  CU_ASSERT_EQUAL((uintptr_t) data % 64, 0);
+  data[0] = 1;
+  data[999] = 2;
+  pool_free(data);
+  /* A request of the same size class gets the cached block back */
+  double *again = pool_alloc(990);
+  CU_ASSERT_PTR_EQUAL(again, data);
+  pool_free(again);
+  pool_get_stats(&after);
+  CU_ASSERT_EQUAL(after.allocs - before.allocs, 2);
+  CU_ASSERT_EQUAL(after.frees - before.frees, 2);
+  CU_ASSERT(after.hits - before.hits >= 1);
+  CU_ASSERT_EQUAL(after.live_bytes, before.live_bytes);
+  CU_ASSERT(after.peak_bytes >= before.live_bytes + 1000 * sizeof(double));
+  pool_trim();
+  pool_get_stats(&after);
+  CU_ASSERT_EQUAL(after.cached_blocks, 0);
+  CU_ASSERT_EQUAL(after.cached_bytes, 0);
+  pool_reset_peak();
+  pool_get_stats(&after);
+  CU_ASSERT_EQUAL(after.peak_bytes, after.live_bytes);
+}
+
+void threads_test(void) {
+  int previous = set_num_threads(3);
+  CU_ASSERT_EQUAL(get_num_threads(), 3);
+  CU_ASSERT_EQUAL(set_num_threads(previous), 3);
+  long cutoff = get_parallel_cutoff(KERNEL_GEMM);
+  set_parallel_cutoff(KERNEL_GEMM, 0);
+  /* A product run on more threads than there are rows still gives the serial result */
+  set_num_threads(4);
+  matrix *a = NULL, *b = NULL, *c = NULL;
+  allocate_matrix(&a, 3, 5);
+  allocate_matrix(&b, 5, 2);
+  allocate_matrix(&c, 3, 2);
+  for (int i = 0; i < 15; i++) {
+    a->data[i] = i;
+  }
+  for (int i = 0; i < 10; i++) {
+    b->data[i] = i % 3;
+  }
+  CU_ASSERT_EQUAL(mul_matrix(c, a, b), 0);
+  for (int i = 0; i < 3; i++) {
+    for (int j = 0; j < 2; j++) {
+      double expected = 0;
+      for (int k = 0; k < 5; k++) {
+        expected += a->data[i * 5 + k] * b->data[k * 2 + j];
+      }
+      CU_ASSERT_EQUAL(get(c, i, j), expected);
+    }
+  }
+  set_num_threads(previous);
+  set_parallel_cutoff(KERNEL_GEMM, cutoff);
+  CU_ASSERT_EQUAL(get_parallel_cutoff(KERNEL_GEMM), cutoff);
+  CU_ASSERT_EQUAL(strcmp(kernel_name(KERNEL_REDUCE), "reduce"), 0);
+  deallocate_matrix(a);
+  deallocate_matrix(b);
+  deallocate_matrix(c);
+}
+
+void dtype_test(void) {
+  matrix *a = NULL, *b = NULL, *c = NULL, *f = NULL;
+  CU_ASSERT_EQUAL(allocate_matrix_typed(&a, 3, 5, DTYPE_INT32), 0);
+  CU_ASSERT_EQUAL(allocate_matrix_typed(&b, 5, 2, DTYPE_INT32), 0);
+  CU_ASSERT_EQUAL(allocate_matrix_typed(&c, 3, 2, DTYPE_INT32), 0);
+  CU_ASSERT_EQUAL(allocate_matrix_typed(&f, 3, 2, DTYPE_FLOAT32), 0);
+  for (int i = 0; i < 15; i++) {
+    a->idata[i] = i - 7;
+  }
+  for (int i = 0; i < 10; i++) {
+    b->idata[i] = i % 3;
+  }
+  CU_ASSERT_EQUAL(mul_matrix(c, a, b), 0);
+  for (int i = 0; i < 3; i++) {
+    for (int j = 0; j < 2; j++) {
+      int expected = 0;
+      for (int k = 0; k < 5; k++) {
+        expected += a->idata[i * 5 + k] * b->idata[k * 2 + j];
+      }
+      CU_ASSERT_EQUAL(c->idata[i * 2 + j], expected);
+    }
+  }
+  /* Mixed operands are computed in float64 and rounded to the float32 result */
+  CU_ASSERT_EQUAL(mul_matrix(f, a, b), 0);
+  CU_ASSERT_EQUAL(f->fdata[5], (float) c->idata[5]);
+  CU_ASSERT_EQUAL(add_matrix(f, f, c), 0);
+  CU_ASSERT_EQUAL(get(f, 2, 1), 2.0 * c->idata[5]);
+  /* Native int32 arithmetic wraps around, while conversions saturate */
+  fill_matrix(c, INT32_MAX);
+  CU_ASSERT_EQUAL(add_matrix(c, c, c), 0);
+  CU_ASSERT_EQUAL(c->idata[0], -2);
+  set(c, 0, 1, 1e20);
+  set(c, 1, 0, -1e20);
+  set(c, 1, 1, NAN);
+  CU_ASSERT_EQUAL(get(c, 0, 1), INT32_MAX);
+  CU_ASSERT_EQUAL(get(c, 1, 0), INT32_MIN);
+  CU_ASSERT_EQUAL(get(c, 1, 1), 0);
+  CU_ASSERT_EQUAL(promote_dtypes(DTYPE_INT32, DTYPE_FLOAT32), DTYPE_FLOAT64);
+  CU_ASSERT_EQUAL(promote_dtypes(DTYPE_FLOAT32, DTYPE_FLOAT32), DTYPE_FLOAT32);
+  CU_ASSERT_EQUAL(strcmp(dtype_name(DTYPE_INT32), "int32"), 0);
+  deallocate_matrix(a);
+  deallocate_matrix(b);
+  deallocate_matrix(c);
+  deallocate_matrix(f);
+}
+
+void sparse_test(void) {
+  /* [[1 0 2], [0 0 0], [0 3 0]] with a repeated coordinate */
+  int rows[] = {2, 0, 0, 0};
+  int cols[] = {1, 2, 0, 2};
+  double values[] = {3, 1.5, 1, 0.5};
+  sparse_matrix *s = NULL, *sum = NULL;
+  CU_ASSERT_EQUAL(sparse_from_coo(&s, 3, 3, 4, rows, cols, values), 0);
+  CU_ASSERT_EQUAL(s->nnz, 3);
+  CU_ASSERT_EQUAL(s->row_ptr[1], 2);
+  CU_ASSERT_EQUAL(s->row_ptr[2], 2);
+  CU_ASSERT_EQUAL(s->col_idx[1], 2);
+  CU_ASSERT_EQUAL(s->values[1], 2);
+  rows[0] = 3;
+  CU_ASSERT_EQUAL(sparse_from_coo(&sum, 3, 3, 4, rows, cols, values), -1);
+
+  matrix *dense = NULL, *b = NULL, *c = NULL;
+  allocate_matrix(&dense, 3, 3);
+  allocate_matrix(&b, 3, 2);
+  allocate_matrix(&c, 3, 2);
+  CU_ASSERT_EQUAL(sparse_to_dense(dense, s), 0);
+  CU_ASSERT_EQUAL(get(dense, 0, 2), 2);
+  CU_ASSERT_EQUAL(get(dense, 2, 1), 3);
+  for (int i = 0; i < 6; i++) {
+    b->data[i] = i + 1;
+  }
+  CU_ASSERT_EQUAL(sparse_mul_dense(c, s, b), 0);
+  CU_ASSERT_EQUAL(get(c, 0, 0), 1 * 1 + 2 * 5);
+  CU_ASSERT_EQUAL(get(c, 1, 1), 0);
+  CU_ASSERT_EQUAL(get(c, 2, 1), 3 * 4);
+  CU_ASSERT_EQUAL(sparse_mul_dense(c, s, dense), -101);
+  /* dense * s, written over dense itself */
+  CU_ASSERT_EQUAL(dense_mul_sparse(dense, dense, s), 0);
+  CU_ASSERT_EQUAL(get(dense, 0, 0), 1);
+  CU_ASSERT_EQUAL(get(dense, 0, 1), 6);
+  CU_ASSERT_EQUAL(get(dense, 0, 2), 2);
+  CU_ASSERT_EQUAL(sparse_add_dense(dense, s, dense), 0);
+  CU_ASSERT_EQUAL(get(dense, 0, 1), 6);
+  CU_ASSERT_EQUAL(get(dense, 2, 1), 3);
+
+  sparse_matrix *back = NULL;
+  CU_ASSERT_EQUAL(sparse_from_dense(&back, dense), 0);
+  CU_ASSERT_EQUAL(back->nnz, 4);
+  CU_ASSERT_EQUAL(sparse_add_sparse(&sum, s, back), 0);
+  CU_ASSERT_EQUAL(sum->nnz, 4);
+  CU_ASSERT_EQUAL(sum->values[0], 3);
+  CU_ASSERT_EQUAL(sum->col_idx[1], 1);
+  CU_ASSERT_EQUAL(sum->values[2], 6);
+  CU_ASSERT_EQUAL(sum->values[3], 6);
+  deallocate_sparse(s);
+  deallocate_sparse(sum);
+  deallocate_sparse(back);
+  deallocate_matrix(dense);
+  deallocate_matrix(b);
+  deallocate_matrix(c);
+}
+
+void compare_test(void) {
+  matrix *a = NULL, *b = NULL, *f = NULL;
+  comparison result;
+  allocate_matrix(&a, 3, 7);
+  allocate_matrix(&b, 3, 7);
+  allocate_matrix_typed(&f, 3, 7, DTYPE_FLOAT32);
+  for (int i = 0; i < 21; i++) {
+    a->data[i] = b->data[i] = i + 0.5;
+    f->fdata[i] = i + 0.5;
+  }
+  CU_ASSERT_EQUAL(compare_matrix(a, b, 0, 0, &result), 0);
+  CU_ASSERT_EQUAL(result.mismatch, -1);
+  CU_ASSERT_EQUAL(result.max_abs_err, 0);
+  CU_ASSERT_EQUAL(compare_matrix(f, b, 0, 0, &result), 0);
+  CU_ASSERT_EQUAL(result.mismatch, -1);
+  /* Mismatches in the vectorized part and in the tail of later rows */
+  b->data[13] += 0.25;
+  b->data[20] += 1;
+  CU_ASSERT_EQUAL(compare_matrix(a, b, 0, 0.1, &result), 0);
+  CU_ASSERT_EQUAL(result.mismatch, 13);
+  CU_ASSERT_EQUAL(result.max_abs_err, 1);
+  CU_ASSERT_DOUBLE_EQUAL(result.max_rel_err, 1 / 21.5, 1e-12);
+  CU_ASSERT_EQUAL(compare_matrix(a, b, 0, 0.5, &result), 0);
+  CU_ASSERT_EQUAL(result.mismatch, 20);
+  CU_ASSERT_EQUAL(compare_matrix(a, b, 0.1, 0, &result), 0);
+  CU_ASSERT_EQUAL(result.mismatch, -1);
+  b->data[2] = 0.0 / 0.0;
+  CU_ASSERT_EQUAL(compare_matrix(a, b, 1, 1, &result), 0);
+  CU_ASSERT_EQUAL(result.mismatch, 2);
+  CU_ASSERT_EQUAL(result.max_abs_err, 1);
+  CU_ASSERT_EQUAL(compare_matrix(a, f, 0, 0, &result), 0);
+  CU_ASSERT_EQUAL(result.mismatch, -1);
+  deallocate_matrix(f);
+  allocate_matrix(&f, 7, 3);
+  CU_ASSERT_EQUAL(compare_matrix(a, f, 0, 0, &result), -100);
+  deallocate_matrix(a);
+  deallocate_matrix(b);
+  deallocate_matrix(f);
+}
+
+void strassen_test(void) {
+  int mode = get_strassen_mode(), crossover = get_strassen_crossover();
+  long cutoff = get_parallel_cutoff(KERNEL_GEMM);
+  int threads = get_num_threads();
+  /* Orders that halve evenly, that need padding, and split across 3 threads with tasks */
+  int orders[] = {32, 33, 50};
+  for (int t = 0; t < 2; t++) {
+    if (t) {
+      set_num_threads(3);
+      set_parallel_cutoff(KERNEL_GEMM, 0);
+    }
+    for (int o = 0; o < 3; o++) {
+      int n = orders[o];
+      matrix *a = NULL, *b = NULL, *classic = NULL, *fast = NULL;
+      allocate_matrix(&a, n, n);
+      allocate_matrix(&b, n, n);
+      allocate_matrix(&classic, n, n);
+      allocate_matrix(&fast, n, n);
+      for (int i = 0; i < n * n; i++) {
+        a->data[i] = (i * 7 % 13) - 6;
+        b->data[i] = (i * 5 % 11) - 5;
+      }
+      set_strassen(STRASSEN_OFF, 0);
+      CU_ASSERT_EQUAL(mul_matrix(classic, a, b), 0);
+      set_strassen(STRASSEN_ON, 4);
+      CU_ASSERT_EQUAL(mul_matrix(fast, a, b), 0);
+      /* Small integer entries keep every intermediate exact */
+      for (int i = 0; i < n * n; i++) {
+        CU_ASSERT_EQUAL(fast->data[i], classic->data[i]);
+      }
+      CU_ASSERT_EQUAL(pow_matrix(fast, a, 3), 0);
+      set_strassen(STRASSEN_OFF, 0);
+      CU_ASSERT_EQUAL(pow_matrix(classic, a, 3), 0);
+      for (int i = 0; i < n * n; i++) {
+        CU_ASSERT_EQUAL(fast->data[i], classic->data[i]);
+      }
+      deallocate_matrix(a);
+      deallocate_matrix(b);
+      deallocate_matrix(classic);
+      deallocate_matrix(fast);
+    }
+  }
+  set_strassen(mode, crossover);
+  CU_ASSERT_EQUAL(get_strassen_mode(), mode);
+  CU_ASSERT_EQUAL(get_strassen_crossover(), crossover);
+  set_num_threads(threads);
+  set_parallel_cutoff(KERNEL_GEMM, cutoff);
+}
+
 void alloc_fail_test(void) {
   matrix *mat = NULL;
   CU_ASSERT_EQUAL(allocate_matrix(&mat, 0, 0), -1);
@@ -164,8 +850,8 @@ void alloc_fail_test(void) {
 void alloc_success_test(void) {
   matrix *mat = NULL;
   CU_ASSERT_EQUAL(allocate_matrix(&mat, 3, 2), 0);
-  CU_ASSERT_EQUAL(mat->parent, NULL);
-  CU_ASSERT_EQUAL(mat->ref_cnt, 1);
+  CU_ASSERT_PTR_EQUAL(mat->block->data, mat->data);
+  CU_ASSERT_EQUAL(mat->block->ref_cnt, 1);
   CU_ASSERT_EQUAL(mat->rows, 3);
   CU_ASSERT_EQUAL(mat->cols, 2);
   CU_ASSERT_NOT_EQUAL(mat->data, NULL);
@@ -196,8 +882,8 @@ void alloc_ref_success_test(void) {
   }
   CU_ASSERT_EQUAL(allocate_matrix_ref(&mat, from, 2, 2, 2), 0);
   CU_ASSERT_PTR_EQUAL(mat->data, from->data + 2);
-  CU_ASSERT_PTR_EQUAL(mat->parent, from);
-  CU_ASSERT_EQUAL(mat->parent->ref_cnt, 2);
+  CU_ASSERT_PTR_EQUAL(mat->block, from->block);
+  CU_ASSERT_EQUAL(mat->block->ref_cnt, 2);
   CU_ASSERT_EQUAL(mat->rows, 2);
   CU_ASSERT_EQUAL(mat->cols, 2);
   deallocate_matrix(from);
@@ -259,13 +945,28 @@ int main (void)
 
    /* add the tests to the suite */
    if ((CU_add_test(pSuite, "add_test", add_test) == NULL) ||
-        /* (OPTIONAL) Uncomment the following lines if you have implemented sub_matrix and neg_matrix.
         (CU_add_test(pSuite, "sub_test", sub_test) == NULL) ||
         (CU_add_test(pSuite, "neg_test", neg_test) == NULL) ||
-        */
         (CU_add_test(pSuite, "mul_test", mul_test) == NULL) ||
+        (CU_add_test(pSuite, "mul_nonsquare_test", mul_nonsquare_test) == NULL) ||
         (CU_add_test(pSuite, "abs_test", abs_test) == NULL) ||
         (CU_add_test(pSuite, "pow_test", pow_test) == NULL) ||
+        (CU_add_test(pSuite, "pow_edge_test", pow_edge_test) == NULL) ||
+        (CU_add_test(pSuite, "fused_test", fused_test) == NULL) ||
+        (CU_add_test(pSuite, "broadcast_test", broadcast_test) == NULL) ||
+        (CU_add_test(pSuite, "reduce_test", reduce_test) == NULL) ||
+        (CU_add_test(pSuite, "random_test", random_test) == NULL) ||
+        (CU_add_test(pSuite, "arange_test", arange_test) == NULL) ||
+        (CU_add_test(pSuite, "transpose_test", transpose_test) == NULL) ||
+        (CU_add_test(pSuite, "batch_mul_test", batch_mul_test) == NULL) ||
+        (CU_add_test(pSuite, "view_test", view_test) == NULL) ||
+        (CU_add_test(pSuite, "block_test", block_test) == NULL) ||
+        (CU_add_test(pSuite, "pool_test", pool_test) == NULL) ||
+        (CU_add_test(pSuite, "threads_test", threads_test) == NULL) ||
+        (CU_add_test(pSuite, "dtype_test", dtype_test) == NULL) ||
+        (CU_add_test(pSuite, "sparse_test", sparse_test) == NULL) ||
+        (CU_add_test(pSuite, "strassen_test", strassen_test) == NULL) ||
+        (CU_add_test(pSuite, "compare_test", compare_test) == NULL) ||
         (CU_add_test(pSuite, "alloc_fail_test", alloc_fail_test) == NULL) ||
         (CU_add_test(pSuite, "alloc_success_test", alloc_success_test) == NULL) ||
         (CU_add_test(pSuite, "alloc_ref_fail_test", alloc_ref_fail_test) == NULL) ||
@@ -0,0 +1,213 @@
+"""
+Benchmarks numc operations over a sweep of square sizes
+
+Every case is timed with time.perf_counter_ns after some warmup runs. Small cases repeat the
+operation within each sample so that a sample is long enough to time. The median and
+interquartile range of the samples are reported, together with GFLOP/s and the GB/s of
+compulsory memory traffic (each operand read once, the result written once).
+
+Usage:
+    python3 benchmark.py                              # full sweep, prints a table
+    python3 benchmark.py --ops add,mul --sizes 64,1024
+    python3 benchmark.py --save baseline.json         # records the results
+    python3 benchmark.py --baseline baseline.json     # exits with 1 on a regression
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numc as nc
+
+OPS = ["add", "sub", "mul", "pow", "abs", "neg"]
+SIZES = [2, 16, 64, 256, 1024, 2048, 4096]
+POW_EXPONENT = 3
+
+"""
+Shortest sample, in nanoseconds, that is timed as is. Faster operations are repeated within a
+sample until it takes at least this long, so that the timer resolution does not dominate.
+"""
+MIN_SAMPLE_NS = 100000
+
+
+def measure(fn, warmup=1, repeat=25, min_repeat=5, budget=2.0):
+    """
+    Times fn and returns a dict of per-call statistics in nanoseconds. fn runs `warmup` times
+    untimed, then at least `min_repeat` and at most `repeat` samples are taken, stopping early
+    once `budget` seconds have gone into sampling.
+    """
+    for _ in range(warmup):
+        fn()
+    inner = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(inner):
+            fn()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= MIN_SAMPLE_NS or inner >= 1 << 20:
+            break
+        inner *= 2
+    samples = [elapsed / inner]
+    spent = elapsed
+    while len(samples) < repeat and (len(samples) < min_repeat or spent < budget * 1e9):
+        start = time.perf_counter_ns()
+        for _ in range(inner):
+            fn()
+        elapsed = time.perf_counter_ns() - start
+        samples.append(elapsed / inner)
+        spent += elapsed
+    if len(samples) > 1:
+        q1, median, q3 = statistics.quantiles(samples, n=4, method="inclusive")
+    else:
+        q1 = median = q3 = samples[0]
+    return {"median_ns": median, "q1_ns": q1, "q3_ns": q3, "iqr_ns": q3 - q1,
+            "runs": len(samples), "inner": inner}
+
+
+def pow_products(exponent):
+    """Number of matrix products binary exponentiation takes to raise to `exponent`"""
+    if exponent < 2:
+        return 0
+    return exponent.bit_length() - 1 + bin(exponent).count("1") - 1
+
+
+def work(op, n, exponent=POW_EXPONENT):
+    """Returns the (floating point operations, bytes of compulsory traffic) of op on n x n"""
+    elems = n * n
+    if op in ("add", "sub"):
+        return elems, 3 * 8 * elems
+    if op in ("abs", "neg"):
+        return elems, 2 * 8 * elems
+    if op == "mul":
+        return 2 * n * elems, 3 * 8 * elems
+    if op == "pow":
+        products = pow_products(exponent)
+        return products * 2 * n * elems, products * 3 * 8 * elems
+    raise ValueError(f"unknown operation '{op}'")
+
+
+def case(op, n, exponent=POW_EXPONENT):
+    """Returns a function that runs op once on random n x n operands"""
+    a = nc.Matrix(n, n, rand=True, seed=0)
+    b = nc.Matrix(n, n, rand=True, seed=1)
+    return {
+        "add": lambda: a + b,
+        "sub": lambda: a - b,
+        "mul": lambda: a * b,
+        "pow": lambda: a ** exponent,
+        "abs": lambda: abs(a),
+        "neg": lambda: -a,
+    }[op]
+
+
+def run(ops=OPS, sizes=SIZES, exponent=POW_EXPONENT, **kwargs):
+    """Benchmarks every op at every size and returns the results keyed by 'op/size'"""
+    results = {}
+    for op in ops:
+        for n in sizes:
+            stats = measure(case(op, n, exponent), **kwargs)
+            flops, traffic = work(op, n, exponent)
+            stats.update(op=op, size=n, gflops=flops / stats["median_ns"],
+                         gbps=traffic / stats["median_ns"])
+            results[f"{op}/{n}"] = stats
+    return results
+
+
+def machine():
+    """Describes where the results were taken, so that baselines are compared like for like"""
+    return {"platform": platform.platform(), "processor": platform.processor(),
+            "cpus": os.cpu_count(), "threads": nc.get_num_threads(),
+            "python": platform.python_version()}
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Returns the cases of `results` that regressed against `baseline`, as (key, baseline median,
+    median) tuples. A case regresses when its median is more than `tolerance` slower and its
+    interquartile range lies entirely above the baseline's, so noise alone does not fail a run.
+    """
+    regressions = []
+    for key, new in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        if new["median_ns"] > old["median_ns"] * (1 + tolerance) and new["q1_ns"] > old["q3_ns"]:
+            regressions.append((key, old["median_ns"], new["median_ns"]))
+    return regressions
+
+
+def format_ns(ns):
+    for unit, scale in (("s", 1e9), ("ms", 1e6), ("us", 1e3)):
+        if ns >= scale:
+            return f"{ns / scale:.3g} {unit}"
+    return f"{ns:.3g} ns"
+
+
+def report(results, baseline=None):
+    print(f"{'case':<12}{'median':>12}{'iqr':>12}{'runs':>6}{'GFLOP/s':>10}{'GB/s':>9}"
+          + ("  vs baseline" if baseline else ""))
+    for key, stats in results.items():
+        line = (f"{key:<12}{format_ns(stats['median_ns']):>12}{format_ns(stats['iqr_ns']):>12}"
+                f"{stats['runs']:>6}{stats['gflops']:>10.3g}{stats['gbps']:>9.3g}")
+        if baseline and key in baseline:
+            line += f"  {stats['median_ns'] / baseline[key]['median_ns']:.2f}x"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark numc operations")
+    parser.add_argument("--ops", default=",".join(OPS), help="comma separated operations")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="comma separated matrix orders")
+    parser.add_argument("--exponent", type=int, default=POW_EXPONENT, help="exponent of pow")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs per case")
+    parser.add_argument("--repeat", type=int, default=25, help="most samples per case")
+    parser.add_argument("--min-repeat", type=int, default=5, help="fewest samples per case")
+    parser.add_argument("--budget", type=float, default=2.0,
+                        help="seconds of sampling per case after which it stops early")
+    parser.add_argument("--threads", type=int, help="numc thread count")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown over the baseline median that counts as a regression")
+    args = parser.parse_args(argv)
+
+    ops = args.ops.split(",")
+    for op in ops:
+        if op not in OPS:
+            parser.error(f"unknown operation '{op}'")
+    if args.threads is not None:
+        nc.set_num_threads(args.threads)
+    results = run(ops, [int(n) for n in args.sizes.split(",")], args.exponent,
+                  warmup=args.warmup, repeat=args.repeat, min_repeat=args.min_repeat,
+                  budget=args.budget)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        baseline = stored["results"]
+        if stored.get("machine") != machine():
+            print("warning: the baseline was taken on a different machine or thread count",
+                  file=sys.stderr)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"machine": machine(), "exponent": args.exponent, "results": results}, f,
+                      indent=2)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for key, old, new in regressions:
+            print(f"regression: {key} took {format_ns(new)}, baseline {format_ns(old)}",
+                  file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,8 @@
 from utils import *
 from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+import array, contextlib, io, json, os, pickle, struct, subprocess, sys, tempfile, threading
+import benchmark
 
 """
 - For each operation, you should write tests to test  on matrices of different sizes.
@@ -18,36 +21,47 @@ class TestAdd(TestCase):
         print_speedup(speed_up)
 
     def test_medium_add(self):
-        # TODO: YOUR CODE HERE
-        pass
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(100, 257, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(100, 257, seed=1)
+        is_correct, speed_up = compute([dp_mat1, dp_mat2], [nc_mat1, nc_mat2], "add")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
 
     def test_large_add(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(1000, 1000, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(1000, 1000, seed=1)
+        is_correct, speed_up = compute([dp_mat1, dp_mat2], [nc_mat1, nc_mat2], "add")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
+
+class TestSub(TestCase):
+    def test_small_sub(self):
         # TODO: YOUR CODE HERE
-        pass
-
-# (OPTIONAL) Uncomment the following TestSub class if you have implemented matrix subtraction.
-# class TestSub(TestCase):
-#    def test_small_sub(self):
-#        # TODO: YOUR CODE HERE
-#        dp_mat1, nc_mat1 = rand_dp_nc_matrix(2, 2, seed=0)
-#        dp_mat2, nc_mat2 = rand_dp_nc_matrix(2, 2, seed=1)
-#        is_correct, speed_up = compute([dp_mat1, dp_mat2], [nc_mat1, nc_mat2], "sub")
-#        self.assertTrue(is_correct)
-#        try:
-#            nc.Matrix(3, 3) - nc.Matrix(2, 2)
-#            self.assertTrue(False)
-#        except ValueError as e:
-#            print(e)
-#            pass
-#        print_speedup(speed_up)
-#
-#    def test_medium_sub(self):
-#        # TODO: YOUR CODE HERE
-#        pass
-#
-#    def test_large_sub(self):
-#        # TODO: YOUR CODE HERE
-#        pass
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(2, 2, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(2, 2, seed=1)
+        is_correct, speed_up = compute([dp_mat1, dp_mat2], [nc_mat1, nc_mat2], "sub")
+        self.assertTrue(is_correct)
+        try:
+            nc.Matrix(3, 3) - nc.Matrix(2, 2)
+            self.assertTrue(False)
+        except ValueError as e:
+            print(e)
+            pass
+        print_speedup(speed_up)
+
+    def test_medium_sub(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(100, 257, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(100, 257, seed=1)
+        is_correct, speed_up = compute([dp_mat1, dp_mat2], [nc_mat1, nc_mat2], "sub")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
+
+    def test_large_sub(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(1000, 1000, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(1000, 1000, seed=1)
+        is_correct, speed_up = compute([dp_mat1, dp_mat2], [nc_mat1, nc_mat2], "sub")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
 
 class TestAbs(TestCase):
     def test_small_abs(self):
@@ -58,28 +72,36 @@ class TestAbs(TestCase):
         print_speedup(speed_up)
 
     def test_medium_abs(self):
-        # TODO: YOUR CODE HERE
-        pass
+        dp_mat, nc_mat = rand_dp_nc_matrix(100, 257, low=-1, high=1, seed=0)
+        is_correct, speed_up = compute([dp_mat], [nc_mat], "abs")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
 
     def test_large_abs(self):
+        dp_mat, nc_mat = rand_dp_nc_matrix(1000, 1000, low=-1, high=1, seed=0)
+        is_correct, speed_up = compute([dp_mat], [nc_mat], "abs")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
+
+class TestNeg(TestCase):
+    def test_small_neg(self):
         # TODO: YOUR CODE HERE
-        pass
-
-# (OPTIONAL) Uncomment the following TestNeg class if you have implemented matrix negation.
-# class TestNeg(TestCase):
-#    def test_small_neg(self):
-#        # TODO: YOUR CODE HERE
-#        dp_mat, nc_mat = rand_dp_nc_matrix(2, 2, seed=0)
-#        is_correct, speed_up = compute([dp_mat], [nc_mat], "neg")
-#        self.assertTrue(is_correct)
-#        print_speedup(speed_up)
-#    def test_medium_neg(self):
-#        # TODO: YOUR CODE HERE
-#        pass
-
-#    def test_large_neg(self):
-#        # TODO: YOUR CODE HERE
-#        pass
+        dp_mat, nc_mat = rand_dp_nc_matrix(2, 2, seed=0)
+        is_correct, speed_up = compute([dp_mat], [nc_mat], "neg")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
+
+    def test_medium_neg(self):
+        dp_mat, nc_mat = rand_dp_nc_matrix(100, 257, low=-1, high=1, seed=0)
+        is_correct, speed_up = compute([dp_mat], [nc_mat], "neg")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
+
+    def test_large_neg(self):
+        dp_mat, nc_mat = rand_dp_nc_matrix(1000, 1000, low=-1, high=1, seed=0)
+        is_correct, speed_up = compute([dp_mat], [nc_mat], "neg")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
 
 class TestMul(TestCase):
     def test_small_mul(self):
@@ -91,12 +113,18 @@ class TestMul(TestCase):
         print_speedup(speed_up)
 
     def test_medium_mul(self):
-        # TODO: YOUR CODE HERE
-        pass
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(100, 257, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(257, 95, seed=1)
+        is_correct, speed_up = compute([dp_mat1, dp_mat2], [nc_mat1, nc_mat2], "mul")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
 
     def test_large_mul(self):
-        # TODO: YOUR CODE HERE
-        pass
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(1000, 1000, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(1000, 1000, seed=1)
+        is_correct, speed_up = compute([dp_mat1, dp_mat2], [nc_mat1, nc_mat2], "mul")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
 
 class TestPow(TestCase):
     def test_small_pow(self):
@@ -107,12 +135,24 @@ class TestPow(TestCase):
         print_speedup(speed_up)
 
     def test_medium_pow(self):
-        # TODO: YOUR CODE HERE
-        pass
+        dp_mat, nc_mat = rand_dp_nc_matrix(100, 100, low=-0.1, high=0.1, seed=0)
+        is_correct, speed_up = compute([dp_mat, 13], [nc_mat, 13], "pow")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
 
     def test_large_pow(self):
-        # TODO: YOUR CODE HERE
-        pass
+        dp_mat, nc_mat = rand_dp_nc_matrix(500, 500, low=-0.01, high=0.01, seed=0)
+        is_correct, speed_up = compute([dp_mat, 100], [nc_mat, 100], "pow")
+        self.assertTrue(is_correct)
+        print_speedup(speed_up)
+
+    def test_zero_and_negative_pow(self):
+        nc_mat = nc.Matrix(2, 2, [1, 1, 1, 0])
+        self.assertEqual(nc.to_list(nc_mat ** 0), [[1, 0], [0, 1]])
+        self.assertEqual([[round(x, 9) for x in row] for row in nc.to_list(nc_mat ** -2)],
+            [[1, -1], [-1, 2]])
+        with self.assertRaises(ValueError):
+            nc.Matrix(2, 2, [2, 4, 1, 2]) ** -1
 
 class TestGet(TestCase):
     def test_get(self):
@@ -165,3 +205,1022 @@ class TestSlice(TestCase):
         dp_mat, nc_mat = rand_dp_nc_matrix(2, 2, seed=0)
         self.assertTrue(cmp_dp_nc_matrix(dp_mat[0], nc_mat[0]))
         self.assertTrue(cmp_dp_nc_matrix(dp_mat[1], nc_mat[1]))
+
+class TestInplace(TestCase):
+    def test_inplace_add_sub(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(10, 12, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(10, 12, seed=1)
+        nc_before = nc_mat1
+        nc_mat1 += nc_mat2
+        self.assertIs(nc_mat1, nc_before)
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1 + dp_mat2, nc_mat1))
+        nc_mat1 -= nc_mat2
+        self.assertIs(nc_mat1, nc_before)
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1, nc_mat1))
+
+    def test_inplace_mul_pow(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(8, 8, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(8, 8, seed=1)
+        nc_before = nc_mat1
+        nc_mat1 *= nc_mat2
+        self.assertIs(nc_mat1, nc_before)
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1 * dp_mat2, nc_mat1))
+        nc_mat1 **= 3
+        self.assertIs(nc_mat1, nc_before)
+        self.assertTrue(cmp_dp_nc_matrix((dp_mat1 * dp_mat2) ** 3, nc_mat1))
+
+    def test_inplace_mul_reshape(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(4, 6, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(6, 3, seed=1)
+        nc_mat1 *= nc_mat2
+        self.assertEqual(nc_mat1.shape, (4, 3))
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1 * dp_mat2, nc_mat1))
+
+class TestOut(TestCase):
+    def test_out(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(5, 5, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(5, 5, seed=1)
+        nc_out = nc.Matrix(5, 5)
+        self.assertIs(nc_mat1.add(nc_mat2, out=nc_out), nc_out)
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1 + dp_mat2, nc_out))
+        self.assertIs(nc_mat1.sub(nc_mat2, out=nc_out), nc_out)
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1 - dp_mat2, nc_out))
+        self.assertIs(nc_mat1.mul(nc_mat2, out=nc_out), nc_out)
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1 * dp_mat2, nc_out))
+        self.assertIs(nc_mat1.pow(2, out=nc_out), nc_out)
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1 ** 2, nc_out))
+        self.assertIs(nc_mat1.neg(out=nc_out), nc_out)
+        self.assertTrue(cmp_dp_nc_matrix(-dp_mat1, nc_out))
+        self.assertIs(nc_out.abs(out=nc_out), nc_out)
+        self.assertTrue(cmp_dp_nc_matrix(abs(dp_mat1), nc_out))
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1 + dp_mat2, nc_mat1.add(nc_mat2)))
+
+    def test_out_aliases_operand(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(6, 6, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(6, 6, seed=1)
+        nc_mat1.mul(nc_mat2, out=nc_mat1)
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1 * dp_mat2, nc_mat1))
+
+    def test_out_wrong_shape(self):
+        nc_mat1, nc_mat2 = nc.Matrix(3, 3), nc.Matrix(3, 3)
+        with self.assertRaises(ValueError):
+            nc_mat1.add(nc_mat2, out=nc.Matrix(2, 3))
+        with self.assertRaises(TypeError):
+            nc_mat1.add(nc_mat2, out=[])
+
+class TestBuffer(TestCase):
+    def test_export(self):
+        dp_mat, nc_mat = rand_dp_nc_matrix(3, 5, seed=0)
+        arr = np.asarray(nc_mat)
+        self.assertEqual(arr.shape, (3, 5))
+        self.assertEqual(arr.strides, (5 * 8, 8))
+        self.assertEqual(arr.dtype, np.float64)
+        self.assertEqual(arr[2, 4], nc_mat.get(2, 4))
+        arr[1, 2] = 7
+        self.assertEqual(nc_mat.get(1, 2), 7)
+
+    def test_from_buffer(self):
+        arr = np.arange(12, dtype=np.float64).reshape(3, 4)
+        nc_mat = nc.Matrix.from_buffer(arr)
+        self.assertEqual(nc_mat.shape, (3, 4))
+        arr[2, 3] = -1
+        self.assertEqual(nc_mat.get(2, 3), -1)
+        nc_copy = nc.Matrix.from_buffer(arr, copy=True)
+        arr[2, 3] = 5
+        self.assertEqual(nc_copy.get(2, 3), -1)
+        del arr
+        self.assertEqual(nc_mat.get(2, 3), 5)
+        self.assertEqual(nc.Matrix.from_buffer(np.ones(4)).shape, (1, 4))
+
+    def test_from_buffer_invalid(self):
+        with self.assertRaises(TypeError):
+            nc.Matrix.from_buffer(np.ones((2, 2), dtype=np.int16))
+        with self.assertRaises(ValueError):
+            nc.Matrix.from_buffer(np.ones((4, 4))[:, ::2])
+        with self.assertRaises(ValueError):
+            nc.Matrix.from_buffer(np.ones((2, 2, 2)))
+
+class TestLoadSave(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_float64_roundtrip(self):
+        dp_mat, nc_mat = rand_dp_nc_matrix(30, 20, seed=0)
+        path = os.path.join(self.dir.name, "mat.bin")
+        nc.save(path, nc_mat)
+        self.assertEqual(os.path.getsize(path), 8 + 30 * 20 * 8)
+        for use_mmap in (True, False):
+            loaded = nc.load(path, mmap=use_mmap)
+            self.assertEqual(loaded.shape, (30, 20))
+            self.assertTrue(cmp_dp_nc_matrix(dp_mat, loaded))
+
+    def test_mmap_is_copy_on_write(self):
+        path = os.path.join(self.dir.name, "mat.bin")
+        nc.save(path, nc.Matrix(2, 2, 1))
+        loaded = nc.load(path)
+        loaded.set(0, 0, 5)
+        self.assertEqual(nc.load(path).get(0, 0), 1)
+
+    def test_int32(self):
+        path = os.path.join(self.dir.name, "mat.bin")
+        with open(path, "wb") as f:
+            f.write(struct.pack("<8i", 2, 3, 1, -2, 3, 4, 5, 6))
+        loaded = nc.load(path)
+        self.assertEqual(nc.to_list(loaded), [[1, -2, 3], [4, 5, 6]])
+        nc.save(path, nc.Matrix(1, 2, [1.5, -2.5]), dtype="int32")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), struct.pack("<4i", 1, 2, 1, -2))
+
+    def test_invalid(self):
+        path = os.path.join(self.dir.name, "mat.bin")
+        with open(path, "wb") as f:
+            f.write(struct.pack("<3i", 2, 2, 1))
+        with self.assertRaises(ValueError):
+            nc.load(path)
+        with self.assertRaises(OSError):
+            nc.load(os.path.join(self.dir.name, "missing.bin"))
+
+class TestExport(TestCase):
+    def test_tobytes_and_tolist(self):
+        arr = np.arange(12, dtype=np.float64).reshape(3, 4)
+        nc_mat = nc.Matrix.frombytes(arr.tobytes(), 3, 4)
+        self.assertEqual(nc_mat.tobytes(), arr.tobytes())
+        self.assertEqual(nc_mat[:, 1:4:2].tobytes(), arr[:, 1:4:2].tobytes())
+        self.assertEqual(nc_mat.T.tobytes(), arr.T.tobytes())
+        self.assertEqual(nc_mat.tolist(), arr.tolist())
+        self.assertEqual(nc_mat.T.tolist(), arr.T.tolist())
+
+    def test_tofile(self):
+        arr = np.arange(12, dtype=np.float64).reshape(3, 4)
+        nc_mat = nc.Matrix.frombytes(arr.tobytes(), 3, 4)
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "mat.bin")
+            nc_mat.tofile(path)
+            self.assertTrue(np.array_equal(np.fromfile(path).reshape(3, 4), arr))
+            nc_mat[:, ::2].tofile(path)
+            self.assertTrue(np.array_equal(np.fromfile(path).reshape(3, 2), arr[:, ::2]))
+            with self.assertRaises(OSError):
+                nc_mat.tofile(os.path.join(dir, "missing", "mat.bin"))
+
+    def test_iter(self):
+        nc_mat = nc.arange(6, shape=(2, 3))
+        rows = list(nc_mat)
+        self.assertEqual([row.shape for row in rows], [(3, 1), (3, 1)])
+        self.assertEqual(nc.to_list(rows[1]), [[3], [4], [5]])
+        rows[0][1] = 9
+        self.assertEqual(nc_mat[0, 1], 9)
+        self.assertEqual(list(nc.Matrix(3, 1, [1, 2, 3])), [1, 2, 3])
+
+    def test_repr(self):
+        nc_mat = nc.Matrix(2, 3, [1, -0.5, 1e16, float("inf"), 1 / 3, 0])
+        self.assertEqual(repr(nc_mat), repr(nc_mat.tolist()))
+        self.assertEqual(repr(nc.arange(1000, shape=(10, 100))), repr(nc.arange(1000, shape=(10, 100)).tolist()))
+        self.assertEqual(repr(nc.arange(12000, shape=(1000, 12))),
+                         "[[0.0, 1.0, 2.0, ..., 9.0, 10.0, 11.0], [12.0, 13.0, 14.0, ..., 21.0, 22.0, 23.0], "
+                         "[24.0, 25.0, 26.0, ..., 33.0, 34.0, 35.0], ..., "
+                         "[11964.0, 11965.0, 11966.0, ..., 11973.0, 11974.0, 11975.0], "
+                         "[11976.0, 11977.0, 11978.0, ..., 11985.0, 11986.0, 11987.0], "
+                         "[11988.0, 11989.0, 11990.0, ..., 11997.0, 11998.0, 11999.0]]")
+        self.assertLess(len(repr(nc.Matrix(3000, 3000))), 300)
+
+class TestLazy(TestCase):
+    def setUp(self):
+        self.was_lazy = nc.set_lazy(True)
+
+    def tearDown(self):
+        nc.set_lazy(self.was_lazy)
+
+    def test_fused_chain(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(40, 30, low=-1, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(40, 30, low=-1, seed=1)
+        dp_mat3, nc_mat3 = rand_dp_nc_matrix(40, 30, low=-1, seed=2)
+        nc_result = abs(nc_mat1 + nc_mat2 - nc_mat3) + -nc_mat1
+        self.assertEqual(nc_result.shape, (40, 30))
+        dp_result = abs(dp_mat1 + dp_mat2 - dp_mat3) + -dp_mat1
+        self.assertTrue(cmp_dp_nc_matrix(dp_result, nc_result))
+
+    def test_eval_and_reuse(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(10, 10, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(10, 10, seed=1)
+        nc_sum = nc_mat1 + nc_mat2
+        self.assertIs(nc.eval(nc_sum), nc_sum)
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1 + dp_mat2, nc_sum))
+        self.assertTrue(cmp_dp_nc_matrix((dp_mat1 + dp_mat2) * dp_mat2, nc_sum * nc_mat2))
+
+    def test_long_chain(self):
+        dp_mat1, nc_mat1 = rand_dp_nc_matrix(5, 5, seed=0)
+        dp_mat2, nc_mat2 = rand_dp_nc_matrix(5, 5, seed=1)
+        for _ in range(100):
+            dp_mat1 = dp_mat1 - dp_mat2
+            nc_mat1 = nc_mat1 - nc_mat2
+        self.assertTrue(cmp_dp_nc_matrix(dp_mat1, nc_mat1))
+
+    def test_shape_mismatch(self):
+        with self.assertRaises(ValueError):
+            nc.Matrix(3, 3) + nc.Matrix(2, 2)
+
+    def test_write_after_build(self):
+        a = nc.Matrix(2, 2, 1)
+        b = nc.Matrix(2, 2, 1)
+        total = a + b
+        negated = -total
+        a[0, 0] = 100
+        self.assertEqual(total.tolist(), [[2, 2], [2, 2]])
+        self.assertEqual(negated.tolist(), [[-2, -2], [-2, -2]])
+        total = a + b
+        a[0:1, :][0, 1] = 5
+        self.assertEqual(total.tolist(), [[101, 2], [2, 2]])
+        total = a - b
+        a += b
+        a.add(b, out=b)
+        self.assertEqual(total.tolist(), [[99, 4], [0, 0]])
+        total = a + b
+        np.asarray(a)[0, 1] = 9
+        self.assertEqual(total.tolist(), [[203, 13], [5, 5]])
+        total = a - b
+        memoryview(b).cast("B").cast("d")[0] = 0
+        self.assertEqual(total.tolist(), [[-1, 2], [-1, -1]])
+
+class TestScalar(TestCase):
+    def test_scalar_ops(self):
+        _, nc_mat = rand_dp_nc_matrix(37, 53, seed=0)
+        self.assertEqual((nc_mat * 2.5).get(3, 4), nc_mat.get(3, 4) * 2.5)
+        self.assertEqual((2.5 * nc_mat).get(3, 4), nc_mat.get(3, 4) * 2.5)
+        self.assertEqual((nc_mat + 1).get(5, 6), nc_mat.get(5, 6) + 1)
+        self.assertEqual((1 + nc_mat).get(5, 6), nc_mat.get(5, 6) + 1)
+        self.assertEqual((nc_mat - 0.5).get(7, 8), nc_mat.get(7, 8) - 0.5)
+        self.assertEqual((0.5 - nc_mat).get(7, 8), 0.5 - nc_mat.get(7, 8))
+        self.assertEqual((nc_mat / 3).get(36, 52), nc_mat.get(36, 52) / 3)
+        self.assertEqual(nc_mat.div(3, out=nc.Matrix(37, 53)).get(0, 0), nc_mat.get(0, 0) / 3)
+
+    def test_inplace_scalar(self):
+        _, nc_mat = rand_dp_nc_matrix(20, 20, seed=0)
+        expected = nc_mat.get(1, 2) * 3 / 2 - 1 + 4
+        nc_mat *= 3
+        nc_mat /= 2
+        nc_mat -= 1
+        nc_mat += 4
+        self.assertEqual(nc_mat.get(1, 2), expected)
+
+    def test_broadcast(self):
+        _, nc_mat = rand_dp_nc_matrix(4, 3, seed=0)
+        row = nc.Matrix(1, 3, [1, 2, 3])
+        col = nc.Matrix(4, 1, [10, 20, 30, 40])
+        for i in range(4):
+            for j in range(3):
+                self.assertEqual((nc_mat + row).get(i, j), nc_mat.get(i, j) + j + 1)
+                self.assertEqual((row - nc_mat).get(i, j), j + 1 - nc_mat.get(i, j))
+                self.assertEqual((nc_mat - col).get(i, j), nc_mat.get(i, j) - 10 * (i + 1))
+                self.assertEqual((col + nc_mat).get(i, j), nc_mat.get(i, j) + 10 * (i + 1))
+
+    def test_broadcast_own_row(self):
+        _, nc_mat = rand_dp_nc_matrix(3, 3, seed=0)
+        expected = [[nc_mat.get(i, j) + nc_mat.get(0, i) for j in range(3)] for i in range(3)]
+        nc_mat += nc_mat[0]
+        self.assertEqual(nc.to_list(nc_mat), expected)
+
+    def test_invalid(self):
+        nc_mat = nc.Matrix(3, 3)
+        with self.assertRaises(TypeError):
+            2 / nc_mat
+        with self.assertRaises(TypeError):
+            nc_mat / nc_mat
+        with self.assertRaises(ValueError):
+            nc_mat + nc.Matrix(1, 2)
+
+class TestReduce(TestCase):
+    def test_reductions(self):
+        for rows, cols in [(1, 1), (3, 5), (37, 1029), (500, 700), (300000, 3)]:
+            _, nc_mat = rand_dp_nc_matrix(rows, cols, low=-1, seed=0)
+            arr = np.asarray(nc_mat)
+            self.assertAlmostEqual(nc_mat.sum(), arr.sum(), places=6)
+            self.assertAlmostEqual(nc_mat.mean(), arr.mean(), places=decimal_places)
+            self.assertEqual(nc_mat.min(), arr.min())
+            self.assertEqual(nc_mat.max(), arr.max())
+            self.assertEqual(nc_mat.argmax(), arr.argmax())
+            for axis in (0, 1):
+                for name in ("sum", "mean", "min", "max", "argmax"):
+                    result = getattr(nc_mat, name)(axis=axis)
+                    expected = getattr(arr, name)(axis=axis)
+                    self.assertEqual(result.shape, (1, cols) if axis == 0 else (rows, 1))
+                    self.assertTrue(np.allclose(np.asarray(result).ravel(), expected))
+
+    def test_ties_and_nan(self):
+        nc_mat = nc.Matrix(4, 6, 1)
+        self.assertEqual(nc_mat.argmax(), 0)
+        nc_mat[2][3] = float("nan")
+        nc_mat[3][1] = float("nan")
+        self.assertEqual(nc_mat.argmax(), 15)
+        self.assertNotEqual(nc_mat.max(), nc_mat.max())
+        self.assertEqual(nc.to_list(nc_mat.argmax(axis=1)), [[0], [0], [3], [1]])
+
+    def test_deterministic(self):
+        _, nc_mat = rand_dp_nc_matrix(1000, 1000, low=-1, seed=0)
+        self.assertEqual(nc_mat.sum(), nc_mat.sum())
+        self.assertEqual(nc.to_list(nc_mat.sum(axis=0)), nc.to_list(nc_mat.sum(axis=0)))
+
+    def test_invalid_axis(self):
+        with self.assertRaises(ValueError):
+            nc.Matrix(2, 2).sum(axis=2)
+        with self.assertRaises(TypeError):
+            nc.Matrix(2, 2).max(axis="rows")
+
+class TestConstructors(TestCase):
+    def test_frombytes(self):
+        arr = np.arange(12, dtype=np.float64).reshape(3, 4)
+        self.assertEqual(nc.to_list(nc.Matrix.frombytes(arr.tobytes(), 3, 4)), arr.tolist())
+        self.assertEqual(nc.to_list(nc.Matrix.frombytes(bytearray(arr.tobytes()), 4, 3)),
+                         arr.reshape(4, 3).tolist())
+        with self.assertRaises(ValueError):
+            nc.Matrix.frombytes(arr.tobytes(), 3, 3)
+        with self.assertRaises(ValueError):
+            nc.Matrix.frombytes(b"", 0, 0)
+
+    def test_fromiter(self):
+        expected = [[0, 0.5, 1], [1.5, 2, 2.5]]
+        self.assertEqual(nc.to_list(nc.Matrix.fromiter((i / 2 for i in range(6)), 2, 3)), expected)
+        self.assertEqual(nc.to_list(nc.Matrix.fromiter(range(6), 3, 2)), [[0, 1], [2, 3], [4, 5]])
+        self.assertEqual(nc.to_list(nc.Matrix.fromiter((0, 0.5, 1, 1.5, 2, 2.5), 2, 3)), expected)
+        with self.assertRaises(ValueError):
+            nc.Matrix.fromiter(range(5), 2, 3)
+        with self.assertRaises(ValueError):
+            nc.Matrix.fromiter(iter(range(7)), 2, 3)
+        with self.assertRaises(TypeError):
+            nc.Matrix.fromiter(["a"], 1, 1)
+
+    def test_from_array(self):
+        for code in "bBhHiIlLqQfd":
+            arr = array.array(code, range(6))
+            self.assertEqual(nc.to_list(nc.Matrix.from_array(arr)), [[0, 1, 2, 3, 4, 5]])
+            self.assertEqual(nc.to_list(nc.Matrix.from_array(arr, 2, 3)), [[0, 1, 2], [3, 4, 5]])
+        arr = array.array("d", [1, 2, 3, 4])
+        nc_mat = nc.Matrix.from_array(arr, rows=2)
+        arr[0] = 9
+        self.assertEqual(nc.to_list(nc_mat), [[1, 2], [3, 4]])
+        with self.assertRaises(ValueError):
+            nc.Matrix.from_array(arr, 3, 1)
+        with self.assertRaises(TypeError):
+            nc.Matrix.from_array(array.array("u", "ab"))
+
+    def test_tuples(self):
+        self.assertEqual(nc.to_list(nc.Matrix(2, 2, (1, 2, 3, 4))), [[1, 2], [3, 4]])
+        self.assertEqual(nc.to_list(nc.Matrix(((1, 2), [3, 4]))), [[1, 2], [3, 4]])
+        with self.assertRaises(TypeError):
+            nc.Matrix(1, 2, [1, "a"])
+
+    def test_arange_and_eye(self):
+        self.assertEqual(nc.to_list(nc.arange(4)), [[0, 1, 2, 3]])
+        self.assertTrue(np.array_equal(np.asarray(nc.arange(0, 1, 0.1)), np.arange(0, 1, 0.1)[None]))
+        self.assertTrue(np.array_equal(np.asarray(nc.arange(10, 0, -3)), np.arange(10, 0, -3)[None]))
+        self.assertEqual(nc.to_list(nc.arange(1, 7, shape=(2, 3))), [[1, 2, 3], [4, 5, 6]])
+        with self.assertRaises(ValueError):
+            nc.arange(3, 3)
+        with self.assertRaises(ValueError):
+            nc.arange(0, 3, 0)
+        with self.assertRaises(ValueError):
+            nc.arange(6, shape=(4, 2))
+        self.assertEqual(nc.to_list(nc.eye(3)), np.eye(3).tolist())
+        self.assertEqual(nc.to_list(nc.eye(2, 4)), np.eye(2, 4).tolist())
+        with self.assertRaises(ValueError):
+            nc.eye(0)
+
+class TestRandom(TestCase):
+    def test_reproducible(self):
+        for rows, cols in [(1, 1), (3, 5), (1, 10001), (300, 257)]:
+            for generate in (nc.uniform, nc.normal):
+                nc_mat = generate(rows, cols, seed=11)
+                self.assertEqual(nc_mat.shape, (rows, cols))
+                self.assertEqual(nc_mat.tobytes(), generate(rows, cols, seed=11).tobytes())
+                self.assertNotEqual(nc_mat.tobytes(), generate(rows, cols, seed=12).tobytes())
+        # Entry k in row-major order only depends on the seed and k
+        flat = np.asarray(nc.uniform(1, 600, seed=3)).ravel()
+        self.assertTrue(np.array_equal(np.asarray(nc.uniform(20, 30, seed=3)).ravel(), flat))
+        flat = np.asarray(nc.normal(1, 601, seed=3)).ravel()
+        self.assertTrue(np.array_equal(np.asarray(nc.normal(601, 1, seed=3)).ravel(), flat))
+
+    def test_distributions(self):
+        arr = np.asarray(nc.uniform(500, 400, low=-2, high=3, seed=1))
+        self.assertGreaterEqual(arr.min(), -2)
+        self.assertLess(arr.max(), 3)
+        self.assertAlmostEqual(arr.mean(), 0.5, places=1)
+        arr = np.asarray(nc.normal(500, 400, mean=4, std=2, seed=1))
+        self.assertAlmostEqual(arr.mean(), 4, places=1)
+        self.assertAlmostEqual(arr.std(), 2, places=1)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            nc.uniform(2, 2, low=1, high=1)
+        with self.assertRaises(ValueError):
+            nc.normal(2, 2, std=-1)
+        with self.assertRaises(ValueError):
+            nc.uniform(0, 2)
+
+class TestTranspose(TestCase):
+    def test_transpose(self):
+        for rows, cols in [(1, 1), (1, 9), (9, 1), (33, 65), (300, 257)]:
+            _, nc_mat = rand_dp_nc_matrix(rows, cols, seed=0)
+            arr = np.asarray(nc_mat)
+            self.assertEqual(nc.to_list(nc.transpose(nc_mat)), arr.T.tolist())
+            self.assertEqual(nc_mat.T.shape, (cols, rows))
+            self.assertEqual(nc.to_list(nc_mat.T), arr.T.tolist())
+            self.assertEqual(nc.to_list(nc_mat.T.T), arr.tolist())
+        with self.assertRaises(TypeError):
+            nc.transpose([[1]])
+
+    def test_view_writes(self):
+        nc_mat = nc.Matrix(3, 4)
+        nc_mat.T[1, 2] = 5
+        self.assertEqual(nc_mat[2, 1], 5)
+        _, square = rand_dp_nc_matrix(50, 50, seed=1)
+        arr = np.asarray(square).copy()
+        square[:, :] = square.T
+        self.assertEqual(nc.to_list(square), arr.T.tolist())
+
+    def test_transposed_mul(self):
+        _, a = rand_dp_nc_matrix(150, 90, seed=2)
+        _, b = rand_dp_nc_matrix(150, 70, seed=3)
+        arr_a, arr_b = np.asarray(a), np.asarray(b)
+        self.assertTrue(np.allclose(np.asarray(a.T * b), arr_a.T @ arr_b))
+        self.assertTrue(np.allclose(np.asarray(a.T * a), arr_a.T @ arr_a))
+        self.assertTrue(np.allclose(np.asarray(a * a.T), arr_a @ arr_a.T))
+        self.assertTrue(np.allclose(np.asarray(a[:, 10:80] * b.T), arr_a[:, 10:80] @ arr_b.T))
+
+class TestBatchMul(TestCase):
+    def test_batch(self):
+        shapes = [(64, 64, 64)] * 20 + [(1, 1, 1), (3, 7, 2), (130, 40, 90)]
+        lhs = [rand_dp_nc_matrix(m, k, seed=i)[1] for i, (m, k, _) in enumerate(shapes)]
+        rhs = [rand_dp_nc_matrix(k, n, seed=i + 100)[1] for i, (_, k, n) in enumerate(shapes)]
+        results = nc.batch_mul(lhs, tuple(rhs))
+        self.assertEqual(len(results), len(shapes))
+        for a, b, result in zip(lhs, rhs, results):
+            self.assertTrue(np.allclose(np.asarray(result), np.asarray(a) @ np.asarray(b)))
+        self.assertEqual(nc.batch_mul([], []), [])
+
+    def test_views(self):
+        _, nc_mat = rand_dp_nc_matrix(40, 40, seed=0)
+        arr = np.asarray(nc_mat)
+        results = nc.batch_mul([nc_mat[::2, 1:21], nc_mat[:, 3]], [nc_mat[5:25, ::3], nc_mat[7:8, :]])
+        self.assertTrue(np.allclose(np.asarray(results[0]), arr[::2, 1:21] @ arr[5:25, ::3]))
+        self.assertTrue(np.allclose(np.asarray(results[1]), arr[:, 3:4] @ arr[7:8, :]))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            nc.batch_mul([nc.Matrix(2, 2)], [nc.Matrix(2, 2), nc.Matrix(2, 2)])
+        with self.assertRaises(ValueError):
+            nc.batch_mul([nc.Matrix(2, 2), nc.Matrix(2, 3)], [nc.Matrix(2, 2), nc.Matrix(2, 3)])
+        with self.assertRaises(TypeError):
+            nc.batch_mul([nc.Matrix(2, 2)], [1])
+
+class TestViews(TestCase):
+    def test_nested_slices_outlive_root(self):
+        mat = nc.Matrix(50, 50)
+        mat[49, 49] = 7
+        views = [mat]
+        for _ in range(49):
+            views.append(views[-1][1:, 1:])
+        del mat
+        del views[:-1]
+        self.assertEqual(views[-1].shape, (1, 1))
+        self.assertEqual(views[-1][0], 7)
+
+    def test_slices(self):
+        _, nc_mat = rand_dp_nc_matrix(20, 30, seed=0)
+        arr = np.asarray(nc_mat)
+        for key in [(slice(2, 9), slice(5, 17)), (slice(None), 4), (3, slice(1, 28, 3)),
+                    (slice(1, 20, 4), slice(None, None, 2))]:
+            view = nc_mat[key]
+            expected = arr[key].reshape(view.shape)
+            self.assertTrue(np.array_equal(np.asarray(view), expected))
+            self.assertEqual(nc.to_list(view + view), (expected + expected).tolist())
+            self.assertEqual(nc.to_list(abs(-view)), expected.tolist())
+        self.assertEqual(nc_mat[3, 4], arr[3, 4])
+
+    def test_write_through(self):
+        nc_mat = nc.Matrix(6, 8)
+        nc_mat[1:5, 2:4] = 3
+        nc_mat[:, 7] = nc.Matrix(6, 1, 2)
+        view = nc_mat[::2, ::2]
+        view += 1
+        arr = np.zeros((6, 8))
+        arr[1:5, 2:4] = 3
+        arr[:, 7] = 2
+        arr[::2, ::2] += 1
+        self.assertEqual(nc.to_list(nc_mat), arr.tolist())
+        with self.assertRaises(ValueError):
+            nc_mat[1:3, 1:3] = nc.Matrix(3, 3)
+        with self.assertRaises(ValueError):
+            nc_mat[::-1, 0]
+
+    def test_mul_and_pow(self):
+        _, nc_mat = rand_dp_nc_matrix(90, 120, seed=1)
+        arr = np.asarray(nc_mat)
+        lhs, rhs = nc_mat[10:70, 3:83:2], nc_mat[40:80, 0:120:3]
+        expected = arr[10:70, 3:83:2] @ arr[40:80, 0:120:3]
+        self.assertTrue(np.allclose(np.asarray(lhs * rhs), expected))
+        square = nc_mat[5:65:2, 1:91:3]
+        expected = np.linalg.matrix_power(arr[5:65:2, 1:91:3], 3)
+        self.assertTrue(np.allclose(np.asarray(square ** 3), expected))
+        self.assertAlmostEqual(square.sum(), arr[5:65:2, 1:91:3].sum(), places=6)
+
+    def test_overlapping_out(self):
+        nc_mat = nc.Matrix(4, 4)
+        for i in range(4):
+            for j in range(4):
+                nc_mat[i, j] = i * 4 + j
+        arr = np.asarray(nc_mat).copy()
+        nc_mat[0:3, 0:3].add(nc_mat[1:4, 1:4], out=nc_mat[1:4, 0:3])
+        arr[1:4, 0:3] = arr[0:3, 0:3] + arr[1:4, 1:4]
+        self.assertEqual(nc.to_list(nc_mat), arr.tolist())
+
+class TestPool(TestCase):
+    def test_reuse(self):
+        nc.pool_trim()
+        before = nc.pool_stats()
+        for _ in range(10):
+            nc.Matrix(100, 100) + nc.Matrix(100, 100, 1)
+        after = nc.pool_stats()
+        self.assertEqual(after["allocs"] - before["allocs"], 30)
+        self.assertGreaterEqual(after["hits"] - before["hits"], 27)
+        self.assertEqual(after["live_bytes"], before["live_bytes"])
+        self.assertGreaterEqual(after["peak_bytes"], before["live_bytes"] + 3 * 100 * 100 * 8)
+
+    def test_trim(self):
+        nc.Matrix(50, 50, 1)
+        self.assertGreater(nc.pool_stats()["cached_blocks"], 0)
+        nc.pool_trim()
+        stats = nc.pool_stats()
+        self.assertEqual(stats["cached_blocks"], 0)
+        self.assertEqual(stats["cached_bytes"], 0)
+
+class TestThreads(TestCase):
+    def test_concurrent_mul(self):
+        pairs = [rand_dp_nc_matrix(200, 200, seed=i) for i in range(8)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            nc_results = list(executor.map(lambda p: p[1] * p[1], pairs))
+        for (dp_mat, _), nc_result in zip(pairs, nc_results):
+            self.assertTrue(cmp_dp_nc_matrix(dp_mat * dp_mat, nc_result))
+
+    def test_concurrent_inplace(self):
+        dp_mat, nc_mat = rand_dp_nc_matrix(300, 300, seed=0)
+        nc_mats = [nc.Matrix(300, 300) for _ in range(4)]
+        def add_three_times(m):
+            # Each task owns its output, since unsynchronized writes to one matrix race
+            for _ in range(3):
+                m.add(nc_mat, out=m)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for _ in executor.map(add_three_times, nc_mats):
+                pass
+        for m in nc_mats:
+            self.assertTrue(cmp_dp_nc_matrix(dp_mat + dp_mat + dp_mat, m))
+
+    def test_concurrent_pow(self):
+        dp_mat, nc_mat = rand_dp_nc_matrix(100, 100, seed=0)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            nc_results = list(executor.map(lambda n: nc_mat ** n, range(2, 6)))
+        for n, nc_result in zip(range(2, 6), nc_results):
+            self.assertTrue(cmp_dp_nc_matrix(dp_mat ** n, nc_result))
+
+    def test_concurrent_force(self):
+        dp_mats, nc_mats = zip(*[rand_dp_nc_matrix(300, 300, low=-1, seed=i) for i in range(3)])
+        was_lazy = nc.set_lazy(True)
+        try:
+            nc_result = abs(nc_mats[0] + nc_mats[1] - nc_mats[2])
+            del nc_mats
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                firsts = list(executor.map(lambda _: nc_result[0, 0], range(8)))
+        finally:
+            nc.set_lazy(was_lazy)
+        self.assertEqual(len(set(firsts)), 1)
+        self.assertTrue(cmp_dp_nc_matrix(abs(dp_mats[0] + dp_mats[1] - dp_mats[2]), nc_result))
+
+class TestThreadConfig(TestCase):
+    def tearDown(self):
+        nc.set_num_threads(None)
+
+    def test_set_get(self):
+        nc.set_num_threads(3)
+        self.assertEqual(nc.get_num_threads(), 3)
+        nc.set_num_threads(None)
+        self.assertGreaterEqual(nc.get_num_threads(), 1)
+        for bad in [0, -2]:
+            with self.assertRaises(ValueError):
+                nc.set_num_threads(bad)
+
+    def test_context_manager(self):
+        nc.set_num_threads(3)
+        with nc.threads(2):
+            self.assertEqual(nc.get_num_threads(), 2)
+            with nc.threads(1):
+                self.assertEqual(nc.get_num_threads(), 1)
+            self.assertEqual(nc.get_num_threads(), 2)
+        self.assertEqual(nc.get_num_threads(), 3)
+        with self.assertRaises(KeyError):
+            with nc.threads(1):
+                raise KeyError
+        self.assertEqual(nc.get_num_threads(), 3)
+
+    def test_context_manager_per_thread(self):
+        nc.set_num_threads(3)
+        entered, a_exited = threading.Barrier(2), threading.Event()
+        seen = {}
+        def a():
+            with nc.threads(1):
+                entered.wait()
+                seen["a"] = nc.get_num_threads()
+            a_exited.set()
+        def b():
+            with nc.threads(4):
+                entered.wait()
+                a_exited.wait()
+                seen["b"] = nc.get_num_threads()
+            seen["b_after"] = nc.get_num_threads()
+        workers = [threading.Thread(target=a), threading.Thread(target=b)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(seen, {"a": 1, "b": 4, "b_after": 3})
+        self.assertEqual(nc.get_num_threads(), 3)
+
+    def test_cutoffs(self):
+        cutoffs = nc.get_parallel_cutoffs()
+        self.assertIn("gemm", cutoffs)
+        try:
+            nc.set_parallel_cutoff("gemm", 0)
+            self.assertEqual(nc.get_parallel_cutoffs()["gemm"], 0)
+        finally:
+            nc.set_parallel_cutoff("gemm", cutoffs["gemm"])
+        with self.assertRaises(ValueError):
+            nc.set_parallel_cutoff("gemm", -1)
+        with self.assertRaises(ValueError):
+            nc.set_parallel_cutoff("nonexistent", 1)
+
+    def test_results_independent_of_threads(self):
+        dp_mat, nc_mat = rand_dp_nc_matrix(150, 150, seed=0)
+        cutoffs = nc.get_parallel_cutoffs()
+        try:
+            for kernel in cutoffs:
+                nc.set_parallel_cutoff(kernel, 0)
+            for threads in [1, 4]:
+                with nc.threads(threads):
+                    self.assertTrue(cmp_dp_nc_matrix(dp_mat * dp_mat, nc_mat * nc_mat))
+                    self.assertTrue(cmp_dp_nc_matrix(dp_mat + dp_mat, nc_mat + nc_mat))
+                    self.assertTrue(cmp_dp_nc_matrix(dp_mat ** 3, nc_mat ** 3))
+        finally:
+            for kernel, cutoff in cutoffs.items():
+                nc.set_parallel_cutoff(kernel, cutoff)
+
+    def test_environment(self):
+        env = dict(os.environ, NUMC_NUM_THREADS="5", NUMC_CUTOFF_GEMM="123")
+        code = "import numc; print(numc.get_num_threads(), numc.get_parallel_cutoffs()['gemm'])"
+        output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True,
+                                text=True, check=True).stdout
+        self.assertEqual(output.split()[-2:], ["5", "123"])
+
+class TestDtype(TestCase):
+    def test_constructors(self):
+        self.assertEqual(nc.Matrix(2, 2).dtype, "float64")
+        self.assertEqual(nc.Matrix(2, 2, 1.5, dtype="float32").dtype, "float32")
+        mat = nc.Matrix([[1, 2], [3, 4]], dtype="int32")
+        self.assertEqual(mat.tolist(), [[1, 2], [3, 4]])
+        self.assertIsInstance(mat[1, 1], int)
+        self.assertEqual(nc.eye(2, dtype="int32").tolist(), [[1, 0], [0, 1]])
+        self.assertEqual(nc.arange(3, dtype="float32").dtype, "float32")
+        self.assertEqual(nc.uniform(2, 2, dtype="float32").dtype, "float32")
+        with self.assertRaises(ValueError):
+            nc.uniform(2, 2, dtype="int32")
+        with self.assertRaises(ValueError):
+            nc.Matrix(2, 2, dtype="int8")
+
+    def test_promotion(self):
+        i = nc.Matrix(2, 2, 3, dtype="int32")
+        f = nc.Matrix(2, 2, 1.5, dtype="float32")
+        self.assertEqual((i + f).dtype, "float64")
+        self.assertEqual((f - f).dtype, "float32")
+        self.assertEqual((i * 2).dtype, "int32")
+        self.assertEqual((i * 2.5).dtype, "float64")
+        self.assertEqual((f * 2.5).dtype, "float32")
+        self.assertEqual((i / 2).tolist(), [[1.5, 1.5], [1.5, 1.5]])
+        self.assertEqual((-i).dtype, "int32")
+        self.assertEqual(i.sum(), 12.0)
+        with self.assertRaises(TypeError):
+            i.add(f, out=i)
+        out = nc.Matrix(2, 2)
+        i.add(i, out=out)
+        self.assertEqual(out.tolist(), [[6, 6], [6, 6]])
+
+    def test_mul(self):
+        for dtype in [np.float32, np.int32]:
+            a = np.random.randint(-50, 50, (67, 45)).astype(dtype)
+            b = np.random.randint(-50, 50, (45, 38)).astype(dtype)
+            result = nc.Matrix.from_buffer(a) * nc.Matrix.from_buffer(b)
+            self.assertEqual(np.asarray(result).dtype, dtype)
+            self.assertTrue(np.array_equal(np.asarray(result), a @ b))
+
+    def test_pow_wraps(self):
+        self.assertEqual((nc.Matrix(1, 1, 65536, dtype="int32") ** 2).tolist(), [[0]])
+        self.assertEqual((nc.Matrix(1, 1, 3, dtype="int32") ** 21).tolist(), [[1870418611]])
+        a = nc.Matrix.from_buffer(np.random.randint(-1000, 1000, (9, 9)).astype(np.int32))
+        for pow in [2, 3, 6, 11]:
+            expected = a
+            for _ in range(pow - 1):
+                expected = expected * a
+            result = a ** pow
+            self.assertEqual(result.dtype, "int32")
+            self.assertEqual(result.tolist(), expected.tolist())
+        view = a[::2, ::2]
+        self.assertEqual((view ** 3).tolist(), (view * view * view).tolist())
+
+    def test_conversions(self):
+        mat = nc.Matrix(1, 4, [1e20, -1e20, float("nan"), -2.7])
+        self.assertEqual(mat.astype("int32").tolist(), [[2 ** 31 - 1, -2 ** 31, 0, -2]])
+        big = nc.Matrix(1, 1, 2 ** 31 - 1, dtype="int32")
+        self.assertEqual((big + big)[0, 0], -2)
+        ones = nc.Matrix(2, 2, 1, dtype="int32")
+        self.assertEqual((ones + (2 ** 31 - 2)).tolist(), [[2 ** 31 - 1] * 2] * 2)
+        self.assertEqual((ones * -2 ** 31).tolist(), [[-2 ** 31] * 2] * 2)
+        for scalar in [2 ** 31, -2 ** 31 - 1, 2 ** 40]:
+            with self.assertRaises(OverflowError):
+                ones + scalar
+            with self.assertRaises(OverflowError):
+                ones * scalar
+        with self.assertRaises(OverflowError):
+            ones -= 2 ** 40
+        self.assertEqual((ones / 2 ** 40).dtype, "float64")
+        self.assertEqual(repr(nc.Matrix(1, 1, 0.1, dtype="float32")), "[[0.1]]")
+
+    def test_load_int32(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mat.bin")
+            with open(path, "wb") as f:
+                f.write(struct.pack("=6i", 2, 2, 1, -2, 3, 4))
+            mat = nc.load(path, dtype="int32")
+            self.assertEqual(mat.dtype, "int32")
+            self.assertEqual(mat.tolist(), [[1, -2], [3, 4]])
+            self.assertEqual(nc.load(path).dtype, "float64")
+            nc.save(path, mat * 2)
+            self.assertEqual(nc.load(path, dtype="int32").tolist(), [[2, -4], [6, 8]])
+
+class TestSparse(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.dense = rng.random((60, 45))
+        self.dense[self.dense < 0.9] = 0
+        self.sparse = nc.SparseMatrix(nc.Matrix.from_buffer(self.dense.copy()))
+
+    def test_construct(self):
+        self.assertEqual(self.sparse.shape, (60, 45))
+        self.assertEqual(self.sparse.nnz, np.count_nonzero(self.dense))
+        self.assertTrue(np.array_equal(np.asarray(self.sparse.todense()), self.dense))
+        coo = nc.SparseMatrix(2, 3, [1, 0, 1], [2, 0, 2], [1.0, 2.0, 3.0])
+        self.assertEqual(coo.todense().tolist(), [[2.0, 0.0, 0.0], [0.0, 0.0, 4.0]])
+        self.assertEqual(coo.tocoo(), ([0, 1], [0, 2], [2.0, 4.0]))
+        with self.assertRaises(ValueError):
+            nc.SparseMatrix(2, 3, [2], [0], [1.0])
+        with self.assertRaises(ValueError):
+            nc.SparseMatrix(2, 3, [1, 0], [0], [1.0])
+
+    def test_mul(self):
+        rng = np.random.default_rng(1)
+        for cols in [1, 7]:
+            b = rng.random((45, cols))
+            product = self.sparse * nc.Matrix.from_buffer(b)
+            self.assertTrue(np.allclose(np.asarray(product), self.dense @ b))
+        a = rng.random((5, 60))
+        self.assertTrue(np.allclose(np.asarray(nc.Matrix.from_buffer(a) * self.sparse), a @ self.dense))
+        self.assertTrue(np.allclose(np.asarray((2 * self.sparse).todense()), 2 * self.dense))
+        with self.assertRaises(ValueError):
+            self.sparse * nc.Matrix(60, 2)
+        with self.assertRaises(TypeError):
+            self.sparse * self.sparse
+
+    def test_add(self):
+        mat = nc.Matrix.from_buffer(np.ones((60, 45)))
+        self.assertTrue(np.allclose(np.asarray(self.sparse + mat), self.dense + 1))
+        self.assertTrue(np.allclose(np.asarray(mat + self.sparse), self.dense + 1))
+        self.assertTrue(np.allclose(np.asarray((self.sparse + self.sparse).todense()), 2 * self.dense))
+        mat += self.sparse
+        self.assertTrue(np.allclose(np.asarray(mat), self.dense + 1))
+        with self.assertRaises(TypeError):
+            nc.Matrix(60, 45, 1, dtype="int32").add(self.sparse, out=nc.Matrix(60, 45, 1, dtype="int32"))
+
+class TestStrassen(TestCase):
+    def setUp(self):
+        self.previous = nc.get_strassen()
+
+    def tearDown(self):
+        nc.set_strassen(*self.previous)
+
+    def test_set_get(self):
+        self.assertEqual(nc.get_strassen()[0], "auto")
+        nc.set_strassen("on", 16)
+        self.assertEqual(nc.get_strassen(), ("on", 16))
+        nc.set_strassen("off")
+        self.assertEqual(nc.get_strassen(), ("off", 16))
+        with self.assertRaises(ValueError):
+            nc.set_strassen("always")
+        with self.assertRaises(ValueError):
+            nc.set_strassen("on", 0)
+
+    def test_matches_classic(self):
+        rng = np.random.default_rng(0)
+        for mode, n in [("auto", 128), ("on", 100), ("on", 67)]:
+            a, b = rng.random((n, n)), rng.random((n, n))
+            nc.set_strassen(mode, 16)
+            product = np.asarray(nc.Matrix.from_buffer(a) * nc.Matrix.from_buffer(b))
+            power = np.asarray(nc.Matrix.from_buffer(a) ** 3)
+            # 3 levels of splitting loosen the classic bound by up to 18 ** 3
+            self.assertTrue(np.allclose(product, a @ b, rtol=0, atol=n * 18 ** 3 * 1e-16))
+            self.assertTrue(np.allclose(power, a @ a @ a, rtol=1e-10))
+        mat = nc.Matrix.from_buffer(a.copy())
+        mat *= nc.Matrix.from_buffer(b)
+        self.assertTrue(np.allclose(np.asarray(mat), a @ b))
+
+    def test_threads(self):
+        rng = np.random.default_rng(1)
+        a, b = rng.random((96, 96)), rng.random((96, 96))
+        cutoff = nc.get_parallel_cutoffs()["gemm"]
+        try:
+            nc.set_parallel_cutoff("gemm", 0)
+            nc.set_strassen("on", 8)
+            with nc.threads(3):
+                product = nc.Matrix.from_buffer(a) * nc.Matrix.from_buffer(b)
+            self.assertTrue(np.allclose(np.asarray(product), a @ b))
+        finally:
+            nc.set_parallel_cutoff("gemm", cutoff)
+
+class TestBenchmark(TestCase):
+    def test_measure(self):
+        stats = measure(lambda: nc.Matrix(2, 2) + nc.Matrix(2, 2), repeat=7, min_repeat=7)
+        self.assertEqual(stats["runs"], 7)
+        self.assertLessEqual(stats["q1_ns"], stats["median_ns"])
+        self.assertLessEqual(stats["median_ns"], stats["q3_ns"])
+        self.assertGreaterEqual(stats["inner"], 1)
+
+    def test_work(self):
+        self.assertEqual(benchmark.work("mul", 4), (128, 384))
+        self.assertEqual(benchmark.pow_products(3), 2)
+        self.assertEqual(benchmark.pow_products(8), 3)
+        self.assertEqual(benchmark.pow_products(1), 0)
+
+    def test_compare(self):
+        base = {"add/2": {"median_ns": 100, "q1_ns": 90, "q3_ns": 110}}
+        noisy = {"add/2": {"median_ns": 115, "q1_ns": 105, "q3_ns": 130}}
+        slow = {"add/2": {"median_ns": 200, "q1_ns": 190, "q3_ns": 210}}
+        self.assertEqual(benchmark.compare(noisy, base), [])
+        self.assertEqual(benchmark.compare(slow, base), [("add/2", 100, 200)])
+
+    def test_baseline_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "baseline.json")
+            args = ["--ops", "add,pow", "--sizes", "2,8", "--repeat", "3", "--min-repeat", "3"]
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(benchmark.main(args + ["--save", path]), 0)
+            with open(path) as f:
+                self.assertEqual(set(json.load(f)["results"]), {"add/2", "add/8", "pow/2", "pow/8"})
+            # An impossibly fast baseline is a regression
+            with open(path) as f:
+                stored = json.load(f)
+            for stats in stored["results"].values():
+                stats.update(median_ns=1e-3, q1_ns=1e-3, q3_ns=1e-3)
+            with open(path, "w") as f:
+                json.dump(stored, f)
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                self.assertEqual(benchmark.main(args + ["--baseline", path]), 1)
+
+class TestCompare(TestCase):
+    def test_compare(self):
+        rng = np.random.default_rng(0)
+        a = rng.random((37, 53))
+        b = a.copy()
+        b[5, 7] += 1e-3
+        b[20, 1] = np.nan
+        result = nc.compare(a, b)
+        self.assertEqual(result["mismatch"], (5, 7))
+        self.assertAlmostEqual(result["max_abs_err"], 1e-3)
+        self.assertTrue(nc.allclose(a, b, atol=1e-2) is False)
+        self.assertTrue(nc.allclose(nc.Matrix.from_buffer(a.copy()), a))
+        self.assertTrue(nc.allclose(a.T, a.T.copy()))
+        self.assertEqual(nc.compare(a, a + 1e-9, atol=0, rtol=0)["mismatch"], (0, 0))
+
+    def test_matches_numpy(self):
+        a = np.array([np.inf, -np.inf, 1.0, 0.0, np.nan, 1.0, 2.0])
+        b = np.array([np.inf, np.inf, np.inf, 1e-9, np.nan, 1.0 + 1e-6, 2.1])
+        for i in range(len(a)):
+            self.assertEqual(nc.allclose(a[i:i + 1], b[i:i + 1]), np.isclose(a[i], b[i]))
+        self.assertEqual(nc.compare(a, b)["mismatch"], (0, 1))
+
+    def test_operands(self):
+        dp_mat, nc_mat = rand_dp_nc_matrix(3, 4, seed=0)
+        self.assertTrue(nc.allclose(nc_mat, dp_mat))
+        self.assertTrue(nc.allclose(np.float32(nc.to_list(nc_mat)), nc_mat, rtol=1e-6))
+        self.assertTrue(nc.allclose(nc.Matrix(2, 2, 3, dtype="int32"), np.full((2, 2), 3.0)))
+        with self.assertRaises(ValueError):
+            nc.allclose(nc_mat, nc.Matrix(4, 3))
+        with self.assertRaises(TypeError):
+            nc.allclose(nc_mat, "abc")
+        with self.assertRaises(TypeError):
+            nc.allclose(np.zeros((3, 4), dtype=np.int16), nc_mat)
+
+class TestStats(TestCase):
+    def tearDown(self):
+        nc.set_stats_callback(None)
+
+    def test_counters(self):
+        a, b = nc.Matrix(8, 8, rand=True), nc.Matrix(8, 8, rand=True)
+        nc.reset_stats()
+        a + b
+        a - 1
+        a * b
+        a ** 5
+        -a
+        abs(a)
+        a[1:3, 2:5]
+        a[1, 1]
+        stats = nc.stats()
+        ops = stats["ops"]
+        for op in ["add", "sub", "mul", "pow", "neg", "abs", "slice"]:
+            self.assertEqual(ops[op]["calls"], 1, op)
+            self.assertGreater(ops[op]["ns"], 0, op)
+        self.assertEqual(ops["div"]["calls"], 0)
+        self.assertEqual(ops["add"]["flops"], 64)
+        self.assertEqual(ops["mul"]["flops"], 2 * 8 ** 3)
+        # a ** 5 squares twice and multiplies once
+        self.assertEqual(ops["pow"]["flops"], 3 * 2 * 8 ** 3)
+        self.assertEqual(ops["add"]["bytes"], 64 * 8)
+        self.assertEqual(ops["slice"]["bytes"], 0)
+        self.assertGreaterEqual(stats["allocs"], 6)
+        self.assertGreaterEqual(stats["peak_bytes"], stats["live_bytes"])
+        a.add(b, out=b)
+        self.assertEqual(nc.stats()["ops"]["add"]["bytes"], 64 * 8)
+        nc.reset_stats()
+        self.assertEqual(nc.stats()["ops"]["add"]["calls"], 0)
+        self.assertEqual(nc.stats()["peak_bytes"], nc.stats()["live_bytes"])
+
+    def test_callback(self):
+        events = []
+        nc.set_stats_callback(lambda op, shape, ns: events.append((op, shape)))
+        a = nc.Matrix(3, 4, 1)
+        a + a
+        a * nc.Matrix(4, 2)
+        a[0]
+        nc.set_stats_callback(None)
+        a + a
+        self.assertEqual(events, [("add", (3, 4)), ("mul", (3, 2)), ("slice", (4, 1))])
+        with self.assertRaises(TypeError):
+            nc.set_stats_callback(3)
+
+    def test_failing_callback(self):
+        def callback(op, shape, ns):
+            raise KeyError(op)
+        unraisable = []
+        nc.set_stats_callback(callback)
+        hook, sys.unraisablehook = sys.unraisablehook, unraisable.append
+        try:
+            self.assertEqual((nc.Matrix(2, 2, 1) + nc.Matrix(2, 2, 1)).tolist(), [[2, 2], [2, 2]])
+        finally:
+            sys.unraisablehook = hook
+        self.assertEqual(len(unraisable), 1)
+        self.assertIsInstance(unraisable[0].exc_value, KeyError)
+
+class TestPickle(TestCase):
+    def test_round_trip(self):
+        _, nc_mat = rand_dp_nc_matrix(5, 7, seed=0)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(nc_mat, protocol=protocol))
+            self.assertEqual(loaded.shape, (5, 7))
+            self.assertEqual(loaded.tolist(), nc_mat.tolist())
+        for dtype in ["float32", "int32"]:
+            mat = nc.Matrix(3, 4, 2, dtype=dtype)
+            loaded = pickle.loads(pickle.dumps(mat, protocol=5))
+            self.assertEqual(loaded.dtype, dtype)
+            self.assertEqual(loaded.tolist(), mat.tolist())
+
+    def test_views(self):
+        _, nc_mat = rand_dp_nc_matrix(6, 8, seed=1)
+        view = nc_mat[1:6:2, ::3]
+        for protocol in [2, 5]:
+            self.assertEqual(pickle.loads(pickle.dumps(view, protocol=protocol)).tolist(),
+                             view.tolist())
+
+    def test_out_of_band(self):
+        _, nc_mat = rand_dp_nc_matrix(4, 4, seed=2)
+        buffers = []
+        data = pickle.dumps(nc_mat, protocol=5, buffer_callback=buffers.append)
+        self.assertEqual(len(buffers), 1)
+        self.assertLess(len(data), 4 * 4 * 8)
+        loaded = pickle.loads(data, buffers=buffers)
+        loaded[0, 0] = 42
+        self.assertEqual(nc_mat[0, 0], 42)
+        # Read-only buffers, such as bytes received from another process, are copied once
+        copied = pickle.loads(data, buffers=[bytes(buffers[0].raw())])
+        copied[1, 1] = -1
+        self.assertEqual(copied.tolist()[0][0], 42)
+        self.assertNotEqual(nc_mat[1, 1], -1)
+
+    def test_bad_data(self):
+        with self.assertRaises(ValueError):
+            nc.Matrix._from_pickle(bytes(8 * 5), 2, 3, "float64")
@@ -6,15 +6,13 @@ Provided by CS 61C staff
 import dumbpy as dp
 import numc as nc
 import numpy as np
-import hashlib, struct
 from typing import Union, List
 import operator
-import time
+from benchmark import measure
 
 """
 Global vars
 """
-num_samples = 1000
 decimal_places = 6
 func_mapping = {
     "add": operator.add,
@@ -43,70 +41,46 @@ def rand_dp_nc_matrix(rows, cols, low=0, high=1, seed=0):
 
 """
 Returns whether the given dumbpy matrix dp_mat is equal to the numc matrix nc_mat
-This function allows a reasonable margin of( floating point errors
+Every entry is compared, allowing a margin of 10 ** -decimal_places for floating point errors
 """
 def cmp_dp_nc_matrix(dp_mat: dp.Matrix, nc_mat: nc.Matrix):
-    return rand_md5(dp_mat) == rand_md5(nc_mat)
+    tolerance = 10 ** -decimal_places
+    return nc.allclose(nc_mat, dp_mat, rtol=tolerance, atol=tolerance)
 
 """
 Test if numc returns the correct result given an operation and some matrices.
-If speed_up is set to True, returns the speedup as well
+Also returns the speedup, the ratio of the median times of `repeat` timed runs after one warmup
 """
 def compute(dp_mat_lst: List[Union[dp.Matrix, int]],
-    nc_mat_lst: List[Union[nc.Matrix, int]], op: str):
+    nc_mat_lst: List[Union[nc.Matrix, int]], op: str, repeat: int = 3):
     f = func_mapping[op]
-    nc_start, nc_end, dp_start, dp_end = None, None, None, None
-    nc_result, dp_result = None, None
     assert(op in list(func_mapping.keys()))
     if op == "neg" or op == "abs":
         assert(len(dp_mat_lst) == 1)
         assert(len(nc_mat_lst) == 1)
-        nc_start = time.time()
-        nc_result = f(nc_mat_lst[0])
-        nc_end = time.time()
-
-        dp_start = time.time()
-        dp_result = f(dp_mat_lst[0])
-        dp_end = time.time()
     else:
         assert(len(dp_mat_lst) > 1)
         assert(len(nc_mat_lst) > 1)
-        nc_start = time.time()
-        nc_result = nc_mat_lst[0]
-        for mat in nc_mat_lst[1:]:
-            nc_result = f(nc_result, mat)
-        nc_end = time.time()
 
-        dp_start = time.time()
-        dp_result = dp_mat_lst[0]
-        for mat in dp_mat_lst[1:]:
-            dp_result = f(dp_result, mat)
-        dp_end = time.time()
+    def chain(mat_lst):
+        if len(mat_lst) == 1:
+            return f(mat_lst[0])
+        result = mat_lst[0]
+        for mat in mat_lst[1:]:
+            result = f(result, mat)
+        return result
+
+    # The runs that produce the results double as warmup
+    nc_result = chain(nc_mat_lst)
+    dp_result = chain(dp_mat_lst)
+    nc_time = measure(lambda: chain(nc_mat_lst), warmup=0, repeat=repeat, min_repeat=repeat)
+    dp_time = measure(lambda: chain(dp_mat_lst), warmup=0, repeat=repeat, min_repeat=repeat)
     # Check for correctness
     is_correct = cmp_dp_nc_matrix(nc_result, dp_result)
-    return is_correct, (dp_end - dp_start) / (nc_end - nc_start)
+    return is_correct, dp_time["median_ns"] / nc_time["median_ns"]
 
 """
 Print speedup
 """
 def print_speedup(speed_up):
     print("Speed up is:", speed_up)
-
-"""
-Generate a md5 hash by sampling random elements in nc_mat
-"""
-def rand_md5(mat: Union[dp.Matrix, nc.Matrix]):
-    np.random.seed(1)
-    m = hashlib.md5()
-    rows, cols = mat.shape
-    total_cnt = mat.shape[0] * mat.shape[1]
-    if total_cnt < num_samples:
-        for i in range(rows):
-            for j in range(cols):
-                m.update(struct.pack("f", round(mat.get(i, j), decimal_places)))
-    else:
-        for _ in range(num_samples):
-            i = np.random.randint(rows)
-            j = np.random.randint(cols)
-            m.update(struct.pack("f", round(mat.get(i, j), decimal_places)))
-    return m.digest()